@@ -0,0 +1,2 @@
+# Copyright 2022 Block, Inc.
+"""Benchmarks for pyfu-usb."""
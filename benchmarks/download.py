@@ -0,0 +1,508 @@
+# Copyright 2022 Block, Inc.
+"""Benchmark DFU and DfuSe downloads to a simulated device.
+
+Each case downloads an image of one size with one transfer size to a
+`simulator.SimulatedDevice` which responds without latency, so the results
+measure the host side of the protocol: wall time, control transfers per KiB,
+GETSTATUS polls, peak Python allocations (copies of image data show up here)
+and peak RSS. Every case runs in its own process so its peak RSS is its own.
+
+Run all cases and save the results, then compare a later run against them:
+
+    just bench --json baseline.json
+    just bench --compare baseline.json
+"""
+
+import argparse
+import dataclasses
+import json
+import logging
+import math
+import multiprocessing
+import platform
+import sys
+import time
+import tracemalloc
+from importlib.metadata import version
+from typing import Any, Dict, List, Optional, Sequence
+
+from rich.console import Console
+from rich.table import Table
+
+from pyfu_usb import DownloadOptions, descriptor, downloader, image
+from pyfu_usb.progress import NullProgress
+from pyfu_usb.simulator import OP_GETSTATUS, SimulatedDevice
+
+# Protocols to benchmark
+PROTOCOL_DFU = "dfu"
+PROTOCOL_DFUSE = "dfuse"
+
+# Default image sizes, transfer sizes and limit on the number of blocks
+DEFAULT_IMAGE_SIZES = "4K,64K,1M,16M,64M"
+DEFAULT_TRANSFER_SIZES = "64,256,1K,4K"
+DEFAULT_MAX_BLOCKS = 1 << 18
+
+# Version of the results file format
+RESULTS_VERSION = 1
+
+# Start address and page size of the simulated DfuSe flash
+_FLASH_ADDRESS = 0x08000000
+_PAGE_SIZE = 16 * 1024
+
+# Sparse images only have data in one of this many 4 KiB blocks
+_SPARSE_BLOCK_SIZE = 4096
+_SPARSE_DATA_EVERY = 4
+
+# Wall time increases below this are noise, not regressions
+_MIN_SLOWDOWN_S = 0.01
+
+# Size suffixes
+_SIZE_UNITS = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+
+logger = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass(frozen=True)
+class Case:
+    """Download to benchmark."""
+
+    protocol: str
+    image_size: int
+    transfer_size: int
+    sparse: bool
+
+    @property
+    def name(self) -> str:
+        """Unique name of the case, which results are compared by."""
+        density = "sparse" if self.sparse else "dense"
+        return (
+            f"{self.protocol}-{self.image_size}-{self.transfer_size}-"
+            f"{density}"
+        )
+
+
+@dataclasses.dataclass
+class Result:
+    """Measurements of one case."""
+
+    name: str
+    protocol: str
+    image_size: int
+    transfer_size: int
+    sparse: bool
+    wall_time_s: float
+    throughput_kib_s: float
+    transfers: int
+    transfers_per_kib: float
+    getstatus_polls: int
+    peak_alloc_bytes: Optional[int]
+    peak_rss_bytes: Optional[int]
+
+
+def parse_size(text: str) -> int:
+    """Parse a size like "64", "4K" or "16M".
+
+    Args:
+        text: Size with an optional K, M or G suffix.
+
+    Returns:
+        Size in bytes.
+
+    Raises:
+        ValueError: Invalid size.
+    """
+    text = text.strip().upper()
+    multiplier = _SIZE_UNITS.get(text[-1:], 1)
+    if multiplier != 1:
+        text = text[:-1]
+    return int(text) * multiplier
+
+
+def make_cases(
+    image_sizes: Sequence[int],
+    transfer_sizes: Sequence[int],
+    protocols: Sequence[str] = (PROTOCOL_DFU, PROTOCOL_DFUSE),
+    max_blocks: int = DEFAULT_MAX_BLOCKS,
+) -> List[Case]:
+    """List the cases to run. Cases with more blocks than `max_blocks` are
+    left out, since they take minutes without telling much more.
+
+    Args:
+        image_sizes: Image sizes in bytes.
+        transfer_sizes: Transfer sizes in bytes.
+        protocols: `PROTOCOL_DFU` and/or `PROTOCOL_DFUSE`.
+        max_blocks: Largest number of blocks to download in one case.
+
+    Returns:
+        Cases, sparse and dense for each combination.
+    """
+    cases = []
+    for protocol in protocols:
+        for image_size in image_sizes:
+            for transfer_size in transfer_sizes:
+                if math.ceil(image_size / transfer_size) > max_blocks:
+                    logger.info(
+                        "Skipping %d byte image in %d byte blocks",
+                        image_size,
+                        transfer_size,
+                    )
+                    continue
+                for sparse in (False, True):
+                    cases.append(
+                        Case(protocol, image_size, transfer_size, sparse)
+                    )
+    return cases
+
+
+def make_image(size: int, sparse: bool) -> bytes:
+    """Create an image without erased blocks, or a sparse image where most
+    4 KiB blocks are erased (0xFF).
+
+    Args:
+        size: Image size in bytes.
+        sparse: Whether to leave most blocks erased.
+
+    Returns:
+        Image data.
+    """
+    data = bytearray((bytes(range(255)) * (size // 255 + 1))[:size])
+    if sparse:
+        erased = b"\xff" * _SPARSE_BLOCK_SIZE
+        for index, offset in enumerate(range(0, size, _SPARSE_BLOCK_SIZE)):
+            if index % _SPARSE_DATA_EVERY:
+                end = min(offset + _SPARSE_BLOCK_SIZE, size)
+                data[offset:end] = erased[: end - offset]
+    return bytes(data)
+
+
+def make_device(case: Case) -> SimulatedDevice:
+    """Create a simulated device large enough for the image of a case.
+
+    Args:
+        case: Benchmark case.
+
+    Returns:
+        Device without latencies.
+    """
+    attributes = (
+        descriptor.DFU_ATTR_CAN_DOWNLOAD
+        | descriptor.DFU_ATTR_CAN_UPLOAD
+        | descriptor.DFU_ATTR_MANIFESTATION_TOLERANT
+    )
+    if case.protocol == PROTOCOL_DFU:
+        return SimulatedDevice(
+            layouts=(),
+            transfer_size=case.transfer_size,
+            attributes=attributes,
+            firmware_size=case.image_size,
+        )
+
+    pages = max(1, math.ceil(case.image_size / _PAGE_SIZE))
+    layout = (
+        f"@Internal Flash  /0x{_FLASH_ADDRESS:08X}/"
+        f"{pages:04d}*{_PAGE_SIZE // 1024:03d}Kg"
+    )
+    return SimulatedDevice(
+        layouts=(layout,),
+        transfer_size=case.transfer_size,
+        attributes=attributes,
+    )
+
+
+def _download(case: Case, device: SimulatedDevice, data: bytes) -> None:
+    """Download the image of a case, without showing progress.
+
+    Args:
+        case: Benchmark case.
+        device: Simulated device.
+        data: Image.
+    """
+    dfu_desc = descriptor.get_dfu_descriptor(device)
+    assert dfu_desc is not None
+    downloader.download_claimed(
+        device,
+        0,
+        dfu_desc,
+        image.ChunkSource(data),
+        _FLASH_ADDRESS if case.protocol == PROTOCOL_DFUSE else None,
+        options=DownloadOptions(sparse=case.sparse),
+        display=NullProgress(),
+        leave=False,
+    )
+
+
+def _peak_rss_bytes() -> Optional[int]:
+    """Get the peak resident set size of this process.
+
+    Returns:
+        Peak RSS in bytes, or None if it cannot be measured on this platform.
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB and macOS reports bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def run_case(
+    case: Case, repeat: int = 1, trace_allocations: bool = True
+) -> Result:
+    """Run one case.
+
+    Args:
+        case: Benchmark case.
+        repeat: Number of timed downloads, of which the fastest is reported.
+        trace_allocations: Download again while tracing Python allocations to
+            measure their peak, which is too slow to do in the timed run.
+
+    Returns:
+        Measurements.
+    """
+    data = make_image(case.image_size, case.sparse)
+
+    wall_time_s = math.inf
+    for _ in range(repeat):
+        device = make_device(case)
+        start = time.perf_counter()
+        _download(case, device, data)
+        wall_time_s = min(wall_time_s, time.perf_counter() - start)
+
+    peak_alloc_bytes = None
+    if trace_allocations:
+        traced_device = make_device(case)
+        tracemalloc.start()
+        try:
+            _download(case, traced_device, data)
+            peak_alloc_bytes = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    transfers = device.counts["transfer"]
+    return Result(
+        name=case.name,
+        protocol=case.protocol,
+        image_size=case.image_size,
+        transfer_size=case.transfer_size,
+        sparse=case.sparse,
+        wall_time_s=wall_time_s,
+        throughput_kib_s=case.image_size / 1024 / max(wall_time_s, 1e-9),
+        transfers=transfers,
+        transfers_per_kib=transfers / (case.image_size / 1024),
+        getstatus_polls=device.counts[OP_GETSTATUS],
+        peak_alloc_bytes=peak_alloc_bytes,
+        peak_rss_bytes=_peak_rss_bytes(),
+    )
+
+
+def _run_isolated(args: Any) -> Result:
+    """Run one case in a worker process."""
+    logging.getLogger("pyfu_usb").setLevel(logging.WARNING)
+    return run_case(*args)
+
+
+def compare(
+    results: Sequence[Result],
+    baseline: Dict[str, Any],
+    tolerance: float,
+) -> List[str]:
+    """Compare results with a baseline results file.
+
+    Control transfers and polls are deterministic, so any increase is a
+    regression. Wall time is a regression if it grew by more than
+    `tolerance` and by more than 10 ms.
+
+    Args:
+        results: Results of this run.
+        baseline: Contents of a results file.
+        tolerance: Allowed relative increase of wall time, e.g. 0.1 for 10%.
+
+    Returns:
+        Description of each regression.
+    """
+    previous = {result["name"]: result for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        before = previous.get(result.name)
+        if before is None:
+            continue
+        for field in ("transfers", "getstatus_polls"):
+            if getattr(result, field) > before[field]:
+                regressions.append(
+                    f"{result.name}: {field} {before[field]} -> "
+                    f"{getattr(result, field)}"
+                )
+        slower_s = result.wall_time_s - before["wall_time_s"]
+        if (
+            slower_s > before["wall_time_s"] * tolerance
+            and slower_s > _MIN_SLOWDOWN_S
+        ):
+            regressions.append(
+                f"{result.name}: wall time {before['wall_time_s']:.3f} s -> "
+                f"{result.wall_time_s:.3f} s"
+            )
+    return regressions
+
+
+def _print_table(console: Console, results: Sequence[Result]) -> None:
+    """Print results as a table."""
+    table = Table(title="Download benchmarks")
+    for column in (
+        "Case",
+        "Time (s)",
+        "KiB/s",
+        "Transfers/KiB",
+        "Polls",
+        "Peak alloc (KiB)",
+        "Peak RSS (MiB)",
+    ):
+        table.add_column(
+            column, justify="left" if column == "Case" else "right"
+        )
+    for result in results:
+        table.add_row(
+            result.name,
+            f"{result.wall_time_s:.3f}",
+            f"{result.throughput_kib_s:.0f}",
+            f"{result.transfers_per_kib:.2f}",
+            str(result.getstatus_polls),
+            "-"
+            if result.peak_alloc_bytes is None
+            else str(result.peak_alloc_bytes // 1024),
+            "-"
+            if result.peak_rss_bytes is None
+            else str(result.peak_rss_bytes // (1 << 20)),
+        )
+    console.print(table)
+
+
+def create_parser() -> argparse.ArgumentParser:
+    """Define command-line arguments.
+
+    Returns:
+        ArgumentParser
+    """
+    parser = argparse.ArgumentParser(
+        description="Benchmark DFU and DfuSe downloads to a simulated device."
+    )
+    parser.add_argument(
+        "--sizes",
+        help=f"Image sizes (default: {DEFAULT_IMAGE_SIZES})",
+        default=DEFAULT_IMAGE_SIZES,
+    )
+    parser.add_argument(
+        "--transfer-sizes",
+        help=f"Transfer sizes (default: {DEFAULT_TRANSFER_SIZES})",
+        default=DEFAULT_TRANSFER_SIZES,
+    )
+    parser.add_argument(
+        "--protocol",
+        help="Only benchmark one protocol",
+        choices=[PROTOCOL_DFU, PROTOCOL_DFUSE],
+        default=None,
+    )
+    parser.add_argument(
+        "--max-blocks",
+        help="Skip cases with more blocks than this "
+        f"(default: {DEFAULT_MAX_BLOCKS})",
+        type=int,
+        default=DEFAULT_MAX_BLOCKS,
+    )
+    parser.add_argument(
+        "--repeat",
+        help="Time each case <count> times and report the fastest "
+        "(default: 3)",
+        metavar="COUNT",
+        type=int,
+        default=3,
+    )
+    parser.add_argument(
+        "--no-alloc",
+        help="Do not measure peak allocations, which downloads twice",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--json",
+        help="Write results to <file>",
+        metavar="FILE",
+        default=None,
+    )
+    parser.add_argument(
+        "--compare",
+        help="Compare results with a results file and fail on regressions",
+        metavar="FILE",
+        default=None,
+    )
+    parser.add_argument(
+        "--tolerance",
+        help="Allowed wall time increase with --compare (default: 0.1)",
+        type=float,
+        default=0.1,
+    )
+    return parser
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    """Run benchmarks.
+
+    Args:
+        argv: Command-line arguments, or None for `sys.argv`.
+
+    Returns:
+        0 for success, 1 if a regression was found.
+    """
+    args = create_parser().parse_args(argv)
+    logging.basicConfig(format="%(message)s", level=logging.INFO)
+    console = Console()
+
+    cases = make_cases(
+        [parse_size(size) for size in args.sizes.split(",")],
+        [parse_size(size) for size in args.transfer_sizes.split(",")],
+        protocols=[args.protocol]
+        if args.protocol
+        else [PROTOCOL_DFU, PROTOCOL_DFUSE],
+        max_blocks=args.max_blocks,
+    )
+
+    # A new process for each case, so peak RSS is measured per case
+    context = multiprocessing.get_context("spawn")
+    results = []
+    with context.Pool(1, maxtasksperchild=1) as pool:
+        for result in pool.imap(
+            _run_isolated,
+            [(case, args.repeat, not args.no_alloc) for case in cases],
+        ):
+            console.log(f"{result.name}: {result.wall_time_s:.3f} s")
+            results.append(result)
+    _print_table(console, results)
+
+    if args.json:
+        with open(args.json, "w") as fout:
+            json.dump(
+                {
+                    "version": RESULTS_VERSION,
+                    "pyfu_usb": version("pyfu_usb"),
+                    "python": platform.python_version(),
+                    "platform": platform.platform(),
+                    "results": [
+                        dataclasses.asdict(result) for result in results
+                    ],
+                },
+                fout,
+                indent=2,
+            )
+
+    if args.compare:
+        with open(args.compare) as fin:
+            regressions = compare(results, json.load(fin), args.tolerance)
+        for regression in regressions:
+            console.print(f"[red]Regression[/red] {regression}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
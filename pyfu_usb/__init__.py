@@ -6,229 +6,475 @@
 - Download binary files to DFU devices using `download`. If a device implements
   the DfuSe protocol (e.g. STM32), an `address` must be provided which is the
   beginning of the binary file in device memory.
+
+Modules which are not needed to list devices or for every download, like rich,
+image loaders, hotplug and tracing, are imported when first used, to keep the
+CLI quick to start.
 """
 
+import concurrent.futures
+import contextlib
+import dataclasses
+import importlib
 import logging
-from typing import List, Optional
+import re
+import threading
+import time
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Union,
+)
 
 import usb
-from rich.progress import Progress, TaskID
 
-from . import descriptor, dfu, dfuse
+from . import (
+    descriptor,
+    dfu,
+    downloader,
+    image,
+    plan,
+    progress,
+    transport,
+)
+
+# Download results are part of the public API
+from .downloader import DownloadResult, PhaseTimes  # noqa: F401
+
+# Option values are part of the public API
+from .options import (  # noqa: F401
+    ERASE_INTERLEAVED,
+    ERASE_UPFRONT,
+    VERIFY_COMPARE,
+    VERIFY_HASH,
+    DownloadOptions,
+)
+
+if TYPE_CHECKING:
+    from . import cache
+    from .session import DfuSession  # noqa: F401
 
 _BYTES_PER_KILOBYTE = 1024
 
+# Bounds of the delay between scans when waiting for a device without hotplug
+_WAIT_POLL_MIN_S = 0.01
+_WAIT_POLL_MAX_S = 0.25
+
+# Location of a device, see `descriptor.get_port_path`
+_PORT_PATH_RE = re.compile(r"\d+-(\d+(\.\d+)*|@\d+)")
+
+# Groups of devices for limiting concurrent downloads
+GROUP_BUS = "bus"
+GROUP_HUB = "hub"
+
+# Request type bits of class requests to an interface, like DFU requests
+_CLASS_INTERFACE_REQUEST = 0x21
+
 logger = logging.getLogger(__name__)
 
+# Submodules imported when first used, see `__getattr__`
+_LAZY_SUBMODULES = ("cache", "hotplug", "loaders", "metrics", "trace")
+
+# Attributes defined in submodules which import this module, mapped to their
+# submodule, see `__getattr__`
+_LAZY_ATTRIBUTES = {"DfuSession": "session"}
+
 
-def _make_progress_bar(progress: Progress, total: int) -> Optional[TaskID]:
-    """Create task for rich progress bar, but only if logging level is not
-    DEBUG since they would conflict on the output.
+def __getattr__(name: str) -> Any:
+    """Import lazily loaded submodules on first access as attributes, e.g.
+    `pyfu_usb.trace`, and the attributes they define, e.g.
+    `pyfu_usb.DfuSession`.
 
     Args:
-        progress: rich progress bar.
+        name: Attribute name.
 
     Returns:
-        Task for rich progress bar or None if logging level is DEBUG.
+        Submodule or attribute.
+
+    Raises:
+        AttributeError: No such attribute.
     """
-    if logger.getEffectiveLevel() != logging.DEBUG:
-        return progress.add_task(
-            "[blue]Downloading firmware",
-            total=total,
-            start_task=False,
-        )
+    if name in _LAZY_SUBMODULES:
+        return importlib.import_module(f".{name}", __name__)
+    if name in _LAZY_ATTRIBUTES:
+        module = importlib.import_module(f".{_LAZY_ATTRIBUTES[name]}", __name__)
+        return getattr(module, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+@dataclasses.dataclass
+class DeviceResult:
+    """Result of downloading to one of several DFU devices."""
+
+    bus: Optional[int]
+    device_address: Optional[int]
+    port_path: str
+    error: Optional[Exception]
+    duration: float
+
+    @property
+    def success(self) -> bool:
+        """Whether the download succeeded."""
+        return self.error is None
+
+
+class DownloadCancelled(Exception):
+    """A download was cancelled, see the `cancel` argument of `download`."""
+
+
+class _CancellableDevice(transport.DeviceWrapper):
+    """Device which stops sending control transfers once cancelled."""
+
+    def __init__(self, dev: usb.core.Device, cancel: threading.Event) -> None:
+        """Wrap a device.
+
+        Args:
+            dev: USB device.
+            cancel: Set to cancel the next transfer.
+        """
+        super().__init__(dev)
+        self.cancel = cancel
+        self.aborted = False
+
+    def ctrl_transfer(
+        self,
+        bmRequestType: int,
+        bRequest: int,
+        wValue: int = 0,
+        wIndex: int = 0,
+        data_or_wLength: Optional[Union[int, Sequence[int], bytes]] = None,
+        timeout: Optional[int] = None,
+    ) -> Any:
+        """Send a control transfer, unless cancelled. The first DFU request
+        after cancelling aborts the DFU transaction instead, so the device
+        returns to the idle state.
+
+        Args:
+            bmRequestType: Request type.
+            bRequest: Request code.
+            wValue: Request value.
+            wIndex: Request index.
+            data_or_wLength: Data of OUT requests, or length of IN requests.
+            timeout: Timeout in milliseconds.
+
+        Returns:
+            Result of the wrapped device's transfer.
+
+        Raises:
+            DownloadCancelled: Download was cancelled.
+            usb.core.USBError: Request failed or was stalled.
+        """
+        if not self.cancel.is_set():
+            return self.wrapped.ctrl_transfer(
+                bmRequestType,
+                bRequest,
+                wValue,
+                wIndex,
+                data_or_wLength,
+                timeout,
+            )
 
-    return None
+        if (
+            not self.aborted
+            and bmRequestType & 0x7F == _CLASS_INTERFACE_REQUEST
+        ):
+            self.aborted = True
+            logger.debug("Aborting cancelled download")
+            try:
+                dfu.abort(self.wrapped, wIndex)
+            except usb.core.USBError as err:
+                logger.warning("Ignoring USB error when aborting: %s", err)
+        raise DownloadCancelled("Download was cancelled")
 
 
 def _get_dfu_devices(
-    vid: Optional[int] = None, pid: Optional[int] = None
+    vid: Optional[int] = None,
+    pid: Optional[int] = None,
+    serial: Optional[str] = None,
+    bus: Optional[int] = None,
+    port_path: Optional[str] = None,
+    runtime: Optional[bool] = False,
 ) -> List[usb.core.Device]:
     """Get USB devices in DFU mode.
 
+    Filters are checked from cheapest to most expensive: VID, PID and bus only
+    need the device descriptor, the port path only needs the device location,
+    DFU interfaces need the configuration descriptors and the serial number
+    needs a string descriptor request to the device.
+
     Args:
         vid: Filter by VID if provided.
         pid: Filter by PID if provided.
+        serial: Filter by serial number (iSerialNumber) if provided.
+        bus: Filter by USB bus number if provided.
+        port_path: Filter by location if provided, as bus and port numbers
+            like "1-2.3".
+        runtime: Get devices in runtime mode instead of DFU mode if True, or
+            devices in either mode if None.
 
     Returns:
         List of USB devices which are currently in DFU mode.
     """
+    # Checked by pyusb before custom_match
+    filters = {}
+    if vid is not None:
+        filters["idVendor"] = vid
+    if pid is not None:
+        filters["idProduct"] = pid
+    if bus is not None:
+        filters["bus"] = bus
+    elif port_path is not None:
+        filters["bus"] = int(_check_port_path(port_path).partition("-")[0])
 
     class FilterDFU:
         """Identify devices which are in DFU mode."""
 
         def __call__(self, device: usb.core.Device) -> bool:
-            if vid is None or vid == device.idVendor:
-                if pid is None or pid == device.idProduct:
-                    for cfg in device:
-                        for intf in cfg:
-                            if (
-                                intf.bInterfaceClass == 0xFE
-                                and intf.bInterfaceSubClass == 1
-                            ):
-                                return True
+            if (
+                port_path is not None
+                and descriptor.get_port_path(device) != port_path
+            ):
+                return False
+
+            for cfg in device:
+                for intf in cfg:
+                    if (
+                        intf.bInterfaceClass != descriptor.DFU_INTERFACE_CLASS
+                        or intf.bInterfaceSubClass
+                        != descriptor.DFU_INTERFACE_SUBCLASS
+                    ):
+                        continue
+                    is_runtime = (
+                        intf.bInterfaceProtocol
+                        == descriptor.DFU_PROTOCOL_RUNTIME
+                    )
+                    if runtime is None or is_runtime == runtime:
+                        return (
+                            serial is None
+                            or descriptor.get_serial_number(device) == serial
+                        )
             return False
 
-    return list(usb.core.find(find_all=True, custom_match=FilterDFU()))
+    return list(
+        usb.core.find(find_all=True, custom_match=FilterDFU(), **filters)
+    )
 
 
-def _dfuse_download(
-    dev: usb.core.Device,
-    interface: int,
-    data: bytes,
-    xfer_size: int,
-    start_address: int,
-) -> None:
-    """Download data to DfuSe device.
+def _check_port_path(port_path: str) -> str:
+    """Check a location given to find a device has the format of
+    `descriptor.get_port_path`.
 
     Args:
-        dev: USB device in DFU mode.
-        interface: USB device interface.
-        data: Binary data to download.
-        xfer_size: Transfer size to use when downloading.
-        start_address: Start address of data in device memory.
+        port_path: Bus and port numbers like "1-2.3", or bus number and device
+            address like "1-@5".
+
+    Returns:
+        The location.
+
+    Raises:
+        ValueError: The location is malformed.
     """
-    for segment_num, segment in enumerate(
-        descriptor.get_memory_layout(dev, interface)
-    ):
-        for page_num in range(segment.num_pages):
-            page_addr = segment.addr + page_num * segment.page_size
-            if start_address <= page_addr <= start_address + len(data):
-                logger.info(
-                    "Erasing page 0x%X of size %d in segment %d",
-                    page_addr,
-                    segment.page_size,
-                    segment_num,
-                )
+    if not _PORT_PATH_RE.fullmatch(port_path):
+        raise ValueError(
+            f"Invalid port path {port_path!r}, expected "
+            "<bus>-<port>[.<port>...]"
+        )
+    return port_path
 
-                dfuse.page_erase(dev, interface, page_addr)
 
-    # Download data
-    progress = Progress()
-    with progress:
-        task = _make_progress_bar(progress, len(data))
+def _group_key(dev: usb.core.Device, group: str) -> str:
+    """Get the group a USB device belongs to for limiting concurrency.
 
-        bytes_downloaded = 0
-        while bytes_downloaded < len(data):
-            chunk_size = min(xfer_size, len(data) - bytes_downloaded)
-            chunk = data[bytes_downloaded : bytes_downloaded + chunk_size]
+    Args:
+        dev: USB device.
+        group: `GROUP_BUS` or `GROUP_HUB`.
 
-            dfuse.set_address(dev, interface, start_address + bytes_downloaded)
+    Returns:
+        Identifier shared by devices on the same bus or hub.
+    """
+    if group == GROUP_BUS:
+        return str(dev.bus)
+    return descriptor.get_port_path(dev).rpartition(".")[0] or str(dev.bus)
 
-            logger.debug(
-                "Downloading %d bytes (total: %d bytes)",
-                chunk_size,
-                bytes_downloaded,
-            )
 
-            # Unclear why 2 is needed for DfuSe vs. a counter for DFU
-            dfu.download(dev, interface, 2, chunk)
+def _get_dfu_device(
+    vid: Optional[int] = None,
+    pid: Optional[int] = None,
+    serial: Optional[str] = None,
+    bus: Optional[int] = None,
+    port_path: Optional[str] = None,
+    runtime: Optional[bool] = False,
+) -> usb.core.Device:
+    """Get the only USB device in DFU mode.
 
-            bytes_downloaded += chunk_size
-            if task is not None:
-                progress.update(task, advance=chunk_size)
+    Args:
+        vid: Filter by VID if provided.
+        pid: Filter by PID if provided.
+        serial: Filter by serial number if provided.
+        bus: Filter by USB bus number if provided.
+        port_path: Filter by location if provided.
+        runtime: Get a device in runtime mode instead of DFU mode if True, or
+            a device in either mode if None.
 
-    # Set jump address
-    dfuse.set_address(dev, interface, start_address)
+    Returns:
+        USB device in DFU mode.
 
-    # End with empty download
-    try:
-        dfu.download(dev, interface, 0, None)
-    except usb.core.USBError as err:
-        logger.warning("Ignoring USB error when exiting DFU: %s", err)
+    Raises:
+        RuntimeError: No device or more than one device found.
+    """
+    devices = _get_dfu_devices(
+        vid=vid,
+        pid=pid,
+        serial=serial,
+        bus=bus,
+        port_path=port_path,
+        runtime=runtime,
+    )
 
+    if not devices:
+        raise RuntimeError("No devices found in DFU mode")
 
-def _dfuse_download_with_retry(
-    dev: usb.core.Device,
-    interface: int,
-    data: bytes,
-    xfer_size: int,
-    start_address: int,
-) -> None:
-    """Download data to DfuSe device, with a retry to clear any leftover status.
+    if len(devices) > 1:
+        raise RuntimeError(
+            f"Too many devices in DFU mode ({len(devices)}). List devices for "
+            "more info and specify vid:pid, serial number or path to filter."
+        )
 
-    Args:
-        dev: USB device in DFU mode.
-        interface: USB device interface.
-        data: Binary data to download.
-        xfer_size: Transfer size to use when downloading.
-        start_address: Start address of data in device memory.
-    """
-    try:
-        _dfuse_download(dev, interface, data, xfer_size, start_address)
-    except usb.core.USBError as err:
-        if "pipe error" in str(err).lower():
-            logger.debug("Clearing status before DfuSe download")
-            dfu.clear_status(dev, interface)
-            _dfuse_download(dev, interface, data, xfer_size, start_address)
-        else:
-            raise err
+    return devices[0]
 
 
-def _dfu_download(
-    dev: usb.core.Device, interface: int, data: bytes, xfer_size: int
+def _download_to_device(
+    dev: usb.core.Device,
+    interface: int,
+    source: image.ChunkSource,
+    address: Optional[int],
+    options: Optional[DownloadOptions] = None,
+    display: Optional[progress.ProgressSink] = None,
+    descriptor_cache: Optional["cache.DescriptorCache"] = None,
+    result: Optional[DownloadResult] = None,
 ) -> None:
-    """Download data to DFU device.
+    """Claim a DFU device, download an image to it and release it.
 
     Args:
         dev: USB device in DFU mode.
         interface: USB device interface.
-        data: Binary data to download.
-        xfer_size: Transfer size to use when downloading.
-    """
-    # Download data
-    progress = Progress()
-    with progress:
-        task = _make_progress_bar(progress, len(data))
-
-        transaction = 0
-        bytes_downloaded = 0
-        while bytes_downloaded < len(data):
-            chunk_size = min(xfer_size, len(data) - bytes_downloaded)
-            chunk = data[bytes_downloaded : bytes_downloaded + chunk_size]
-
-            logger.debug(
-                "Downloading %d bytes (total: %d bytes)",
-                chunk_size,
-                bytes_downloaded,
-            )
+        source: Image to download.
+        address: See `downloader.download_claimed`.
+        options: Download options, or None for the defaults.
+        display: Progress display, or None for a rich progress bar.
+        descriptor_cache: See `download`.
+        result: Updated with the time spent in each phase and the number of
+            retries, if provided.
 
-            dfu.download(dev, interface, transaction, chunk)
+    Raises:
+        ValueError: Could not read DFU device USB descriptor.
+        ValueError: Address not provided for DfuSe device.
+        ValueError: DfuSe file is invalid or the device is not DfuSe.
+        ValueError: Device does not support verification.
+        RuntimeError: Verification failed.
+    """
+    result = result or DownloadResult()
+    try:
+        start = time.monotonic()
+        dfu.claim_interface(dev, interface)
+        result.phases.claim += time.monotonic() - start
 
-            transaction += 1
-            bytes_downloaded += chunk_size
-            if task is not None:
-                progress.update(task, advance=chunk_size)
+        start = time.monotonic()
+        dfu_desc = (
+            descriptor.get_dfu_descriptor(dev)
+            if descriptor_cache is None
+            else descriptor_cache.get_dfu_descriptor(dev)
+        )
+        result.phases.descriptor += time.monotonic() - start
+        if dfu_desc is None:
+            raise ValueError("No DFU descriptor, is this a valid DFU device?")
 
-    # End with empty download
-    try:
-        dfu.download(dev, interface, 0, None)
-    except usb.core.USBError as err:
-        logger.warning("Ignoring USB error when exiting DFU: %s", err)
+        downloader.download_claimed(
+            dev,
+            interface,
+            dfu_desc,
+            source,
+            address,
+            options=options,
+            display=display,
+            layouts=None
+            if descriptor_cache is None
+            else descriptor_cache.layouts(dev, interface),
+            result=result,
+        )
+    finally:
+        dfu.release_interface(dev)
 
 
-def list_devices(vid: Optional[int] = None, pid: Optional[int] = None) -> None:
-    """List devices detected in DFU mode. For DfuSe devices, the memory layout
-    will be listed as well.
+def list_devices(
+    vid: Optional[int] = None,
+    pid: Optional[int] = None,
+    serial: Optional[str] = None,
+    bus: Optional[int] = None,
+    port_path: Optional[str] = None,
+    descriptor_cache: Optional["cache.DescriptorCache"] = None,
+) -> None:
+    """List devices detected in DFU mode or runtime mode. For DfuSe devices,
+    the memory layout will be listed as well.
 
     Args:
         vid: Vendor ID to narrow the search for DFU devices.
         pid: Product ID to narrow the search for DFU devices.
+        serial: Serial number to narrow the search for DFU devices.
+        bus: USB bus number to narrow the search for DFU devices.
+        port_path: Location to narrow the search for DFU devices, as bus and
+            port numbers like "1-2.3".
+        descriptor_cache: Cache to read memory layouts from. When listing all
+            devices, entries of devices which are no longer attached are
+            removed from it.
     """
-    for device in _get_dfu_devices(vid=vid, pid=pid):
+    devices = _get_dfu_devices(
+        vid=vid,
+        pid=pid,
+        serial=serial,
+        bus=bus,
+        port_path=port_path,
+        runtime=None,
+    )
+    if descriptor_cache is not None and all(
+        value is None for value in (vid, pid, serial, bus, port_path)
+    ):
+        descriptor_cache.prune(devices)
+
+    for device in devices:
+        runtime_intf = descriptor.get_runtime_interface(device)
+        mode = "" if runtime_intf is None else " (runtime mode)"
         logger.info(
-            "Bus {} Device {:03d}: ID {:04x}:{:04x}".format(
-                device.bus, device.address, device.idVendor, device.idProduct
-            )
+            "Bus %s Device %03d: ID %04x:%04x, path %s, serial %s%s",
+            device.bus,
+            device.address,
+            device.idVendor,
+            device.idProduct,
+            descriptor.get_port_path(device),
+            descriptor.get_serial_number(device),
+            mode,
         )
+        if runtime_intf is not None:
+            continue
 
         for cfg in device:
             for intf in cfg:
-                for segment in descriptor.get_memory_layout(
-                    device,
-                    intf.bInterfaceNumber,
-                    alternate_index=intf.alternate_index,
-                ):
+                if descriptor_cache is None:
+                    layout = descriptor.get_memory_layout(
+                        device,
+                        intf.bInterfaceNumber,
+                        alternate_index=intf.alternate_index,
+                    )
+                else:
+                    layout = descriptor_cache.get_memory_layout(
+                        device, intf.bInterfaceNumber, intf.alternate_index
+                    )
+                for segment in layout:
                     if segment.page_size > _BYTES_PER_KILOBYTE:
                         page_size = segment.page_size // _BYTES_PER_KILOBYTE
                         page_char = "K"
@@ -246,59 +492,528 @@ def list_devices(vid: Optional[int] = None, pid: Optional[int] = None) -> None:
                     )
 
 
+def _wait_for_dfu_devices(
+    vid: Optional[int] = None,
+    pid: Optional[int] = None,
+    serial: Optional[str] = None,
+    timeout: float = 10.0,
+    bus: Optional[int] = None,
+    port_path: Optional[str] = None,
+    runtime: Optional[bool] = False,
+) -> List[usb.core.Device]:
+    """Wait for at least one device in DFU mode to appear.
+
+    Devices are scanned when libusb reports a matching device arriving, if the
+    backend supports hotplug, and otherwise with an exponential backoff
+    between scans.
+
+    Args:
+        vid: Filter by VID if provided.
+        pid: Filter by PID if provided.
+        serial: Filter by serial number if provided.
+        timeout: Maximum time to wait in seconds.
+        bus: Filter by USB bus number if provided.
+        port_path: Filter by location if provided.
+        runtime: Wait for a device in runtime mode instead of DFU mode if
+            True, or in either mode if None.
+
+    Returns:
+        List of matching USB devices.
+
+    Raises:
+        RuntimeError: No device appeared before the timeout.
+    """
+    from . import hotplug
+
+    deadline = time.monotonic() + timeout
+    delay = _WAIT_POLL_MIN_S
+    # Start monitoring before the first scan so an arrival is not missed
+    monitor = hotplug.open_monitor(vid=vid, pid=pid)
+    if monitor is None:
+        logger.debug("Hotplug unavailable, polling for DFU devices")
+    try:
+        while True:
+            devices = _get_dfu_devices(
+                vid=vid,
+                pid=pid,
+                serial=serial,
+                bus=bus,
+                port_path=port_path,
+                runtime=runtime,
+            )
+            if devices:
+                return devices
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                if runtime is None:
+                    mode = ""
+                else:
+                    mode = " in runtime mode" if runtime else " in DFU mode"
+                raise RuntimeError(
+                    f"No devices found{mode} within {timeout:g} s"
+                )
+
+            if monitor is not None:
+                # Rescan occasionally in case the DFU interface appears after
+                # the arrival event, e.g. if the configuration changes
+                monitor.wait(min(remaining, _WAIT_POLL_MAX_S))
+            else:
+                time.sleep(min(remaining, delay))
+                delay = min(2 * delay, _WAIT_POLL_MAX_S)
+    finally:
+        if monitor is not None:
+            monitor.close()
+
+
+def wait_for_device(
+    vid: Optional[int] = None,
+    pid: Optional[int] = None,
+    serial: Optional[str] = None,
+    timeout: float = 10.0,
+    bus: Optional[int] = None,
+    port_path: Optional[str] = None,
+) -> usb.core.Device:
+    """Wait for a device in DFU mode to appear, e.g. after it was reset into
+    its bootloader. Uses libusb hotplug notifications where supported instead
+    of repeatedly scanning all devices.
+
+    Args:
+        vid: Vendor ID to narrow the search for DFU devices.
+        pid: Product ID to narrow the search for DFU devices.
+        serial: Serial number to narrow the search for DFU devices.
+        timeout: Maximum time to wait in seconds.
+        bus: USB bus number to narrow the search for DFU devices.
+        port_path: Location to narrow the search for DFU devices, as bus and
+            port numbers like "1-2.3".
+
+    Returns:
+        USB device in DFU mode.
+
+    Raises:
+        RuntimeError: No device appeared before the timeout, or more than one
+            device matched.
+    """
+    devices = _wait_for_dfu_devices(
+        vid=vid,
+        pid=pid,
+        serial=serial,
+        timeout=timeout,
+        bus=bus,
+        port_path=port_path,
+    )
+
+    if len(devices) > 1:
+        raise RuntimeError(
+            f"Too many devices in DFU mode ({len(devices)}). List devices for "
+            "more info and specify vid:pid, serial number or path to filter."
+        )
+
+    return devices[0]
+
+
+def detach_device(
+    vid: Optional[int] = None,
+    pid: Optional[int] = None,
+    serial: Optional[str] = None,
+    timeout: float = 10.0,
+    bus: Optional[int] = None,
+    port_path: Optional[str] = None,
+) -> usb.core.Device:
+    """Switch a device from runtime mode to DFU mode and wait for it to
+    re-enumerate. A device which is already in DFU mode is returned as is.
+
+    The device is sent DFU_DETACH with its wDetachTimeOut. Unless its DFU
+    descriptor says it will detach by itself, it is then reset. The DFU mode
+    device is found at the same location, since it usually has a different
+    PID.
+
+    Args:
+        vid: Vendor ID to narrow the search for runtime mode devices.
+        pid: Product ID to narrow the search for runtime mode devices.
+        serial: Serial number to narrow the search for devices.
+        timeout: Maximum time in seconds to wait for the device to re-enumerate,
+            in addition to its wDetachTimeOut.
+        bus: USB bus number to narrow the search for devices.
+        port_path: Location to narrow the search for devices, as bus and port
+            numbers like "1-2.3".
+
+    Returns:
+        USB device in DFU mode.
+
+    Raises:
+        ValueError: Could not read DFU device USB descriptor.
+        RuntimeError: Could not locate device, or it did not re-enumerate in
+            DFU mode.
+    """
+    devices = _get_dfu_devices(
+        vid=vid,
+        pid=pid,
+        serial=serial,
+        bus=bus,
+        port_path=port_path,
+        runtime=True,
+    )
+    if not devices:
+        logger.debug("No devices in runtime mode, looking for DFU mode")
+        return _get_dfu_device(
+            vid=vid, pid=pid, serial=serial, bus=bus, port_path=port_path
+        )
+    if len(devices) > 1:
+        raise RuntimeError(
+            f"Too many devices in runtime mode ({len(devices)}). List devices "
+            "for more info and specify vid:pid, serial number or path to "
+            "filter."
+        )
+
+    dev = devices[0]
+    interface = descriptor.get_runtime_interface(dev)
+    dfu_desc = descriptor.get_dfu_descriptor(dev)
+    if interface is None or dfu_desc is None:
+        raise ValueError("No DFU descriptor, is this a valid DFU device?")
+
+    # Location is stable across re-enumeration, unlike the device address
+    location = descriptor.get_port_path(dev)
+    has_ports = "@" not in location
+    if not has_ports and serial is None:
+        serial = descriptor.get_serial_number(dev)
+
+    will_detach = bool(dfu_desc.bmAttributes & descriptor.DFU_ATTR_WILL_DETACH)
+    logger.info("Detaching device at %s", location)
+    dfu.claim_interface(dev, interface)
+    try:
+        dfu.detach(dev, interface, dfu_desc.wDetachTimeOut)
+    except usb.core.USBError as err:
+        # Devices which detach by themselves may disconnect before the
+        # request completes
+        if not will_detach:
+            raise
+        logger.debug("Device disconnected during DFU_DETACH: %s", err)
+    finally:
+        try:
+            dfu.release_interface(dev)
+        except usb.core.USBError as err:
+            logger.debug("Failed to release interface: %s", err)
+
+    if not will_detach:
+        logger.debug("Resetting device to enter DFU mode")
+        try:
+            dev.reset()
+        except usb.core.USBError as err:
+            # The device may disconnect before the reset completes
+            logger.debug("Device disconnected during reset: %s", err)
+    usb.util.dispose_resources(dev)
+
+    return wait_for_device(
+        serial=serial,
+        timeout=dfu_desc.wDetachTimeOut / 1000 + timeout,
+        bus=dev.bus,
+        port_path=location if has_ports else None,
+    )
+
+
+def get_erase_plan(
+    filename: image.ImageSource,
+    address: Optional[int],
+    interface: int = 0,
+    vid: Optional[int] = None,
+    pid: Optional[int] = None,
+    serial: Optional[str] = None,
+    bus: Optional[int] = None,
+    port_path: Optional[str] = None,
+    sparse: bool = False,
+    mass_erase_threshold: Optional[float] = None,
+    descriptor_cache: Optional["cache.DescriptorCache"] = None,
+) -> plan.ErasePlan:
+    """Plan the erase operations of a DfuSe download without downloading (dry
+    run). Only the memory layout is read from the device.
+
+    Args:
+        filename: Path to binary file, or a buffer, file-like object or
+            iterator of bytes with the image.
+        address: Start address of the image in device memory. Not needed for
+            images with addresses, like Intel HEX or ELF files.
+        interface: USB device interface.
+        vid: Vendor ID to narrow the search for DFU devices.
+        pid: Product ID to narrow the search for DFU devices.
+        serial: Serial number to narrow the search for DFU devices.
+        bus: USB bus number to narrow the search for DFU devices.
+        port_path: Location to narrow the search for DFU devices.
+        sparse: See `download`.
+        mass_erase_threshold: See `download`.
+        descriptor_cache: See `download`.
+
+    Returns:
+        Erase plan.
+
+    Raises:
+        RuntimeError: Could not locate DFU device.
+        ValueError: Address not provided for a raw binary image.
+    """
+    with image.ChunkSource(filename) as source:
+        data, address = downloader.dfuse_image(source, None, address)
+        dev = _get_dfu_device(
+            vid=vid, pid=pid, serial=serial, bus=bus, port_path=port_path
+        )
+        if descriptor_cache is None:
+            layout = descriptor.get_memory_layout(dev, interface)
+        else:
+            layout = descriptor_cache.get_memory_layout(dev, interface)
+        return plan.plan_erase_segments(
+            layout,
+            downloader.as_segments(data, address),
+            sparse,
+            mass_erase_threshold,
+        )
+
+
 def download(
-    filename: str,
+    filename: image.ImageSource,
     interface: int = 0,
     vid: Optional[int] = None,
     pid: Optional[int] = None,
     address: Optional[int] = None,
-) -> None:
+    options: Optional[DownloadOptions] = None,
+    serial: Optional[str] = None,
+    bus: Optional[int] = None,
+    port_path: Optional[str] = None,
+    detach: bool = False,
+    descriptor_cache: Optional["cache.DescriptorCache"] = None,
+    trace_path: Optional[str] = None,
+    metrics_hook: Optional[Callable[[DownloadResult], None]] = None,
+    display: Optional[progress.ProgressSink] = None,
+    cancel: Optional[threading.Event] = None,
+) -> DownloadResult:
     """Download a file to the DFU device defined by vid:pid. If vid:pid is not
     provided and only one DFU device is present, that device will be used.
 
     Args:
-        filename: Binary file to download.
+        filename: Binary file to download, which is memory mapped. May also be
+            a bytes-like buffer, a binary file-like object or an iterator of
+            bytes. Pipes and iterators are streamed to DFU devices, but read
+            into memory for DfuSe devices or verification.
         interface: USB device interface.
         vid: Vendor ID to narrow the search for DFU devices.
         pid: Product ID to narrow the search for DFU devices.
-        address: Base address to jump to in memory. This is required for DfuSe.
+        address: Base address to jump to in memory. This is required for DfuSe,
+            unless the image is a DfuSe file (.dfu), whose elements are each
+            written to their own address and alternate setting in one session,
+            or an Intel HEX, S-record or ELF file (by extension), whose
+            segments are each written to their own address. Those default to
+            jumping to their first element or segment. Files with a DFU suffix
+            are checked against its CRC32 and downloaded without it.
+        options: How to erase, write and verify the image, or None for the
+            defaults, see `DownloadOptions`.
+        serial: Serial number to narrow the search for DFU devices.
+        bus: USB bus number to narrow the search for DFU devices.
+        port_path: Location to narrow the search for DFU devices, as bus and
+            port numbers like "1-2.3".
+        detach: Switch a device in runtime mode to DFU mode first, see
+            `detach_device`.
+        descriptor_cache: Cache of DFU descriptors and DfuSe memory layouts to
+            use instead of reading them from the device, see
+            `cache.DescriptorCache`.
+        trace_path: File to record the USB control transfers of the download
+            in, which can be replayed and profiled, see `trace`.
+        metrics_hook: Called with the download's metrics when it finishes,
+            also when it fails, e.g. to report them to a production system.
+        display: Receives the progress of erasing, writing and verifying,
+            or None for a rich progress bar. Use `progress.NullProgress` to
+            run without rich, or `progress.CallbackProgress` to report
+            progress to a function.
+        cancel: Set from another thread to cancel the download. The DFU
+            transaction in progress is aborted, and the interface released.
+            A DfuSe download with a checkpoint can be continued later.
+
+    Returns:
+        Metrics of the download: time spent in each phase, bytes sent, control
+        transfers, GETSTATUS polls, retries and latency by request.
 
     Raises:
+        DownloadCancelled: Download was cancelled.
         ValueError: Could not read DFU device USB descriptor.
         ValueError: Address not provided for DfuSe device.
+        ValueError: Device does not support verification.
         RuntimeError: Could not locate DFU device.
+        RuntimeError: Verification failed.
     """
-    logger.info("Downloading binary file: %s", filename)
-    with open(filename, "rb") as fin:
-        data = fin.read()
+    from . import metrics, trace
 
-    devices = _get_dfu_devices(vid=vid, pid=pid)
+    result = DownloadResult()
+    start = time.monotonic()
+    try:
+        if cancel is not None and cancel.is_set():
+            raise DownloadCancelled("Download was cancelled")
+
+        with contextlib.ExitStack() as stack:
+            source = stack.enter_context(image.ChunkSource(filename))
+            logger.info("Downloading binary file: %s", source.name)
+
+            if detach:
+                dev = detach_device(
+                    vid=vid,
+                    pid=pid,
+                    serial=serial,
+                    bus=bus,
+                    port_path=port_path,
+                )
+            else:
+                dev = _get_dfu_device(
+                    vid=vid,
+                    pid=pid,
+                    serial=serial,
+                    bus=bus,
+                    port_path=port_path,
+                )
+            result.phases.discovery = time.monotonic() - start
+            if trace_path is not None:
+                dev = stack.enter_context(trace.TraceRecorder(dev, trace_path))
+
+            recorder = metrics.MetricsRecorder(dev)
+            stack.callback(result.add_transfers, recorder)
+            _download_to_device(
+                recorder
+                if cancel is None
+                else _CancellableDevice(recorder, cancel),
+                interface,
+                source,
+                address,
+                options=options,
+                display=display,
+                descriptor_cache=descriptor_cache,
+                result=result,
+            )
+    except Exception as err:
+        result.error = err
+        raise
+    finally:
+        result.duration = time.monotonic() - start
+        if metrics_hook is not None:
+            metrics_hook(result)
 
-    if not devices:
-        raise RuntimeError("No devices found in DFU mode")
+    return result
 
-    if len(devices) > 1:
-        raise RuntimeError(
-            f"Too many devices in DFU mode ({len(devices)}). List devices for "
-            "more info and specify vid:pid to filter."
-        )
 
-    dev = devices[0]
+def download_all(
+    filename: image.ImageSource,
+    interface: int = 0,
+    vid: Optional[int] = None,
+    pid: Optional[int] = None,
+    address: Optional[int] = None,
+    max_workers: Optional[int] = None,
+    max_per_group: Optional[int] = None,
+    group: str = GROUP_BUS,
+    options: Optional[DownloadOptions] = None,
+    bus: Optional[int] = None,
+    descriptor_cache: Optional["cache.DescriptorCache"] = None,
+    display: Optional[progress.ProgressSink] = None,
+) -> List[DeviceResult]:
+    """Download a file to every DFU device matching vid:pid at the same time.
+    Each device is downloaded to by its own worker thread.
 
-    try:
-        dfu.claim_interface(dev, interface)
+    Args:
+        filename: Binary file to download, see `download`. The file is read
+            into memory once if it cannot be memory mapped.
+        interface: USB device interface.
+        vid: Vendor ID to narrow the search for DFU devices.
+        pid: Product ID to narrow the search for DFU devices.
+        address: Base address to jump to in memory. This is required for DfuSe,
+            unless the image is a DfuSe file (.dfu), whose elements are each
+            written to their own address and alternate setting in one session,
+            or an Intel HEX, S-record or ELF file (by extension), whose
+            segments are each written to their own address. Those default to
+            jumping to their first element or segment. Files with a DFU suffix
+            are checked against its CRC32 and downloaded without it.
+        max_workers: Maximum number of devices to download to at once, or None
+            for all of them.
+        max_per_group: Maximum number of devices in the same group to download
+            to at once, or None for no limit. Devices on the same bus or hub
+            share its bandwidth.
+        group: Group devices by `GROUP_BUS` or `GROUP_HUB`.
+        options: Options of the download to each device, or None for the
+            defaults. Resuming from a checkpoint is not supported.
+        bus: USB bus number to narrow the search for DFU devices.
+        descriptor_cache: See `download`.
+        display: See `download`. Task descriptions are prefixed with the
+            location of the device.
 
-        dfu_desc = descriptor.get_dfu_descriptor(dev)
-        if dfu_desc is None:
-            raise ValueError("No DFU descriptor, is this a valid DFU device?")
+    Returns:
+        Result for each device, in the order the devices were found.
 
-        if dfu_desc.bcdDFUVersion == dfuse.DFUSE_VERSION_NUMBER:
-            if address is None:
-                raise ValueError("Must provide address for DfuSe")
-            _dfuse_download_with_retry(
-                dev, interface, data, dfu_desc.wTransferSize, address
+    Raises:
+        ValueError: Unknown device group, or a checkpoint file was given.
+        RuntimeError: Could not locate any DFU devices.
+    """
+    if group not in (GROUP_BUS, GROUP_HUB):
+        raise ValueError(f"Unknown device group: {group}")
+    if options is not None and options.checkpoint_path is not None:
+        raise ValueError("Checkpoints are not supported for several devices")
+
+    with image.ChunkSource(filename) as source:
+        logger.info("Downloading binary file to all devices: %s", source.name)
+
+        # Every device reads its own chunks from the same buffer
+        data = source.buffer
+
+        devices = _get_dfu_devices(vid=vid, pid=pid, bus=bus)
+        if not devices:
+            raise RuntimeError("No devices found in DFU mode")
+
+        limits: Dict[str, threading.Semaphore] = {}
+        for dev in devices:
+            limits.setdefault(
+                _group_key(dev, group),
+                threading.Semaphore(max_per_group or len(devices)),
             )
-        else:
-            _dfu_download(dev, interface, data, dfu_desc.wTransferSize)
-    finally:
-        dfu.release_interface(dev)
+
+        def worker(dev: usb.core.Device) -> DeviceResult:
+            port_path = descriptor.get_port_path(dev)
+            with limits[_group_key(dev, group)]:
+                start = time.perf_counter()
+                # Keep the file name, which selects the image format
+                device_source = image.ChunkSource(data)
+                device_source.name = source.name
+                try:
+                    _download_to_device(
+                        dev,
+                        interface,
+                        device_source,
+                        address,
+                        options=options,
+                        display=progress.LabelledProgress(
+                            sink, f"[{port_path}]"
+                        ),
+                        descriptor_cache=descriptor_cache,
+                    )
+                    error = None
+                except Exception as err:
+                    logger.error("[%s] DFU download failed: %r", port_path, err)
+                    error = err
+
+            return DeviceResult(
+                bus=dev.bus,
+                device_address=dev.address,
+                port_path=port_path,
+                error=error,
+                duration=time.perf_counter() - start,
+            )
+
+        with contextlib.ExitStack() as stack:
+            # Devices share one rich progress bar by default
+            sink = display or stack.enter_context(
+                progress.RichProgress.shared()
+            )
+            pool = stack.enter_context(
+                concurrent.futures.ThreadPoolExecutor(
+                    max_workers=max_workers or len(devices)
+                )
+            )
+            results = list(pool.map(worker, devices))
+
+    logger.info(
+        "Downloaded to %d of %d devices",
+        sum(result.success for result in results),
+        len(results),
+    )
+
+    return results
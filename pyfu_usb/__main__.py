@@ -2,17 +2,90 @@
 """Command-line interface (CLI) for pyfu-usb."""
 
 import argparse
+import json
 import logging
 import sys
-from importlib.metadata import version
+from typing import TYPE_CHECKING, Callable, Optional
 
 import usb
-from rich.logging import RichHandler
 
-from . import download, list_devices
+from . import (
+    ERASE_INTERLEAVED,
+    ERASE_UPFRONT,
+    GROUP_BUS,
+    GROUP_HUB,
+    VERIFY_COMPARE,
+    VERIFY_HASH,
+    DownloadOptions,
+    DownloadResult,
+    _check_port_path,
+    _wait_for_dfu_devices,
+    detach_device,
+    download,
+    download_all,
+    get_erase_plan,
+    list_devices,
+)
+from .descriptor import get_device_ids
+from .plan import check_mass_erase_threshold
+from .progress import NullProgress, ProgressSink
+
+if TYPE_CHECKING:
+    from .cache import DescriptorCache
 
 logger = logging.getLogger(__name__)
 
+# Expected exceptions when downloading, which are logged instead of raised
+_DOWNLOAD_ERRORS = (
+    RuntimeError,
+    ValueError,
+    FileNotFoundError,
+    IsADirectoryError,
+    usb.core.USBError,
+)
+
+# Formats of the metrics file
+_METRICS_JSON = "json"
+_METRICS_PROMETHEUS = "prometheus"
+
+
+def _port_path_arg(value: str) -> str:
+    """Parse a device location argument.
+
+    Args:
+        value: Argument value.
+
+    Returns:
+        The location.
+
+    Raises:
+        argparse.ArgumentTypeError: The location is malformed.
+    """
+    try:
+        return _check_port_path(value)
+    except ValueError as err:
+        raise argparse.ArgumentTypeError(str(err)) from err
+
+
+def _fraction_arg(value: str) -> float:
+    """Parse a mass erase threshold argument.
+
+    Args:
+        value: Argument value.
+
+    Returns:
+        The threshold.
+
+    Raises:
+        argparse.ArgumentTypeError: The threshold is not a number in (0, 1].
+    """
+    try:
+        threshold = float(value)
+        check_mass_erase_threshold(threshold)
+    except ValueError as err:
+        raise argparse.ArgumentTypeError(str(err)) from err
+    return threshold
+
 
 def create_parser() -> argparse.ArgumentParser:
     """Define command-line arguments for pyfu-usb.
@@ -21,7 +94,9 @@ def create_parser() -> argparse.ArgumentParser:
         ArgumentParser
     """
     parser = argparse.ArgumentParser(
-        description="Python device firmware update utility."
+        description="Python device firmware update utility.",
+        epilog="Run 'pyfu-usb serve -h' for the service which flashes jobs "
+        "sent over a local socket.",
     )
     parser.add_argument(
         "-v",
@@ -51,7 +126,7 @@ def create_parser() -> argparse.ArgumentParser:
         "-D",
         "--download",
         dest="file",
-        help="Download firmware from <file> to device",
+        help="Download firmware from <file> to device, or - for stdin",
         required=False,
     )
     parser.add_argument(
@@ -68,6 +143,46 @@ def create_parser() -> argparse.ArgumentParser:
         help="Specify DFU device in hex as <vid>:<pid>",
         required=False,
     )
+    parser.add_argument(
+        "-S",
+        "--serial",
+        dest="serial",
+        help="Specify DFU device by serial number",
+        required=False,
+    )
+    parser.add_argument(
+        "--bus",
+        dest="bus",
+        help="Specify DFU device by USB bus number",
+        type=int,
+        required=False,
+    )
+    parser.add_argument(
+        "-p",
+        "--path",
+        dest="path",
+        help="Specify DFU device by location as <bus>-<port>[.<port>...]",
+        type=_port_path_arg,
+        required=False,
+    )
+    parser.add_argument(
+        "-e",
+        "--detach",
+        dest="detach",
+        help="Switch a device in runtime mode to DFU mode before downloading",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "-w",
+        "--wait",
+        dest="wait",
+        help="Wait up to <seconds> for a matching DFU device to appear before "
+        "listing or downloading",
+        metavar="SECONDS",
+        type=float,
+        default=None,
+    )
     parser.add_argument(
         "-i",
         "--interface",
@@ -76,29 +191,562 @@ def create_parser() -> argparse.ArgumentParser:
         required=False,
         default=0,
     )
+    parser.add_argument(
+        "--per-chunk-address",
+        dest="per_chunk_address",
+        help="Send DfuSe SET_ADDRESS before every chunk (compatibility mode)",
+        action="store_true",
+        default=False,
+    )
+
+    parser.add_argument(
+        "--sparse",
+        dest="sparse",
+        help="Skip erasing and writing DfuSe regions which are all 0xFF",
+        action="store_true",
+        default=False,
+    )
+
+    parser.add_argument(
+        "--delta",
+        dest="delta",
+        help="Read back DfuSe pages and only rewrite the ones which changed",
+        action="store_true",
+        default=False,
+    )
+
+    parser.add_argument(
+        "--verify",
+        dest="verify",
+        help="Read back and verify the download by comparing every byte "
+        f"({VERIFY_COMPARE}, default) or only a hash ({VERIFY_HASH})",
+        nargs="?",
+        const=VERIFY_COMPARE,
+        choices=[VERIFY_COMPARE, VERIFY_HASH],
+        default=None,
+    )
+
+    parser.add_argument(
+        "--mass-erase",
+        dest="mass_erase",
+        help="Mass erase a DfuSe device instead of erasing pages if the image "
+        "needs at least <fraction> of its memory erased (default: 0.9). "
+        "Memory outside the image is erased too",
+        metavar="FRACTION",
+        nargs="?",
+        const=0.9,
+        type=_fraction_arg,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--erase-schedule",
+        dest="erase_schedule",
+        help=f"Erase all DfuSe pages before writing ({ERASE_UPFRONT}, "
+        f"default) or each page just before it is written "
+        f"({ERASE_INTERLEAVED})",
+        choices=[ERASE_UPFRONT, ERASE_INTERLEAVED],
+        default=ERASE_UPFRONT,
+    )
+
+    parser.add_argument(
+        "--dry-run",
+        dest="dry_run",
+        help="Show the DfuSe erase plan for the download without changing the "
+        "device",
+        action="store_true",
+        default=False,
+    )
+
+    parser.add_argument(
+        "--checkpoint",
+        dest="checkpoint",
+        help="Record DfuSe download progress in <file>, and resume an "
+        "interrupted download of the same image from it",
+        metavar="FILE",
+        default=None,
+    )
+
+    parser.add_argument(
+        "--cache",
+        dest="cache",
+        help="Keep DFU descriptors and DfuSe memory layouts in <file>, so "
+        "later runs do not read them from the device again",
+        metavar="FILE",
+        default=None,
+    )
+
+    parser.add_argument(
+        "--trace",
+        dest="trace",
+        help="Record the USB control transfers of the download in <file>, to "
+        "replay or profile them",
+        metavar="FILE",
+        default=None,
+    )
+
+    parser.add_argument(
+        "--no-progress",
+        dest="no_progress",
+        help="Do not show progress bars, e.g. when running without a terminal",
+        action="store_true",
+        default=False,
+    )
+
+    parser.add_argument(
+        "--metrics",
+        dest="metrics",
+        help="Write the metrics of the download to <file>, also when it fails",
+        metavar="FILE",
+        default=None,
+    )
+    parser.add_argument(
+        "--metrics-format",
+        dest="metrics_format",
+        help=f"Format of the metrics file: {_METRICS_JSON} (default) or "
+        f"Prometheus text ({_METRICS_PROMETHEUS})",
+        choices=[_METRICS_JSON, _METRICS_PROMETHEUS],
+        default=_METRICS_JSON,
+    )
+
+    parser.add_argument(
+        "--all",
+        dest="all",
+        help="Download to every matching DFU device in parallel",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        dest="jobs",
+        help="Maximum number of devices to download to at once with --all",
+        type=int,
+        default=None,
+    )
+    limit_group = parser.add_mutually_exclusive_group()
+    limit_group.add_argument(
+        "--max-per-bus",
+        dest="max_per_bus",
+        help="Maximum number of devices per USB bus to download to at once",
+        type=int,
+        default=None,
+    )
+    limit_group.add_argument(
+        "--max-per-hub",
+        dest="max_per_hub",
+        help="Maximum number of devices per USB hub to download to at once",
+        type=int,
+        default=None,
+    )
 
     return parser
 
 
-def cli(args: argparse.Namespace) -> int:
-    """Command-line interface (CLI) for pyfu-usb.
+def _descriptor_cache(
+    args: argparse.Namespace,
+) -> Optional["DescriptorCache"]:
+    """Open the descriptor cache file, if one was given.
 
     Args:
         args: Command-line arguments.
 
     Returns:
-        0 for success, 1 for failure.
+        Descriptor cache, or None to read descriptors from the device.
+    """
+    if args.cache is None:
+        return None
+
+    from .cache import DescriptorCache
+
+    return DescriptorCache(args.cache)
+
+
+def _log_handler() -> logging.Handler:
+    """Get the rich log handler. rich is imported here, once logging is
+    configured, so importing the CLI stays quick.
+
+    Returns:
+        Log handler.
+    """
+    from rich.logging import RichHandler
+
+    return RichHandler()
+
+
+def _display(args: argparse.Namespace) -> Optional[ProgressSink]:
+    """Get the progress display.
+
+    Args:
+        args: Command-line arguments.
+
+    Returns:
+        Progress display, or None for rich progress bars.
+    """
+    return NullProgress() if args.no_progress else None
+
+
+def _download_options(
+    args: argparse.Namespace, checkpoint_path: Optional[str] = None
+) -> DownloadOptions:
+    """Get the options of downloads.
+
+    Args:
+        args: Command-line arguments.
+        checkpoint_path: File to record the progress of the download in, if
+            provided.
+
+    Returns:
+        Download options.
+    """
+    return DownloadOptions(
+        per_chunk_address=args.per_chunk_address,
+        sparse=args.sparse,
+        delta=args.delta,
+        verify=args.verify,
+        checkpoint_path=checkpoint_path,
+        mass_erase_threshold=args.mass_erase,
+        erase_schedule=args.erase_schedule,
+    )
+
+
+def _metrics_writer(
+    args: argparse.Namespace,
+) -> Optional[Callable[[DownloadResult], None]]:
+    """Get a hook which writes download metrics to the metrics file, if one
+    was given.
+
+    Args:
+        args: Command-line arguments.
+
+    Returns:
+        Metrics hook, or None to not write metrics.
+    """
+    if args.metrics is None:
+        return None
+
+    # Samples are labelled with the serial number to tell boards apart
+    labels = {} if args.serial is None else {"serial": args.serial}
+
+    def write(result: DownloadResult) -> None:
+        with open(args.metrics, "w") as f:
+            if args.metrics_format == _METRICS_PROMETHEUS:
+                f.write(result.to_prometheus(labels))
+            else:
+                json.dump(result.to_json(), f, indent=2)
+        logger.debug("Wrote download metrics to %s", args.metrics)
+
+    return write
+
+
+def _download(
+    args: argparse.Namespace,
+    vid: Optional[int],
+    pid: Optional[int],
+    address: Optional[int],
+) -> int:
+    """Download file to the only matching DFU device.
+
+    Args:
+        args: Command-line arguments.
+        vid: Vendor ID to narrow the search for DFU devices.
+        pid: Product ID to narrow the search for DFU devices.
+        address: Base address for DfuSe devices.
+
+    Returns:
+        0 if the download succeeded, 1 otherwise.
+    """
+    try:
+        download(
+            sys.stdin.buffer if args.file == "-" else args.file,
+            interface=args.interface,
+            vid=vid,
+            pid=pid,
+            address=address,
+            options=_download_options(args, args.checkpoint),
+            serial=args.serial,
+            bus=args.bus,
+            port_path=args.path,
+            detach=args.detach,
+            descriptor_cache=_descriptor_cache(args),
+            trace_path=args.trace,
+            metrics_hook=_metrics_writer(args),
+            display=_display(args),
+        )
+    except _DOWNLOAD_ERRORS as err:
+        logger.error("DFU download failed: %s", repr(err))
+        return 1
+
+    return 0
+
+
+def _dry_run(
+    args: argparse.Namespace,
+    vid: Optional[int],
+    pid: Optional[int],
+    address: Optional[int],
+) -> int:
+    """Log the DfuSe erase plan for downloading file to the only matching DFU
+    device.
+
+    Args:
+        args: Command-line arguments.
+        vid: Vendor ID to narrow the search for DFU devices.
+        pid: Product ID to narrow the search for DFU devices.
+        address: Base address for DfuSe devices.
+
+    Returns:
+        0 if the plan was created, 1 otherwise.
+    """
+    try:
+        erase_plan = get_erase_plan(
+            sys.stdin.buffer if args.file == "-" else args.file,
+            address,
+            interface=args.interface,
+            vid=vid,
+            pid=pid,
+            serial=args.serial,
+            bus=args.bus,
+            port_path=args.path,
+            sparse=args.sparse,
+            mass_erase_threshold=args.mass_erase,
+            descriptor_cache=_descriptor_cache(args),
+        )
+    except _DOWNLOAD_ERRORS as err:
+        logger.error("DFU erase plan failed: %s", repr(err))
+        return 1
+
+    logger.info(
+        "%d pages in image, %d skipped, %d erase operations (%s)",
+        len(erase_plan.pages),
+        erase_plan.pages_skipped,
+        erase_plan.num_operations,
+        "mass erase" if erase_plan.mass_erase else "page erase",
+    )
+    if not erase_plan.mass_erase:
+        for start, end in erase_plan.erase_ranges:
+            logger.info("    Erase 0x%08X-0x%08X", start, end - 1)
+    return 0
+
+
+def _detach(
+    args: argparse.Namespace, vid: Optional[int], pid: Optional[int]
+) -> int:
+    """Switch the only matching device from runtime mode to DFU mode.
+
+    Args:
+        args: Command-line arguments.
+        vid: Vendor ID to narrow the search for devices.
+        pid: Product ID to narrow the search for devices.
+
+    Returns:
+        0 if the device is in DFU mode, 1 otherwise.
+    """
+    try:
+        dev = detach_device(
+            vid=vid,
+            pid=pid,
+            serial=args.serial,
+            bus=args.bus,
+            port_path=args.path,
+        )
+    except _DOWNLOAD_ERRORS as err:
+        logger.error("DFU detach failed: %s", repr(err))
+        return 1
+
+    logger.info("Device in DFU mode: ID %04x:%04x", *get_device_ids(dev))
+    return 0
+
+
+def _download_all(
+    args: argparse.Namespace,
+    vid: Optional[int],
+    pid: Optional[int],
+    address: Optional[int],
+) -> int:
+    """Download file to every matching DFU device and log each result.
+
+    Args:
+        args: Command-line arguments.
+        vid: Vendor ID to narrow the search for DFU devices.
+        pid: Product ID to narrow the search for DFU devices.
+        address: Base address for DfuSe devices.
+
+    Returns:
+        0 if every download succeeded, 1 otherwise.
+    """
+    if args.serial or args.path or args.detach or args.trace or args.metrics:
+        logger.error(
+            "--all cannot be combined with --serial, --path, --detach, "
+            "--trace or --metrics"
+        )
+        return 1
+
+    if args.max_per_hub:
+        max_per_group, group = args.max_per_hub, GROUP_HUB
+    else:
+        max_per_group, group = args.max_per_bus, GROUP_BUS
+
+    try:
+        results = download_all(
+            sys.stdin.buffer if args.file == "-" else args.file,
+            interface=args.interface,
+            vid=vid,
+            pid=pid,
+            address=address,
+            max_workers=args.jobs,
+            max_per_group=max_per_group,
+            group=group,
+            options=_download_options(args),
+            bus=args.bus,
+            descriptor_cache=_descriptor_cache(args),
+            display=_display(args),
+        )
+    except _DOWNLOAD_ERRORS as err:
+        logger.error("DFU download failed: %s", repr(err))
+        return 1
+
+    for result in results:
+        if result.success:
+            logger.info(
+                "[%s] Download done in %.1f s",
+                result.port_path,
+                result.duration,
+            )
+        else:
+            logger.error(
+                "[%s] Download failed after %.1f s: %s",
+                result.port_path,
+                result.duration,
+                repr(result.error),
+            )
+
+    return 0 if all(result.success for result in results) else 1
+
+
+def _configure_logging(verbose: bool) -> None:
+    """Set log level based on verbosity argument.
+
+    Args:
+        verbose: Whether to log debug statements.
     """
-    # Set log level based on verbosity argument
     logging.basicConfig(
         format="%(message)s",
         datefmt="%H:%M:%S.%f",
-        level=logging.DEBUG if args.verbose else logging.INFO,
-        handlers=[RichHandler()],
+        level=logging.DEBUG if verbose else logging.INFO,
+        handlers=[_log_handler()],
     )
 
+
+def create_serve_parser() -> argparse.ArgumentParser:
+    """Define command-line arguments for `pyfu-usb serve`.
+
+    Returns:
+        ArgumentParser
+    """
+    parser = argparse.ArgumentParser(
+        prog="pyfu-usb serve",
+        description="Serve flash jobs sent over a local socket.",
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        dest="verbose",
+        help="Print verbose debug statements",
+        action="store_true",
+        default=False,
+    )
+    listen_group = parser.add_mutually_exclusive_group(required=True)
+    listen_group.add_argument(
+        "--socket",
+        dest="socket",
+        help="Listen on Unix socket <path>",
+        metavar="PATH",
+    )
+    listen_group.add_argument(
+        "--port",
+        dest="port",
+        help="Listen on TCP <port> on localhost, e.g. where Unix sockets are "
+        "not supported",
+        type=int,
+    )
+    parser.add_argument(
+        "--max-per-bus",
+        dest="max_per_bus",
+        help="Run at most <n> jobs at once per USB bus",
+        metavar="N",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--image-root",
+        dest="image_root",
+        help="Let clients name images by path under <dir>, instead of "
+        "uploading them",
+        metavar="DIR",
+        default=None,
+    )
+    parser.add_argument(
+        "--image-cache-size",
+        dest="image_cache_size",
+        help="Keep up to <size> MiB of parsed images in memory "
+        "(default: %(default)s)",
+        metavar="SIZE",
+        type=int,
+        default=256,
+    )
+    parser.add_argument(
+        "--cache",
+        dest="cache",
+        help="Keep DFU descriptors and DfuSe memory layouts in <file>",
+        metavar="FILE",
+        default=None,
+    )
+    return parser
+
+
+def serve_cli(args: argparse.Namespace) -> int:
+    """Command-line interface of `pyfu-usb serve`.
+
+    Args:
+        args: Command-line arguments.
+
+    Returns:
+        0 when interrupted.
+    """
+    _configure_logging(args.verbose)
+
+    from .serve import serve
+
+    try:
+        serve(
+            socket_path=args.socket,
+            port=args.port,
+            max_per_bus=args.max_per_bus,
+            image_cache_bytes=args.image_cache_size * 1024 * 1024,
+            descriptor_cache=_descriptor_cache(args),
+            image_root=args.image_root,
+        )
+    except KeyboardInterrupt:
+        logger.info("Stopped serving")
+    return 0
+
+
+def cli(args: argparse.Namespace) -> int:
+    """Command-line interface (CLI) for pyfu-usb.
+
+    Args:
+        args: Command-line arguments.
+
+    Returns:
+        0 for success, 1 for failure.
+    """
+    _configure_logging(args.verbose)
+
     # Get pyfu-usb verion
     if args.version:
+        from importlib.metadata import version
+
         logger.info(version("pyfu_usb"))
         return 0
 
@@ -116,42 +764,57 @@ def cli(args: argparse.Namespace) -> int:
         vid, pid = None, None
 
     # Parse address if provided
-    if args.address:
-        address = int(args.address, 16)
-    else:
-        address = None
+    address = int(args.address, 16) if args.address else None
+
+    # Wait for a DFU device to appear, which may still be in runtime mode if
+    # it is about to be detached
+    if args.wait is not None:
+        try:
+            _wait_for_dfu_devices(
+                vid=vid,
+                pid=pid,
+                serial=args.serial,
+                timeout=args.wait,
+                bus=args.bus,
+                port_path=args.path,
+                runtime=None if args.detach else False,
+            )
+        except _DOWNLOAD_ERRORS as err:
+            logger.error("DFU device not found: %s", repr(err))
+            return 1
 
     # List DFU devices
     if args.list:
-        list_devices(vid=vid, pid=pid)
+        list_devices(
+            vid=vid,
+            pid=pid,
+            serial=args.serial,
+            bus=args.bus,
+            port_path=args.path,
+            descriptor_cache=_descriptor_cache(args),
+        )
         return 0
 
-    # Download file to DFU device
-    try:
-        if args.file:
-            download(
-                args.file,
-                interface=args.interface,
-                vid=vid,
-                pid=pid,
-                address=address,
-            )
-    except (
-        RuntimeError,
-        ValueError,
-        FileNotFoundError,
-        IsADirectoryError,
-        usb.core.USBError,
-    ) as err:
-        logger.error("DFU download failed: %s", repr(err))
-        return 1
+    # Download file to DFU device, or to every matching DFU device
+    if args.file:
+        if args.dry_run:
+            download_fn = _dry_run
+        elif args.all:
+            download_fn = _download_all
+        else:
+            download_fn = _download
+        return download_fn(args, vid, pid, address)
 
-    return 0
+    # Only switch device to DFU mode
+    return _detach(args, vid, pid) if args.detach else 0
 
 
 def main() -> None:
     """CLI entry point."""
-    sys.exit(cli(create_parser().parse_args()))
+    argv = sys.argv[1:]
+    if argv[:1] == ["serve"]:
+        sys.exit(serve_cli(create_serve_parser().parse_args(argv[1:])))
+    sys.exit(cli(create_parser().parse_args(argv)))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,420 @@
+# Copyright 2022 Block, Inc.
+"""asyncio API, for discovering and downloading to devices without blocking
+an event loop.
+
+The blocking USB work runs on worker threads: downloads to the same device
+run one after another on the worker of its location, however the device was
+selected, so downloads to different devices run at once. A worker stops once
+it has no downloads left. Cancelling a download aborts the DFU
+transaction in progress and releases the interface. Its progress is an async
+iterator::
+
+    job = aio.download("app.bin", address=0x08000000, serial="ABC123")
+    async for update in job:
+        print(update.description, update.completed, update.total)
+    result = await job
+"""
+
+import asyncio
+import concurrent.futures
+import functools
+import logging
+import threading
+from typing import (
+    Any,
+    AsyncIterator,
+    Dict,
+    Generator,
+    List,
+    Optional,
+    Tuple,
+)
+
+import usb
+
+from . import (
+    DownloadResult,
+    _check_port_path,
+    _get_dfu_device,
+    _get_dfu_devices,
+    descriptor,
+    image,
+    progress,
+)
+from . import download as _download
+from . import wait_for_device as _wait_for_device
+
+logger = logging.getLogger(__name__)
+
+# Device selector: VID, PID, serial number, bus and port path
+_Selector = Tuple[
+    Optional[int], Optional[int], Optional[str], Optional[int], Optional[str]
+]
+
+
+class _Worker:
+    """Thread running the downloads to one device one after another."""
+
+    def __init__(self) -> None:
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="pyfu-usb"
+        )
+        # Downloads submitted and not finished yet
+        self.jobs = 0
+
+
+# Workers by device location, see `descriptor.get_port_path`
+_workers: Dict[str, _Worker] = {}
+_workers_lock = threading.Lock()
+
+
+def _acquire_worker(location: str) -> _Worker:
+    """Get the worker of a device for a new download, starting it if needed.
+
+    Args:
+        location: Device location.
+
+    Returns:
+        Worker, which must be released when the download finishes.
+    """
+    with _workers_lock:
+        worker = _workers.get(location)
+        if worker is None:
+            worker = _workers[location] = _Worker()
+        worker.jobs += 1
+        return worker
+
+
+def _release_worker(location: str, worker: _Worker) -> None:
+    """Release a worker after a download, stopping it if it has no
+    downloads left.
+
+    Args:
+        location: Device location.
+        worker: Worker returned by `_acquire_worker`.
+    """
+    with _workers_lock:
+        worker.jobs -= 1
+        if worker.jobs:
+            return
+        if _workers.get(location) is worker:
+            del _workers[location]
+    worker.executor.shutdown(wait=False)
+
+
+def _device_location(selector: _Selector, detach: bool) -> str:
+    """Find the location of the device a download selects.
+
+    Args:
+        selector: Device selector.
+        detach: Whether the device may still be in runtime mode.
+
+    Returns:
+        Device location.
+
+    Raises:
+        RuntimeError: No device or more than one device found.
+        ValueError: Location in the selector is malformed.
+    """
+    vid, pid, serial, bus, port_path = selector
+    if port_path is not None:
+        return _check_port_path(port_path)
+    return descriptor.get_port_path(
+        _get_dfu_device(
+            vid=vid,
+            pid=pid,
+            serial=serial,
+            bus=bus,
+            runtime=None if detach else False,
+        )
+    )
+
+
+def shutdown() -> None:
+    """Stop the download workers once their downloads finish, e.g. when the
+    event loop closes. Later downloads start new workers.
+    """
+    with _workers_lock:
+        workers = list(_workers.values())
+        _workers.clear()
+    for worker in workers:
+        worker.executor.shutdown(wait=False)
+
+
+async def list_devices(
+    vid: Optional[int] = None,
+    pid: Optional[int] = None,
+    serial: Optional[str] = None,
+    bus: Optional[int] = None,
+    port_path: Optional[str] = None,
+) -> List[usb.core.Device]:
+    """Find devices in DFU mode or runtime mode. Unlike
+    `pyfu_usb.list_devices`, the devices are returned instead of logged.
+
+    Args:
+        vid: Vendor ID to narrow the search for DFU devices.
+        pid: Product ID to narrow the search for DFU devices.
+        serial: Serial number to narrow the search for DFU devices.
+        bus: USB bus number to narrow the search for DFU devices.
+        port_path: Location to narrow the search for DFU devices, as bus and
+            port numbers like "1-2.3".
+
+    Returns:
+        Matching USB devices.
+    """
+    return await asyncio.get_running_loop().run_in_executor(
+        None,
+        functools.partial(
+            _get_dfu_devices,
+            vid=vid,
+            pid=pid,
+            serial=serial,
+            bus=bus,
+            port_path=port_path,
+            runtime=None,
+        ),
+    )
+
+
+async def wait_for_device(
+    vid: Optional[int] = None,
+    pid: Optional[int] = None,
+    serial: Optional[str] = None,
+    timeout: float = 10.0,
+    bus: Optional[int] = None,
+    port_path: Optional[str] = None,
+) -> usb.core.Device:
+    """Wait for a device in DFU mode to appear, see
+    `pyfu_usb.wait_for_device`. When cancelled, the worker thread keeps
+    waiting until the timeout, but the result is discarded.
+
+    Args:
+        vid: Vendor ID to narrow the search for DFU devices.
+        pid: Product ID to narrow the search for DFU devices.
+        serial: Serial number to narrow the search for DFU devices.
+        timeout: Maximum time to wait in seconds.
+        bus: USB bus number to narrow the search for DFU devices.
+        port_path: Location to narrow the search for DFU devices, as bus and
+            port numbers like "1-2.3".
+
+    Returns:
+        USB device in DFU mode.
+
+    Raises:
+        RuntimeError: No device appeared before the timeout, or more than one
+            device matched.
+    """
+    return await asyncio.get_running_loop().run_in_executor(
+        None,
+        functools.partial(
+            _wait_for_device,
+            vid=vid,
+            pid=pid,
+            serial=serial,
+            timeout=timeout,
+            bus=bus,
+            port_path=port_path,
+        ),
+    )
+
+
+class Download:
+    """Download running on a worker thread, see `download`.
+
+    Await it for its result, and iterate over it for its progress. Cancelling
+    a task awaiting it cancels the download.
+    """
+
+    def __init__(
+        self,
+        filename: image.ImageSource,
+        selector: _Selector,
+        min_interval_s: float,
+        options: Dict[str, Any],
+    ) -> None:
+        """Start a download.
+
+        Args:
+            filename: Image to download.
+            selector: Device selector.
+            min_interval_s: Minimum time between progress updates of a task.
+            options: Other arguments of `pyfu_usb.download`.
+        """
+        self._loop = asyncio.get_running_loop()
+        self._cancel = threading.Event()
+        self._updates: "asyncio.Queue[Optional[progress.ProgressUpdate]]" = (
+            asyncio.Queue()
+        )
+        self._future = asyncio.ensure_future(
+            self._start(filename, selector, min_interval_s, options)
+        )
+
+    async def _start(
+        self,
+        filename: image.ImageSource,
+        selector: _Selector,
+        min_interval_s: float,
+        options: Dict[str, Any],
+    ) -> DownloadResult:
+        """Find the device, then download on the worker of its location.
+
+        Args:
+            filename: Image to download.
+            selector: Device selector.
+            min_interval_s: Minimum time between progress updates of a task.
+            options: Other arguments of `pyfu_usb.download`.
+
+        Returns:
+            Metrics of the download.
+        """
+        detach = bool(options.get("detach"))
+        try:
+            location = await self._loop.run_in_executor(
+                None, _device_location, selector, detach
+            )
+        except BaseException:
+            self._updates.put_nowait(None)
+            raise
+
+        vid, pid, serial, bus, port_path = selector
+        if not detach:
+            # Download to the device whose worker runs it. A detached device
+            # re-enumerates, so it is selected again as given.
+            port_path = location
+        run = functools.partial(
+            self._run,
+            filename,
+            vid=vid,
+            pid=pid,
+            serial=serial,
+            bus=bus,
+            port_path=port_path,
+            display=progress.CallbackProgress(self._report, min_interval_s),
+            cancel=self._cancel,
+            **options,
+        )
+        worker = _acquire_worker(location)
+        try:
+            future = worker.executor.submit(run)
+        except BaseException:
+            _release_worker(location, worker)
+            raise
+        # Released on the worker thread, before the result is awaited
+        future.add_done_callback(lambda _: _release_worker(location, worker))
+        return await asyncio.wrap_future(future)
+
+    def _report(self, update: progress.ProgressUpdate) -> None:
+        """Pass a progress update from the worker thread to the event loop.
+
+        Args:
+            update: Progress of a task.
+        """
+        self._loop.call_soon_threadsafe(self._updates.put_nowait, update)
+
+    def _run(self, *args: Any, **kwargs: Any) -> DownloadResult:
+        """Download on the worker thread, then end the progress updates.
+
+        Args:
+            args: Arguments of `pyfu_usb.download`.
+            kwargs: Keyword arguments of `pyfu_usb.download`.
+
+        Returns:
+            Metrics of the download.
+        """
+        try:
+            return _download(*args, **kwargs)
+        finally:
+            self._loop.call_soon_threadsafe(self._updates.put_nowait, None)
+
+    @property
+    def cancelled(self) -> bool:
+        """Whether the download was cancelled."""
+        return self._cancel.is_set()
+
+    def cancel(self) -> None:
+        """Cancel the download. Awaiting it raises
+        `pyfu_usb.DownloadCancelled`, unless it already finished.
+        """
+        self._cancel.set()
+
+    async def aclose(self) -> None:
+        """Cancel the download, and wait for the worker to abort it and
+        release the device. Errors of the download are discarded.
+        """
+        self.cancel()
+        await asyncio.gather(self._future, return_exceptions=True)
+
+    def done(self) -> bool:
+        """Whether the download finished, also when it failed."""
+        return self._future.done()
+
+    async def _wait(self) -> DownloadResult:
+        """Wait for the download to finish.
+
+        Returns:
+            Metrics of the download.
+
+        Raises:
+            asyncio.CancelledError: Waiting was cancelled, which cancels the
+                download after the device was released.
+        """
+        try:
+            return await asyncio.shield(self._future)
+        except asyncio.CancelledError:
+            await self.aclose()
+            raise
+
+    def __await__(self) -> Generator[Any, None, DownloadResult]:
+        return self._wait().__await__()
+
+    def __aiter__(self) -> AsyncIterator[progress.ProgressUpdate]:
+        return self
+
+    async def __anext__(self) -> progress.ProgressUpdate:
+        update = await self._updates.get()
+        if update is None:
+            # Keep ending later iterations
+            self._updates.put_nowait(None)
+            raise StopAsyncIteration
+        return update
+
+
+def download(
+    filename: image.ImageSource,
+    vid: Optional[int] = None,
+    pid: Optional[int] = None,
+    serial: Optional[str] = None,
+    bus: Optional[int] = None,
+    port_path: Optional[str] = None,
+    min_interval_s: float = progress.DEFAULT_MIN_INTERVAL_S,
+    **options: Any,
+) -> Download:
+    """Start downloading a file to a DFU device on the worker of its
+    location, from a running event loop.
+
+    Args:
+        filename: Image to download, see `pyfu_usb.download`.
+        vid: Vendor ID to narrow the search for DFU devices.
+        pid: Product ID to narrow the search for DFU devices.
+        serial: Serial number to narrow the search for DFU devices.
+        bus: USB bus number to narrow the search for DFU devices.
+        port_path: Location to narrow the search for DFU devices, as bus and
+            port numbers like "1-2.3".
+        min_interval_s: Minimum time between progress updates of a task.
+        options: Other arguments of `pyfu_usb.download`, like `address` or
+            `options`, except `display` and `cancel`.
+
+    Returns:
+        Download, which gives its metrics when awaited and its progress when
+        iterated over.
+
+    Raises:
+        ValueError: Arguments for progress or cancellation were given.
+    """
+    for name in ("display", "cancel"):
+        if name in options:
+            raise ValueError(f"{name} is managed by the download")
+
+    return Download(
+        filename, (vid, pid, serial, bus, port_path), min_interval_s, options
+    )
@@ -0,0 +1,302 @@
+# Copyright 2022 Block, Inc.
+"""Cache parsed DFU descriptors and DfuSe memory layouts by device identity,
+so they are not read from the device again.
+"""
+
+import dataclasses
+import json
+import logging
+import os
+import threading
+from typing import Any, Dict, Iterable, Iterator, List, MutableMapping, Optional
+
+import usb
+
+from . import descriptor
+
+logger = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass(frozen=True)
+class DeviceKey:
+    """Identity of a USB device, which determines its descriptors."""
+
+    # NOTE: Alternate naming convention used to match USB spec
+    idVendor: int
+    idProduct: int
+    bcdDevice: int
+    serial: Optional[str]
+
+    @classmethod
+    def from_device(cls, dev: usb.core.Device) -> "DeviceKey":
+        """Get the identity of a USB device.
+
+        Args:
+            dev: USB device.
+
+        Returns:
+            Device identity. Reading it may request the serial number string
+            descriptor, which pyusb then caches.
+        """
+        vid, pid = descriptor.get_device_ids(dev)
+        return cls(
+            idVendor=vid,
+            idProduct=pid,
+            bcdDevice=dev.bcdDevice,  # ty: ignore[unresolved-attribute]
+            serial=descriptor.get_serial_number(dev),
+        )
+
+    def __str__(self) -> str:
+        return (
+            f"{self.idVendor:04x}:{self.idProduct:04x}:{self.bcdDevice:04x}:"
+            f"{self.serial or ''}"
+        )
+
+
+class DescriptorCache:
+    """Parsed DFU descriptors and DfuSe memory layouts, keyed by device
+    identity, interface and alternate setting.
+
+    The cache is kept in memory and, if a path is given, saved to a JSON file
+    whenever it changes so later processes can use it. Entries are removed by
+    `invalidate`, or by `prune` for devices which are no longer attached.
+    The cache can be shared between threads.
+    """
+
+    def __init__(self, path: Optional[str] = None) -> None:
+        """Create cache, loading the file if it exists.
+
+        Args:
+            path: File to persist the cache in, or None to only keep it in
+                memory.
+        """
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.RLock()
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        if path is not None:
+            self._entries = _load(path)
+
+    def get_dfu_descriptor(
+        self, dev: usb.core.Device
+    ) -> Optional[descriptor.DfuDescriptor]:
+        """Get the DFU descriptor of a device, reading it on a miss.
+
+        Args:
+            dev: USB device.
+
+        Returns:
+            `DfuDescriptor` or None if not found.
+        """
+        key = str(DeviceKey.from_device(dev))
+        with self._lock:
+            cached = self._entries.get(key, {}).get("dfu_descriptor")
+            if cached is not None:
+                self.hits += 1
+                return descriptor.DfuDescriptor(**cached)
+            self.misses += 1
+
+        desc = descriptor.get_dfu_descriptor(dev)
+        if desc is not None:
+            with self._lock:
+                entry = self._entries.setdefault(key, {})
+                entry["dfu_descriptor"] = dataclasses.asdict(desc)
+                self._save()
+        return desc
+
+    def get_memory_layout(
+        self, dev: usb.core.Device, interface: int, alternate_index: int = 0
+    ) -> List[descriptor.DfuSeMemoryLayout]:
+        """Get the DfuSe memory layout of a device, reading it on a miss.
+
+        Args:
+            dev: USB device.
+            interface: USB device interface.
+            alternate_index: USB device alternate index for interface.
+
+        Returns:
+            List of `DfuSeMemoryLayout`, one for each segment in memory.
+        """
+        return self.layouts(dev, interface)[alternate_index]
+
+    def layouts(
+        self, dev: usb.core.Device, interface: int
+    ) -> MutableMapping[int, List[descriptor.DfuSeMemoryLayout]]:
+        """Get the memory layouts of an interface by alternate setting.
+
+        Args:
+            dev: USB device.
+            interface: USB device interface.
+
+        Returns:
+            Mapping which reads layouts from the device on a miss and stores
+            the layouts added to it.
+        """
+        return _InterfaceLayouts(self, dev, interface)
+
+    def invalidate(self, dev: usb.core.Device) -> None:
+        """Remove the entries of a device.
+
+        Args:
+            dev: USB device.
+        """
+        with self._lock:
+            if self._entries.pop(str(DeviceKey.from_device(dev)), None):
+                self._save()
+
+    def prune(self, devices: Iterable[usb.core.Device]) -> None:
+        """Remove the entries of devices which are not attached.
+
+        Args:
+            devices: All attached devices.
+        """
+        attached = {str(DeviceKey.from_device(dev)) for dev in devices}
+        with self._lock:
+            removed = [key for key in self._entries if key not in attached]
+            for key in removed:
+                logger.debug("Removing unplugged device %s from cache", key)
+                del self._entries[key]
+            if removed:
+                self._save()
+
+    def _get_layout(
+        self, key: str, interface: int, alternate_index: int
+    ) -> Optional[List[descriptor.DfuSeMemoryLayout]]:
+        """Look up a memory layout.
+
+        Returns:
+            Memory layout, or None if it is not cached.
+        """
+        with self._lock:
+            layouts = self._entries.get(key, {}).get("layouts", {})
+            cached = layouts.get(f"{interface}/{alternate_index}")
+        if cached is None:
+            return None
+        return [descriptor.DfuSeMemoryLayout(**segment) for segment in cached]
+
+    def _set_layout(
+        self,
+        key: str,
+        interface: int,
+        alternate_index: int,
+        layout: List[descriptor.DfuSeMemoryLayout],
+    ) -> None:
+        """Store a memory layout."""
+        with self._lock:
+            layouts = self._entries.setdefault(key, {}).setdefault(
+                "layouts", {}
+            )
+            layouts[f"{interface}/{alternate_index}"] = [
+                dataclasses.asdict(segment) for segment in layout
+            ]
+            self._save()
+
+    def _delete_layout(
+        self, key: str, interface: int, alternate_index: int
+    ) -> None:
+        """Remove a memory layout, raising KeyError if it is not cached."""
+        with self._lock:
+            layouts = self._entries.get(key, {}).get("layouts", {})
+            del layouts[f"{interface}/{alternate_index}"]
+            self._save()
+
+    def _save(self) -> None:
+        """Write the cache to its file, replacing the file atomically."""
+        if self.path is None:
+            return
+
+        temp_path = f"{self.path}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(temp_path, "w") as fout:
+                json.dump(self._entries, fout)
+            os.replace(temp_path, self.path)
+        except OSError as err:
+            logger.warning("Cannot save descriptor cache: %s", err)
+
+
+class _InterfaceLayouts(
+    MutableMapping[int, List[descriptor.DfuSeMemoryLayout]]
+):
+    """Memory layouts of one interface of a device in a `DescriptorCache`."""
+
+    def __init__(
+        self, cache: DescriptorCache, dev: usb.core.Device, interface: int
+    ) -> None:
+        self._cache = cache
+        self._dev = dev
+        self._interface = interface
+        self._key = str(DeviceKey.from_device(dev))
+
+    def __getitem__(
+        self, alternate_index: int
+    ) -> List[descriptor.DfuSeMemoryLayout]:
+        with self._cache._lock:
+            layout = self._cache._get_layout(
+                self._key, self._interface, alternate_index
+            )
+            if layout is not None:
+                self._cache.hits += 1
+            else:
+                self._cache.misses += 1
+        if layout is None:
+            layout = descriptor.get_memory_layout(
+                self._dev, self._interface, alternate_index=alternate_index
+            )
+            # An empty layout means the string descriptor could not be read
+            if layout:
+                self[alternate_index] = layout
+        return layout
+
+    def __contains__(self, alternate_index: object) -> bool:
+        return isinstance(alternate_index, int) and (
+            self._cache._get_layout(self._key, self._interface, alternate_index)
+            is not None
+        )
+
+    def __setitem__(
+        self, alternate_index: int, layout: List[descriptor.DfuSeMemoryLayout]
+    ) -> None:
+        self._cache._set_layout(
+            self._key, self._interface, alternate_index, layout
+        )
+
+    def __delitem__(self, alternate_index: int) -> None:
+        self._cache._delete_layout(self._key, self._interface, alternate_index)
+
+    def __iter__(self) -> Iterator[int]:
+        prefix = f"{self._interface}/"
+        with self._cache._lock:
+            layouts = self._cache._entries.get(self._key, {}).get("layouts", {})
+            names = list(layouts)
+        return iter(
+            int(n[len(prefix) :]) for n in names if n.startswith(prefix)
+        )
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+
+def _load(path: str) -> Dict[str, Dict[str, Any]]:
+    """Load a cache file.
+
+    Args:
+        path: Cache file.
+
+    Returns:
+        Entries by device key, empty if the file does not exist or is invalid.
+    """
+    try:
+        with open(path) as fin:
+            entries = json.load(fin)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as err:
+        logger.warning("Ignoring invalid descriptor cache %s: %s", path, err)
+        return {}
+
+    if not isinstance(entries, dict):
+        logger.warning("Ignoring invalid descriptor cache %s", path)
+        return {}
+    return entries
@@ -0,0 +1,137 @@
+# Copyright 2022 Block, Inc.
+"""Record the progress of DfuSe downloads so they can be resumed."""
+
+import dataclasses
+import json
+import logging
+import os
+from typing import Optional, TextIO
+
+logger = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass
+class Checkpoint:
+    """Progress of a DfuSe download."""
+
+    # Download which the progress belongs to
+    device: str
+    image_sha256: str
+    address: int
+    xfer_size: int
+    sparse: bool
+
+    # Address after the last page which was erased (or skipped)
+    erased_end: int = 0
+
+    # Offset in the image after the last block the device confirmed
+    written_end: int = 0
+
+    def matches(self, other: "Checkpoint") -> bool:
+        """Check if another checkpoint belongs to the same download.
+
+        Args:
+            other: Checkpoint to compare with.
+
+        Returns:
+            True if the device, image and download options are the same.
+        """
+        return (
+            self.device == other.device
+            and self.image_sha256 == other.image_sha256
+            and self.address == other.address
+            and self.xfer_size == other.xfer_size
+            and self.sparse == other.sparse
+        )
+
+
+def _load(path: str) -> Optional[Checkpoint]:
+    """Load a checkpoint from a file.
+
+    Args:
+        path: Checkpoint file.
+
+    Returns:
+        Checkpoint, or None if the file does not exist or is invalid.
+    """
+    try:
+        with open(path) as fin:
+            return Checkpoint(**json.load(fin))
+    except FileNotFoundError:
+        return None
+    except (OSError, TypeError, ValueError) as err:
+        logger.warning("Ignoring invalid checkpoint %s: %s", path, err)
+        return None
+
+
+class Checkpointer:
+    """Keep a checkpoint file up to date while downloading.
+
+    The file is rewritten in place after every confirmed block, without
+    syncing it to disk, so it survives the process being interrupted but adds
+    little time per block.
+    """
+
+    def __init__(self, path: str, checkpoint: Checkpoint) -> None:
+        """Load the checkpoint for a download, if the file holds one.
+
+        Args:
+            path: Checkpoint file.
+            checkpoint: Checkpoint for the download starting from scratch.
+        """
+        self.path = path
+        self.state = checkpoint
+        self._file: Optional[TextIO] = None
+
+        stored = _load(path)
+        if stored is not None and stored.matches(checkpoint):
+            logger.info(
+                "Resuming download from checkpoint, %d bytes already written",
+                stored.written_end,
+            )
+            self.state = stored
+        elif stored is not None:
+            logger.info("Checkpoint is for a different download, ignoring it")
+
+    def erased(self, end: int) -> None:
+        """Record that the pages before an address were erased.
+
+        Args:
+            end: Address after the last erased page.
+        """
+        self.state.erased_end = end
+        self._save()
+
+    def written(self, end: int) -> None:
+        """Record that the image was written up to an offset.
+
+        Args:
+            end: Offset in the image after the last confirmed block.
+        """
+        self.state.written_end = end
+        self._save()
+
+    def _save(self) -> None:
+        """Write the checkpoint to the file."""
+        if self._file is None:
+            self._file = open(self.path, "w")
+        self._file.seek(0)
+        self._file.truncate()
+        json.dump(dataclasses.asdict(self.state), self._file)
+        self._file.flush()
+
+    def close(self) -> None:
+        """Close the checkpoint file, keeping it so the download can be
+        resumed.
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def finish(self) -> None:
+        """Remove the checkpoint file once the download completed."""
+        self.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
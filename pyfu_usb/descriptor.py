@@ -4,15 +4,30 @@
 import dataclasses
 import logging
 import re
-from typing import List, Optional
+from typing import List, Optional, Tuple
 
 import usb
 
 logger = logging.getLogger(__name__)
 
+# Page group in a DfuSe memory layout string, e.g. "04*016Kg"
+_SEGMENT_RE = re.compile(r"(\d+)\*(\d+)(.)(.)")
+
 _DFU_DESCRIPTOR_LEN = 9
 _DFU_DESCRIPTOR_ID = 0x21
 
+# DFU interface class, subclass and protocols
+DFU_INTERFACE_CLASS = 0xFE
+DFU_INTERFACE_SUBCLASS = 0x01
+DFU_PROTOCOL_RUNTIME = 0x01
+DFU_PROTOCOL_DFU = 0x02
+
+# DFU descriptor bmAttributes bits
+DFU_ATTR_CAN_DOWNLOAD = 0x01
+DFU_ATTR_CAN_UPLOAD = 0x02
+DFU_ATTR_MANIFESTATION_TOLERANT = 0x04
+DFU_ATTR_WILL_DETACH = 0x08
+
 
 @dataclasses.dataclass
 class DfuDescriptor:
@@ -64,6 +79,75 @@ def get_dfu_descriptor(dev: usb.core.Device) -> Optional[DfuDescriptor]:
     return None
 
 
+def get_serial_number(dev: usb.core.Device) -> Optional[str]:
+    """Get the serial number of a USB device.
+
+    Args:
+        dev: USB device.
+
+    Returns:
+        Serial number or None if the device has none or it cannot be read.
+    """
+    try:
+        return dev.serial_number
+    except (usb.core.USBError, ValueError, NotImplementedError) as err:
+        logger.debug("Cannot read serial number: %s", err)
+        return None
+
+
+def get_device_ids(dev: usb.core.Device) -> Tuple[int, int]:
+    """Get the vendor and product ID of a USB device. pyusb sets them from the
+    device descriptor at runtime, which type checkers cannot see.
+
+    Args:
+        dev: USB device.
+
+    Returns:
+        Vendor ID and product ID.
+    """
+    return (
+        dev.idVendor,  # ty: ignore[unresolved-attribute]
+        dev.idProduct,  # ty: ignore[unresolved-attribute]
+    )
+
+
+def get_port_path(dev: usb.core.Device) -> str:
+    """Get the physical location of a USB device, e.g. "1-2.3" for port 3 of a
+    hub on port 2 of bus 1.
+
+    Args:
+        dev: USB device.
+
+    Returns:
+        Bus number and port numbers, or bus number and device address if the
+        backend cannot provide port numbers.
+    """
+    ports = getattr(dev, "port_numbers", None)
+    if not ports:
+        return f"{dev.bus}-@{dev.address}"
+    return f"{dev.bus}-{'.'.join(str(port) for port in ports)}"
+
+
+def get_runtime_interface(dev: usb.core.Device) -> Optional[int]:
+    """Find the DFU interface of a USB device in runtime mode.
+
+    Args:
+        dev: USB device.
+
+    Returns:
+        Interface number, or None if the device has no runtime DFU interface.
+    """
+    for cfg in dev:
+        for intf in cfg:
+            if (
+                intf.bInterfaceClass == DFU_INTERFACE_CLASS
+                and intf.bInterfaceSubClass == DFU_INTERFACE_SUBCLASS
+                and intf.bInterfaceProtocol == DFU_PROTOCOL_RUNTIME
+            ):
+                return intf.bInterfaceNumber
+    return None
+
+
 def get_memory_layout(
     device: usb.core.Device,
     interface: int,
@@ -83,19 +167,31 @@ def get_memory_layout(
     # devices rarely have more than one configuration.
     intf = device[0][(interface, alternate_index)]
     try:
-        mem_layout_str = usb.util.get_string(device, intf.iInterface).split("/")
+        mem_layout_str = usb.util.get_string(device, intf.iInterface)
     except usb.core.USBError:
         logger.warning("Failed to get string descriptor, not a DfuSe device?")
         return []
 
-    # Parse memory layout string
+    return parse_memory_layout(mem_layout_str)
+
+
+def parse_memory_layout(layout: str) -> List[DfuSeMemoryLayout]:
+    """Parse a DfuSe memory layout string, like
+    "@Internal Flash  /0x08000000/04*016Kg,01*064Kg,07*128Kg".
+
+    Args:
+        layout: Memory layout string from the interface string descriptor.
+
+    Returns:
+        List of `DfuSeMemoryLayout`, one for each "segment" in device memory.
+    """
+    mem_layout_str = layout.split("/")
     addr = int(mem_layout_str[1], 0)
     segments = mem_layout_str[2].split(",")
-    seg_re = re.compile(r"(\d+)\*(\d+)(.)(.)")
 
     mem_layout = []
     for segment in segments:
-        seg_match = seg_re.match(segment)
+        seg_match = _SEGMENT_RE.match(segment)
         assert seg_match is not None
 
         num_pages = int(seg_match.groups()[0], 10)
@@ -1,23 +1,53 @@
 # Copyright 2022 Block, Inc.
 """Minimal DFU protocol implementation."""
 
+import dataclasses
 import logging
-from typing import Optional
+import time
+from typing import Generator, Optional, Union
 
 import usb
 
+from .image import Buffer
+from .transport import ClaimableTransport, Transport
+
 # Default USB request timeout
 _TIMEOUT_MS = 5000
 
 # DFU states
 _DFU_STATE_DFU_IDLE = 0x02
+_DFU_STATE_DFU_DOWNLOAD_SYNC = 0x03
+_DFU_STATE_DFU_DOWNLOAD_BUSY = 0x04
 _DFU_STATE_DFU_DOWNLOAD_IDLE = 0x05
+_DFU_STATE_DFU_MANIFEST_SYNC = 0x06
+_DFU_STATE_DFU_MANIFEST = 0x07
+_DFU_STATE_DFU_MANIFEST_WAIT_RESET = 0x08
+_DFU_STATE_DFU_UPLOAD_IDLE = 0x09
 _DFU_STATE_DFU_ERROR = 0x0A
 
+# States in which the device is still processing a request and must be polled
+# again after waiting bwPollTimeout
+_DFU_BUSY_STATES = (
+    _DFU_STATE_DFU_DOWNLOAD_SYNC,
+    _DFU_STATE_DFU_DOWNLOAD_BUSY,
+    _DFU_STATE_DFU_MANIFEST_SYNC,
+    _DFU_STATE_DFU_MANIFEST,
+)
+
+# States in which the device is ready for the next request
+_DFU_IDLE_STATES = (
+    _DFU_STATE_DFU_IDLE,
+    _DFU_STATE_DFU_DOWNLOAD_IDLE,
+)
+
 # DFU commands
+_DFU_CMD_DETACH = 0
 _DFU_CMD_DOWNLOAD = 1
+_DFU_CMD_UPLOAD = 2
 _DFU_CMD_GETSTATUS = 3
 _DFU_CMD_CLRSTATUS = 4
+_DFU_CMD_GETSTATE = 5
+_DFU_CMD_ABORT = 6
 _DFU_STATE_LEN = 6
 
 # USB request types
@@ -27,10 +57,21 @@ _USB_REQUEST_TYPE_RECV = 0xA1
 logger = logging.getLogger(__name__)
 
 
-def get_state(
-    dev: usb.core.Device, interface: int, timeout_ms: int = _TIMEOUT_MS
-) -> int:
-    """Get device state.
+@dataclasses.dataclass
+class DfuStatus:
+    """Response to a DFU_GETSTATUS request."""
+
+    # NOTE: Alternate naming convention used to match DFU spec
+    bStatus: int
+    bwPollTimeout: int
+    bState: int
+    iString: int
+
+
+def get_status(
+    dev: Transport, interface: int, timeout_ms: int = _TIMEOUT_MS
+) -> DfuStatus:
+    """Get device status.
 
     Args:
         dev: USB device.
@@ -38,10 +79,7 @@ def get_state(
         timeout_ms: Timeout in milliseconds for USB control transfer.
 
     Returns:
-        Device state code.
-
-    Raises:
-        RuntimeError: Device returned error state.
+        `DfuStatus` parsed from the GETSTATUS response.
     """
     status = dev.ctrl_transfer(
         bmRequestType=_USB_REQUEST_TYPE_RECV,
@@ -52,7 +90,31 @@ def get_state(
         timeout=timeout_ms,
     )
 
-    state: int = status[4]
+    return DfuStatus(
+        bStatus=status[0],
+        bwPollTimeout=status[3] << 16 | status[2] << 8 | status[1],
+        bState=status[4],
+        iString=status[5],
+    )
+
+
+def get_state(
+    dev: Transport, interface: int, timeout_ms: int = _TIMEOUT_MS
+) -> int:
+    """Get device state.
+
+    Args:
+        dev: USB device.
+        interface: USB device interface.
+        timeout_ms: Timeout in milliseconds for USB control transfer.
+
+    Returns:
+        Device state code.
+
+    Raises:
+        RuntimeError: Device returned error state.
+    """
+    state = get_status(dev, interface, timeout_ms=timeout_ms).bState
 
     if state == _DFU_STATE_DFU_ERROR:
         raise RuntimeError("Target device error")
@@ -60,8 +122,65 @@ def get_state(
     return state
 
 
+def wait_for_idle(
+    dev: Transport,
+    interface: int,
+    timeout_ms: int = _TIMEOUT_MS,
+    deadline_ms: Optional[int] = None,
+) -> int:
+    """Poll device status until it is ready for the next request, sleeping for
+    the bwPollTimeout requested by the device between polls.
+
+    Args:
+        dev: USB device.
+        interface: USB device interface.
+        timeout_ms: Timeout in milliseconds for USB control transfer.
+        deadline_ms: Overall time limit in milliseconds for the device to
+            become ready, or None to wait indefinitely.
+
+    Returns:
+        Number of GETSTATUS requests issued.
+
+    Raises:
+        RuntimeError: Device returned error state, an unexpected state, or did
+            not become ready before the deadline.
+    """
+    start = time.monotonic()
+    polls = 0
+    while True:
+        status = get_status(dev, interface, timeout_ms=timeout_ms)
+        polls += 1
+
+        if status.bState in _DFU_IDLE_STATES:
+            return polls
+
+        # Device will not respond again until it is reset
+        if status.bState == _DFU_STATE_DFU_MANIFEST_WAIT_RESET:
+            return polls
+
+        if status.bState == _DFU_STATE_DFU_ERROR:
+            raise RuntimeError(
+                f"Target device error (bStatus: 0x{status.bStatus:02X})"
+            )
+
+        if status.bState not in _DFU_BUSY_STATES:
+            raise RuntimeError(
+                f"Unexpected DFU state while waiting: 0x{status.bState:02X}"
+            )
+
+        if deadline_ms is not None:
+            elapsed_ms = (time.monotonic() - start) * 1000
+            if elapsed_ms + status.bwPollTimeout > deadline_ms:
+                raise RuntimeError(
+                    f"Device still busy after {elapsed_ms:.0f} ms "
+                    f"({polls} polls)"
+                )
+
+        time.sleep(status.bwPollTimeout / 1000)
+
+
 def clear_status(
-    dev: usb.core.Device, interface: int, timeout_ms: int = _TIMEOUT_MS
+    dev: Transport, interface: int, timeout_ms: int = _TIMEOUT_MS
 ) -> None:
     """Wait for idle state and then clear device status.
 
@@ -80,13 +199,43 @@ def clear_status(
     )
 
 
+def recover(
+    dev: Transport, interface: int, timeout_ms: int = _TIMEOUT_MS
+) -> int:
+    """Return the device to the idle state after a failed request. Errors are
+    cleared with CLRSTATUS and transfers in progress are ended with ABORT.
+
+    Args:
+        dev: USB device.
+        interface: USB device interface.
+        timeout_ms: Timeout in milliseconds for USB control transfer.
+
+    Returns:
+        Device state code before recovering.
+    """
+    status = get_status(dev, interface, timeout_ms=timeout_ms)
+    while status.bState in _DFU_BUSY_STATES:
+        time.sleep(status.bwPollTimeout / 1000)
+        status = get_status(dev, interface, timeout_ms=timeout_ms)
+
+    if status.bState == _DFU_STATE_DFU_ERROR:
+        logger.debug("Clearing error status 0x%02X", status.bStatus)
+        clear_status(dev, interface, timeout_ms=timeout_ms)
+    elif status.bState != _DFU_STATE_DFU_IDLE:
+        logger.debug("Aborting from state 0x%02X", status.bState)
+        abort(dev, interface, timeout_ms=timeout_ms)
+
+    return status.bState
+
+
 def download(
-    dev: usb.core.Device,
+    dev: Transport,
     interface: int,
     transaction: int,
-    data: Optional[bytes],
+    data: Optional[Buffer],
     timeout_ms: int = _TIMEOUT_MS,
-) -> None:
+    deadline_ms: Optional[int] = None,
+) -> int:
     """Download data.
 
     Args:
@@ -95,6 +244,11 @@ def download(
         transaction: Transaction counter.
         data: Data to download or None to indicate end of download.
         timeout_ms: Timeout in milliseconds for USB control transfer.
+        deadline_ms: Overall time limit in milliseconds for the device to
+            finish processing the download, or None to wait indefinitely.
+
+    Returns:
+        Number of GETSTATUS requests issued while waiting for the device.
     """
     # Send data
     dev.ctrl_transfer(
@@ -107,29 +261,148 @@ def download(
     )
 
     # Wait for download to process
-    while get_state(dev, interface, timeout_ms=timeout_ms) not in [
-        _DFU_STATE_DFU_IDLE,
-        _DFU_STATE_DFU_DOWNLOAD_IDLE,
-    ]:
-        pass
+    return wait_for_idle(
+        dev, interface, timeout_ms=timeout_ms, deadline_ms=deadline_ms
+    )
 
 
-def claim_interface(dev: usb.core.Device, interface: int) -> None:
-    """Claim DFU interface for USB device.
+def upload(
+    dev: Transport,
+    interface: int,
+    transaction: int,
+    length: int,
+    timeout_ms: int = _TIMEOUT_MS,
+) -> bytes:
+    """Upload data.
+
+    Args:
+        dev: USB device.
+        interface: USB device interface.
+        transaction: Transaction counter.
+        length: Maximum number of bytes to upload.
+        timeout_ms: Timeout in milliseconds for USB control transfer.
+
+    Returns:
+        Data uploaded from the device. A block shorter than `length` indicates
+        the end of the upload.
+    """
+    data = dev.ctrl_transfer(
+        bmRequestType=_USB_REQUEST_TYPE_RECV,
+        bRequest=_DFU_CMD_UPLOAD,
+        wValue=transaction,
+        wIndex=interface,
+        data_or_wLength=length,
+        timeout=timeout_ms,
+    )
+    return bytes(data)
+
+
+def read_firmware(
+    dev: Transport,
+    interface: int,
+    length: int,
+    xfer_size: int,
+) -> Generator[bytes, None, None]:
+    """Read firmware from the start with UPLOAD requests, one block at a time.
+    The device is returned to the idle state when the iterator is exhausted or
+    closed.
+
+    Args:
+        dev: USB device.
+        interface: USB device interface.
+        length: Maximum number of bytes to read.
+        xfer_size: Transfer size to use when uploading.
+
+    Yields:
+        Blocks of firmware. Fewer than `length` bytes are yielded in total if
+        the device ends the upload early.
+    """
+    transaction = 0
+    offset = 0
+    try:
+        while offset < length:
+            block = upload(dev, interface, transaction, xfer_size)
+            yield block[: length - offset]
+
+            offset += len(block)
+            transaction += 1
+            if len(block) < xfer_size:
+                break
+    finally:
+        if transaction:
+            abort(dev, interface)
+
+
+def detach(
+    dev: Transport,
+    interface: int,
+    detach_timeout_ms: int,
+    timeout_ms: int = _TIMEOUT_MS,
+) -> None:
+    """Request a device in runtime mode to detach and re-enumerate in DFU mode.
+
+    Args:
+        dev: USB device.
+        interface: USB device runtime DFU interface.
+        detach_timeout_ms: Time in milliseconds the device waits for a USB
+            reset before giving up, at most wDetachTimeOut.
+        timeout_ms: Timeout in milliseconds for USB control transfer.
+    """
+    dev.ctrl_transfer(
+        bmRequestType=_USB_REQUEST_TYPE_SEND,
+        bRequest=_DFU_CMD_DETACH,
+        wValue=detach_timeout_ms,
+        wIndex=interface,
+        data_or_wLength=None,
+        timeout=timeout_ms,
+    )
+
+
+def abort(
+    dev: Transport, interface: int, timeout_ms: int = _TIMEOUT_MS
+) -> None:
+    """Abort the current transfer and return the device to the idle state.
 
     Args:
         dev: USB device.
         interface: USB device interface.
+        timeout_ms: Timeout in milliseconds for USB control transfer.
+    """
+    dev.ctrl_transfer(
+        bmRequestType=_USB_REQUEST_TYPE_SEND,
+        bRequest=_DFU_CMD_ABORT,
+        wValue=0,
+        wIndex=interface,
+        data_or_wLength=None,
+        timeout=timeout_ms,
+    )
+
+
+def claim_interface(
+    dev: Union[usb.core.Device, ClaimableTransport], interface: int
+) -> None:
+    """Claim DFU interface for USB device.
+
+    Args:
+        dev: USB device, or a transport which claims its own interface.
+        interface: USB device interface.
     """
     logger.info("Claiming USB DFU interface %d", interface)
-    usb.util.claim_interface(dev, interface)
+    if isinstance(dev, ClaimableTransport):
+        dev.claim_interface(interface)
+    else:
+        usb.util.claim_interface(dev, interface)
 
 
-def release_interface(dev: usb.core.Device) -> None:
+def release_interface(dev: Union[usb.core.Device, ClaimableTransport]) -> None:
     """Release DFU interface for USB device.
 
     Args:
-        dev: USB device in DFU mode.
+        dev: USB device in DFU mode, or a transport which claims its own
+            interface.
     """
     logger.info("Releasing USB DFU interface")
-    usb.util.dispose_resources(dev)
+    if isinstance(dev, ClaimableTransport):
+        dev.release_interface()
+    else:
+        usb.util.dispose_resources(dev)
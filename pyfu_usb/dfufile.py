@@ -0,0 +1,259 @@
+# Copyright 2022 Block, Inc.
+"""Parse DFU files: the DFU suffix and the DfuSe container format."""
+
+import dataclasses
+import logging
+import struct
+import zlib
+from typing import List, Optional
+
+from .image import Buffer
+
+logger = logging.getLogger(__name__)
+
+# DFU suffix: bcdDevice, idProduct, idVendor, bcdDFU, ucDfuSignature, bLength,
+# dwCRC
+_SUFFIX_FORMAT = "<HHHH3sBI"
+_SUFFIX_LEN = struct.calcsize(_SUFFIX_FORMAT)
+_SUFFIX_SIGNATURE = b"UFD"
+
+# DfuSe prefix: szSignature, bVersion, DFUImageSize, bTargets
+_DFUSE_PREFIX_FORMAT = "<5sBIB"
+_DFUSE_PREFIX_LEN = struct.calcsize(_DFUSE_PREFIX_FORMAT)
+_DFUSE_SIGNATURE = b"DfuSe"
+_DFUSE_VERSION = 0x01
+
+# Target prefix: szSignature, bAlternateSetting, bTargetNamed, szTargetName,
+# dwTargetSize, dwNbElements
+_TARGET_PREFIX_FORMAT = "<6sBI255sII"
+_TARGET_PREFIX_LEN = struct.calcsize(_TARGET_PREFIX_FORMAT)
+_TARGET_SIGNATURE = b"Target"
+
+# Element: dwElementAddress, dwElementSize
+_ELEMENT_FORMAT = "<II"
+_ELEMENT_LEN = struct.calcsize(_ELEMENT_FORMAT)
+
+# Wildcard for VID, PID and bcdDevice in the suffix
+SUFFIX_ANY = 0xFFFF
+
+
+@dataclasses.dataclass
+class DfuSuffix:
+    """DFU file suffix."""
+
+    # NOTE: Alternate naming convention used to match DFU spec
+    bcdDevice: int
+    idProduct: int
+    idVendor: int
+    bcdDFU: int
+    dwCRC: int
+
+
+@dataclasses.dataclass
+class DfuSeElement:
+    """Image element to write to one address."""
+
+    address: int
+    data: memoryview
+
+
+@dataclasses.dataclass
+class DfuSeTarget:
+    """Image for one alternate setting of the DFU interface."""
+
+    alternate_setting: int
+    name: str
+    elements: List[DfuSeElement]
+
+
+@dataclasses.dataclass
+class DfuFile:
+    """Firmware image with a DFU suffix."""
+
+    suffix: DfuSuffix
+
+    # File contents without the suffix
+    payload: memoryview
+
+    # Targets if the payload is a DfuSe container, otherwise empty
+    targets: List[DfuSeTarget]
+
+
+def _crc32(data: Buffer) -> int:
+    """Calculate the CRC32 used in the DFU suffix, which has no final XOR.
+
+    Args:
+        data: Binary data.
+
+    Returns:
+        CRC32 of data.
+    """
+    return zlib.crc32(data) ^ 0xFFFFFFFF
+
+
+def parse_suffix(data: Buffer) -> Optional[DfuSuffix]:
+    """Parse and validate the DFU suffix at the end of a file.
+
+    Args:
+        data: File contents.
+
+    Returns:
+        DFU suffix, or None if the file does not end with one.
+
+    Raises:
+        ValueError: CRC32 does not match the file.
+    """
+    view = memoryview(data).cast("B")
+    if len(view) < _SUFFIX_LEN:
+        return None
+
+    (
+        bcd_device,
+        product_id,
+        vendor_id,
+        bcd_dfu,
+        signature,
+        length,
+        crc,
+    ) = struct.unpack(_SUFFIX_FORMAT, view[-_SUFFIX_LEN:])
+    if signature != _SUFFIX_SIGNATURE or length != _SUFFIX_LEN:
+        return None
+
+    # One pass over the file, which is not copied
+    actual_crc = _crc32(view[:-4])
+    if actual_crc != crc:
+        raise ValueError(
+            f"DFU suffix CRC32 0x{crc:08X} does not match file "
+            f"(0x{actual_crc:08X})"
+        )
+
+    return DfuSuffix(
+        bcdDevice=bcd_device,
+        idProduct=product_id,
+        idVendor=vendor_id,
+        bcdDFU=bcd_dfu,
+        dwCRC=crc,
+    )
+
+
+def parse_dfuse(data: Buffer) -> List[DfuSeTarget]:
+    """Parse a DfuSe container. Element data are views into `data`.
+
+    Args:
+        data: DfuSe container, without the DFU suffix.
+
+    Returns:
+        Targets in the order they appear in the container.
+
+    Raises:
+        ValueError: Data is not a valid DfuSe container.
+    """
+    view = memoryview(data).cast("B")
+    if len(view) < _DFUSE_PREFIX_LEN:
+        raise ValueError("DfuSe prefix truncated")
+
+    signature, version, image_size, num_targets = struct.unpack(
+        _DFUSE_PREFIX_FORMAT, view[:_DFUSE_PREFIX_LEN]
+    )
+    if signature != _DFUSE_SIGNATURE or version != _DFUSE_VERSION:
+        raise ValueError("Invalid DfuSe prefix")
+    if image_size != len(view):
+        raise ValueError(
+            f"DfuSe image size {image_size} does not match file ({len(view)})"
+        )
+
+    targets = []
+    offset = _DFUSE_PREFIX_LEN
+    for _ in range(num_targets):
+        if offset + _TARGET_PREFIX_LEN > len(view):
+            raise ValueError("DfuSe target prefix truncated")
+        (
+            signature,
+            alternate_setting,
+            named,
+            name,
+            target_size,
+            num_elements,
+        ) = struct.unpack(
+            _TARGET_PREFIX_FORMAT, view[offset : offset + _TARGET_PREFIX_LEN]
+        )
+        if signature != _TARGET_SIGNATURE:
+            raise ValueError(f"Invalid DfuSe target prefix at {offset}")
+        offset += _TARGET_PREFIX_LEN
+        target_end = offset + target_size
+        if target_end > len(view):
+            raise ValueError("DfuSe target truncated")
+
+        elements = []
+        for _ in range(num_elements):
+            if offset + _ELEMENT_LEN > target_end:
+                raise ValueError("DfuSe element truncated")
+            address, size = struct.unpack(
+                _ELEMENT_FORMAT, view[offset : offset + _ELEMENT_LEN]
+            )
+            offset += _ELEMENT_LEN
+            if offset + size > target_end:
+                raise ValueError("DfuSe element truncated")
+            elements.append(
+                DfuSeElement(address=address, data=view[offset : offset + size])
+            )
+            offset += size
+
+        target = DfuSeTarget(
+            alternate_setting=alternate_setting,
+            name=name.split(b"\0", 1)[0].decode(errors="replace")
+            if named
+            else "",
+            elements=elements,
+        )
+        logger.debug(
+            "DfuSe target %d '%s' with %d elements",
+            target.alternate_setting,
+            target.name,
+            len(target.elements),
+        )
+        targets.append(target)
+        offset = target_end
+
+    return targets
+
+
+def parse(data: Buffer) -> Optional[DfuFile]:
+    """Parse a file with a DFU suffix, and the DfuSe container it holds if
+    any.
+
+    Args:
+        data: File contents.
+
+    Returns:
+        Parsed file, or None if the file has no DFU suffix.
+
+    Raises:
+        ValueError: Suffix CRC32 does not match or DfuSe container is invalid.
+    """
+    suffix = parse_suffix(data)
+    if suffix is None:
+        return None
+
+    payload = memoryview(data).cast("B")[:-_SUFFIX_LEN]
+    targets = []
+    if payload[: len(_DFUSE_SIGNATURE)] == _DFUSE_SIGNATURE:
+        targets = parse_dfuse(payload)
+    return DfuFile(suffix=suffix, payload=payload, targets=targets)
+
+
+def matches_device(suffix: DfuSuffix, vid: int, pid: int) -> bool:
+    """Check if a DFU file is meant for a device.
+
+    Args:
+        suffix: DFU suffix of file.
+        vid: VID of device.
+        pid: PID of device.
+
+    Returns:
+        True if the VID and PID in the suffix match or are wildcards.
+    """
+    return suffix.idVendor in (SUFFIX_ANY, vid) and suffix.idProduct in (
+        SUFFIX_ANY,
+        pid,
+    )
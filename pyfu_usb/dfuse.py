@@ -3,10 +3,10 @@
 
 import logging
 import struct
+from typing import Generator
 
-import usb
-
-from .dfu import download
+from .dfu import abort, download, upload
+from .transport import Transport
 
 logger = logging.getLogger(__name__)
 
@@ -15,24 +15,106 @@ _DFUSE_CMD_ERASE = 0x41
 
 DFUSE_VERSION_NUMBER = 0x11A
 
+# Data blocks are written to: address + (wBlockNum - 2) * wTransferSize, where
+# address was given by the last SET_ADDRESS command. Block numbers 0 and 1 are
+# reserved for commands and upload of the command set.
+DFUSE_FIRST_BLOCK_NUM = 2
+DFUSE_LAST_BLOCK_NUM = 0xFFFF
+
 
-def set_address(dev: usb.core.Device, interface: int, address: int) -> None:
+def set_address(dev: Transport, interface: int, address: int) -> int:
     """Sets the address for the next operation.
 
     Args:
         dev: USB device.
         interface: USB device interface.
         address: Device address.
+
+    Returns:
+        Number of GETSTATUS requests issued while waiting for the device.
     """
-    download(dev, interface, 0, struct.pack("<BI", _DFUSE_CMD_ADDR, address))
+    return download(
+        dev, interface, 0, struct.pack("<BI", _DFUSE_CMD_ADDR, address)
+    )
 
 
-def page_erase(dev: usb.core.Device, interface: int, address: int) -> None:
+def page_erase(dev: Transport, interface: int, address: int) -> int:
     """Erases a single page of device memory.
 
     Args:
         dev: USB device.
         interface: USB device interface.
         address: Address of page in device memory.
+
+    Returns:
+        Number of GETSTATUS requests issued while waiting for the erase.
+    """
+    return download(
+        dev, interface, 0, struct.pack("<BI", _DFUSE_CMD_ERASE, address)
+    )
+
+
+def mass_erase(dev: Transport, interface: int) -> int:
+    """Erases all device memory which can be erased.
+
+    Args:
+        dev: USB device.
+        interface: USB device interface.
+
+    Returns:
+        Number of GETSTATUS requests issued while waiting for the erase.
     """
-    download(dev, interface, 0, struct.pack("<BI", _DFUSE_CMD_ERASE, address))
+    return download(dev, interface, 0, struct.pack("<B", _DFUSE_CMD_ERASE))
+
+
+def read_memory(
+    dev: Transport,
+    interface: int,
+    address: int,
+    length: int,
+    xfer_size: int,
+) -> Generator[bytes, None, None]:
+    """Read device memory with UPLOAD requests, one block at a time. The device
+    is returned to the idle state when the iterator is exhausted or closed.
+
+    Args:
+        dev: USB device.
+        interface: USB device interface.
+        address: Address of first byte to read in device memory.
+        length: Number of bytes to read.
+        xfer_size: Transfer size to use when uploading.
+
+    Yields:
+        Blocks of device memory, each `xfer_size` bytes except the last.
+
+    Raises:
+        RuntimeError: Device returned less data than requested.
+    """
+    offset = 0
+    block_num = DFUSE_LAST_BLOCK_NUM + 1
+    started = False
+    try:
+        while offset < length:
+            if block_num > DFUSE_LAST_BLOCK_NUM:
+                # Upload is only allowed from the idle state
+                started = True
+                abort(dev, interface)
+                set_address(dev, interface, address + offset)
+                abort(dev, interface)
+                block_num = DFUSE_FIRST_BLOCK_NUM
+
+            size = min(xfer_size, length - offset)
+            block = upload(dev, interface, block_num, size)
+            if len(block) != size:
+                raise RuntimeError(
+                    f"Short upload at 0x{address + offset:X}: {len(block)} "
+                    f"of {size} bytes"
+                )
+
+            yield block
+
+            offset += size
+            block_num += 1
+    finally:
+        if started:
+            abort(dev, interface)
@@ -0,0 +1,836 @@
+# Copyright 2022 Block, Inc.
+"""Download an image to a DFU device whose interface is claimed, shared by
+`pyfu_usb.download` and `pyfu_usb.DfuSession`.
+"""
+
+import dataclasses
+import hashlib
+import logging
+import time
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Dict,
+    List,
+    MutableMapping,
+    Optional,
+    Tuple,
+    Union,
+)
+
+import usb
+
+from . import (
+    checkpoint,
+    descriptor,
+    dfu,
+    dfufile,
+    dfuse,
+    image,
+    plan,
+    progress,
+    writer,
+)
+from .options import DownloadOptions
+from .verify import check_can_verify, verify_firmware, verify_segments
+
+if TYPE_CHECKING:
+    from . import metrics
+
+logger = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass
+class PhaseTimes:
+    """Time spent in each phase of a download, in seconds. Erasing is only
+    counted once when it is interleaved with writing.
+    """
+
+    discovery: float = 0.0
+    claim: float = 0.0
+    descriptor: float = 0.0
+    erase: float = 0.0
+    write: float = 0.0
+    verify: float = 0.0
+    manifest: float = 0.0
+
+
+@dataclasses.dataclass
+class DownloadResult:
+    """Metrics of a download to a DFU device."""
+
+    phases: PhaseTimes = dataclasses.field(default_factory=PhaseTimes)
+    # Total duration, in seconds
+    duration: float = 0.0
+    # Data sent in control transfers, including DfuSe commands
+    bytes_sent: int = 0
+    transfers: int = 0
+    polls: int = 0
+    # Blocks and downloads sent again after a USB error
+    retries: int = 0
+    # Latency by request name, see `trace.request_name`
+    latency: Dict[str, "metrics.LatencyHistogram"] = dataclasses.field(
+        default_factory=dict
+    )
+    # Error the download failed with, if any
+    error: Optional[Exception] = None
+
+    @property
+    def throughput(self) -> float:
+        """Effective throughput over the whole download, in bytes/s."""
+        return self.bytes_sent / self.duration if self.duration else 0.0
+
+    def add_transfers(self, recorder: "metrics.MetricsRecorder") -> None:
+        """Add the transfers counted by a metrics recorder.
+
+        Args:
+            recorder: Recorder which wrapped the device.
+        """
+        self.bytes_sent += recorder.bytes_sent
+        self.transfers += recorder.transfers
+        self.polls += recorder.polls
+        self.latency.update(recorder.latency)
+
+    def to_json(self) -> Dict[str, Any]:
+        """Convert to a JSON object.
+
+        Returns:
+            JSON object, with latency histogram buckets in the order of
+            `metrics.LATENCY_BUCKETS_S`.
+        """
+        from . import metrics
+
+        obj = dataclasses.asdict(self)
+        obj["error"] = None if self.error is None else repr(self.error)
+        obj["throughput"] = self.throughput
+        obj["latency_buckets"] = list(metrics.LATENCY_BUCKETS_S)
+        return obj
+
+    def to_prometheus(self, labels: Optional[Dict[str, str]] = None) -> str:
+        """Format in the Prometheus text exposition format.
+
+        Args:
+            labels: Labels of every sample, e.g. to identify the board.
+
+        Returns:
+            Metrics text.
+        """
+        from . import metrics
+
+        labels = labels or {}
+        prefix = metrics.PROMETHEUS_PREFIX
+        gauges = [
+            (
+                "download_success",
+                "Whether the download succeeded",
+                int(self.error is None),
+            ),
+            (
+                "download_duration_seconds",
+                "Duration of the download",
+                self.duration,
+            ),
+            (
+                "download_bytes_sent",
+                "Bytes sent in control transfers",
+                self.bytes_sent,
+            ),
+            ("download_transfers", "Control transfers", self.transfers),
+            ("download_polls", "GETSTATUS requests", self.polls),
+            ("download_retries", "Retries after USB errors", self.retries),
+            (
+                "download_throughput_bytes_per_second",
+                "Effective throughput",
+                self.throughput,
+            ),
+        ]
+        lines = []
+        for name, help_text, value in gauges:
+            lines.append(f"# HELP {prefix}_{name} {help_text}")
+            lines.append(f"# TYPE {prefix}_{name} gauge")
+            lines.append(
+                f"{prefix}_{name}{metrics.prometheus_labels(labels)} {value}"
+            )
+
+        name = f"{prefix}_download_phase_seconds"
+        lines.append(f"# HELP {name} Duration of each download phase")
+        lines.append(f"# TYPE {name} gauge")
+        for phase, duration in dataclasses.asdict(self.phases).items():
+            phase_labels = metrics.prometheus_labels({**labels, "phase": phase})
+            lines.append(f"{name}{phase_labels} {duration}")
+
+        name = f"{prefix}_request_duration_seconds"
+        lines.append(f"# HELP {name} Latency of each kind of USB request")
+        lines.append(f"# TYPE {name} histogram")
+        for request, histogram in sorted(self.latency.items()):
+            lines.extend(
+                metrics.prometheus_histogram(
+                    name, histogram, {**labels, "request": request}
+                )
+            )
+        return "\n".join(lines) + "\n"
+
+
+def get_layout(
+    dev: usb.core.Device,
+    interface: int,
+    alternate_index: int = 0,
+    layouts: Optional[
+        MutableMapping[int, List[descriptor.DfuSeMemoryLayout]]
+    ] = None,
+) -> List[descriptor.DfuSeMemoryLayout]:
+    """Get the memory layout of a DfuSe device, reading it only once per
+    alternate setting if a cache is provided.
+
+    Args:
+        dev: USB device in DFU mode.
+        interface: USB device interface.
+        alternate_index: Alternate setting of the interface.
+        layouts: Memory layouts by alternate setting, or None to always read
+            the layout.
+
+    Returns:
+        Memory layout.
+    """
+    if layouts is not None and alternate_index in layouts:
+        return layouts[alternate_index]
+
+    layout = descriptor.get_memory_layout(
+        dev, interface, alternate_index=alternate_index
+    )
+    if layouts is not None:
+        layouts[alternate_index] = layout
+    return layout
+
+
+def as_segments(
+    data: Union[image.Buffer, List[image.Segment]], start_address: int
+) -> List[image.Segment]:
+    """Get the segments of data to download.
+
+    Args:
+        data: Binary data or segments.
+        start_address: Start address of binary data in device memory.
+
+    Returns:
+        Segments, one for binary data.
+
+    Raises:
+        ValueError: No segments to download.
+    """
+    if not isinstance(data, list):
+        return [image.Segment(start_address, data)]
+    if not data:
+        raise ValueError("No data to download")
+    return data
+
+
+def _dfuse_checkpointer(
+    dev: usb.core.Device,
+    path: str,
+    segment: image.Segment,
+    xfer_size: int,
+    sparse: bool,
+) -> checkpoint.Checkpointer:
+    """Open the checkpoint file of a DfuSe download.
+
+    Args:
+        dev: USB device in DFU mode.
+        path: Checkpoint file.
+        segment: Data to download.
+        xfer_size: Transfer size to use when downloading.
+        sparse: Whether the download is sparse.
+
+    Returns:
+        Checkpointer, resuming the download if the file holds its progress.
+    """
+    return checkpoint.Checkpointer(
+        path,
+        checkpoint.Checkpoint(
+            device=descriptor.get_serial_number(dev)
+            or descriptor.get_port_path(dev),
+            image_sha256=hashlib.sha256(segment.data).hexdigest(),
+            address=segment.address,
+            xfer_size=xfer_size,
+            sparse=sparse,
+        ),
+    )
+
+
+def _dfuse_supported_options(
+    options: DownloadOptions,
+    segments: List[image.Segment],
+    pages: List[plan.Page],
+) -> DownloadOptions:
+    """Turn off the options of a DfuSe download which its data does not
+    support, with a warning.
+
+    Args:
+        options: Download options.
+        segments: Data to download.
+        pages: Device pages which cover the first segment.
+
+    Returns:
+        Options to download with.
+    """
+    delta, checkpoint_path = options.delta, options.checkpoint_path
+    if len(segments) != 1 and (delta or checkpoint_path is not None):
+        logger.warning(
+            "Delta and resuming require contiguous data, ignoring them"
+        )
+        delta, checkpoint_path = False, None
+
+    if delta and not (
+        pages
+        and pages[0].addr <= segments[0].address
+        and pages[-1].end >= segments[0].end
+    ):
+        logger.warning("Memory layout does not cover data, disabling delta")
+        delta = False
+
+    if checkpoint_path is not None and delta:
+        logger.warning(
+            "Delta downloads resume by reading back, ignoring checkpoint"
+        )
+        checkpoint_path = None
+
+    return dataclasses.replace(
+        options, delta=delta, checkpoint_path=checkpoint_path
+    )
+
+
+def dfuse_download(
+    dev: usb.core.Device,
+    interface: int,
+    data: Union[image.Buffer, List[image.Segment]],
+    xfer_size: int,
+    start_address: int,
+    options: Optional[DownloadOptions] = None,
+    display: Optional[progress.ProgressSink] = None,
+    result: Optional[DownloadResult] = None,
+    alternate_index: int = 0,
+    layouts: Optional[
+        MutableMapping[int, List[descriptor.DfuSeMemoryLayout]]
+    ] = None,
+    leave: bool = True,
+) -> plan.SkipReport:
+    """Download data to DfuSe device.
+
+    Args:
+        dev: USB device in DFU mode.
+        interface: USB device interface.
+        data: Binary data to download, or segments sorted by address as
+            returned by `loaders.load`. Each segment is written from its own
+            address, and only the pages it touches are erased.
+        xfer_size: Transfer size to use when downloading.
+        start_address: Start address of data in device memory, which is also
+            the address to jump to when leaving DFU mode.
+        options: Download options, or None for the defaults. Delta and
+            resuming are only supported for contiguous data.
+        display: Progress display, or None for a rich progress bar.
+        result: Updated with the time spent in each phase and the number of
+            retries, if provided.
+        alternate_index: Alternate setting of the interface, which selects
+            the memory layout.
+        layouts: Memory layouts by alternate setting, which are read from
+            the device and added when missing, if provided.
+        leave: Leave DFU mode and jump to `start_address` after downloading.
+
+    Returns:
+        Work skipped by a sparse or delta download.
+
+    Raises:
+        ValueError: No segments to download.
+    """
+    options = options or DownloadOptions()
+    display = display or progress.RichProgress()
+    result = result or DownloadResult()
+    times = result.phases
+    report = plan.SkipReport()
+    dfuse_writer = writer.DfuSeWriter(
+        dev, interface, xfer_size, options.per_chunk_address
+    )
+    start = time.monotonic()
+    layout = get_layout(dev, interface, alternate_index, layouts)
+    times.descriptor += time.monotonic() - start
+
+    segments = as_segments(data, start_address)
+    pages = plan.get_pages(layout, segments[0].address, segments[0].end)
+    options = _dfuse_supported_options(options, segments, pages)
+    checkpointer = None
+    if options.checkpoint_path is not None:
+        checkpointer = _dfuse_checkpointer(
+            dev, options.checkpoint_path, segments[0], xfer_size, options.sparse
+        )
+
+    try:
+        if options.delta:
+            start = time.monotonic()
+            with display.task(len(segments[0].data)) as advance:
+                writer.write_delta(
+                    dev,
+                    interface,
+                    pages,
+                    segments[0].data,
+                    segments[0].address,
+                    dfuse_writer,
+                    options.sparse,
+                    report,
+                    advance,
+                )
+            times.write += time.monotonic() - start
+        else:
+            erase_time, write_time = writer.erase_and_write(
+                dfuse_writer,
+                layout,
+                segments,
+                options,
+                report,
+                display,
+                checkpointer,
+            )
+            times.erase += erase_time
+            times.write += write_time
+
+        if checkpointer:
+            checkpointer.finish()
+    finally:
+        if checkpointer:
+            checkpointer.close()
+
+    logger.debug(
+        "Download took %d GETSTATUS polls, %d SET_ADDRESS commands and %d "
+        "retries",
+        dfuse_writer.polls,
+        dfuse_writer.set_address_count,
+        dfuse_writer.retries,
+    )
+    result.retries += dfuse_writer.retries
+
+    if options.sparse or options.delta:
+        logger.info(
+            "Skipped %d bytes in %d chunks and %d pages",
+            report.bytes_skipped,
+            report.chunks_skipped,
+            report.pages_skipped,
+        )
+
+    if options.verify is not None:
+        start = time.monotonic()
+        verify_segments(
+            dev,
+            interface,
+            segments,
+            xfer_size,
+            options.sparse,
+            options.verify,
+            display,
+        )
+        times.verify += time.monotonic() - start
+
+    if leave:
+        start = time.monotonic()
+        dfuse_leave(dev, interface, start_address)
+        times.manifest += time.monotonic() - start
+
+    return report
+
+
+def dfuse_leave(dev: usb.core.Device, interface: int, address: int) -> None:
+    """Leave DFU mode on a DfuSe device and jump to an address.
+
+    Args:
+        dev: USB device in DFU mode.
+        interface: USB device interface.
+        address: Address to jump to in device memory.
+    """
+    # Set jump address
+    dfuse.set_address(dev, interface, address)
+
+    # End with empty download
+    try:
+        dfu.download(dev, interface, 0, None)
+    except usb.core.USBError as err:
+        logger.warning("Ignoring USB error when exiting DFU: %s", err)
+
+
+def dfuse_download_from_idle(
+    dev: usb.core.Device,
+    interface: int,
+    data: Union[image.Buffer, List[image.Segment]],
+    xfer_size: int,
+    start_address: int,
+    options: Optional[DownloadOptions] = None,
+    display: Optional[progress.ProgressSink] = None,
+    result: Optional[DownloadResult] = None,
+    alternate_index: int = 0,
+    layouts: Optional[
+        MutableMapping[int, List[descriptor.DfuSeMemoryLayout]]
+    ] = None,
+    leave: bool = True,
+) -> plan.SkipReport:
+    """Download data to DfuSe device, after clearing any status left over by
+    an earlier session. Arguments are those of `dfuse_download`.
+
+    A device left in an error state stalls the first request, so the status
+    is cleared before anything is erased. Failures during the download are
+    retried per block and are not recovered from by starting again.
+
+    Returns:
+        Work skipped by a sparse or delta download.
+    """
+    dfu.recover(dev, interface)
+    return dfuse_download(
+        dev,
+        interface,
+        data,
+        xfer_size,
+        start_address,
+        options=options,
+        display=display,
+        result=result,
+        alternate_index=alternate_index,
+        layouts=layouts,
+        leave=leave,
+    )
+
+
+def dfu_download(
+    dev: usb.core.Device,
+    interface: int,
+    source: image.ChunkSource,
+    xfer_size: int,
+    verify: Optional[str] = None,
+    display: Optional[progress.ProgressSink] = None,
+    result: Optional[DownloadResult] = None,
+) -> None:
+    """Download data to DFU device.
+
+    Args:
+        dev: USB device in DFU mode.
+        interface: USB device interface.
+        source: Image to download, which is read one chunk at a time.
+        xfer_size: Transfer size to use when downloading.
+        verify: Verification mode to read back the data after manifestation,
+            or None to skip verification.
+        display: Progress display, or None for a rich progress bar.
+        result: Updated with the time spent in each phase, if provided.
+    """
+    display = display or progress.RichProgress()
+    times = (result or DownloadResult()).phases
+    if verify is not None:
+        # Streamed images are kept in memory to compare against
+        data = source.buffer
+
+    # Download data
+    start = time.monotonic()
+    with display.task(source.length) as advance:
+        transaction = 0
+        download_polls = 0
+        bytes_downloaded = 0
+        for chunk in source.chunks(xfer_size):
+            logger.debug(
+                "Downloading %d bytes (total: %d bytes)",
+                len(chunk),
+                bytes_downloaded,
+            )
+
+            download_polls += dfu.download(dev, interface, transaction, chunk)
+
+            transaction += 1
+            bytes_downloaded += len(chunk)
+            advance(len(chunk))
+
+    logger.debug("Download took %d GETSTATUS polls", download_polls)
+    times.write += time.monotonic() - start
+
+    # End with empty download
+    start = time.monotonic()
+    try:
+        dfu.download(dev, interface, 0, None)
+    except usb.core.USBError as err:
+        logger.warning("Ignoring USB error when exiting DFU: %s", err)
+    times.manifest += time.monotonic() - start
+
+    if verify is not None:
+        start = time.monotonic()
+        verify_firmware(dev, interface, data, xfer_size, verify, display)
+        times.verify += time.monotonic() - start
+
+
+def parse_dfu_file(
+    dev: usb.core.Device, source: image.ChunkSource
+) -> Optional[dfufile.DfuFile]:
+    """Parse the DFU suffix of an image, and warn if it is for another device.
+
+    Args:
+        dev: USB device in DFU mode.
+        source: Image to download. Streamed images are not parsed.
+
+    Returns:
+        Parsed file, or None if the image has no DFU suffix or is streamed.
+
+    Raises:
+        ValueError: Suffix CRC32 does not match or DfuSe container is invalid.
+    """
+    if source.length is None:
+        return None
+
+    dfu_file = dfufile.parse(source.buffer)
+    if dfu_file is None:
+        return None
+
+    vid, pid = descriptor.get_device_ids(dev)
+    if not dfufile.matches_device(dfu_file.suffix, vid, pid):
+        logger.warning(
+            "DFU file is for %04x:%04x, not %04x:%04x",
+            dfu_file.suffix.idVendor,
+            dfu_file.suffix.idProduct,
+            vid,
+            pid,
+        )
+    return dfu_file
+
+
+def _load_segments(source: image.ChunkSource) -> Optional[List[image.Segment]]:
+    """Load an image in a format with addresses, like Intel HEX or ELF.
+
+    Args:
+        source: Image to download. Streamed images are not loaded, and
+            loaded images are not loaded again.
+
+    Returns:
+        Segments sorted by address, or None for a raw binary image.
+
+    Raises:
+        ValueError: Image is invalid in the format of its file extension.
+    """
+    if source.loaded is not None:
+        return source.loaded.segments
+    if source.length is None:
+        return None
+
+    from . import loaders
+
+    return loaders.load(source.buffer, source.name)
+
+
+def dfuse_image(
+    source: image.ChunkSource,
+    dfu_file: Optional[dfufile.DfuFile],
+    address: Optional[int],
+) -> Tuple[Union[image.Buffer, List[image.Segment]], int]:
+    """Get the data to download to a DfuSe device.
+
+    Args:
+        source: Image to download.
+        dfu_file: DFU suffix of the image, if it has one.
+        address: Base address to jump to in memory, if provided.
+
+    Returns:
+        Binary data or segments to download, and the address to jump to,
+        which defaults to the first segment.
+
+    Raises:
+        ValueError: Address not provided for a raw binary image.
+    """
+    if dfu_file is not None:
+        data: Union[image.Buffer, List[image.Segment]] = dfu_file.payload
+    else:
+        segments = _load_segments(source)
+        if segments:
+            return segments, segments[0].address if address is None else address
+        data = source.buffer
+
+    if address is None:
+        raise ValueError("Must provide address for DfuSe")
+    return data, address
+
+
+def dfu_image(
+    source: image.ChunkSource, dfu_file: Optional[dfufile.DfuFile]
+) -> image.ChunkSource:
+    """Get the image to download to a DFU device.
+
+    Args:
+        source: Image to download.
+        dfu_file: DFU suffix of the image, if it has one.
+
+    Returns:
+        Image without the DFU suffix.
+
+    Raises:
+        ValueError: Image has addresses, which require a DfuSe device.
+    """
+    if dfu_file is not None:
+        return image.ChunkSource(dfu_file.payload)
+    if _load_segments(source):
+        raise ValueError(f"{source.name} has addresses, requires DfuSe")
+    return source
+
+
+def _dfuse_download_targets(
+    dev: usb.core.Device,
+    interface: int,
+    targets: List[dfufile.DfuSeTarget],
+    xfer_size: int,
+    address: Optional[int] = None,
+    options: Optional[DownloadOptions] = None,
+    display: Optional[progress.ProgressSink] = None,
+    layouts: Optional[
+        MutableMapping[int, List[descriptor.DfuSeMemoryLayout]]
+    ] = None,
+    leave: bool = True,
+    result: Optional[DownloadResult] = None,
+) -> None:
+    """Download the targets of a DfuSe file, each to its alternate setting,
+    without releasing the interface in between.
+
+    Args:
+        dev: USB device in DFU mode.
+        interface: USB device interface.
+        targets: Targets of the DfuSe file.
+        xfer_size: Transfer size to use when downloading.
+        address: Address to jump to after downloading, or None to jump to the
+            first element.
+        options: Download options, or None for the defaults.
+        display: Progress display, or None for a rich progress bar.
+        layouts: See `dfuse_download`.
+        leave: Leave DFU mode after downloading. Otherwise the interface is
+            switched back to alternate setting 0.
+        result: See `dfuse_download`.
+
+    Raises:
+        ValueError: DfuSe file has no elements.
+    """
+    elements = [(t, e) for t in targets for e in t.elements]
+    if not elements:
+        raise ValueError("DfuSe file has no elements")
+
+    display = display or progress.RichProgress()
+    alternate_setting = None
+    for target, element in elements:
+        if target.alternate_setting != alternate_setting:
+            logger.info(
+                "Downloading target %d '%s'",
+                target.alternate_setting,
+                target.name,
+            )
+            dev.set_interface_altsetting(interface, target.alternate_setting)
+            alternate_setting = target.alternate_setting
+
+        dfuse_download_from_idle(
+            dev,
+            interface,
+            element.data,
+            xfer_size,
+            element.address,
+            options=options,
+            display=display,
+            result=result,
+            alternate_index=target.alternate_setting,
+            layouts=layouts,
+            leave=False,
+        )
+
+    if leave:
+        start = time.monotonic()
+        dfuse_leave(
+            dev,
+            interface,
+            elements[0][1].address if address is None else address,
+        )
+        if result is not None:
+            result.phases.manifest += time.monotonic() - start
+    elif alternate_setting != 0:
+        dev.set_interface_altsetting(interface, 0)
+
+
+def download_claimed(
+    dev: usb.core.Device,
+    interface: int,
+    dfu_desc: descriptor.DfuDescriptor,
+    source: image.ChunkSource,
+    address: Optional[int],
+    options: Optional[DownloadOptions] = None,
+    display: Optional[progress.ProgressSink] = None,
+    layouts: Optional[
+        MutableMapping[int, List[descriptor.DfuSeMemoryLayout]]
+    ] = None,
+    leave: bool = True,
+    result: Optional[DownloadResult] = None,
+) -> None:
+    """Download an image to a DFU device whose interface is claimed.
+
+    Args:
+        dev: USB device in DFU mode.
+        interface: USB device interface.
+        dfu_desc: DFU descriptor of device.
+        source: Image to download.
+        address: Base address to jump to in memory. This is required for DfuSe,
+            unless the image is a DfuSe file.
+        options: Download options, or None for the defaults.
+        display: Progress display, or None for a rich progress bar.
+        layouts: See `dfuse_download`.
+        leave: For DfuSe, leave DFU mode after downloading. Plain DFU
+            downloads always end with manifestation.
+        result: Updated with the time spent in each phase and the number of
+            retries, if provided.
+
+    Raises:
+        ValueError: Address not provided for DfuSe device.
+        ValueError: DfuSe file is invalid or the device is not DfuSe.
+        ValueError: Device does not support verification.
+        RuntimeError: Verification failed.
+    """
+    options = options or DownloadOptions()
+    if options.verify is not None:
+        check_can_verify(dfu_desc)
+
+    dfu_file = parse_dfu_file(dev, source)
+    is_dfuse = dfu_desc.bcdDFUVersion == dfuse.DFUSE_VERSION_NUMBER
+    if dfu_file is not None and dfu_file.targets:
+        if not is_dfuse:
+            raise ValueError("DfuSe file requires a DfuSe device")
+        if options.checkpoint_path is not None:
+            logger.warning("Resuming DfuSe files is unsupported, ignoring")
+        _dfuse_download_targets(
+            dev,
+            interface,
+            dfu_file.targets,
+            dfu_desc.wTransferSize,
+            address,
+            options=dataclasses.replace(options, checkpoint_path=None),
+            display=display,
+            layouts=layouts,
+            leave=leave,
+            result=result,
+        )
+    elif is_dfuse:
+        data, jump_address = dfuse_image(source, dfu_file, address)
+        dfuse_download_from_idle(
+            dev,
+            interface,
+            data,
+            dfu_desc.wTransferSize,
+            jump_address,
+            options=options,
+            display=display,
+            result=result,
+            layouts=layouts,
+            leave=leave,
+        )
+    else:
+        if options.delta:
+            logger.warning("Delta download requires DfuSe, ignoring")
+        if options.checkpoint_path is not None:
+            logger.warning("Resuming requires DfuSe, ignoring checkpoint")
+        dfu_download(
+            dev,
+            interface,
+            dfu_image(source, dfu_file),
+            dfu_desc.wTransferSize,
+            verify=options.verify,
+            display=display,
+            result=result,
+        )
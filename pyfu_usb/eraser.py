@@ -0,0 +1,115 @@
+# Copyright 2022 Block, Inc.
+"""Erase the pages of a DfuSe device according to an erase plan."""
+
+import logging
+import sys
+import time
+from typing import TYPE_CHECKING, Optional
+
+import usb
+
+from . import checkpoint, dfuse, plan
+
+if TYPE_CHECKING:
+    from .writer import DfuSeWriter
+
+logger = logging.getLogger(__name__)
+
+
+class DfuSeEraser:
+    """Erase the pages of a DfuSe device in address order, either all before
+    writing or each one just before it is first written.
+    """
+
+    def __init__(
+        self,
+        dev: usb.core.Device,
+        interface: int,
+        erase_plan: plan.ErasePlan,
+        writer: "DfuSeWriter",
+        checkpointer: Optional[checkpoint.Checkpointer] = None,
+    ) -> None:
+        """Create eraser for a DfuSe device.
+
+        Args:
+            dev: USB device in DFU mode.
+            interface: USB device interface.
+            erase_plan: Erase operations to issue.
+            writer: Writer which is reset after each erase, since erasing
+                moves the device address pointer.
+            checkpointer: Skips pages which were already erased, and records
+                each page erased, if provided.
+        """
+        self.dev = dev
+        self.interface = interface
+        self.erase_plan = erase_plan
+        self.writer = writer
+        self.checkpointer = checkpointer
+        self.polls = 0
+        self.duration = 0.0
+        self._erased_end = checkpointer.state.erased_end if checkpointer else 0
+        self._next_page = 0
+
+    def erase_before(self, end: int) -> None:
+        """Erase the pages which start before an address and were not erased
+        yet. A mass erase is done on the first call.
+
+        Args:
+            end: Address after the last byte about to be written.
+        """
+        start = time.monotonic()
+        if self.erase_plan.mass_erase:
+            self._mass_erase()
+        else:
+            pages = self.erase_plan.erase_pages
+            while (
+                self._next_page < len(pages)
+                and pages[self._next_page].addr < end
+            ):
+                self._page_erase(pages[self._next_page])
+                self._next_page += 1
+        self.duration += time.monotonic() - start
+
+    def erase_all(self) -> None:
+        """Erase all pages which were not erased yet."""
+        self.erase_before(sys.maxsize)
+        logger.debug(
+            "Erase took %d GETSTATUS polls and %.2f s",
+            self.polls,
+            self.duration,
+        )
+
+    def _mass_erase(self) -> None:
+        """Erase all device memory, unless that was already done."""
+        mass_erase_end = self.erase_plan.pages[-1].end
+        if mass_erase_end <= self._erased_end:
+            return
+
+        logger.info("Mass erasing device")
+        self.polls += dfuse.mass_erase(self.dev, self.interface)
+        self._erased_end = mass_erase_end
+        self.writer.reset()
+        if self.checkpointer:
+            self.checkpointer.erased(mass_erase_end)
+
+    def _page_erase(self, page: plan.Page) -> None:
+        """Erase a page, unless that was already done.
+
+        Args:
+            page: Page to erase.
+        """
+        if page.end <= self._erased_end:
+            logger.debug("Page 0x%X already erased", page.addr)
+            return
+
+        logger.info(
+            "Erasing page 0x%X of size %d in segment %d",
+            page.addr,
+            page.size,
+            page.segment_num,
+        )
+        self.polls += dfuse.page_erase(self.dev, self.interface, page.addr)
+        self._erased_end = page.end
+        self.writer.reset()
+        if self.checkpointer:
+            self.checkpointer.erased(page.end)
@@ -0,0 +1,171 @@
+# Copyright 2022 Block, Inc.
+"""Notifications of USB devices arriving, using libusb hotplug events."""
+
+import ctypes
+import logging
+import time
+from typing import Any, Optional
+
+from usb.backend import libusb1
+
+logger = logging.getLogger(__name__)
+
+# libusb constants, see libusb.h
+_LIBUSB_CAP_HAS_HOTPLUG = 0x0101
+_LIBUSB_HOTPLUG_EVENT_DEVICE_ARRIVED = 0x01
+_LIBUSB_HOTPLUG_NO_FLAGS = 0
+_LIBUSB_HOTPLUG_MATCH_ANY = -1
+_LIBUSB_ERROR_INTERRUPTED = -10
+
+# int (*libusb_hotplug_callback_fn)(ctx, device, event, user_data)
+_HotplugCallback = ctypes.CFUNCTYPE(
+    ctypes.c_int,
+    ctypes.c_void_p,
+    ctypes.c_void_p,
+    ctypes.c_int,
+    ctypes.c_void_p,
+)
+
+
+class _Timeval(ctypes.Structure):
+    """struct timeval for libusb_handle_events_timeout_completed."""
+
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_usec", ctypes.c_long)]
+
+
+class HotplugMonitor:
+    """Wait for USB devices to arrive without polling the device list.
+
+    The callback is registered when the monitor is created, so devices which
+    arrive between creating the monitor and calling `wait` are not missed.
+    """
+
+    def __init__(
+        self,
+        lib: Any,
+        ctx: Any,
+        vid: Optional[int] = None,
+        pid: Optional[int] = None,
+    ) -> None:
+        """Register a hotplug callback.
+
+        Args:
+            lib: libusb library loaded by the pyusb libusb1 backend.
+            ctx: libusb context of the pyusb libusb1 backend.
+            vid: Only notify about devices with this VID if provided.
+            pid: Only notify about devices with this PID if provided.
+
+        Raises:
+            RuntimeError: Callback could not be registered.
+        """
+        self._lib = lib
+        self._ctx = ctx
+        self._arrived = False
+        self._handle: Optional[ctypes.c_int] = None
+        # Keep a reference so the callback is not garbage collected
+        self._callback = _HotplugCallback(self._on_event)
+
+        handle = ctypes.c_int()
+        ret = lib.libusb_hotplug_register_callback(
+            ctx,
+            _LIBUSB_HOTPLUG_EVENT_DEVICE_ARRIVED,
+            _LIBUSB_HOTPLUG_NO_FLAGS,
+            _LIBUSB_HOTPLUG_MATCH_ANY if vid is None else vid,
+            _LIBUSB_HOTPLUG_MATCH_ANY if pid is None else pid,
+            _LIBUSB_HOTPLUG_MATCH_ANY,
+            self._callback,
+            None,
+            ctypes.byref(handle),
+        )
+        if ret < 0:
+            raise RuntimeError(f"Failed to register hotplug callback ({ret})")
+        self._handle = handle
+
+    def _on_event(
+        self, ctx: Any, device: Any, event: int, user_data: Any
+    ) -> int:
+        """Record that a device arrived. Called by libusb while handling
+        events.
+
+        Returns:
+            0 to keep the callback registered.
+        """
+        self._arrived = True
+        return 0
+
+    def wait(self, timeout: float) -> bool:
+        """Wait for a device to arrive.
+
+        Args:
+            timeout: Maximum time to wait in seconds.
+
+        Returns:
+            True if a device arrived since the monitor was created or since
+            the last call, False if the timeout expired first.
+
+        Raises:
+            RuntimeError: libusb failed to handle events.
+        """
+        deadline = time.monotonic() + timeout
+        while not self._arrived:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+
+            tv = _Timeval(int(remaining), int(remaining % 1 * 1e6))
+            ret = self._lib.libusb_handle_events_timeout_completed(
+                self._ctx, ctypes.byref(tv), None
+            )
+            if ret < 0 and ret != _LIBUSB_ERROR_INTERRUPTED:
+                raise RuntimeError(f"Failed to handle hotplug events ({ret})")
+
+        arrived, self._arrived = self._arrived, False
+        return arrived
+
+    def close(self) -> None:
+        """Deregister the hotplug callback."""
+        if self._handle is not None:
+            self._lib.libusb_hotplug_deregister_callback(
+                self._ctx, self._handle
+            )
+            self._handle = None
+
+    def __enter__(self) -> "HotplugMonitor":
+        return self
+
+    def __exit__(self, *args: object) -> None:
+        self.close()
+
+
+def open_monitor(
+    vid: Optional[int] = None, pid: Optional[int] = None
+) -> Optional[HotplugMonitor]:
+    """Start monitoring for USB devices arriving.
+
+    Args:
+        vid: Only notify about devices with this VID if provided.
+        pid: Only notify about devices with this PID if provided.
+
+    Returns:
+        Monitor, or None if the libusb1 backend is unavailable or does not
+        support hotplug on this platform.
+    """
+    backend = libusb1.get_backend()
+    if backend is None:
+        logger.debug("libusb1 backend unavailable, hotplug not supported")
+        return None
+
+    lib = getattr(backend, "lib", None)
+    ctx = getattr(backend, "ctx", None)
+    if lib is None or ctx is None:
+        return None
+
+    try:
+        if not lib.libusb_has_capability(_LIBUSB_CAP_HAS_HOTPLUG):
+            logger.debug("libusb does not support hotplug on this platform")
+            return None
+        return HotplugMonitor(lib, ctx, vid=vid, pid=pid)
+    except (AttributeError, RuntimeError) as err:
+        # Older libusb versions do not have the hotplug API
+        logger.debug("Hotplug not supported: %s", err)
+        return None
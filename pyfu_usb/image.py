@@ -0,0 +1,199 @@
+# Copyright 2022 Block, Inc.
+"""Firmware image sources which can be downloaded without copying them."""
+
+import dataclasses
+import functools
+import io
+import logging
+import mmap
+import os
+import stat
+from typing import BinaryIO, Iterable, Iterator, List, Optional, Union, cast
+
+logger = logging.getLogger(__name__)
+
+# Size of reads from streamed file-like objects
+_READ_SIZE = 1 << 16
+
+# Random access image data
+Buffer = Union[bytes, bytearray, memoryview]
+
+
+@dataclasses.dataclass
+class Segment:
+    """Image data to write at an address in device memory."""
+
+    address: int
+    data: Buffer
+
+    @property
+    def end(self) -> int:
+        """Address after the last byte of the segment."""
+        return self.address + len(self.data)
+
+
+@dataclasses.dataclass
+class LoadedImage:
+    """Image which was read into memory and whose segments were loaded
+    already, so it can be downloaded many times without parsing it again.
+    """
+
+    # File name, which tells the image format
+    name: str
+    data: Buffer
+    # Segments sorted by address, or None for a raw binary image
+    segments: Optional[List[Segment]] = None
+
+
+# Anything `ChunkSource` can read an image from
+ImageSource = Union[
+    str, "os.PathLike[str]", Buffer, LoadedImage, BinaryIO, Iterable[bytes]
+]
+
+
+def _rechunk(pieces: Iterable[bytes], size: int) -> Iterator[bytes]:
+    """Split and join pieces of data into chunks of a fixed size.
+
+    Args:
+        pieces: Pieces of data of any size.
+        size: Size of chunks.
+
+    Yields:
+        Chunks of `size` bytes, except for the last one.
+    """
+    pending = bytearray()
+    for piece in pieces:
+        pending += piece
+        while len(pending) >= size:
+            yield bytes(pending[:size])
+            del pending[:size]
+    if pending:
+        yield bytes(pending)
+
+
+class ChunkSource:
+    """Firmware image that download loops read in transfer size chunks.
+
+    Files are memory mapped and buffers are wrapped in a `memoryview`, so chunks
+    are slices which do not copy the image. Pipes, non-seekable file-like
+    objects and iterators of bytes are streamed, and are only read into memory
+    if random access is required.
+    """
+
+    def __init__(self, source: ImageSource) -> None:
+        """Open image source.
+
+        Args:
+            source: Path to a binary file, a bytes-like buffer, a loaded
+                image, a binary file-like object or an iterator of bytes.
+
+        Raises:
+            FileNotFoundError: File does not exist.
+            IsADirectoryError: Path is a directory.
+        """
+        self.name: str = "<stream>"
+        # Loaded image, whose segments need not be loaded again
+        self.loaded: Optional[LoadedImage] = None
+        self._mmap: Optional[mmap.mmap] = None
+        self._view: Optional[memoryview] = None
+        self._stream: Optional[Iterable[bytes]] = None
+        self._file: Optional[BinaryIO] = None
+
+        if isinstance(source, (str, os.PathLike)):
+            self.name = os.fsdecode(os.fspath(source))
+            self._file = open(self.name, "rb")
+            self._map_or_stream(self._file)
+        elif isinstance(source, (bytes, bytearray, memoryview)):
+            self.name = "<buffer>"
+            self._view = memoryview(source).cast("B")
+        elif isinstance(source, LoadedImage):
+            self.name = source.name
+            self.loaded = source
+            self._view = memoryview(source.data).cast("B")
+        elif hasattr(source, "read"):
+            self.name = str(getattr(source, "name", self.name))
+            self._map_or_stream(cast(BinaryIO, source))
+        else:
+            self._stream = cast(Iterable[bytes], source)
+
+    def _map_or_stream(self, fin: BinaryIO) -> None:
+        """Memory map a file, or stream it if it cannot be mapped.
+
+        Args:
+            fin: Binary file-like object.
+        """
+        if isinstance(fin, io.BytesIO):
+            self._view = fin.getbuffer()[fin.tell() :]
+            return
+
+        try:
+            fileno = fin.fileno()
+            file_stat = os.fstat(fileno)
+        except (OSError, io.UnsupportedOperation):
+            file_stat = None
+
+        if file_stat is None or not stat.S_ISREG(file_stat.st_mode):
+            logger.debug("Cannot memory map %s, streaming it", self.name)
+            self._stream = iter(functools.partial(fin.read, _READ_SIZE), b"")
+        elif file_stat.st_size == 0:
+            # Empty files cannot be mapped
+            self._view = memoryview(b"")
+        else:
+            self._mmap = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+            self._view = memoryview(self._mmap)[fin.tell() :]
+
+    @property
+    def length(self) -> Optional[int]:
+        """Size of the image in bytes, or None if it is streamed."""
+        return None if self._view is None else len(self._view)
+
+    @property
+    def buffer(self) -> memoryview:
+        """Random access view of the whole image. Streamed images are read into
+        memory the first time this is used.
+        """
+        if self._view is None:
+            logger.debug("Reading streamed image %s into memory", self.name)
+            self._view = memoryview(bytearray().join(self._stream or []))
+            self._stream = None
+        return self._view
+
+    def chunks(self, size: int) -> Iterator[Buffer]:
+        """Read the image in chunks.
+
+        Args:
+            size: Size of chunks.
+
+        Yields:
+            Chunks of `size` bytes, except for the last one.
+        """
+        if self._view is not None:
+            view = self._view
+            for offset in range(0, len(view), size):
+                yield view[offset : offset + size]
+        else:
+            stream, self._stream = self._stream, None
+            yield from _rechunk(stream or [], size)
+
+    def close(self) -> None:
+        """Release the image. Any chunks must no longer be in use."""
+        if self._view is not None:
+            self._view.release()
+            self._view = None
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # Slices still referenced, e.g. by a traceback. The map is
+                # closed when they are garbage collected.
+                logger.debug("Image %s still in use, not unmapping", self.name)
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self) -> "ChunkSource":
+        return self
+
+    def __exit__(self, *args: object) -> None:
+        self.close()
@@ -0,0 +1,277 @@
+# Copyright 2022 Block, Inc.
+"""Load Intel HEX, Motorola S-record and ELF images as address segments."""
+
+import binascii
+import logging
+import os
+import struct
+from typing import Callable, Dict, List, Optional
+
+from .image import Buffer, Segment
+
+logger = logging.getLogger(__name__)
+
+# Intel HEX record types
+_IHEX_DATA = 0x00
+_IHEX_EOF = 0x01
+_IHEX_EXTENDED_SEGMENT_ADDRESS = 0x02
+_IHEX_START_SEGMENT_ADDRESS = 0x03
+_IHEX_EXTENDED_LINEAR_ADDRESS = 0x04
+_IHEX_START_LINEAR_ADDRESS = 0x05
+
+# S-record data record types and the size of their address field
+_SREC_ADDRESS_SIZES = {"1": 2, "2": 3, "3": 4}
+
+# ELF identification and program header type of loadable segments
+_ELF_MAGIC = b"\x7fELF"
+_ELF_CLASS_32 = 1
+_ELF_CLASS_64 = 2
+_ELF_DATA_LSB = 1
+_ELF_DATA_MSB = 2
+_ELF_PT_LOAD = 1
+
+# Size of the ELF header by class
+_ELF_HEADER_SIZES = {_ELF_CLASS_32: 0x34, _ELF_CLASS_64: 0x40}
+
+
+class _SegmentBuilder:
+    """Collect data records into segments, extending the current segment
+    while records are contiguous so that each segment is one buffer.
+    """
+
+    def __init__(self) -> None:
+        self.segments: List[Segment] = []
+        self._data: Optional[bytearray] = None
+        self._end = 0
+
+    def add(self, address: int, data: Buffer) -> None:
+        """Add the data of a record.
+
+        Args:
+            address: Address of the record.
+            data: Record data.
+        """
+        if not data:
+            return
+        if self._data is None or address != self._end:
+            self._data = bytearray()
+            self.segments.append(Segment(address, self._data))
+        self._data += data
+        self._end = address + len(data)
+
+    def finish(self, merge: bool = True) -> List[Segment]:
+        """Sort the segments and merge the ones which are adjacent.
+
+        Args:
+            merge: Merge adjacent segments, which copies their data.
+
+        Returns:
+            Segments sorted by address.
+
+        Raises:
+            ValueError: Segments overlap.
+        """
+        merged: List[Segment] = []
+        for segment in sorted(self.segments, key=lambda s: s.address):
+            if merged and segment.address < merged[-1].end:
+                raise ValueError(
+                    f"Data at 0x{segment.address:08X} overlaps segment at "
+                    f"0x{merged[-1].address:08X}"
+                )
+            if merge and merged and segment.address == merged[-1].end:
+                previous = merged[-1]
+                previous.data = bytearray(previous.data) + segment.data
+            else:
+                merged.append(segment)
+        return merged
+
+
+def load_ihex(data: Buffer) -> List[Segment]:
+    """Load an Intel HEX image.
+
+    Args:
+        data: Contents of the file.
+
+    Returns:
+        Segments sorted by address, with contiguous records merged.
+
+    Raises:
+        ValueError: File is not valid Intel HEX.
+    """
+    builder = _SegmentBuilder()
+    base = 0
+    for line_num, raw_line in enumerate(bytes(data).splitlines(), start=1):
+        line = raw_line.strip()
+        if not line:
+            continue
+        if line[:1] != b":":
+            raise ValueError(f"Line {line_num}: missing start code")
+        try:
+            record = binascii.unhexlify(line[1:])
+        except binascii.Error:
+            raise ValueError(f"Line {line_num}: invalid hex digits") from None
+        if len(record) < 5 or len(record) != record[0] + 5:
+            raise ValueError(f"Line {line_num}: invalid record length")
+        if sum(record) & 0xFF:
+            raise ValueError(f"Line {line_num}: checksum mismatch")
+
+        record_type = record[3]
+        payload = record[4:-1]
+        if record_type == _IHEX_DATA:
+            offset = (record[1] << 8) | record[2]
+            builder.add(base + offset, payload)
+        elif record_type == _IHEX_EOF:
+            break
+        elif record_type == _IHEX_EXTENDED_SEGMENT_ADDRESS:
+            base = int.from_bytes(payload, "big") << 4
+        elif record_type == _IHEX_EXTENDED_LINEAR_ADDRESS:
+            base = int.from_bytes(payload, "big") << 16
+        elif record_type not in (
+            _IHEX_START_SEGMENT_ADDRESS,
+            _IHEX_START_LINEAR_ADDRESS,
+        ):
+            raise ValueError(
+                f"Line {line_num}: unknown record type {record_type}"
+            )
+    return builder.finish()
+
+
+def load_srec(data: Buffer) -> List[Segment]:
+    """Load a Motorola S-record image.
+
+    Args:
+        data: Contents of the file.
+
+    Returns:
+        Segments sorted by address, with contiguous records merged.
+
+    Raises:
+        ValueError: File is not a valid S-record file.
+    """
+    builder = _SegmentBuilder()
+    for line_num, raw_line in enumerate(bytes(data).splitlines(), start=1):
+        line = raw_line.strip()
+        if not line:
+            continue
+        if line[:1] != b"S" or len(line) < 2:
+            raise ValueError(f"Line {line_num}: missing record start")
+        try:
+            record = binascii.unhexlify(line[2:])
+        except binascii.Error:
+            raise ValueError(f"Line {line_num}: invalid hex digits") from None
+        if not record or len(record) != record[0] + 1:
+            raise ValueError(f"Line {line_num}: invalid record length")
+        if sum(record) & 0xFF != 0xFF:
+            raise ValueError(f"Line {line_num}: checksum mismatch")
+
+        # Header, count and termination records hold no data
+        address_size = _SREC_ADDRESS_SIZES.get(chr(line[1]))
+        if address_size is not None:
+            address = int.from_bytes(record[1 : 1 + address_size], "big")
+            builder.add(address, record[1 + address_size : -1])
+    return builder.finish()
+
+
+def load_elf(data: Buffer) -> List[Segment]:
+    """Load the loadable segments of an ELF file. Segments are placed at
+    their physical (load) address and are views into `data`.
+
+    Args:
+        data: Contents of the file.
+
+    Returns:
+        Segments sorted by address. Segments without file data, like .bss,
+        are left out.
+
+    Raises:
+        ValueError: File is not a valid ELF file.
+    """
+    view = memoryview(data).cast("B")
+    if len(view) < 6 or view[:4] != _ELF_MAGIC:
+        raise ValueError("Not an ELF file")
+
+    elf_class, elf_data = view[4], view[5]
+    if len(view) < _ELF_HEADER_SIZES.get(elf_class, 0):
+        raise ValueError("ELF header truncated")
+    if elf_data not in (_ELF_DATA_LSB, _ELF_DATA_MSB):
+        raise ValueError(f"Unknown ELF data encoding {elf_data}")
+    endian = "<" if elf_data == _ELF_DATA_LSB else ">"
+    if elf_class == _ELF_CLASS_32:
+        phoff, phentsize, phnum = struct.unpack_from(
+            endian + "I10xHH", view, 0x1C
+        )
+        # p_type, p_offset, p_vaddr, p_paddr, p_filesz
+        header_format = endian + "IIIII"
+    elif elf_class == _ELF_CLASS_64:
+        phoff, phentsize, phnum = struct.unpack_from(
+            endian + "Q14xHH", view, 0x20
+        )
+        # p_type, p_flags, p_offset, p_vaddr, p_paddr, p_filesz
+        header_format = endian + "IIQQQQ"
+    else:
+        raise ValueError(f"Unknown ELF class {elf_class}")
+
+    builder = _SegmentBuilder()
+    for index in range(phnum):
+        header_offset = phoff + index * phentsize
+        if header_offset + struct.calcsize(header_format) > len(view):
+            raise ValueError("ELF program header truncated")
+        header = struct.unpack_from(header_format, view, header_offset)
+        if elf_class == _ELF_CLASS_64:
+            header = header[:1] + header[2:]
+        p_type, p_offset, _, p_paddr, p_filesz = header
+        if p_type != _ELF_PT_LOAD or p_filesz == 0:
+            continue
+        if p_offset + p_filesz > len(view):
+            raise ValueError(f"ELF segment {index} truncated")
+        builder.segments.append(
+            Segment(p_paddr, view[p_offset : p_offset + p_filesz])
+        )
+    # Not merged, so the data is not copied
+    return builder.finish(merge=False)
+
+
+# Loaders by file extension
+_LOADERS: Dict[str, Callable[[Buffer], List[Segment]]] = {
+    ".hex": load_ihex,
+    ".ihex": load_ihex,
+    ".ihx": load_ihex,
+    ".srec": load_srec,
+    ".s19": load_srec,
+    ".s28": load_srec,
+    ".s37": load_srec,
+    ".mot": load_srec,
+    ".elf": load_elf,
+    ".axf": load_elf,
+}
+
+
+def load(data: Buffer, name: str = "") -> Optional[List[Segment]]:
+    """Load an image with addresses, if it is in one of the supported formats.
+    The format is chosen by file extension, and ELF files are also recognized
+    by their contents.
+
+    Args:
+        data: Contents of the file.
+        name: Name of the file.
+
+    Returns:
+        Segments sorted by address, or None if the image is a raw binary.
+
+    Raises:
+        ValueError: File is not valid in the format of its extension.
+    """
+    loader = _LOADERS.get(os.path.splitext(name)[1].lower())
+    if loader is None and memoryview(data)[:4] == _ELF_MAGIC:
+        loader = load_elf
+    if loader is None:
+        return None
+
+    segments = loader(data)
+    logger.debug(
+        "Loaded %d segments with %d bytes from %s",
+        len(segments),
+        sum(len(segment.data) for segment in segments),
+        name or "image",
+    )
+    return segments
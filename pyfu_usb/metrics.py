@@ -0,0 +1,193 @@
+# Copyright 2022 Block, Inc.
+"""Counters and latency histograms of the USB control transfers of a
+download.
+
+`MetricsRecorder` wraps a device and counts the transfers sent through it,
+the bytes they send and their latency by request, cheaply enough to stay on
+for every download. `download` returns them in a `DownloadResult`, which can
+be exported as JSON or in the Prometheus text format.
+"""
+
+import bisect
+import dataclasses
+import time
+from typing import Any, Dict, List, Optional, Sequence, Union
+
+import usb
+
+from .trace import request_name
+from .transport import DeviceWrapper
+
+# Upper bounds of the latency histogram buckets, in seconds, from a fast
+# transfer on a high-speed bus to a slow erase
+LATENCY_BUCKETS_S = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+)
+
+# Prefix of the names of exported metrics
+PROMETHEUS_PREFIX = "pyfu_usb"
+
+
+@dataclasses.dataclass
+class LatencyHistogram:
+    """Latency of one kind of request, in seconds."""
+
+    # Number of latencies up to each of `LATENCY_BUCKETS_S`, then above all of
+    # them. Unlike Prometheus buckets, these are not cumulative.
+    buckets: List[int] = dataclasses.field(
+        default_factory=lambda: [0] * (len(LATENCY_BUCKETS_S) + 1)
+    )
+    count: int = 0
+    errors: int = 0
+    sum_s: float = 0.0
+    max_s: float = 0.0
+
+    def observe(self, latency_s: float, error: bool = False) -> None:
+        """Add a latency.
+
+        Args:
+            latency_s: Latency in seconds.
+            error: Whether the request failed.
+        """
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS_S, latency_s)] += 1
+        self.count += 1
+        self.errors += error
+        self.sum_s += latency_s
+        self.max_s = max(self.max_s, latency_s)
+
+    @property
+    def mean_s(self) -> float:
+        """Mean latency."""
+        return self.sum_s / self.count if self.count else 0.0
+
+
+class MetricsRecorder(DeviceWrapper):
+    """Device which counts the control transfers sent through it."""
+
+    def __init__(self, dev: usb.core.Device) -> None:
+        """Start counting the transfers to a device.
+
+        Args:
+            dev: USB device, or another transport with its descriptors like
+                `simulator.SimulatedDevice`.
+        """
+        super().__init__(dev)
+        self.transfers = 0
+        self.bytes_sent = 0
+        self.latency: Dict[str, LatencyHistogram] = {}
+
+    @property
+    def polls(self) -> int:
+        """Number of GETSTATUS requests."""
+        histogram = self.latency.get("GETSTATUS")
+        return histogram.count if histogram else 0
+
+    def ctrl_transfer(
+        self,
+        bmRequestType: int,
+        bRequest: int,
+        wValue: int = 0,
+        wIndex: int = 0,
+        data_or_wLength: Optional[Union[int, Sequence[int], bytes]] = None,
+        timeout: Optional[int] = None,
+    ) -> Any:
+        """Send a control transfer to the wrapped device and count it.
+
+        Args:
+            bmRequestType: Request type.
+            bRequest: Request code.
+            wValue: Request value.
+            wIndex: Request index.
+            data_or_wLength: Data of OUT requests, or length of IN requests.
+            timeout: Timeout in milliseconds.
+
+        Returns:
+            Result of the wrapped device's transfer.
+
+        Raises:
+            usb.core.USBError: Request failed or was stalled.
+        """
+        start_ns = time.perf_counter_ns()
+        error = True
+        try:
+            result = self.wrapped.ctrl_transfer(
+                bmRequestType,
+                bRequest,
+                wValue,
+                wIndex,
+                data_or_wLength,
+                timeout,
+            )
+            error = False
+        finally:
+            latency_s = (time.perf_counter_ns() - start_ns) / 1e9
+            sent = (
+                b""
+                if isinstance(data_or_wLength, int)
+                else data_or_wLength or b""
+            )
+            name = request_name(bmRequestType, bRequest, wValue, sent)
+            histogram = self.latency.get(name)
+            if histogram is None:
+                histogram = self.latency[name] = LatencyHistogram()
+            histogram.observe(latency_s, error)
+            self.transfers += 1
+            self.bytes_sent += len(sent)
+        return result
+
+
+def prometheus_histogram(
+    name: str, histogram: LatencyHistogram, labels: Dict[str, str]
+) -> List[str]:
+    """Format a latency histogram in the Prometheus text format.
+
+    Args:
+        name: Metric name, without the bucket, sum or count suffix.
+        histogram: Latency histogram.
+        labels: Labels of every sample.
+
+    Returns:
+        Sample lines, with cumulative buckets.
+    """
+    lines = []
+    cumulative = 0
+    bounds = [str(bound) for bound in LATENCY_BUCKETS_S] + ["+Inf"]
+    for bound, count in zip(bounds, histogram.buckets):
+        cumulative += count
+        bucket_labels = prometheus_labels({**labels, "le": bound})
+        lines.append(f"{name}_bucket{bucket_labels} {cumulative}")
+    lines.append(f"{name}_sum{prometheus_labels(labels)} {histogram.sum_s}")
+    lines.append(f"{name}_count{prometheus_labels(labels)} {histogram.count}")
+    return lines
+
+
+def prometheus_labels(labels: Dict[str, str]) -> str:
+    """Format labels of a sample in the Prometheus text format.
+
+    Args:
+        labels: Label values by name.
+
+    Returns:
+        Labels in braces, or an empty string if there are none.
+    """
+    if not labels:
+        return ""
+    escaped = (
+        (key, value.replace("\\", "\\\\").replace('"', '\\"'))
+        for key, value in labels.items()
+    )
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
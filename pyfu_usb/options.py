@@ -0,0 +1,78 @@
+# Copyright 2022 Block, Inc.
+"""Options of a download, passed unchanged from `download` to the code which
+erases, writes and verifies.
+"""
+
+import dataclasses
+from typing import Optional
+
+from . import plan
+
+# Verification modes
+VERIFY_COMPARE = "compare"
+VERIFY_HASH = "hash"
+
+# DfuSe erase schedules
+ERASE_UPFRONT = "upfront"
+ERASE_INTERLEAVED = "interleaved"
+
+
+@dataclasses.dataclass(frozen=True)
+class DownloadOptions:
+    """How to erase, write and verify an image. The options are checked when
+    they are created, before any device is touched.
+    """
+
+    # For DfuSe, send SET_ADDRESS before every chunk instead of relying on
+    # block number auto-increment. Only needed for devices which do not
+    # implement auto-increment correctly.
+    per_chunk_address: bool = False
+
+    # For DfuSe, skip erasing pages which the image only covers with the
+    # erased value (0xFF) and skip writing chunks of erased values to erased
+    # pages. Pages which are not erased keep their previous contents, so
+    # erased-value regions of the image are treated as "don't care".
+    sparse: bool = False
+
+    # For DfuSe, read back each page and only erase and write the pages which
+    # differ from the image. Falls back to rewriting every page if reading
+    # back is slower than writing on the device. Only supported for
+    # contiguous data.
+    delta: bool = False
+
+    # Read back device memory after downloading and compare it with the
+    # image, or None to skip verification. `VERIFY_COMPARE` reports the first
+    # differing address, `VERIFY_HASH` only compares a SHA-256 hash. For DFU
+    # devices this requires upload support and manifestation tolerance.
+    verify: Optional[str] = None
+
+    # File to record the progress of a DfuSe download in. If the file holds
+    # the progress of an interrupted download of the same image to the same
+    # device, the download continues from the last confirmed block without
+    # erasing again. The file is removed once the download completes. Only
+    # supported for contiguous data.
+    checkpoint_path: Optional[str] = None
+
+    # For DfuSe, erase all device memory with one command if the image needs
+    # at least this fraction (0 to 1) of it erased, instead of erasing pages.
+    # Memory outside the image is erased too. See `get_erase_plan` to check
+    # the plan first.
+    mass_erase_threshold: Optional[float] = None
+
+    # For DfuSe, `ERASE_UPFRONT` erases all pages before writing, and
+    # `ERASE_INTERLEAVED` erases each page just before its first chunk is
+    # written, so writing starts sooner and erase failures show up early.
+    erase_schedule: str = ERASE_UPFRONT
+
+    def __post_init__(self) -> None:
+        """Check the options before any device is touched.
+
+        Raises:
+            ValueError: Unknown verification mode or erase schedule.
+            ValueError: Mass erase threshold is not in (0, 1].
+        """
+        if self.verify not in (None, VERIFY_COMPARE, VERIFY_HASH):
+            raise ValueError(f"Unknown verification mode: {self.verify}")
+        if self.erase_schedule not in (ERASE_UPFRONT, ERASE_INTERLEAVED):
+            raise ValueError(f"Unknown erase schedule: {self.erase_schedule}")
+        plan.check_mass_erase_threshold(self.mass_erase_threshold)
@@ -0,0 +1,288 @@
+# Copyright 2022 Block, Inc.
+"""Plan DfuSe erase and write operations using the device memory layout."""
+
+import bisect
+import dataclasses
+import sys
+from typing import List, Optional, Sequence, Tuple
+
+from .descriptor import DfuSeMemoryLayout
+from .image import Buffer, Segment
+
+# Value of every byte in an erased page of flash memory
+ERASED_VALUE = 0xFF
+
+# Data is compared against the erased value in windows of this size
+_ERASED_WINDOW = bytes([ERASED_VALUE]) * (1 << 16)
+
+
+@dataclasses.dataclass
+class SkipReport:
+    """Work skipped by a sparse download."""
+
+    bytes_skipped: int = 0
+    chunks_skipped: int = 0
+    pages_skipped: int = 0
+
+
+@dataclasses.dataclass
+class Page:
+    """Page of DfuSe device memory."""
+
+    addr: int
+    size: int
+    segment_num: int
+
+    @property
+    def end(self) -> int:
+        """Address after the last byte of the page."""
+        return self.addr + self.size
+
+
+@dataclasses.dataclass
+class ErasePlan:
+    """Erase operations to issue before writing an image to a DfuSe device."""
+
+    # Pages which contain at least one byte of the image, in address order
+    pages: List[Page]
+
+    # Pages to erase one at a time, in address order
+    erase_pages: List[Page]
+
+    # Erase all device memory with one command instead of erasing pages
+    mass_erase: bool = False
+
+    @property
+    def num_operations(self) -> int:
+        """Number of erase commands which will be sent to the device."""
+        return 1 if self.mass_erase else len(self.erase_pages)
+
+    @property
+    def pages_skipped(self) -> int:
+        """Number of pages of the image which do not need to be erased."""
+        return 0 if self.mass_erase else len(self.pages) - len(self.erase_pages)
+
+    @property
+    def erase_ranges(self) -> List[Tuple[int, int]]:
+        """Merged address ranges which will be erased page by page."""
+        return merge_ranges(
+            [(page.addr, page.end) for page in self.erase_pages]
+        )
+
+    @property
+    def blank_ranges(self) -> List[Tuple[int, int]]:
+        """Merged address ranges of the image which will hold the erased value,
+        or whose contents do not matter, after erasing.
+        """
+        return merge_ranges([(page.addr, page.end) for page in self.pages])
+
+
+def get_pages(
+    layout: Sequence[DfuSeMemoryLayout], start: int, end: int
+) -> List[Page]:
+    """Get the pages of device memory which intersect an address range.
+
+    Args:
+        layout: Device memory layout.
+        start: Start address of range.
+        end: End address (exclusive) of range.
+
+    Returns:
+        Pages in address order which contain at least one byte of the range.
+    """
+    pages = []
+    for segment_num, segment in enumerate(layout):
+        if end <= segment.addr or segment.last_addr < start:
+            continue
+
+        first = max(start - segment.addr, 0) // segment.page_size
+        last = (min(end, segment.last_addr + 1) - 1 - segment.addr) // (
+            segment.page_size
+        )
+        for page_num in range(first, last + 1):
+            pages.append(
+                Page(
+                    addr=segment.addr + page_num * segment.page_size,
+                    size=segment.page_size,
+                    segment_num=segment_num,
+                )
+            )
+    return pages
+
+
+def is_erased(data: Buffer, start: int, end: int) -> bool:
+    """Check if a range of data only contains the erased value. The range is
+    checked in windows of bounded size, so large ranges are not copied.
+
+    Args:
+        data: Binary data.
+        start: Offset of first byte to check.
+        end: Offset after the last byte to check.
+
+    Returns:
+        True if every byte in the range is the erased value (or the range is
+        empty).
+    """
+    view = memoryview(data)
+    for begin in range(start, end, len(_ERASED_WINDOW)):
+        window = view[begin : min(begin + len(_ERASED_WINDOW), end)]
+        # Comparing bytes is much faster than comparing memoryviews
+        if window.tobytes() != _ERASED_WINDOW[: len(window)]:
+            return False
+    return True
+
+
+def get_data_ranges(
+    data: Buffer, chunk_size: int, skip_erased: bool
+) -> List[Tuple[int, int]]:
+    """Get the ranges of data which must be written to the device.
+
+    Args:
+        data: Binary data.
+        chunk_size: Size of the chunks the data is written in.
+        skip_erased: Leave out chunks which only contain the erased value.
+
+    Returns:
+        Merged `(begin, end)` offsets in the data, where `end` is exclusive.
+    """
+    if not skip_erased:
+        return [(0, len(data))] if data else []
+
+    ranges = []
+    for begin in range(0, len(data), chunk_size):
+        end = min(begin + chunk_size, len(data))
+        if not is_erased(data, begin, end):
+            ranges.append((begin, end))
+    return merge_ranges(ranges)
+
+
+def merge_ranges(ranges: Sequence[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    """Merge overlapping and adjacent address ranges.
+
+    Args:
+        ranges: `(start, end)` address ranges, where `end` is exclusive.
+
+    Returns:
+        Sorted list of disjoint, non-adjacent `(start, end)` ranges.
+    """
+    merged: List[Tuple[int, int]] = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def ranges_contain(
+    ranges: Sequence[Tuple[int, int]], start: int, end: int
+) -> bool:
+    """Check if an address range is entirely within one of a list of ranges.
+
+    Args:
+        ranges: Ranges as returned by `merge_ranges`.
+        start: Start address of range to check.
+        end: End address (exclusive) of range to check.
+
+    Returns:
+        True if `[start, end)` is contained within a single range.
+    """
+    idx = bisect.bisect_right(ranges, (start, sys.maxsize)) - 1
+    return idx >= 0 and ranges[idx][0] <= start and end <= ranges[idx][1]
+
+
+def check_mass_erase_threshold(threshold: Optional[float]) -> None:
+    """Check a mass erase threshold is a fraction of device memory.
+
+    Args:
+        threshold: Mass erase threshold, or None to always erase pages.
+
+    Raises:
+        ValueError: Threshold is not in (0, 1].
+    """
+    if threshold is not None and not 0 < threshold <= 1:
+        raise ValueError(
+            f"Mass erase threshold must be in (0, 1], got {threshold}"
+        )
+
+
+def plan_erase(
+    layout: Sequence[DfuSeMemoryLayout],
+    data: Buffer,
+    start_address: int,
+    sparse: bool = False,
+    mass_erase_threshold: Optional[float] = None,
+) -> ErasePlan:
+    """Plan the erase operations for writing an image to a DfuSe device.
+
+    Args:
+        layout: Device memory layout.
+        data: Binary data to download.
+        start_address: Start address of data in device memory.
+        sparse: Skip pages which the data only covers with the erased value.
+        mass_erase_threshold: Erase all device memory with one command if the
+            pages to erase make up at least this fraction of the memory in the
+            layout, or None to always erase pages. Memory outside the image is
+            erased too.
+
+    Returns:
+        Erase plan.
+
+    Raises:
+        ValueError: Mass erase threshold is not in (0, 1].
+    """
+    return plan_erase_segments(
+        layout, [Segment(start_address, data)], sparse, mass_erase_threshold
+    )
+
+
+def plan_erase_segments(
+    layout: Sequence[DfuSeMemoryLayout],
+    segments: Sequence[Segment],
+    sparse: bool = False,
+    mass_erase_threshold: Optional[float] = None,
+) -> ErasePlan:
+    """Plan the erase operations for writing image segments to a DfuSe
+    device. Pages shared by several segments are erased once.
+
+    Args:
+        layout: Device memory layout.
+        segments: Segments of the image, sorted by address and not
+            overlapping.
+        sparse: Skip pages which the segments only cover with the erased
+            value.
+        mass_erase_threshold: See `plan_erase`.
+
+    Returns:
+        Erase plan. Mass erase is only chosen if some page needs erasing.
+
+    Raises:
+        ValueError: Mass erase threshold is not in (0, 1].
+    """
+    check_mass_erase_threshold(mass_erase_threshold)
+    pages: List[Page] = []
+    dirty = set()
+    for segment in segments:
+        for page in get_pages(layout, segment.address, segment.end):
+            if not pages or pages[-1].addr != page.addr:
+                pages.append(page)
+            if not sparse or not is_erased(
+                segment.data,
+                max(page.addr - segment.address, 0),
+                min(page.end - segment.address, len(segment.data)),
+            ):
+                dirty.add(page.addr)
+    erase_pages = [page for page in pages if page.addr in dirty]
+
+    total_size = sum(segment.size for segment in layout)
+    erase_size = sum(page.size for page in erase_pages)
+    mass_erase = (
+        mass_erase_threshold is not None
+        and bool(erase_pages)
+        and total_size > 0
+        and erase_size >= mass_erase_threshold * total_size
+    )
+
+    return ErasePlan(
+        pages=pages, erase_pages=erase_pages, mass_erase=mass_erase
+    )
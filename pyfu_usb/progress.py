@@ -0,0 +1,323 @@
+# Copyright 2022 Block, Inc.
+"""Progress displays for downloads, called sinks.
+
+Downloads report progress to a `ProgressSink` after every block. The default
+`RichProgress` shows a rich progress bar, `CallbackProgress` passes progress
+to a function, e.g. to report it to a production system, and `NullProgress`
+discards it, for headless use. Updates to rich and callbacks are throttled,
+so they cost little even with small transfer sizes::
+
+    download("app.bin", address=0x08000000, display=NullProgress())
+
+rich is only imported once a rich progress bar is shown, so headless users
+don't pay for importing it.
+"""
+
+import contextlib
+import dataclasses
+import logging
+import time
+from typing import (
+    TYPE_CHECKING,
+    Callable,
+    ContextManager,
+    Iterator,
+    Optional,
+    Protocol,
+)
+
+if TYPE_CHECKING:
+    from rich.progress import Progress, TaskID
+
+logger = logging.getLogger(__name__)
+
+# Default minimum time between updates of a task, in seconds
+DEFAULT_MIN_INTERVAL_S = 0.1
+
+# Default task description
+_DOWNLOAD_DESCRIPTION = "Downloading firmware"
+
+
+class ProgressSink(Protocol):
+    """Receives the progress of download tasks, like erasing, writing or
+    verifying.
+    """
+
+    def task(
+        self, total: Optional[int], description: str = _DOWNLOAD_DESCRIPTION
+    ) -> ContextManager[Callable[[int], None]]:
+        """Start a task.
+
+        Args:
+            total: Total number of bytes, or None if unknown.
+            description: Description of the task.
+
+        Returns:
+            Context manager for the duration of the task, which gives a
+            function to call with the number of bytes handled.
+        """
+
+
+@dataclasses.dataclass
+class ProgressUpdate:
+    """Progress of a task, passed to `CallbackProgress` callbacks."""
+
+    description: str
+    completed: int
+    total: Optional[int]
+
+    @property
+    def finished(self) -> bool:
+        """Whether every byte of a task with a known total was handled."""
+        return self.total is not None and self.completed >= self.total
+
+
+class _Throttle:
+    """Batch the bytes handled by a task into fewer updates."""
+
+    def __init__(
+        self,
+        update: Callable[[int], None],
+        min_interval_s: float,
+        min_bytes: Optional[int],
+    ) -> None:
+        """Create throttle.
+
+        Args:
+            update: Called with the number of bytes handled since the last
+                update.
+            min_interval_s: Minimum time between updates, in seconds.
+            min_bytes: Update before the interval passes once this many bytes
+                were handled, or None to only update by time.
+        """
+        self._update = update
+        self._min_interval_s = min_interval_s
+        self._min_bytes = min_bytes
+        self._pending = 0
+        self._last_update = time.monotonic()
+
+    def advance(self, num_bytes: int) -> None:
+        """Add bytes handled, and update if enough time passed or enough
+        bytes were handled since the last update.
+
+        Args:
+            num_bytes: Number of bytes handled.
+        """
+        self._pending += num_bytes
+        if self._min_bytes is not None and self._pending >= self._min_bytes:
+            self.flush()
+            return
+        now = time.monotonic()
+        if now - self._last_update >= self._min_interval_s:
+            self.flush(now)
+
+    def flush(self, now: Optional[float] = None) -> None:
+        """Update with the bytes handled since the last update, if any.
+
+        Args:
+            now: Current monotonic time, if already known.
+        """
+        self._last_update = time.monotonic() if now is None else now
+        if self._pending:
+            pending, self._pending = self._pending, 0
+            self._update(pending)
+
+
+class NullProgress:
+    """Discard progress."""
+
+    @contextlib.contextmanager
+    def task(
+        self, total: Optional[int], description: str = _DOWNLOAD_DESCRIPTION
+    ) -> Iterator[Callable[[int], None]]:
+        """Start a task whose progress is discarded.
+
+        Args:
+            total: Total number of bytes, or None if unknown.
+            description: Description of the task.
+
+        Yields:
+            Function which ignores the number of bytes handled.
+        """
+        yield lambda num_bytes: None
+
+
+class CallbackProgress:
+    """Pass the progress of tasks to a function."""
+
+    def __init__(
+        self,
+        callback: Callable[[ProgressUpdate], None],
+        min_interval_s: float = DEFAULT_MIN_INTERVAL_S,
+        min_bytes: Optional[int] = None,
+    ) -> None:
+        """Create progress sink.
+
+        Args:
+            callback: Called with the progress of a task when it starts, at
+                most every `min_interval_s` or `min_bytes` while it runs, and
+                when it ends. Tasks of several devices downloading at once
+                call it from their own threads.
+            min_interval_s: Minimum time between updates of a task.
+            min_bytes: Update before the interval passes once this many bytes
+                were handled, or None to only update by time.
+        """
+        self.callback = callback
+        self.min_interval_s = min_interval_s
+        self.min_bytes = min_bytes
+
+    @contextlib.contextmanager
+    def task(
+        self, total: Optional[int], description: str = _DOWNLOAD_DESCRIPTION
+    ) -> Iterator[Callable[[int], None]]:
+        """Start a task.
+
+        Args:
+            total: Total number of bytes, or None if unknown.
+            description: Description of the task.
+
+        Yields:
+            Function to call with the number of bytes handled.
+        """
+        update = ProgressUpdate(description, 0, total)
+        self.callback(dataclasses.replace(update))
+
+        def report(num_bytes: int) -> None:
+            update.completed += num_bytes
+            self.callback(dataclasses.replace(update))
+
+        throttle = _Throttle(report, self.min_interval_s, self.min_bytes)
+        try:
+            yield throttle.advance
+        finally:
+            throttle.flush()
+
+
+class LabelledProgress:
+    """Prefix the descriptions of tasks passed to another sink, e.g. to tell
+    devices downloading at once apart.
+    """
+
+    def __init__(self, sink: ProgressSink, label: str) -> None:
+        """Create progress sink.
+
+        Args:
+            sink: Sink to pass tasks to.
+            label: Prefix for task descriptions.
+        """
+        self.sink = sink
+        self.label = label
+
+    def task(
+        self, total: Optional[int], description: str = _DOWNLOAD_DESCRIPTION
+    ) -> ContextManager[Callable[[int], None]]:
+        """Start a task on the other sink.
+
+        Args:
+            total: Total number of bytes, or None if unknown.
+            description: Description of the task.
+
+        Returns:
+            The other sink's task.
+        """
+        return self.sink.task(total, f"{self.label} {description}")
+
+
+def _make_progress_bar(
+    progress: "Progress",
+    total: Optional[int],
+    description: str = _DOWNLOAD_DESCRIPTION,
+) -> Optional["TaskID"]:
+    """Create task for rich progress bar, but only if logging level is not
+    DEBUG since they would conflict on the output.
+
+    Args:
+        progress: rich progress bar.
+        total: Total number of bytes, or None if unknown.
+        description: Description of the task.
+
+    Returns:
+        Task for rich progress bar or None if logging level is DEBUG.
+    """
+    if logger.getEffectiveLevel() != logging.DEBUG:
+        return progress.add_task(
+            f"[blue]{description}",
+            total=total,
+            start_task=False,
+        )
+
+    return None
+
+
+class RichProgress:
+    """Show download tasks on a rich progress bar, which may be shared by
+    several devices downloading at once.
+    """
+
+    def __init__(
+        self,
+        progress: Optional["Progress"] = None,
+        min_interval_s: float = DEFAULT_MIN_INTERVAL_S,
+    ) -> None:
+        """Create progress display.
+
+        Args:
+            progress: Shared rich progress bar, which must already be started,
+                or None to show a new progress bar for each task.
+            min_interval_s: Minimum time between updates of a task.
+        """
+        self.progress = progress
+        self.min_interval_s = min_interval_s
+
+    @classmethod
+    @contextlib.contextmanager
+    def shared(
+        cls, min_interval_s: float = DEFAULT_MIN_INTERVAL_S
+    ) -> Iterator["RichProgress"]:
+        """Show one rich progress bar for the tasks of several devices.
+
+        Args:
+            min_interval_s: Minimum time between updates of a task.
+
+        Yields:
+            Progress display, until the progress bar is stopped.
+        """
+        from rich.progress import Progress
+
+        with Progress() as progress:
+            yield cls(progress, min_interval_s)
+
+    @contextlib.contextmanager
+    def task(
+        self, total: Optional[int], description: str = _DOWNLOAD_DESCRIPTION
+    ) -> Iterator[Callable[[int], None]]:
+        """Show progress of a task.
+
+        Args:
+            total: Total number of bytes, or None if unknown.
+            description: Description of the task.
+
+        Yields:
+            Function to call with the number of bytes handled.
+        """
+        if self.progress is None:
+            with RichProgress.shared(self.min_interval_s) as display:
+                with display.task(total, description) as advance:
+                    yield advance
+            return
+
+        task = _make_progress_bar(self.progress, total, description)
+        if task is None:
+            yield lambda num_bytes: None
+            return
+
+        progress = self.progress
+        throttle = _Throttle(
+            lambda num_bytes: progress.update(task, advance=num_bytes),
+            self.min_interval_s,
+            None,
+        )
+        try:
+            yield throttle.advance
+        finally:
+            throttle.flush()
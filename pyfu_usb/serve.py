@@ -0,0 +1,682 @@
+# Copyright 2022 Block, Inc.
+"""Long-running service which flashes jobs sent over a local socket, for
+stations which flash many boards (`pyfu-usb serve`).
+
+Clients send one JSON request per line and receive JSON lines back. A flash
+job names an image, a device selector and options of `pyfu_usb.download`::
+
+    {"op": "flash", "image": "app.hex", "device": {"serial": "ABC123"},
+     "options": {"verify": "hash"}}
+
+The image is either uploaded as base64 in "data", where its name only tells
+its format, or read from a path under the image root the service was started
+with. Clients cannot name other files, since the service usually runs with
+access to USB devices, often as root.
+
+Its status is streamed back to the client which sent it: "queued", then
+"running" and "progress" updates, and finally "done" with the metrics of the
+download, "failed" or "cancelled". Jobs keep running if their client
+disconnects. `{"op": "cancel", "job": 1}` cancels a job, and
+`{"op": "list"}` lists the attached devices.
+
+Images are read, hashed and parsed once, and kept in an LRU cache keyed by
+their content hash. Each job runs on the first idle device matching its
+selector, with an optional limit of jobs at once per USB bus.
+"""
+
+import asyncio
+import base64
+import collections
+import contextlib
+import dataclasses
+import functools
+import hashlib
+import itertools
+import json
+import logging
+import os
+import stat
+import threading
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    OrderedDict,
+    Set,
+    Tuple,
+)
+
+import usb
+
+from . import (
+    GROUP_BUS,
+    DownloadCancelled,
+    DownloadOptions,
+    _get_dfu_devices,
+    _group_key,
+    aio,
+    cache,
+    descriptor,
+    image,
+    loaders,
+)
+
+logger = logging.getLogger(__name__)
+
+# Default size of the image cache, in bytes
+DEFAULT_IMAGE_CACHE_BYTES = 256 * 1024 * 1024
+
+# Maximum size of a request line, which includes uploaded images
+MAX_REQUEST_BYTES = 64 * 1024 * 1024
+
+# Job statuses
+STATUS_QUEUED = "queued"
+STATUS_RUNNING = "running"
+STATUS_PROGRESS = "progress"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+STATUS_CANCELLED = "cancelled"
+
+# Keys of the device selectors and options of flash jobs. Options other than
+# the interface and address are those of `DownloadOptions`.
+_SELECTOR_KEYS = ("vid", "pid", "serial", "bus", "port_path")
+_ARGUMENT_KEYS = ("interface", "address")
+_OPTION_KEYS = (
+    *_ARGUMENT_KEYS,
+    "per_chunk_address",
+    "sparse",
+    "delta",
+    "verify",
+    "mass_erase_threshold",
+    "erase_schedule",
+)
+
+# Keys given in hex, like on the command line
+_HEX_KEYS = ("vid", "pid", "address")
+
+# Image cache key: SHA-256 hash of the content and file extension
+_ImageKey = Tuple[str, str]
+
+# Sends a message to a client
+_Send = Callable[[Dict[str, Any]], Awaitable[None]]
+
+
+def _image_size(loaded: image.LoadedImage) -> int:
+    """Estimate the memory used by a loaded image.
+
+    Args:
+        loaded: Loaded image.
+
+    Returns:
+        Size of the image and its segments, in bytes.
+    """
+    return len(loaded.data) + sum(
+        len(segment.data) for segment in loaded.segments or []
+    )
+
+
+class ImageCache:
+    """LRU cache of loaded images, keyed by content hash. The cache can be
+    shared between threads.
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_IMAGE_CACHE_BYTES) -> None:
+        """Create an empty cache.
+
+        Args:
+            max_bytes: Size of the cached images and their segments above
+                which the least recently used images are evicted. The most
+                recent image is kept even if it is larger.
+        """
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._size = 0
+        self._images: OrderedDict[_ImageKey, image.LoadedImage] = (
+            collections.OrderedDict()
+        )
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._images)
+
+    def load(self, path: str) -> Tuple[str, image.LoadedImage, bool]:
+        """Read an image, and load it unless an image with the same content
+        and format is cached.
+
+        Args:
+            path: Image file.
+
+        Returns:
+            SHA-256 hash of the image, the loaded image, and whether it was
+            cached.
+
+        Raises:
+            FileNotFoundError: File does not exist.
+            ValueError: Image is invalid in the format of its file extension.
+        """
+        with open(path, "rb") as fin:
+            data = fin.read()
+        return self.load_data(path, data)
+
+    def load_data(
+        self, name: str, data: bytes
+    ) -> Tuple[str, image.LoadedImage, bool]:
+        """Load an image unless an image with the same content and format is
+        cached.
+
+        Args:
+            name: Image name, whose extension tells its format.
+            data: Image content.
+
+        Returns:
+            SHA-256 hash of the image, the loaded image, and whether it was
+            cached.
+
+        Raises:
+            ValueError: Image is invalid in the format of its file extension.
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        # The extension tells the format, so it is part of the key
+        key = (digest, os.path.splitext(name)[1].lower())
+        with self._lock:
+            loaded = self._images.get(key)
+            if loaded is not None:
+                self._images.move_to_end(key)
+                self.hits += 1
+                return digest, loaded, True
+
+        loaded = image.LoadedImage(name, data, loaders.load(data, name))
+        with self._lock:
+            self.misses += 1
+            if key not in self._images:
+                self._images[key] = loaded
+                self._size += _image_size(loaded)
+            while self._size > self.max_bytes and len(self._images) > 1:
+                _, evicted = self._images.popitem(last=False)
+                self._size -= _image_size(evicted)
+                logger.debug("Evicted image %s from cache", evicted.name)
+        return digest, loaded, False
+
+
+class DeviceScheduler:
+    """Assigns jobs to idle devices, with an optional limit of jobs at once
+    per USB bus.
+    """
+
+    def __init__(self, max_per_bus: Optional[int] = None) -> None:
+        """Create scheduler. Must be created in the event loop it is used in.
+
+        Args:
+            max_per_bus: Maximum number of jobs at once per USB bus, or None
+                for no limit.
+        """
+        self.max_per_bus = max_per_bus
+        self.busy: Set[str] = set()
+        self._bus_jobs: Dict[str, int] = collections.Counter()
+        self._released = asyncio.Condition()
+        # Number of releases so far, to notice one which happened during a scan
+        self._releases = 0
+
+    def _available(self, dev: usb.core.Device) -> bool:
+        """Check whether a job can start on a device.
+
+        Args:
+            dev: USB device in DFU mode.
+
+        Returns:
+            Whether the device is idle and its bus below the limit.
+        """
+        return descriptor.get_port_path(dev) not in self.busy and (
+            self.max_per_bus is None
+            or self._bus_jobs[_group_key(dev, GROUP_BUS)] < self.max_per_bus
+        )
+
+    async def acquire(self, selector: Dict[str, Any]) -> usb.core.Device:
+        """Wait for a device matching a selector to be available, and mark it
+        busy.
+
+        Args:
+            selector: Arguments of `_get_dfu_devices` to select devices.
+
+        Returns:
+            USB device in DFU mode.
+
+        Raises:
+            RuntimeError: No matching device is attached.
+        """
+        loop = asyncio.get_running_loop()
+        scan = functools.partial(_get_dfu_devices, **selector)
+        while True:
+            # Scan without holding the lock, so other jobs can start and end
+            releases = self._releases
+            devices = await loop.run_in_executor(None, scan)
+            if not devices:
+                raise RuntimeError("No devices found in DFU mode")
+
+            async with self._released:
+                for dev in devices:
+                    if self._available(dev):
+                        self.busy.add(descriptor.get_port_path(dev))
+                        self._bus_jobs[_group_key(dev, GROUP_BUS)] += 1
+                        return dev
+
+                # Scan again once a job ends, unless one ended during the scan
+                if self._releases == releases:
+                    await self._released.wait()
+
+    async def release(self, dev: usb.core.Device) -> None:
+        """Mark a device idle again.
+
+        Args:
+            dev: USB device returned by `acquire`.
+        """
+        async with self._released:
+            self.busy.discard(descriptor.get_port_path(dev))
+            self._bus_jobs[_group_key(dev, GROUP_BUS)] -= 1
+            self._releases += 1
+            self._released.notify_all()
+
+
+def _parse_hex(value: Any) -> Any:
+    """Parse a hex string, like the VID, PID and address arguments of the
+    CLI. Other values are passed as they are, e.g. numbers.
+
+    Args:
+        value: Hex string or other value.
+
+    Returns:
+        Number or other value.
+
+    Raises:
+        ValueError: String is not a hex number.
+    """
+    return int(value, 16) if isinstance(value, str) else value
+
+
+def _image_path(image_root: Optional[str], name: str) -> str:
+    """Resolve the path of an image under the image root.
+
+    Args:
+        image_root: Directory of the images clients can name, or None if
+            images must be uploaded.
+        name: Image path relative to the image root.
+
+    Returns:
+        Image file.
+
+    Raises:
+        ValueError: Images cannot be named, or the path is outside the image
+            root.
+    """
+    if image_root is None:
+        raise ValueError("Flash job must upload its image data")
+
+    root = os.path.realpath(image_root)
+    path = os.path.realpath(os.path.join(root, name))
+    if os.path.commonpath([root, path]) != root:
+        raise ValueError(f"Image is outside the image root: {name}")
+    return path
+
+
+def _parse_job(
+    request: Dict[str, Any], image_root: Optional[str]
+) -> Tuple[str, Optional[bytes], Dict[str, Any], Dict[str, Any]]:
+    """Parse a flash job request.
+
+    Args:
+        request: Request from a client.
+        image_root: Directory of the images clients can name, or None if
+            images must be uploaded.
+
+    Returns:
+        Image name or path, uploaded image data or None to read the path,
+        device selector, and the interface, address and `DownloadOptions`
+        arguments of `pyfu_usb.download`.
+
+    Raises:
+        ValueError: Request or its options are invalid.
+    """
+    name = request.get("image")
+    if not isinstance(name, str):
+        raise ValueError("Flash job needs an image name")
+
+    encoded = request.get("data")
+    if encoded is None:
+        data = None
+        name = _image_path(image_root, name)
+    elif isinstance(encoded, str):
+        # binascii.Error is a ValueError
+        data = base64.b64decode(encoded, validate=True)
+        name = os.path.basename(name)
+    else:
+        raise ValueError("Flash job data must be a base64 string")
+
+    parsed = []
+    for field, allowed in (
+        ("device", _SELECTOR_KEYS),
+        ("options", _OPTION_KEYS),
+    ):
+        values = request.get(field, {})
+        if not isinstance(values, dict):
+            raise ValueError(f"Flash job {field} must be an object")
+        unknown = sorted(set(values) - set(allowed))
+        if unknown:
+            raise ValueError(f"Unknown flash job {field}: {', '.join(unknown)}")
+        parsed.append(
+            {
+                key: _parse_hex(value) if key in _HEX_KEYS else value
+                for key, value in values.items()
+            }
+        )
+    selector, values = parsed
+    arguments = {
+        key: values.pop(key) for key in _ARGUMENT_KEYS if key in values
+    }
+    return (
+        name,
+        data,
+        selector,
+        {**arguments, "options": DownloadOptions(**values)},
+    )
+
+
+def _describe_devices() -> List[Dict[str, Any]]:
+    """Describe the devices in DFU mode or runtime mode.
+
+    Returns:
+        Identity, bus, address and location of each device.
+    """
+    return [
+        {
+            **dataclasses.asdict(cache.DeviceKey.from_device(dev)),
+            "bus": dev.bus,
+            "address": dev.address,
+            "port_path": descriptor.get_port_path(dev),
+        }
+        for dev in _get_dfu_devices(runtime=None)
+    ]
+
+
+class Server:
+    """Accepts flash jobs from clients and runs them."""
+
+    def __init__(
+        self,
+        image_cache: Optional[ImageCache] = None,
+        max_per_bus: Optional[int] = None,
+        descriptor_cache: Optional[cache.DescriptorCache] = None,
+        image_root: Optional[str] = None,
+    ) -> None:
+        """Create server. Must be created in the event loop it runs in.
+
+        Args:
+            image_cache: Cache of loaded images, or None for a new one.
+            max_per_bus: Maximum number of jobs at once per USB bus, or None
+                for no limit.
+            descriptor_cache: Cache of DFU descriptors and DfuSe memory
+                layouts, see `pyfu_usb.download`.
+            image_root: Directory of the images clients can name by path, or
+                None if clients must upload their images.
+        """
+        self.image_cache = image_cache or ImageCache()
+        self.image_root = image_root
+        self.scheduler = DeviceScheduler(max_per_bus)
+        self.descriptor_cache = descriptor_cache
+        self.jobs: Dict[int, "asyncio.Future[None]"] = {}
+        self._job_ids = itertools.count(1)
+
+    async def start(
+        self, socket_path: Optional[str] = None, port: Optional[int] = None
+    ) -> asyncio.Server:
+        """Start listening on a Unix socket, or a TCP port on localhost.
+
+        Args:
+            socket_path: Unix socket path. A stale socket is replaced.
+            port: TCP port, used if no socket path is given. 0 picks a free
+                port.
+
+        Returns:
+            Listening server.
+
+        Raises:
+            ValueError: Neither a socket path nor a port was given.
+        """
+        if socket_path is not None:
+            with contextlib.suppress(FileNotFoundError):
+                if stat.S_ISSOCK(os.stat(socket_path).st_mode):
+                    os.unlink(socket_path)
+            listener = await asyncio.start_unix_server(
+                self.handle, path=socket_path, limit=MAX_REQUEST_BYTES
+            )
+        elif port is not None:
+            listener = await asyncio.start_server(
+                self.handle,
+                host="127.0.0.1",
+                port=port,
+                limit=MAX_REQUEST_BYTES,
+            )
+        else:
+            raise ValueError("Must provide socket path or port")
+
+        for sock in listener.sockets or []:
+            logger.info("Serving on %s", sock.getsockname())
+        return listener
+
+    async def handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        """Serve a client connection until the client disconnects.
+
+        Args:
+            reader: Requests from the client.
+            writer: Messages to the client.
+        """
+        lock = asyncio.Lock()
+
+        async def send(message: Dict[str, Any]) -> None:
+            async with lock:
+                if writer.is_closing():
+                    return
+                writer.write(json.dumps(message).encode() + b"\n")
+                with contextlib.suppress(ConnectionError):
+                    await writer.drain()
+
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    await self._handle_request(json.loads(line), send)
+                except ValueError as err:
+                    await send({"error": str(err)})
+        finally:
+            writer.close()
+
+    async def _handle_request(self, request: Any, send: _Send) -> None:
+        """Handle a request from a client.
+
+        Args:
+            request: Parsed JSON request.
+            send: Sends a message to the client.
+
+        Raises:
+            ValueError: Request is invalid.
+        """
+        if not isinstance(request, dict):
+            raise ValueError("Request must be an object")
+
+        op = request.get("op")
+        if op == "flash":
+            name, data, selector, options = _parse_job(request, self.image_root)
+            job_id = next(self._job_ids)
+            await send({"job": job_id, "status": STATUS_QUEUED})
+            task = asyncio.ensure_future(
+                self._run_job(job_id, name, data, selector, options, send)
+            )
+            self.jobs[job_id] = task
+            task.add_done_callback(lambda _: self.jobs.pop(job_id, None))
+        elif op == "cancel":
+            job_id = request.get("job")
+            task = self.jobs.get(job_id) if isinstance(job_id, int) else None
+            if task is None:
+                raise ValueError(f"No such job: {job_id}")
+            task.cancel()
+        elif op == "list":
+            devices = await asyncio.get_running_loop().run_in_executor(
+                None, _describe_devices
+            )
+            for device in devices:
+                device["busy"] = device["port_path"] in self.scheduler.busy
+            await send({"devices": devices})
+        else:
+            raise ValueError(f"Unknown op: {op}")
+
+    async def _run_job(
+        self,
+        job_id: int,
+        name: str,
+        data: Optional[bytes],
+        selector: Dict[str, Any],
+        options: Dict[str, Any],
+        send: _Send,
+    ) -> None:
+        """Run a flash job and report its status.
+
+        Args:
+            job_id: Job number.
+            name: Image file, or name of the uploaded image.
+            data: Uploaded image, or None to read the image file.
+            selector: Device selector.
+            options: Options of `pyfu_usb.download`.
+            send: Sends a message to the client which sent the job.
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            if data is None:
+                load = functools.partial(self.image_cache.load, name)
+            else:
+                load = functools.partial(self.image_cache.load_data, name, data)
+            digest, loaded, cached = await loop.run_in_executor(None, load)
+            dev = await self.scheduler.acquire(selector)
+            try:
+                port_path = descriptor.get_port_path(dev)
+                logger.info("[%s] Running job %d", port_path, job_id)
+                await send(
+                    {
+                        "job": job_id,
+                        "status": STATUS_RUNNING,
+                        "device": port_path,
+                        "image": digest,
+                        "cached": cached,
+                    }
+                )
+                download = aio.download(
+                    loaded,
+                    bus=dev.bus,
+                    port_path=port_path,
+                    descriptor_cache=self.descriptor_cache,
+                    **options,
+                )
+                try:
+                    async for update in download:
+                        await send(
+                            {
+                                "job": job_id,
+                                "status": STATUS_PROGRESS,
+                                **dataclasses.asdict(update),
+                            }
+                        )
+                    result = await download
+                except asyncio.CancelledError:
+                    await download.aclose()
+                    raise
+            finally:
+                await self.scheduler.release(dev)
+        except (asyncio.CancelledError, DownloadCancelled):
+            logger.info("Job %d cancelled", job_id)
+            await send({"job": job_id, "status": STATUS_CANCELLED})
+            return
+        except Exception as err:
+            logger.error("Job %d failed: %s", job_id, repr(err))
+            await send(
+                {"job": job_id, "status": STATUS_FAILED, "error": repr(err)}
+            )
+            return
+
+        await send(
+            {"job": job_id, "status": STATUS_DONE, "result": result.to_json()}
+        )
+
+
+async def _serve(
+    socket_path: Optional[str],
+    port: Optional[int],
+    max_per_bus: Optional[int],
+    image_cache_bytes: int,
+    descriptor_cache: Optional[cache.DescriptorCache],
+    image_root: Optional[str],
+) -> None:
+    """Run the service until cancelled.
+
+    Args:
+        socket_path: See `serve`.
+        port: See `serve`.
+        max_per_bus: See `serve`.
+        image_cache_bytes: See `serve`.
+        descriptor_cache: See `serve`.
+        image_root: See `serve`.
+    """
+    server = Server(
+        ImageCache(image_cache_bytes),
+        max_per_bus,
+        descriptor_cache,
+        image_root,
+    )
+    listener = await server.start(socket_path, port)
+    try:
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        aio.shutdown()
+        if socket_path is not None:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(socket_path)
+
+
+def serve(
+    socket_path: Optional[str] = None,
+    port: Optional[int] = None,
+    max_per_bus: Optional[int] = None,
+    image_cache_bytes: int = DEFAULT_IMAGE_CACHE_BYTES,
+    descriptor_cache: Optional[cache.DescriptorCache] = None,
+    image_root: Optional[str] = None,
+) -> None:
+    """Serve flash jobs until interrupted.
+
+    Args:
+        socket_path: Unix socket path to listen on.
+        port: TCP port to listen on, on localhost only, if no socket path is
+            given.
+        max_per_bus: Maximum number of jobs at once per USB bus, or None for
+            no limit.
+        image_cache_bytes: Size of the image cache, in bytes.
+        descriptor_cache: Cache of DFU descriptors and DfuSe memory layouts,
+            see `pyfu_usb.download`.
+        image_root: Directory of the images clients can name by path, or None
+            if clients must upload their images.
+    """
+    asyncio.run(
+        _serve(
+            socket_path,
+            port,
+            max_per_bus,
+            image_cache_bytes,
+            descriptor_cache,
+            image_root,
+        )
+    )
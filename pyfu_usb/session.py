@@ -0,0 +1,401 @@
+# Copyright 2022 Block, Inc.
+"""DFU sessions, which keep the interface of a device claimed across several
+operations.
+"""
+
+import logging
+import time
+from typing import TYPE_CHECKING, List, MutableMapping, Optional
+
+import usb
+
+from . import (
+    _get_dfu_device,
+    descriptor,
+    dfu,
+    dfuse,
+    downloader,
+    image,
+    plan,
+    progress,
+)
+from .downloader import DownloadResult
+from .options import VERIFY_COMPARE, DownloadOptions
+from .verify import check_can_verify, verify_firmware, verify_segments
+
+if TYPE_CHECKING:
+    from . import cache
+
+logger = logging.getLogger(__name__)
+
+
+class DfuSession:
+    """DFU device whose interface stays claimed across several operations.
+
+    The DFU functional descriptor and the DfuSe memory layouts are read once
+    and cached, so a job which writes several images, verifies them and then
+    leaves DFU mode pays for finding the device and claiming its interface
+    once::
+
+        with DfuSession(vid=0x0483, pid=0xDF11) as session:
+            session.download("app.bin", address=0x08000000)
+            session.download("config.bin", address=0x080E0000)
+            session.verify("app.bin", address=0x08000000)
+            session.leave(0x08000000)
+
+    DfuSe downloads stay in DFU mode until `leave` is called. Plain DFU
+    downloads always end with manifestation, after which many devices reset.
+    """
+
+    def __init__(
+        self,
+        dev: Optional[usb.core.Device] = None,
+        interface: int = 0,
+        vid: Optional[int] = None,
+        pid: Optional[int] = None,
+        serial: Optional[str] = None,
+        bus: Optional[int] = None,
+        port_path: Optional[str] = None,
+        descriptor_cache: Optional["cache.DescriptorCache"] = None,
+        display: Optional[progress.ProgressSink] = None,
+    ) -> None:
+        """Find the DFU device to use, without claiming it yet.
+
+        Args:
+            dev: USB device in DFU mode, or None to find the only matching
+                device.
+            interface: USB device interface.
+            vid: Vendor ID to narrow the search for DFU devices.
+            pid: Product ID to narrow the search for DFU devices.
+            serial: Serial number to narrow the search for DFU devices.
+            bus: USB bus number to narrow the search for DFU devices.
+            port_path: Location to narrow the search for DFU devices.
+            descriptor_cache: Cache to read the descriptors from, so they are
+                not read again in later sessions with the same device.
+            display: Receives the progress of every operation, or None for a
+                rich progress bar, see `pyfu_usb.download`.
+
+        Raises:
+            RuntimeError: Could not locate exactly one DFU device.
+        """
+        self.dev = dev or _get_dfu_device(
+            vid=vid, pid=pid, serial=serial, bus=bus, port_path=port_path
+        )
+        self.interface = interface
+        self.display = display or progress.RichProgress()
+        self._claimed = False
+        self._descriptor_cache = descriptor_cache
+        self._descriptor: Optional[descriptor.DfuDescriptor] = None
+        self._layouts: MutableMapping[int, List[descriptor.DfuSeMemoryLayout]]
+        if descriptor_cache is None:
+            self._layouts = {}
+        else:
+            self._layouts = descriptor_cache.layouts(self.dev, interface)
+
+    def open(self) -> None:
+        """Claim the DFU interface."""
+        if not self._claimed:
+            dfu.claim_interface(self.dev, self.interface)
+            self._claimed = True
+
+    def close(self) -> None:
+        """Release the DFU interface."""
+        if self._claimed:
+            dfu.release_interface(self.dev)
+            self._claimed = False
+
+    def __enter__(self) -> "DfuSession":
+        self.open()
+        return self
+
+    def __exit__(self, *args: object) -> None:
+        self.close()
+
+    @property
+    def dfu_descriptor(self) -> descriptor.DfuDescriptor:
+        """DFU functional descriptor, read on first use.
+
+        Raises:
+            ValueError: Could not read DFU device USB descriptor.
+        """
+        if self._descriptor is None:
+            if self._descriptor_cache is None:
+                self._descriptor = descriptor.get_dfu_descriptor(self.dev)
+            else:
+                self._descriptor = self._descriptor_cache.get_dfu_descriptor(
+                    self.dev
+                )
+            if self._descriptor is None:
+                raise ValueError(
+                    "No DFU descriptor, is this a valid DFU device?"
+                )
+        return self._descriptor
+
+    @property
+    def is_dfuse(self) -> bool:
+        """True if the device implements the DfuSe extensions."""
+        return self.dfu_descriptor.bcdDFUVersion == dfuse.DFUSE_VERSION_NUMBER
+
+    def memory_layout(
+        self, alternate_index: int = 0
+    ) -> List[descriptor.DfuSeMemoryLayout]:
+        """Get the DfuSe memory layout, read on first use.
+
+        Args:
+            alternate_index: Alternate setting of the interface.
+
+        Returns:
+            Memory layout.
+        """
+        return downloader.get_layout(
+            self.dev, self.interface, alternate_index, self._layouts
+        )
+
+    def _check(self, dfuse_required: bool = False) -> None:
+        """Check the session can be used.
+
+        Args:
+            dfuse_required: Whether the operation requires DfuSe.
+
+        Raises:
+            RuntimeError: Interface is not claimed.
+            ValueError: Device does not implement DfuSe.
+        """
+        if not self._claimed:
+            raise RuntimeError("DFU session is not open")
+        if dfuse_required and not self.is_dfuse:
+            raise ValueError("Operation requires a DfuSe device")
+
+    def _check_can_upload(self, dfuse_required: bool = False) -> None:
+        """Check the session can be used to read device memory.
+
+        Args:
+            dfuse_required: Whether the operation requires DfuSe.
+
+        Raises:
+            RuntimeError: Interface is not claimed.
+            ValueError: Device does not support upload or DfuSe.
+        """
+        self._check(dfuse_required)
+        if (
+            not self.dfu_descriptor.bmAttributes
+            & descriptor.DFU_ATTR_CAN_UPLOAD
+        ):
+            raise ValueError("Device does not support upload")
+
+    def download(
+        self,
+        source: image.ImageSource,
+        address: Optional[int] = None,
+        options: Optional[DownloadOptions] = None,
+    ) -> DownloadResult:
+        """Download an image, staying in DFU mode on DfuSe devices.
+
+        Args:
+            source: Image as accepted by `pyfu_usb.download`.
+            address: Base address to jump to in memory, see
+                `pyfu_usb.download`.
+            options: Download options, or None for the defaults.
+
+        Returns:
+            Time spent in each phase and the number of retries.
+
+        Raises:
+            RuntimeError: Session is not open, or verification failed.
+            ValueError: Address not provided, or the image does not suit the
+                device.
+        """
+        self._check()
+        result = DownloadResult()
+        start = time.monotonic()
+        with image.ChunkSource(source) as chunk_source:
+            downloader.download_claimed(
+                self.dev,
+                self.interface,
+                self.dfu_descriptor,
+                chunk_source,
+                address,
+                options=options,
+                display=self.display,
+                layouts=self._layouts,
+                leave=False,
+                result=result,
+            )
+        result.duration = time.monotonic() - start
+        return result
+
+    def download_segments(
+        self,
+        segments: List[image.Segment],
+        options: Optional[DownloadOptions] = None,
+    ) -> plan.SkipReport:
+        """Download segments to a DfuSe device, e.g. from `loaders.load`.
+
+        Args:
+            segments: Segments sorted by address.
+            options: Download options, or None for the defaults. Delta and
+                resuming are only supported for one segment.
+
+        Returns:
+            Work skipped by a sparse or delta download.
+
+        Raises:
+            RuntimeError: Session is not open, or verification failed.
+            ValueError: Device does not implement DfuSe, or no segments.
+        """
+        self._check(dfuse_required=True)
+        if options is not None and options.verify is not None:
+            check_can_verify(self.dfu_descriptor)
+        return downloader.dfuse_download_from_idle(
+            self.dev,
+            self.interface,
+            segments,
+            self.dfu_descriptor.wTransferSize,
+            downloader.as_segments(segments, 0)[0].address,
+            options=options,
+            display=self.display,
+            layouts=self._layouts,
+            leave=False,
+        )
+
+    def erase(self, address: int, size: int) -> int:
+        """Erase the DfuSe pages which hold an address range.
+
+        Args:
+            address: Start address of range.
+            size: Size of range in bytes.
+
+        Returns:
+            Number of pages erased.
+
+        Raises:
+            RuntimeError: Session is not open.
+            ValueError: Device does not implement DfuSe.
+        """
+        self._check(dfuse_required=True)
+        pages = plan.get_pages(self.memory_layout(), address, address + size)
+        for page in pages:
+            logger.info("Erasing page 0x%X of size %d", page.addr, page.size)
+            dfuse.page_erase(self.dev, self.interface, page.addr)
+        return len(pages)
+
+    def mass_erase(self) -> None:
+        """Erase all DfuSe device memory.
+
+        Raises:
+            RuntimeError: Session is not open.
+            ValueError: Device does not implement DfuSe.
+        """
+        self._check(dfuse_required=True)
+        logger.info("Mass erasing device")
+        dfuse.mass_erase(self.dev, self.interface)
+
+    def upload(self, size: int, address: Optional[int] = None) -> bytes:
+        """Read device memory with UPLOAD requests.
+
+        Args:
+            size: Number of bytes to read.
+            address: Address to read from on DfuSe devices. Plain DFU devices
+                are always read from the start of the firmware.
+
+        Returns:
+            Data read, which may be shorter than `size` for plain DFU devices.
+
+        Raises:
+            RuntimeError: Session is not open.
+            ValueError: Device does not support upload, or no address for a
+                DfuSe device.
+        """
+        self._check_can_upload()
+        xfer_size = self.dfu_descriptor.wTransferSize
+        if not self.is_dfuse:
+            return b"".join(
+                dfu.read_firmware(self.dev, self.interface, size, xfer_size)
+            )
+        if address is None:
+            raise ValueError("Must provide address for DfuSe")
+        return b"".join(
+            dfuse.read_memory(
+                self.dev, self.interface, address, size, xfer_size
+            )
+        )
+
+    def verify(
+        self,
+        source: image.ImageSource,
+        address: Optional[int] = None,
+        mode: str = VERIFY_COMPARE,
+    ) -> None:
+        """Check device memory holds an image by reading it back.
+
+        Args:
+            source: Image as accepted by `pyfu_usb.download`, except DfuSe
+                files.
+            address: Start address of a raw image on DfuSe devices.
+            mode: `VERIFY_COMPARE` or `VERIFY_HASH`.
+
+        Raises:
+            RuntimeError: Session is not open, or verification failed.
+            ValueError: Device does not support upload, or the image does not
+                suit the device.
+        """
+        self._check_can_upload()
+        xfer_size = self.dfu_descriptor.wTransferSize
+        with image.ChunkSource(source) as chunk_source:
+            dfu_file = downloader.parse_dfu_file(self.dev, chunk_source)
+            if dfu_file is not None and dfu_file.targets:
+                raise ValueError("Verifying DfuSe files is unsupported")
+            if self.is_dfuse:
+                data, start_address = downloader.dfuse_image(
+                    chunk_source, dfu_file, address
+                )
+                self.verify_segments(
+                    downloader.as_segments(data, start_address), mode
+                )
+                return
+
+            verify_firmware(
+                self.dev,
+                self.interface,
+                downloader.dfu_image(chunk_source, dfu_file).buffer,
+                xfer_size,
+                mode,
+                self.display,
+            )
+
+    def verify_segments(
+        self, segments: List[image.Segment], mode: str = VERIFY_COMPARE
+    ) -> None:
+        """Check DfuSe device memory holds segments by reading them back.
+
+        Args:
+            segments: Segments sorted by address.
+            mode: `VERIFY_COMPARE` or `VERIFY_HASH`.
+
+        Raises:
+            RuntimeError: Session is not open, or verification failed.
+            ValueError: Device does not support upload or DfuSe.
+        """
+        self._check_can_upload(dfuse_required=True)
+        verify_segments(
+            self.dev,
+            self.interface,
+            segments,
+            self.dfu_descriptor.wTransferSize,
+            False,
+            mode,
+            self.display,
+        )
+
+    def leave(self, address: int) -> None:
+        """Leave DFU mode on a DfuSe device and jump to an address.
+
+        Args:
+            address: Address to jump to in device memory.
+
+        Raises:
+            RuntimeError: Session is not open.
+            ValueError: Device does not implement DfuSe.
+        """
+        self._check(dfuse_required=True)
+        downloader.dfuse_leave(self.dev, self.interface, address)
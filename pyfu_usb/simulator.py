@@ -0,0 +1,892 @@
+# Copyright 2022 Block, Inc.
+"""In-process DFU and DfuSe device, to test and measure downloads without
+hardware.
+
+`SimulatedDevice` implements the DFU 1.1 state machine and the DfuSe commands
+behind the `transport.ClaimableTransport` interface, with the descriptors that
+`descriptor` reads from USB devices. It can be used wherever a DFU device in
+DFU mode is accepted, e.g. `DfuSession(SimulatedDevice())`::
+
+    device = SimulatedDevice(timing=Timing(program_ms_per_kb=1.0))
+    with DfuSession(device) as session:
+        session.download("app.bin", address=0x08000000)
+    assert device.read_memory(0x08000000, 4) == open("app.bin", "rb").read(4)
+
+Flash memory is simulated as NOR flash: erasing sets bytes to 0xFF and
+writing can only clear bits, so writing pages which were not erased corrupts
+them like on a real device.
+"""
+
+import array
+import collections
+import dataclasses
+import errno
+import logging
+import math
+import struct
+import time
+from typing import (
+    TYPE_CHECKING,
+    Counter,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
+
+import usb
+
+from . import descriptor, dfu, dfuse
+
+logger = logging.getLogger(__name__)
+
+# STM32F2 internal flash, the default memory layout
+STM32F2_LAYOUT = "@Internal Flash  /0x08000000/04*016Kg,01*064Kg,07*128Kg"
+
+# Operations which faults can be injected into
+OP_SET_ADDRESS = "set_address"
+OP_ERASE = "erase"
+OP_WRITE = "write"
+OP_MANIFEST = "manifest"
+OP_UPLOAD = "upload"
+OP_GETSTATUS = "getstatus"
+
+# Kinds of faults
+FAULT_STALL = "stall"
+FAULT_TIMEOUT = "timeout"
+FAULT_ERROR = "error"
+FAULT_CORRUPT = "corrupt"
+
+# DFU status codes (bStatus)
+STATUS_OK = 0x00
+STATUS_ERR_TARGET = 0x01
+STATUS_ERR_WRITE = 0x03
+STATUS_ERR_ERASE = 0x04
+STATUS_ERR_PROG = 0x06
+STATUS_ERR_VERIFY = 0x07
+STATUS_ERR_ADDRESS = 0x08
+STATUS_ERR_STALLEDPKT = 0x0F
+
+# Standard GET_DESCRIPTOR request for string descriptors
+_USB_REQUEST_TYPE_STANDARD_IN = 0x80
+_USB_REQ_GET_DESCRIPTOR = 0x06
+_USB_DESC_TYPE_STRING = 0x03
+_USB_LANGID_EN_US = 0x0409
+
+# DfuSe command to upload the supported commands, in block 0
+_DFUSE_CMD_GET_COMMANDS = 0x00
+_DFUSE_CMD_READ_UNPROTECT = 0x92
+
+# Largest bwPollTimeout, which has 3 bytes
+_MAX_POLL_TIMEOUT_MS = 0xFFFFFF
+
+# wDetachTimeOut and bcdDFUVersion of plain DFU devices
+_DETACH_TIMEOUT_MS = 0xFF
+_DFU_VERSION = 0x0110
+
+# String descriptor indices
+_STRING_SERIAL = 1
+_STRING_FIRST_LAYOUT = 2
+
+
+@dataclasses.dataclass
+class Timing:
+    """Latencies of a simulated device, in milliseconds. All default to 0, so
+    the device responds as fast as possible.
+    """
+
+    # Round trip of each control transfer
+    transfer_ms: float = 0.0
+    # Bus throughput for the data stage, or None for no limit
+    bus_kb_per_s: Optional[float] = None
+    # Busy time after SET_ADDRESS and other DfuSe commands
+    command_ms: float = 0.0
+    # Busy time erasing a page, per KiB of the page
+    erase_ms_per_kb: float = 0.0
+    # Busy time erasing all memory
+    mass_erase_ms: float = 0.0
+    # Busy time programming a block, per KiB of data
+    program_ms_per_kb: float = 0.0
+    # Busy time in manifestation
+    manifest_ms: float = 0.0
+    # bwPollTimeout reported while busy, or None to report the remaining busy
+    # time. Devices which report less than they need are polled more often.
+    poll_timeout_ms: Optional[int] = None
+
+
+@dataclasses.dataclass
+class Fault:
+    """Fault to inject into the operations of a simulated device."""
+
+    # Operation to fail, OP_*
+    operation: str
+    # FAULT_STALL fails the request with a pipe error and enters dfuERROR,
+    # FAULT_TIMEOUT fails the request with a timeout and ignores it,
+    # FAULT_ERROR completes a download operation with `status` in dfuERROR,
+    # and FAULT_CORRUPT flips a bit of the data written or uploaded
+    kind: str = FAULT_STALL
+    # Number of matching operations which succeed first
+    after: int = 0
+    # Number of matching operations to fail, or 0 for all of them
+    count: int = 1
+    # bStatus reported for FAULT_ERROR
+    status: int = STATUS_ERR_WRITE
+    # Number of matching operations seen
+    seen: int = 0
+
+    def trigger(self, operation: str) -> bool:
+        """Count an operation and check whether it fails.
+
+        Args:
+            operation: Operation being started, OP_*.
+
+        Returns:
+            True if the fault applies to this operation.
+        """
+        if operation != self.operation:
+            return False
+        self.seen += 1
+        return self.seen > self.after and (
+            self.count == 0 or self.seen <= self.after + self.count
+        )
+
+
+@dataclasses.dataclass
+class _Operation:
+    """Operation started by a download request, which completes while the
+    device is busy.
+    """
+
+    name: str
+    # Address of a DfuSe command, or of the data to write
+    address: Optional[int] = None
+    data: bytes = b""
+    busy_ms: float = 0.0
+    fault: Optional[Fault] = None
+
+
+class _Interface:
+    """Interface descriptor of one alternate setting."""
+
+    def __init__(
+        self, alternate_setting: int, string_index: int, extra: bytes
+    ) -> None:
+        # NOTE: Alternate naming convention used to match USB spec
+        self.bInterfaceNumber = 0
+        self.bAlternateSetting = alternate_setting
+        self.alternate_index = alternate_setting
+        self.bInterfaceClass = descriptor.DFU_INTERFACE_CLASS
+        self.bInterfaceSubClass = descriptor.DFU_INTERFACE_SUBCLASS
+        self.bInterfaceProtocol = descriptor.DFU_PROTOCOL_DFU
+        self.iInterface = string_index
+        self.extra_descriptors = array.array("B", extra)
+
+
+class _Configuration:
+    """Configuration descriptor, which indexes interfaces like pyusb."""
+
+    def __init__(self, interfaces: List[_Interface]) -> None:
+        self._interfaces = interfaces
+
+    def __iter__(self) -> Iterator[_Interface]:
+        return iter(self._interfaces)
+
+    def __getitem__(self, index: Tuple[int, int]) -> _Interface:
+        interface, alternate_setting = index
+        if interface != 0 or alternate_setting >= len(self._interfaces):
+            raise IndexError(f"No interface {index}")
+        return self._interfaces[alternate_setting]
+
+
+# Simulated devices are used in place of pyusb devices
+if TYPE_CHECKING:
+    _DeviceBase = usb.core.Device
+else:
+    _DeviceBase = object
+
+
+class SimulatedDevice(_DeviceBase):
+    """DFU device in DFU mode, simulated in-process.
+
+    Counts of the requests and operations it handled are kept in `counts`,
+    keyed by OP_* or the request name, with the total number of control
+    transfers under "transfer", for measurements.
+    """
+
+    def __init__(
+        self,
+        layouts: Sequence[str] = (STM32F2_LAYOUT,),
+        transfer_size: int = 2048,
+        attributes: int = descriptor.DFU_ATTR_CAN_DOWNLOAD
+        | descriptor.DFU_ATTR_CAN_UPLOAD
+        | descriptor.DFU_ATTR_WILL_DETACH,
+        timing: Optional[Timing] = None,
+        faults: Iterable[Fault] = (),
+        firmware_size: int = 0x10000,
+        serial_number: str = "SIM0001",
+    ) -> None:
+        """Create a device in the dfuIDLE state, with erased memory.
+
+        Args:
+            layouts: DfuSe memory layout string of each alternate setting, or
+                no layouts for a plain DFU device.
+            transfer_size: wTransferSize of the DFU descriptor.
+            attributes: bmAttributes of the DFU descriptor.
+            timing: Latencies, or None to respond as fast as possible.
+            faults: Faults to inject.
+            firmware_size: Size of the firmware of a plain DFU device.
+            serial_number: Serial number string.
+        """
+        # NOTE: Alternate naming convention used to match USB spec
+        self.idVendor = 0x0483
+        self.idProduct = 0xDF11
+        self.bcdDevice = 0x2200
+        self._serial_number = serial_number
+        self.bus = 1
+        self.address = 1
+        self.port_numbers = (1,)
+
+        self.layouts = list(layouts)
+        self.is_dfuse = bool(self.layouts)
+        self.transfer_size = transfer_size
+        self.attributes = attributes
+        self.timing = timing or Timing()
+        self.faults = list(faults)
+        self.counts: Counter[str] = collections.Counter()
+        self.alternate_setting = 0
+        self.claimed = False
+        self.attached = True
+
+        # Memory by segment of every alternate setting's layout
+        self.segments: List[Tuple[descriptor.DfuSeMemoryLayout, bytearray]] = [
+            (segment, bytearray(b"\xff" * segment.size))
+            for layout in self.layouts
+            for segment in descriptor.parse_memory_layout(layout)
+        ]
+        # Firmware of a plain DFU device, allocated up front so downloads do
+        # not allocate device memory
+        self.firmware = bytearray(firmware_size)
+        self.firmware_length = 0
+
+        self.state = dfu._DFU_STATE_DFU_IDLE
+        self.status = STATUS_OK
+        self._address = 0
+        self._upload_offset = 0
+        self._pending: Optional[_Operation] = None
+        self._busy_until = 0.0
+
+        extra = struct.pack(
+            "<BBBHHH",
+            descriptor._DFU_DESCRIPTOR_LEN,
+            descriptor._DFU_DESCRIPTOR_ID,
+            attributes,
+            _DETACH_TIMEOUT_MS,
+            transfer_size,
+            dfuse.DFUSE_VERSION_NUMBER if self.is_dfuse else _DFU_VERSION,
+        )
+        self._configuration = _Configuration(
+            [
+                _Interface(alt, _STRING_FIRST_LAYOUT + alt, extra)
+                for alt in range(max(1, len(self.layouts)))
+            ]
+        )
+
+    @property
+    def serial_number(self) -> str:
+        """Serial number string."""
+        return self._serial_number
+
+    @property
+    def langids(self) -> Tuple[int, ...]:
+        """Language IDs of the string descriptors."""
+        return (_USB_LANGID_EN_US,)
+
+    def __iter__(self) -> Iterator[_Configuration]:
+        return iter([self._configuration])
+
+    def __getitem__(self, index: int) -> _Configuration:
+        if index != 0:
+            raise IndexError(f"No configuration {index}")
+        return self._configuration
+
+    def claim_interface(self, interface: int) -> None:
+        """Claim the DFU interface.
+
+        Args:
+            interface: Interface number, which must be 0.
+
+        Raises:
+            ValueError: No such interface.
+        """
+        if interface != 0:
+            raise ValueError(f"No interface {interface}")
+        self.claimed = True
+
+    def release_interface(self) -> None:
+        """Release the DFU interface."""
+        self.claimed = False
+
+    def set_interface_altsetting(
+        self, interface: int = 0, alternate_setting: int = 0
+    ) -> None:
+        """Select an alternate setting, like `usb.core.Device`.
+
+        Args:
+            interface: Interface number, which must be 0.
+            alternate_setting: Alternate setting.
+
+        Raises:
+            ValueError: No such interface or alternate setting.
+        """
+        if interface != 0 or alternate_setting >= max(1, len(self.layouts)):
+            raise ValueError(
+                f"No alternate setting {alternate_setting} of interface "
+                f"{interface}"
+            )
+        self.alternate_setting = alternate_setting
+
+    def reset(self) -> None:
+        """Reset the device, which enumerates in DFU mode again."""
+        self.attached = True
+        self.state = dfu._DFU_STATE_DFU_IDLE
+        self.status = STATUS_OK
+        self._pending = None
+
+    def read_memory(self, address: int, length: int) -> bytes:
+        """Read device memory, without going through requests.
+
+        Args:
+            address: Address of the first byte, or offset in the firmware of a
+                plain DFU device.
+            length: Number of bytes to read.
+
+        Returns:
+            Memory contents.
+
+        Raises:
+            ValueError: Range is not in device memory.
+        """
+        if not self.is_dfuse:
+            end = min(address + length, self.firmware_length)
+            return bytes(self.firmware[address:end])
+        return b"".join(
+            bytes(memory[offset : offset + size])
+            for memory, offset, size in self._locate(address, length)
+        )
+
+    def ctrl_transfer(
+        self,
+        bmRequestType: int,
+        bRequest: int,
+        wValue: int = 0,
+        wIndex: int = 0,
+        data_or_wLength: Optional[Union[int, Sequence[int], bytes]] = None,
+        timeout: Optional[int] = None,
+    ) -> Union[int, Sequence[int]]:
+        """Handle a control transfer, like `usb.core.Device.ctrl_transfer`.
+
+        Args:
+            bmRequestType: Request type.
+            bRequest: Request code.
+            wValue: Request value.
+            wIndex: Request index.
+            data_or_wLength: Data of OUT requests, or length of IN requests.
+            timeout: Timeout in milliseconds, which is not simulated.
+
+        Returns:
+            Number of bytes received for OUT requests, or the data sent for IN
+            requests.
+
+        Raises:
+            usb.core.USBError: Request stalled, timed out or the device is not
+                attached.
+        """
+        if not self.attached:
+            raise usb.core.USBError("No such device", errno=errno.ENODEV)
+
+        self.counts["transfer"] += 1
+        if isinstance(data_or_wLength, int):
+            size, data = data_or_wLength, b""
+        else:
+            data = bytes(data_or_wLength or b"")
+            size = len(data)
+        self._delay_transfer(size)
+
+        if (bmRequestType, bRequest) == (
+            _USB_REQUEST_TYPE_STANDARD_IN,
+            _USB_REQ_GET_DESCRIPTOR,
+        ):
+            return self._get_string(wValue, size)
+
+        if bmRequestType == dfu._USB_REQUEST_TYPE_SEND:
+            self._handle_out(bRequest, wValue, data)
+            return len(data)
+
+        if bmRequestType == dfu._USB_REQUEST_TYPE_RECV:
+            return array.array("B", self._handle_in(bRequest, wValue, size))
+
+        raise self._stall(f"Unsupported request type 0x{bmRequestType:02X}")
+
+    def _delay_transfer(self, size: int) -> None:
+        """Wait for the time a control transfer takes on the bus.
+
+        Args:
+            size: Number of bytes in the data stage.
+        """
+        delay_s = self.timing.transfer_ms / 1000
+        if self.timing.bus_kb_per_s:
+            delay_s += size / (self.timing.bus_kb_per_s * 1024)
+        if delay_s > 0:
+            time.sleep(delay_s)
+
+    def _get_string(self, wValue: int, length: int) -> Sequence[int]:
+        """Get a string descriptor.
+
+        Args:
+            wValue: Descriptor type and index.
+            length: Maximum length of the descriptor.
+
+        Returns:
+            String descriptor.
+        """
+        index = wValue & 0xFF
+        if wValue >> 8 != _USB_DESC_TYPE_STRING:
+            raise self._stall(f"Unsupported descriptor 0x{wValue:04X}")
+
+        if index == 0:
+            payload = struct.pack("<H", _USB_LANGID_EN_US)
+        elif index == _STRING_SERIAL:
+            payload = self._serial_number.encode("utf-16-le")
+        elif (
+            _STRING_FIRST_LAYOUT
+            <= index
+            < _STRING_FIRST_LAYOUT + len(self.layouts)
+        ):
+            layout = self.layouts[index - _STRING_FIRST_LAYOUT]
+            payload = layout.encode("utf-16-le")
+        else:
+            raise self._stall(f"No string descriptor {index}")
+
+        desc = bytes([len(payload) + 2, _USB_DESC_TYPE_STRING]) + payload
+        return array.array("B", desc[:length])
+
+    def _stall(self, reason: str) -> usb.core.USBError:
+        """Enter the error state after a request the device cannot handle.
+
+        Args:
+            reason: Why the request stalled, for debug logs.
+
+        Returns:
+            Pipe error to raise.
+        """
+        logger.debug("Simulated device stalled: %s", reason)
+        self.counts["stall"] += 1
+        self.state = dfu._DFU_STATE_DFU_ERROR
+        self.status = STATUS_ERR_STALLEDPKT
+        return usb.core.USBError("Pipe error", errno=errno.EPIPE)
+
+    def _inject(self, operation: str) -> Optional[Fault]:
+        """Count an operation and raise the fault injected into it, if it is
+        raised by the request.
+
+        Args:
+            operation: Operation being started, OP_*.
+
+        Returns:
+            Fault which applies to the operation later, if any.
+
+        Raises:
+            usb.core.USBError: Request stalled or timed out.
+        """
+        self.counts[operation] += 1
+        for fault in self.faults:
+            if not fault.trigger(operation):
+                continue
+            if fault.kind == FAULT_STALL:
+                raise self._stall(f"Injected fault in {operation}")
+            if fault.kind == FAULT_TIMEOUT:
+                raise usb.core.USBError(
+                    "Operation timed out", errno=errno.ETIMEDOUT
+                )
+            return fault
+        return None
+
+    def _handle_out(self, request: int, block_num: int, data: bytes) -> None:
+        """Handle a DFU request without a data stage from the device.
+
+        Args:
+            request: DFU request.
+            block_num: wValue, the block number of downloads.
+            data: Data stage.
+
+        Raises:
+            usb.core.USBError: Request stalled.
+        """
+        if request == dfu._DFU_CMD_DOWNLOAD:
+            self._download(block_num, data)
+        elif request == dfu._DFU_CMD_CLRSTATUS:
+            self.counts["clrstatus"] += 1
+            if self.state != dfu._DFU_STATE_DFU_ERROR:
+                raise self._stall("CLRSTATUS outside dfuERROR")
+            self.state = dfu._DFU_STATE_DFU_IDLE
+            self.status = STATUS_OK
+        elif request == dfu._DFU_CMD_ABORT:
+            self.counts["abort"] += 1
+            if self.state not in (
+                dfu._DFU_STATE_DFU_IDLE,
+                dfu._DFU_STATE_DFU_DOWNLOAD_SYNC,
+                dfu._DFU_STATE_DFU_DOWNLOAD_IDLE,
+                dfu._DFU_STATE_DFU_MANIFEST_SYNC,
+                dfu._DFU_STATE_DFU_UPLOAD_IDLE,
+            ):
+                raise self._stall(f"ABORT in state 0x{self.state:02X}")
+            self._pending = None
+            self.state = dfu._DFU_STATE_DFU_IDLE
+        else:
+            raise self._stall(f"Unsupported DFU request {request}")
+
+    def _handle_in(self, request: int, block_num: int, length: int) -> bytes:
+        """Handle a DFU request with a data stage from the device.
+
+        Args:
+            request: DFU request.
+            block_num: wValue, the block number of uploads.
+            length: wLength.
+
+        Returns:
+            Data stage.
+
+        Raises:
+            usb.core.USBError: Request stalled.
+        """
+        if request == dfu._DFU_CMD_GETSTATUS:
+            return self._get_status()
+        if request == dfu._DFU_CMD_GETSTATE:
+            return bytes([self.state])
+        if request == dfu._DFU_CMD_UPLOAD:
+            return self._upload(block_num, length)
+        raise self._stall(f"Unsupported DFU request {request}")
+
+    def _download(self, block_num: int, data: bytes) -> None:
+        """Start the operation of a DNLOAD request.
+
+        Args:
+            block_num: Block number.
+            data: Block data.
+        """
+        if self.state not in (
+            dfu._DFU_STATE_DFU_IDLE,
+            dfu._DFU_STATE_DFU_DOWNLOAD_IDLE,
+        ):
+            raise self._stall(f"DNLOAD in state 0x{self.state:02X}")
+
+        if not data:
+            if self.state != dfu._DFU_STATE_DFU_DOWNLOAD_IDLE:
+                raise self._stall("Zero length DNLOAD before any data")
+            fault = self._inject(OP_MANIFEST)
+            operation = _Operation(
+                OP_MANIFEST, busy_ms=self.timing.manifest_ms, fault=fault
+            )
+            self.state = dfu._DFU_STATE_DFU_MANIFEST_SYNC
+        else:
+            operation = self._parse_download(block_num, data)
+            operation.fault = self._inject(operation.name)
+            self.state = dfu._DFU_STATE_DFU_DOWNLOAD_SYNC
+
+        self._pending = operation
+
+    def _parse_download(self, block_num: int, data: bytes) -> _Operation:
+        """Decode the operation of a DNLOAD request with data.
+
+        Args:
+            block_num: Block number.
+            data: Block data.
+
+        Returns:
+            Operation to run when the device is polled.
+        """
+        if not self.is_dfuse:
+            return _Operation(
+                OP_WRITE,
+                address=block_num * self.transfer_size,
+                data=data,
+                busy_ms=self.timing.program_ms_per_kb * len(data) / 1024,
+            )
+
+        if block_num >= dfuse.DFUSE_FIRST_BLOCK_NUM:
+            offset = (
+                block_num - dfuse.DFUSE_FIRST_BLOCK_NUM
+            ) * self.transfer_size
+            return _Operation(
+                OP_WRITE,
+                address=self._address + offset,
+                data=data,
+                busy_ms=self.timing.program_ms_per_kb * len(data) / 1024,
+            )
+
+        command = data[0]
+        if command == dfuse._DFUSE_CMD_ADDR and len(data) == 5:
+            return _Operation(
+                OP_SET_ADDRESS,
+                address=struct.unpack_from("<I", data, 1)[0],
+                busy_ms=self.timing.command_ms,
+            )
+        if command == dfuse._DFUSE_CMD_ERASE and len(data) == 1:
+            return _Operation(OP_ERASE, busy_ms=self.timing.mass_erase_ms)
+        if command == dfuse._DFUSE_CMD_ERASE and len(data) == 5:
+            address = struct.unpack_from("<I", data, 1)[0]
+            page_size = self._page_size(address)
+            return _Operation(
+                OP_ERASE,
+                address=address,
+                busy_ms=self.timing.erase_ms_per_kb * page_size / 1024,
+            )
+        raise self._stall(f"Unsupported DfuSe command 0x{command:02X}")
+
+    def _get_status(self) -> bytes:
+        """Handle GETSTATUS, which runs the pending operation.
+
+        Returns:
+            GETSTATUS response.
+        """
+        self._inject(OP_GETSTATUS)
+        now = time.monotonic()
+        if self.state in (
+            dfu._DFU_STATE_DFU_DOWNLOAD_SYNC,
+            dfu._DFU_STATE_DFU_MANIFEST_SYNC,
+        ):
+            assert self._pending is not None
+            self._busy_until = now + self._pending.busy_ms / 1000
+            if self.state == dfu._DFU_STATE_DFU_DOWNLOAD_SYNC:
+                self.state = dfu._DFU_STATE_DFU_DOWNLOAD_BUSY
+            else:
+                self.state = dfu._DFU_STATE_DFU_MANIFEST
+
+        if self._pending is not None and now >= self._busy_until:
+            operation, self._pending = self._pending, None
+            self._complete(operation)
+            if not self.attached:
+                raise usb.core.USBError("No such device", errno=errno.ENODEV)
+
+        poll_timeout_ms = 0
+        if self._pending is not None:
+            remaining_ms = math.ceil((self._busy_until - now) * 1000)
+            poll_timeout_ms = min(
+                _MAX_POLL_TIMEOUT_MS,
+                self.timing.poll_timeout_ms
+                if self.timing.poll_timeout_ms is not None
+                else remaining_ms,
+            )
+
+        # bStatus, bwPollTimeout, bState and iString
+        return struct.pack(
+            "<BIB", self.status, poll_timeout_ms | self.state << 24, 0
+        )
+
+    def _complete(self, operation: _Operation) -> None:
+        """Run an operation once the device is no longer busy.
+
+        Args:
+            operation: Operation to run.
+        """
+        if operation.name == OP_MANIFEST:
+            self._manifest(operation)
+            return
+
+        self.state = dfu._DFU_STATE_DFU_DOWNLOAD_IDLE
+        fault = operation.fault
+        if fault is not None and fault.kind == FAULT_ERROR:
+            self._fail(fault.status, f"Injected fault in {operation.name}")
+            return
+
+        data = operation.data
+        if fault is not None and fault.kind == FAULT_CORRUPT and data:
+            data = bytes([data[0] ^ 0x01]) + data[1:]
+        try:
+            if operation.name == OP_SET_ADDRESS:
+                assert operation.address is not None
+                self._locate(operation.address, 1)
+                self._address = operation.address
+            elif operation.name == OP_ERASE:
+                self._erase(operation.address)
+            else:
+                assert operation.address is not None
+                self._write(operation.address, data)
+        except ValueError as err:
+            self._fail(STATUS_ERR_ADDRESS, str(err))
+
+    def _manifest(self, operation: _Operation) -> None:
+        """Complete manifestation. DfuSe devices leave DFU mode, and plain
+        DFU devices wait for a reset unless they are manifestation tolerant.
+
+        Args:
+            operation: Manifestation operation.
+        """
+        fault = operation.fault
+        if fault is not None and fault.kind == FAULT_ERROR:
+            self._fail(fault.status, "Injected fault in manifestation")
+        elif self.is_dfuse:
+            logger.debug("Simulated device leaving DFU mode")
+            self.attached = False
+        elif self.attributes & descriptor.DFU_ATTR_MANIFESTATION_TOLERANT:
+            self.state = dfu._DFU_STATE_DFU_IDLE
+        else:
+            self.state = dfu._DFU_STATE_DFU_MANIFEST_WAIT_RESET
+
+    def _fail(self, status: int, reason: str) -> None:
+        """Enter the error state after an operation failed.
+
+        Args:
+            status: bStatus to report.
+            reason: Why the operation failed, for debug logs.
+        """
+        logger.debug("Simulated device error 0x%02X: %s", status, reason)
+        self.state = dfu._DFU_STATE_DFU_ERROR
+        self.status = status
+
+    def _upload(self, block_num: int, length: int) -> bytes:
+        """Handle UPLOAD.
+
+        Args:
+            block_num: Block number.
+            length: Maximum number of bytes to upload.
+
+        Returns:
+            Uploaded data.
+        """
+        if self.state not in (
+            dfu._DFU_STATE_DFU_IDLE,
+            dfu._DFU_STATE_DFU_UPLOAD_IDLE,
+        ):
+            raise self._stall(f"UPLOAD in state 0x{self.state:02X}")
+        if not self.attributes & descriptor.DFU_ATTR_CAN_UPLOAD:
+            raise self._stall("Upload not supported")
+
+        fault = self._inject(OP_UPLOAD)
+        if self.state == dfu._DFU_STATE_DFU_IDLE:
+            self._upload_offset = 0
+        self.state = dfu._DFU_STATE_DFU_UPLOAD_IDLE
+
+        if not self.is_dfuse:
+            data = self.read_memory(self._upload_offset, length)
+            self._upload_offset += len(data)
+            if len(data) < length:
+                self.state = dfu._DFU_STATE_DFU_IDLE
+        elif block_num == 0:
+            data = bytes(
+                [
+                    _DFUSE_CMD_GET_COMMANDS,
+                    dfuse._DFUSE_CMD_ADDR,
+                    dfuse._DFUSE_CMD_ERASE,
+                    _DFUSE_CMD_READ_UNPROTECT,
+                ]
+            )[:length]
+        elif block_num >= dfuse.DFUSE_FIRST_BLOCK_NUM:
+            offset = (
+                block_num - dfuse.DFUSE_FIRST_BLOCK_NUM
+            ) * self.transfer_size
+            try:
+                data = self.read_memory(self._address + offset, length)
+            except ValueError as err:
+                raise self._stall(str(err)) from None
+        else:
+            raise self._stall(f"Upload of block {block_num}")
+
+        if fault is not None and fault.kind == FAULT_CORRUPT and data:
+            data = bytes([data[0] ^ 0x01]) + data[1:]
+        return data
+
+    def _locate(
+        self, address: int, length: int
+    ) -> List[Tuple[bytearray, int, int]]:
+        """Find the memory of an address range, which may span segments.
+
+        Args:
+            address: Address of the first byte.
+            length: Number of bytes.
+
+        Returns:
+            Memory, offset and size of each part of the range.
+
+        Raises:
+            ValueError: Range is not in device memory.
+        """
+        parts = []
+        end = address + length
+        while address < end:
+            for segment, memory in self.segments:
+                if segment.addr <= address <= segment.last_addr:
+                    offset = address - segment.addr
+                    size = min(end - address, segment.size - offset)
+                    parts.append((memory, offset, size))
+                    address += size
+                    break
+            else:
+                raise ValueError(f"Address 0x{address:08X} not in memory")
+        return parts
+
+    def _page_size(self, address: int) -> int:
+        """Get the size of the page at an address, or 0 if it is unmapped.
+
+        Args:
+            address: Address in device memory.
+        """
+        for segment, _ in self.segments:
+            if segment.addr <= address <= segment.last_addr:
+                return segment.page_size
+        return 0
+
+    def _erase(self, address: Optional[int]) -> None:
+        """Erase the page at an address, or all memory.
+
+        Args:
+            address: Address in the page to erase, or None for all memory.
+
+        Raises:
+            ValueError: Address is not in device memory.
+        """
+        if address is None:
+            for _, memory in self.segments:
+                memory[:] = b"\xff" * len(memory)
+            return
+
+        page_size = self._page_size(address)
+        if not page_size:
+            raise ValueError(f"Address 0x{address:08X} not in memory")
+        ((memory, offset, _),) = self._locate(address, 1)
+        start = offset - offset % page_size
+        memory[start : start + page_size] = b"\xff" * page_size
+
+    def _write(self, address: int, data: bytes) -> None:
+        """Program data, which can only clear bits of flash memory.
+
+        Args:
+            address: Address of the first byte, or offset in the firmware of a
+                plain DFU device.
+            data: Data to program.
+
+        Raises:
+            ValueError: Range is not in device memory.
+        """
+        if not self.is_dfuse:
+            end = address + len(data)
+            if end > len(self.firmware):
+                raise ValueError("Firmware too large")
+            self.firmware[address:end] = data
+            # The first block starts new firmware
+            self.firmware_length = (
+                end if address == 0 else max(self.firmware_length, end)
+            )
+            return
+
+        position = 0
+        for memory, offset, size in self._locate(address, len(data)):
+            old = int.from_bytes(memory[offset : offset + size], "little")
+            new = int.from_bytes(data[position : position + size], "little")
+            memory[offset : offset + size] = (old & new).to_bytes(
+                size, "little"
+            )
+            position += size
@@ -0,0 +1,637 @@
+# Copyright 2022 Block, Inc.
+"""Record the USB control transfers of a download and replay them.
+
+`TraceRecorder` wraps a device and writes every control transfer sent through
+it, i.e. every DFU and DfuSe request, to a JSON Lines file: one line with the
+device's descriptors, then one line per transfer with its request, wValue,
+length, returned status or data, error and timestamps in nanoseconds::
+
+    with TraceRecorder(dev, "flash.trace") as traced:
+        with DfuSession(traced) as session:
+            session.download("app.bin", address=0x08000000)
+
+`ReplayDevice` feeds a recorded trace back through the library in place of the
+device, to reproduce a download deterministically without hardware, and
+`summarize` profiles the latency of each kind of request in a trace.
+
+Data sent to the device is only recorded for DfuSe commands, other downloads
+record a CRC32 of their data so traces stay compact.
+"""
+
+import array
+import dataclasses
+import json
+import logging
+import time
+import zlib
+from typing import (
+    IO,
+    TYPE_CHECKING,
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
+
+import usb
+
+from . import cache, dfu, dfuse
+from .transport import DeviceWrapper
+
+logger = logging.getLogger(__name__)
+
+# Version of the trace file format
+TRACE_VERSION = 1
+
+# Standard GET_DESCRIPTOR request
+_USB_REQUEST_TYPE_STANDARD_IN = 0x80
+_USB_REQ_GET_DESCRIPTOR = 0x06
+
+# Names of the requests in traces, by request type and request code
+_REQUEST_NAMES = {
+    (dfu._USB_REQUEST_TYPE_SEND, dfu._DFU_CMD_DETACH): "DETACH",
+    (dfu._USB_REQUEST_TYPE_SEND, dfu._DFU_CMD_DOWNLOAD): "DNLOAD",
+    (dfu._USB_REQUEST_TYPE_RECV, dfu._DFU_CMD_UPLOAD): "UPLOAD",
+    (dfu._USB_REQUEST_TYPE_RECV, dfu._DFU_CMD_GETSTATUS): "GETSTATUS",
+    (dfu._USB_REQUEST_TYPE_SEND, dfu._DFU_CMD_CLRSTATUS): "CLRSTATUS",
+    (dfu._USB_REQUEST_TYPE_RECV, dfu._DFU_CMD_GETSTATE): "GETSTATE",
+    (dfu._USB_REQUEST_TYPE_SEND, dfu._DFU_CMD_ABORT): "ABORT",
+    (
+        _USB_REQUEST_TYPE_STANDARD_IN,
+        _USB_REQ_GET_DESCRIPTOR,
+    ): "GET_DESCRIPTOR",
+}
+
+# Names of DfuSe commands, sent as downloads of block 0
+_DFUSE_COMMAND_NAMES = {
+    dfuse._DFUSE_CMD_ADDR: "SET_ADDRESS",
+    dfuse._DFUSE_CMD_ERASE: "ERASE",
+}
+
+
+@dataclasses.dataclass
+class TraceRecord:
+    """One control transfer in a trace."""
+
+    # Name of the request, see `request_name`
+    name: str
+    # Start of the transfer since the start of the trace, and its duration
+    t_ns: int
+    duration_ns: int
+    # NOTE: Alternate naming convention used to match USB spec
+    bmRequestType: int
+    bRequest: int
+    wValue: int
+    wIndex: int
+    # Number of bytes sent, or requested for IN transfers
+    length: int
+    # Data received, or sent for DfuSe commands
+    data: Optional[bytes] = None
+    # CRC32 of data sent, when the data is not recorded
+    crc32: Optional[int] = None
+    # Number of bytes sent, for OUT transfers
+    result: Optional[int] = None
+    # Error raised instead of completing the transfer
+    error: Optional[str] = None
+    errno: Optional[int] = None
+    timeout: bool = False
+
+    def to_json(self) -> Dict[str, Any]:
+        """Convert to a JSON object, without empty fields.
+
+        Returns:
+            JSON object.
+        """
+        # Fields are read directly, as `dataclasses.asdict` copies them
+        obj = {}
+        for field in dataclasses.fields(self):
+            value = getattr(self, field.name)
+            if value is not None and value is not False:
+                obj[field.name] = value
+        if self.data is not None:
+            obj["data"] = self.data.hex()
+        return obj
+
+    @classmethod
+    def from_json(cls, obj: Dict[str, Any]) -> "TraceRecord":
+        """Create from a JSON object.
+
+        Args:
+            obj: JSON object written by `to_json`.
+
+        Returns:
+            Trace record.
+        """
+        fields = dict(obj)
+        if "data" in fields:
+            fields["data"] = bytes.fromhex(fields["data"])
+        return cls(**fields)
+
+
+@dataclasses.dataclass
+class LatencyStats:
+    """Latency of one kind of request in a trace, in seconds."""
+
+    count: int = 0
+    errors: int = 0
+    total_s: float = 0.0
+    min_s: float = 0.0
+    max_s: float = 0.0
+
+    @property
+    def mean_s(self) -> float:
+        """Mean latency."""
+        return self.total_s / self.count if self.count else 0.0
+
+
+def request_name(
+    bmRequestType: int, bRequest: int, wValue: int, data: Sequence[int] = b""
+) -> str:
+    """Name a control transfer, for traces and profiles.
+
+    Args:
+        bmRequestType: Request type.
+        bRequest: Request code.
+        wValue: Request value, the block number of downloads.
+        data: Data sent, to name DfuSe commands.
+
+    Returns:
+        DFU request name like "DNLOAD" or "GETSTATUS", DfuSe command name like
+        "SET_ADDRESS", "ERASE" or "MASS_ERASE", or the request type and code
+        of other requests.
+    """
+    name = _REQUEST_NAMES.get((bmRequestType, bRequest))
+    if name is None:
+        return f"0x{bmRequestType:02X}/0x{bRequest:02X}"
+
+    if name == "DNLOAD" and wValue == 0 and data:
+        name = _DFUSE_COMMAND_NAMES.get(data[0], name)
+        if name == "ERASE" and len(data) == 1:
+            name = "MASS_ERASE"
+    return name
+
+
+def _device_info(dev: usb.core.Device) -> Dict[str, Any]:
+    """Describe a device for the header of a trace.
+
+    Args:
+        dev: USB device.
+
+    Returns:
+        JSON object with the device's identity and interface descriptors.
+    """
+    # Only the first configuration is used, like in `descriptor`
+    interfaces = [
+        {
+            "bInterfaceNumber": intf.bInterfaceNumber,
+            "bAlternateSetting": intf.bAlternateSetting,
+            "bInterfaceClass": intf.bInterfaceClass,
+            "bInterfaceSubClass": intf.bInterfaceSubClass,
+            "bInterfaceProtocol": intf.bInterfaceProtocol,
+            "iInterface": intf.iInterface,
+            "extra": bytes(intf.extra_descriptors).hex(),
+        }
+        for intf in dev[0]
+    ]
+    return {
+        "version": TRACE_VERSION,
+        "start": time.time(),
+        **dataclasses.asdict(cache.DeviceKey.from_device(dev)),
+        "langids": list(getattr(dev, "langids", ())),
+        "bus": dev.bus,
+        "address": dev.address,
+        # Not every pyusb backend knows the port numbers
+        "port_numbers": list(getattr(dev, "port_numbers", None) or ()),
+        "interfaces": interfaces,
+    }
+
+
+# Replayed devices are used in place of pyusb devices
+if TYPE_CHECKING:
+    _DeviceBase = usb.core.Device
+else:
+    _DeviceBase = object
+
+
+class TraceRecorder(DeviceWrapper):
+    """Device which records the control transfers sent through it to a
+    trace file.
+    """
+
+    def __init__(self, dev: usb.core.Device, path: str) -> None:
+        """Start a trace of a device.
+
+        Args:
+            dev: USB device, or another transport with its descriptors like
+                `simulator.SimulatedDevice`.
+            path: Trace file, which is overwritten.
+        """
+        super().__init__(dev)
+        self._file: IO[str] = open(path, "w")
+        self._start_ns = time.perf_counter_ns()
+        self._file.write(json.dumps(_device_info(dev)) + "\n")
+        logger.debug("Recording USB trace to %s", path)
+
+    def __enter__(self) -> "TraceRecorder":
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Finish writing the trace."""
+        self._file.close()
+
+    def ctrl_transfer(
+        self,
+        bmRequestType: int,
+        bRequest: int,
+        wValue: int = 0,
+        wIndex: int = 0,
+        data_or_wLength: Optional[Union[int, Sequence[int], bytes]] = None,
+        timeout: Optional[int] = None,
+    ) -> Any:
+        """Send a control transfer to the wrapped device and record it.
+
+        Args:
+            bmRequestType: Request type.
+            bRequest: Request code.
+            wValue: Request value.
+            wIndex: Request index.
+            data_or_wLength: Data of OUT requests, or length of IN requests.
+            timeout: Timeout in milliseconds.
+
+        Returns:
+            Result of the wrapped device's transfer.
+
+        Raises:
+            usb.core.USBError: Request failed or was stalled.
+        """
+        start_ns = time.perf_counter_ns()
+        try:
+            result = self.wrapped.ctrl_transfer(
+                bmRequestType,
+                bRequest,
+                wValue,
+                wIndex,
+                data_or_wLength,
+                timeout,
+            )
+        except usb.core.USBError as err:
+            self._record(
+                start_ns,
+                bmRequestType,
+                bRequest,
+                wValue,
+                wIndex,
+                data_or_wLength,
+                error=err,
+            )
+            raise
+
+        self._record(
+            start_ns,
+            bmRequestType,
+            bRequest,
+            wValue,
+            wIndex,
+            data_or_wLength,
+            result=result,
+        )
+        return result
+
+    def _record(
+        self,
+        start_ns: int,
+        bmRequestType: int,
+        bRequest: int,
+        wValue: int,
+        wIndex: int,
+        data_or_wLength: Optional[Union[int, Sequence[int], bytes]],
+        result: Any = None,
+        error: Optional[usb.core.USBError] = None,
+    ) -> None:
+        """Write a transfer to the trace.
+
+        Args:
+            start_ns: Performance counter when the transfer started.
+            bmRequestType: Request type.
+            bRequest: Request code.
+            wValue: Request value.
+            wIndex: Request index.
+            data_or_wLength: Data of OUT requests, or length of IN requests.
+            result: Result of the transfer, if it completed.
+            error: Error the transfer raised, if it failed.
+        """
+        end_ns = time.perf_counter_ns()
+        if isinstance(data_or_wLength, int):
+            sent, length = b"", data_or_wLength
+        else:
+            sent = bytes(data_or_wLength or b"")
+            length = len(sent)
+
+        name = request_name(bmRequestType, bRequest, wValue, sent)
+        record = TraceRecord(
+            name=name,
+            t_ns=start_ns - self._start_ns,
+            duration_ns=end_ns - start_ns,
+            bmRequestType=bmRequestType,
+            bRequest=bRequest,
+            wValue=wValue,
+            wIndex=wIndex,
+            length=length,
+        )
+        if sent and name in _DFUSE_COMMAND_NAMES.values():
+            record.data = sent
+        elif sent:
+            record.crc32 = zlib.crc32(sent)
+
+        if error is not None:
+            record.error = error.strerror
+            record.errno = error.errno
+            record.timeout = isinstance(error, usb.core.USBTimeoutError)
+        elif isinstance(result, int):
+            record.result = result
+        elif result is not None:
+            record.data = bytes(result)
+
+        self._file.write(
+            json.dumps(record.to_json(), separators=(",", ":")) + "\n"
+        )
+
+
+class _Interface:
+    """Interface descriptor of one alternate setting, from a trace header."""
+
+    def __init__(self, info: Dict[str, Any]) -> None:
+        # NOTE: Alternate naming convention used to match USB spec
+        self.bInterfaceNumber = info["bInterfaceNumber"]
+        self.bAlternateSetting = info["bAlternateSetting"]
+        self.alternate_index = self.bAlternateSetting
+        self.bInterfaceClass = info["bInterfaceClass"]
+        self.bInterfaceSubClass = info["bInterfaceSubClass"]
+        self.bInterfaceProtocol = info["bInterfaceProtocol"]
+        self.iInterface = info["iInterface"]
+        self.extra_descriptors = array.array("B", bytes.fromhex(info["extra"]))
+
+
+class _Configuration:
+    """Configuration descriptor, which indexes interfaces like pyusb."""
+
+    def __init__(self, interfaces: List[_Interface]) -> None:
+        self._interfaces = interfaces
+
+    def __iter__(self) -> Iterator[_Interface]:
+        return iter(self._interfaces)
+
+    def __getitem__(self, index: Tuple[int, int]) -> _Interface:
+        for intf in self._interfaces:
+            if (intf.bInterfaceNumber, intf.bAlternateSetting) == index:
+                return intf
+        raise IndexError(f"No interface {index}")
+
+
+def read_trace(path: str) -> Tuple[Dict[str, Any], List[TraceRecord]]:
+    """Read a trace file.
+
+    Args:
+        path: Trace file written by `TraceRecorder`.
+
+    Returns:
+        Header describing the device, and the recorded transfers.
+
+    Raises:
+        ValueError: File is not a trace, or of an unsupported version.
+    """
+    with open(path) as f:
+        try:
+            header = json.loads(f.readline())
+            records = [TraceRecord.from_json(json.loads(line)) for line in f]
+        except (json.JSONDecodeError, TypeError) as err:
+            raise ValueError(f"Invalid trace file {path}: {err}") from err
+
+    if header.get("version") != TRACE_VERSION:
+        raise ValueError(
+            f"Unsupported trace version {header.get('version')} in {path}"
+        )
+    return header, records
+
+
+def summarize(records: Iterable[TraceRecord]) -> Dict[str, LatencyStats]:
+    """Profile the latency of each kind of request in a trace.
+
+    Args:
+        records: Recorded transfers, see `read_trace`.
+
+    Returns:
+        Latency by request name, see `request_name`.
+    """
+    stats: Dict[str, LatencyStats] = {}
+    for record in records:
+        latency_s = record.duration_ns / 1e9
+        entry = stats.get(record.name)
+        if entry is None:
+            entry = stats[record.name] = LatencyStats(
+                min_s=latency_s, max_s=latency_s
+            )
+        entry.count += 1
+        entry.errors += record.error is not None
+        entry.total_s += latency_s
+        entry.min_s = min(entry.min_s, latency_s)
+        entry.max_s = max(entry.max_s, latency_s)
+    return stats
+
+
+class ReplayDevice(_DeviceBase):
+    """Device which answers control transfers from a recorded trace.
+
+    Transfers must be sent in the recorded order with the recorded requests,
+    otherwise the replay stops with an error, so a replayed download takes
+    the same path through the library as the recorded one.
+    """
+
+    def __init__(self, path: str, realtime: bool = False) -> None:
+        """Load a trace to replay.
+
+        Args:
+            path: Trace file written by `TraceRecorder`.
+            realtime: Take as long as the recorded transfers did, instead of
+                answering immediately.
+
+        Raises:
+            ValueError: File is not a trace, or of an unsupported version.
+        """
+        header, self.records = read_trace(path)
+        self.realtime = realtime
+        self.position = 0
+        self.claimed = False
+
+        # NOTE: Alternate naming convention used to match USB spec
+        self.idVendor = header["idVendor"]
+        self.idProduct = header["idProduct"]
+        self.bcdDevice = header["bcdDevice"]
+        self._serial_number = header["serial"]
+        self._langids: Tuple[int, ...] = tuple(header["langids"])
+        self.bus = header["bus"]
+        self.address = header["address"]
+        self.port_numbers = tuple(header["port_numbers"])
+        self._configuration = _Configuration(
+            [_Interface(info) for info in header["interfaces"]]
+        )
+
+    @property
+    def serial_number(self) -> Optional[str]:
+        """Recorded serial number string."""
+        return self._serial_number
+
+    @property
+    def langids(self) -> Tuple[int, ...]:
+        """Recorded language IDs of the string descriptors."""
+        return self._langids
+
+    @property
+    def finished(self) -> bool:
+        """Whether every recorded transfer was replayed."""
+        return self.position == len(self.records)
+
+    def __iter__(self) -> Iterator[_Configuration]:
+        return iter([self._configuration])
+
+    def __getitem__(self, index: int) -> _Configuration:
+        if index != 0:
+            raise IndexError(f"No configuration {index}")
+        return self._configuration
+
+    def claim_interface(self, interface: int) -> None:
+        """Claim an interface, which is not recorded.
+
+        Args:
+            interface: Interface number.
+        """
+        self.claimed = True
+
+    def release_interface(self) -> None:
+        """Release the claimed interface."""
+        self.claimed = False
+
+    def set_interface_altsetting(
+        self, interface: int = 0, alternate_setting: int = 0
+    ) -> None:
+        """Select an alternate setting, which is not recorded.
+
+        Args:
+            interface: Interface number.
+            alternate_setting: Alternate setting.
+        """
+
+    def reset(self) -> None:
+        """Reset the device, which is not recorded."""
+
+    def ctrl_transfer(
+        self,
+        bmRequestType: int,
+        bRequest: int,
+        wValue: int = 0,
+        wIndex: int = 0,
+        data_or_wLength: Optional[Union[int, Sequence[int], bytes]] = None,
+        timeout: Optional[int] = None,
+    ) -> Any:
+        """Answer a control transfer with the next recorded one.
+
+        Args:
+            bmRequestType: Request type.
+            bRequest: Request code.
+            wValue: Request value.
+            wIndex: Request index.
+            data_or_wLength: Data of OUT requests, or length of IN requests.
+            timeout: Timeout in milliseconds, which is not replayed.
+
+        Returns:
+            Recorded number of bytes sent for OUT requests, or the recorded
+            data for IN requests.
+
+        Raises:
+            RuntimeError: Transfer differs from the recorded one, or the
+                trace has ended.
+            usb.core.USBError: Recorded transfer failed.
+        """
+        if self.finished:
+            raise RuntimeError(
+                f"Trace ended after {self.position} transfers, but request "
+                f"0x{bRequest:02X} was sent"
+            )
+        record = self.records[self.position]
+        self._check(
+            record, bmRequestType, bRequest, wValue, wIndex, data_or_wLength
+        )
+        self.position += 1
+        if self.realtime:
+            time.sleep(record.duration_ns / 1e9)
+
+        if record.error is not None:
+            error_type = (
+                usb.core.USBTimeoutError
+                if record.timeout
+                else usb.core.USBError
+            )
+            raise error_type(record.error, errno=record.errno)
+        if record.result is not None:
+            return record.result
+        return array.array("B", record.data or b"")
+
+    def _check(
+        self,
+        record: TraceRecord,
+        bmRequestType: int,
+        bRequest: int,
+        wValue: int,
+        wIndex: int,
+        data_or_wLength: Optional[Union[int, Sequence[int], bytes]],
+    ) -> None:
+        """Check a transfer is the recorded one.
+
+        Args:
+            record: Recorded transfer.
+            bmRequestType: Request type.
+            bRequest: Request code.
+            wValue: Request value.
+            wIndex: Request index.
+            data_or_wLength: Data of OUT requests, or length of IN requests.
+
+        Raises:
+            RuntimeError: Transfer differs from the recorded one.
+        """
+        if isinstance(data_or_wLength, int):
+            sent, length = b"", data_or_wLength
+        else:
+            sent = bytes(data_or_wLength or b"")
+            length = len(sent)
+
+        if bmRequestType & usb.util.CTRL_IN:
+            sent_matches = True
+        elif record.crc32 is not None:
+            sent_matches = record.crc32 == zlib.crc32(sent)
+        else:
+            sent_matches = record.data in (None, sent)
+
+        request = (bmRequestType, bRequest, wValue, wIndex, length)
+        recorded = (
+            record.bmRequestType,
+            record.bRequest,
+            record.wValue,
+            record.wIndex,
+            record.length,
+        )
+        if request != recorded or not sent_matches:
+            name = request_name(bmRequestType, bRequest, wValue, sent)
+            raise RuntimeError(
+                f"Transfer {self.position} differs from the trace: sent "
+                f"{name} (wValue {wValue}, length {length}), recorded "
+                f"{record.name} (wValue {record.wValue}, length "
+                f"{record.length})"
+            )
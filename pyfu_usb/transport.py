@@ -0,0 +1,152 @@
+# Copyright 2022 Block, Inc.
+"""Transport interface which the DFU and DfuSe requests are sent through.
+
+`usb.core.Device` is the transport for real devices. Other transports, like
+`simulator.SimulatedDevice`, implement the same control transfer method, and
+claim and release their own interface. `DeviceWrapper` is the base of
+transports which observe the transfers of another one.
+"""
+
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Iterator,
+    Optional,
+    Protocol,
+    Sequence,
+    Union,
+    runtime_checkable,
+)
+
+import usb
+
+
+@runtime_checkable
+class Transport(Protocol):
+    """Sends USB control transfers to a device."""
+
+    def ctrl_transfer(
+        self,
+        bmRequestType: int,
+        bRequest: int,
+        wValue: int = 0,
+        wIndex: int = 0,
+        data_or_wLength: Optional[Union[int, Sequence[int], bytes]] = None,
+        timeout: Optional[int] = None,
+    ) -> Any:
+        """Send a control transfer, like `usb.core.Device.ctrl_transfer`.
+
+        Args:
+            bmRequestType: Request type.
+            bRequest: Request code.
+            wValue: Request value.
+            wIndex: Request index, the interface for DFU requests.
+            data_or_wLength: Data to send for OUT requests, or the number of
+                bytes to receive for IN requests.
+            timeout: Timeout in milliseconds.
+
+        Returns:
+            Number of bytes sent for OUT requests, or the data received for
+            IN requests.
+
+        Raises:
+            usb.core.USBError: Request failed or was stalled.
+        """
+
+
+@runtime_checkable
+class ClaimableTransport(Transport, Protocol):
+    """Transport which manages claiming its interface itself, instead of
+    through pyusb.
+    """
+
+    def claim_interface(self, interface: int) -> None:
+        """Claim an interface.
+
+        Args:
+            interface: Interface number.
+        """
+
+    def release_interface(self) -> None:
+        """Release the claimed interface."""
+
+
+# Wrapped devices are used in place of pyusb devices
+if TYPE_CHECKING:
+    _DeviceBase = usb.core.Device
+else:
+    _DeviceBase = object
+
+
+class DeviceWrapper(_DeviceBase):
+    """Device which passes control transfers on to a wrapped device.
+
+    Other attributes and methods are those of the wrapped device, so the
+    wrapper can be used wherever the device is. Subclasses override
+    `ctrl_transfer` to observe transfers.
+    """
+
+    def __init__(self, dev: usb.core.Device) -> None:
+        """Wrap a device.
+
+        Args:
+            dev: USB device, or another transport with its descriptors like
+                `simulator.SimulatedDevice`.
+        """
+        self.wrapped = dev
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.wrapped, name)
+
+    def __iter__(self) -> Iterator[Any]:
+        return iter(self.wrapped)
+
+    def __getitem__(self, index: int) -> Any:
+        return self.wrapped[index]
+
+    def claim_interface(self, interface: int) -> None:
+        """Claim an interface of the wrapped device.
+
+        Args:
+            interface: Interface number.
+        """
+        if isinstance(self.wrapped, ClaimableTransport):
+            self.wrapped.claim_interface(interface)
+        else:
+            usb.util.claim_interface(self.wrapped, interface)
+
+    def release_interface(self) -> None:
+        """Release the claimed interface of the wrapped device."""
+        if isinstance(self.wrapped, ClaimableTransport):
+            self.wrapped.release_interface()
+        else:
+            usb.util.dispose_resources(self.wrapped)
+
+    def ctrl_transfer(
+        self,
+        bmRequestType: int,
+        bRequest: int,
+        wValue: int = 0,
+        wIndex: int = 0,
+        data_or_wLength: Optional[Union[int, Sequence[int], bytes]] = None,
+        timeout: Optional[int] = None,
+    ) -> Any:
+        """Send a control transfer to the wrapped device.
+
+        Args:
+            bmRequestType: Request type.
+            bRequest: Request code.
+            wValue: Request value.
+            wIndex: Request index.
+            data_or_wLength: Data of OUT requests, or length of IN requests.
+            timeout: Timeout in milliseconds.
+
+        Returns:
+            Result of the wrapped device's transfer.
+
+        Raises:
+            usb.core.USBError: Request failed or was stalled.
+        """
+        return self.wrapped.ctrl_transfer(
+            bmRequestType, bRequest, wValue, wIndex, data_or_wLength, timeout
+        )
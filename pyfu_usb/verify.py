@@ -0,0 +1,193 @@
+# Copyright 2022 Block, Inc.
+"""Verify device memory holds an image by reading it back."""
+
+import hashlib
+import logging
+from typing import Callable, Generator, Iterable, List, Optional, Tuple
+
+import usb
+
+from . import descriptor, dfu, dfuse, image, plan, progress
+from .options import VERIFY_COMPARE, VERIFY_HASH
+
+logger = logging.getLogger(__name__)
+
+
+def check_can_verify(dfu_desc: descriptor.DfuDescriptor) -> None:
+    """Check that firmware can be read back from a device after downloading.
+
+    Args:
+        dfu_desc: DFU descriptor of device.
+
+    Raises:
+        ValueError: Device does not support verification.
+    """
+    if not dfu_desc.bmAttributes & descriptor.DFU_ATTR_CAN_UPLOAD:
+        raise ValueError("Device does not support upload, cannot verify")
+
+    # DfuSe devices are verified before leaving DFU mode
+    if (
+        dfu_desc.bcdDFUVersion != dfuse.DFUSE_VERSION_NUMBER
+        and not dfu_desc.bmAttributes
+        & descriptor.DFU_ATTR_MANIFESTATION_TOLERANT
+    ):
+        raise ValueError(
+            "Device is not manifestation tolerant, cannot verify after download"
+        )
+
+
+def first_difference(
+    blocks: Iterable[bytes], data: image.Buffer, begin: int, end: int
+) -> Optional[int]:
+    """Compare blocks read back from a device against a range of data. Blocks
+    are compared in place as they arrive and are not kept.
+
+    Args:
+        blocks: Blocks read back from the device, starting at `begin`.
+        data: Expected data.
+        begin: Offset in data of first byte to compare.
+        end: Offset in data after the last byte to compare.
+
+    Returns:
+        Offset in data of the first byte which differs or was not read back,
+        or None if the range matches.
+    """
+    view = memoryview(data)
+    offset = begin
+    for block in blocks:
+        # Comparing bytes is much faster than comparing memoryviews
+        expected = view[offset : offset + len(block)].tobytes()
+        if expected != block:
+            return offset + next(
+                (i for i, (a, b) in enumerate(zip(expected, block)) if a != b),
+                len(expected),
+            )
+        offset += len(block)
+    return offset if offset < end else None
+
+
+def verify(
+    read: Callable[[int, int], Generator[bytes, None, None]],
+    data: image.Buffer,
+    ranges: List[Tuple[int, int]],
+    base_address: int,
+    mode: str,
+    display: progress.ProgressSink,
+) -> None:
+    """Verify device memory matches data by reading it back.
+
+    Args:
+        read: Returns blocks read from the device for a `(begin, end)` range
+            of offsets in the data.
+        data: Expected data.
+        ranges: `(begin, end)` ranges of offsets in the data to verify.
+        base_address: Address of data in device memory, used for reporting.
+        mode: `VERIFY_COMPARE` to compare each block and report the first
+            differing address, or `VERIFY_HASH` to only compare a hash.
+        display: Progress display.
+
+    Raises:
+        ValueError: Unknown verification mode.
+        RuntimeError: Device memory does not match the data.
+    """
+    if mode not in (VERIFY_COMPARE, VERIFY_HASH):
+        raise ValueError(f"Unknown verification mode: {mode}")
+
+    expected_hash = hashlib.sha256()
+    readback_hash = hashlib.sha256()
+
+    with display.task(
+        sum(end - begin for begin, end in ranges), "Verifying"
+    ) as advance:
+        for begin, end in ranges:
+            blocks = read(begin, end)
+            try:
+                if mode == VERIFY_HASH:
+                    expected_hash.update(memoryview(data)[begin:end])
+                    for block in blocks:
+                        readback_hash.update(block)
+                    diff = None
+                else:
+                    diff = first_difference(blocks, data, begin, end)
+            finally:
+                blocks.close()
+
+            if diff is not None:
+                raise RuntimeError(
+                    f"Verification failed at address 0x{base_address + diff:X}"
+                )
+
+            advance(end - begin)
+
+    if expected_hash.digest() != readback_hash.digest():
+        raise RuntimeError("Verification failed, SHA-256 does not match")
+
+    logger.info("Verified %d bytes", sum(end - begin for begin, end in ranges))
+
+
+def verify_firmware(
+    dev: usb.core.Device,
+    interface: int,
+    data: image.Buffer,
+    xfer_size: int,
+    mode: str,
+    display: progress.ProgressSink,
+) -> None:
+    """Read back the firmware of a DFU device and check it matches data.
+
+    Args:
+        dev: USB device in DFU mode.
+        interface: USB device interface.
+        data: Expected firmware.
+        xfer_size: Transfer size to use when uploading.
+        mode: Verification mode.
+        display: Progress display.
+
+    Raises:
+        RuntimeError: Verification failed.
+    """
+    verify(
+        lambda begin, end: dfu.read_firmware(dev, interface, end, xfer_size),
+        data,
+        [(0, len(data))],
+        0,
+        mode,
+        display,
+    )
+
+
+def verify_segments(
+    dev: usb.core.Device,
+    interface: int,
+    segments: List[image.Segment],
+    xfer_size: int,
+    sparse: bool,
+    mode: str,
+    display: progress.ProgressSink,
+) -> None:
+    """Read back DfuSe device memory and check it holds the downloaded data.
+
+    Args:
+        dev: USB device in DFU mode.
+        interface: USB device interface.
+        segments: Data which was downloaded.
+        xfer_size: Transfer size to use when uploading.
+        sparse: Leave out chunks which only contain the erased value.
+        mode: Verification mode.
+        display: Progress display.
+
+    Raises:
+        RuntimeError: Verification failed.
+    """
+    for segment in segments:
+        # Erased-value regions are "don't care" in sparse mode
+        verify(
+            lambda begin, end, address=segment.address: dfuse.read_memory(
+                dev, interface, address + begin, end - begin, xfer_size
+            ),
+            segment.data,
+            plan.get_data_ranges(segment.data, xfer_size, skip_erased=sparse),
+            segment.address,
+            mode,
+            display,
+        )
@@ -0,0 +1,386 @@
+# Copyright 2022 Block, Inc.
+"""Write data to DfuSe devices: the block writer with its retries, and the
+sparse, delta and interleaved erase strategies built on it.
+"""
+
+import logging
+import math
+import time
+from typing import Callable, List, Optional, Tuple
+
+import usb
+
+from . import checkpoint, descriptor, dfu, dfuse, image, plan, progress
+from .eraser import DfuSeEraser
+from .options import ERASE_INTERLEAVED, DownloadOptions
+from .verify import first_difference
+
+logger = logging.getLogger(__name__)
+
+# Number of times a DfuSe block is retried after a USB error, with a backoff
+# doubling from the minimum to the maximum delay
+_BLOCK_RETRIES = 3
+_RETRY_MIN_S = 0.05
+_RETRY_MAX_S = 1.0
+
+
+class DfuSeWriter:
+    """Write data blocks to a DfuSe device, only sending SET_ADDRESS when the
+    next block does not follow on from the previous one.
+
+    DfuSe devices compute the address of each data block from the last address
+    set and the block number, so a contiguous region only needs one
+    SET_ADDRESS followed by increasing block numbers.
+    """
+
+    def __init__(
+        self,
+        dev: usb.core.Device,
+        interface: int,
+        xfer_size: int,
+        per_chunk_address: bool = False,
+    ) -> None:
+        """Create writer for a DfuSe device.
+
+        Args:
+            dev: USB device in DFU mode.
+            interface: USB device interface.
+            xfer_size: Transfer size to use when downloading.
+            per_chunk_address: Send SET_ADDRESS before every block and always
+                use the first block number, for devices which do not support
+                block number auto-increment.
+        """
+        self.dev = dev
+        self.interface = interface
+        self.xfer_size = xfer_size
+        self.per_chunk_address = per_chunk_address
+        self.polls = 0
+        self.set_address_count = 0
+        self.retries = 0
+        self._block_num = dfuse.DFUSE_FIRST_BLOCK_NUM
+        self._next_address: Optional[int] = None
+
+    def write(self, address: int, chunk: image.Buffer) -> None:
+        """Write a block of data. If the block fails with a USB error, the
+        device is returned to the idle state and the block is sent again after
+        SET_ADDRESS, up to `_BLOCK_RETRIES` times.
+
+        Args:
+            address: Address of block in device memory.
+            chunk: Block data, at most `xfer_size` bytes.
+
+        Raises:
+            usb.core.USBError: Block failed after all retries.
+        """
+        delay = _RETRY_MIN_S
+        for attempt in range(_BLOCK_RETRIES + 1):
+            try:
+                self._write(address, chunk)
+                return
+            except usb.core.USBError as err:
+                if attempt == _BLOCK_RETRIES:
+                    raise
+                logger.warning(
+                    "Block at 0x%X failed (%s), retrying in %.2f s",
+                    address,
+                    err,
+                    delay,
+                )
+
+            self.retries += 1
+            time.sleep(delay)
+            delay = min(2 * delay, _RETRY_MAX_S)
+            try:
+                dfu.recover(self.dev, self.interface)
+            except usb.core.USBError as err:
+                logger.debug("Recovery failed: %s", err)
+            # Device address pointer is unknown after a failure
+            self._next_address = None
+
+    def _write(self, address: int, chunk: image.Buffer) -> None:
+        """Write a block of data once.
+
+        Args:
+            address: Address of block in device memory.
+            chunk: Block data, at most `xfer_size` bytes.
+        """
+        if (
+            self.per_chunk_address
+            or address != self._next_address
+            or self._block_num > dfuse.DFUSE_LAST_BLOCK_NUM
+        ):
+            self.polls += dfuse.set_address(self.dev, self.interface, address)
+            self.set_address_count += 1
+            self._block_num = dfuse.DFUSE_FIRST_BLOCK_NUM
+
+        self.polls += dfu.download(
+            self.dev, self.interface, self._block_num, chunk
+        )
+
+        if self.per_chunk_address or len(chunk) != self.xfer_size:
+            # A short block breaks the address calculation for the next one
+            self._next_address = None
+        else:
+            self._next_address = address + self.xfer_size
+            self._block_num += 1
+
+    def reset(self) -> None:
+        """Send SET_ADDRESS before the next block. Must be called after any
+        other command which moves the device address pointer, like erase or
+        upload.
+        """
+        self._next_address = None
+
+
+def write_range(
+    writer: DfuSeWriter,
+    data: image.Buffer,
+    start_address: int,
+    begin: int,
+    end: int,
+    blank_ranges: List[Tuple[int, int]],
+    sparse: bool,
+    report: plan.SkipReport,
+    advance: Callable[[int], None],
+    checkpointer: Optional[checkpoint.Checkpointer] = None,
+    eraser: Optional[DfuSeEraser] = None,
+) -> None:
+    """Write a range of data to a DfuSe device in transfer size chunks.
+
+    Args:
+        writer: Writer for the DfuSe device.
+        data: Binary data to download.
+        start_address: Start address of data in device memory.
+        begin: Offset in data of first byte to write.
+        end: Offset in data after the last byte to write.
+        blank_ranges: Address ranges which hold the erased value.
+        sparse: Skip chunks of erased values in `blank_ranges`.
+        report: Updated with the number of bytes and chunks skipped.
+        advance: Called with the number of bytes handled after each chunk.
+        checkpointer: Skips chunks which were already written, and records
+            each chunk written, if provided.
+        eraser: Erases pages just before each chunk is written, if provided.
+    """
+    offset = begin
+    while offset < end:
+        chunk_size = min(writer.xfer_size, end - offset)
+        chunk_address = start_address + offset
+
+        if (
+            checkpointer
+            and offset + chunk_size <= checkpointer.state.written_end
+        ):
+            # Written before the download was interrupted
+            pass
+        elif (
+            sparse
+            and plan.is_erased(data, offset, offset + chunk_size)
+            and plan.ranges_contain(
+                blank_ranges, chunk_address, chunk_address + chunk_size
+            )
+        ):
+            report.bytes_skipped += chunk_size
+            report.chunks_skipped += 1
+        else:
+            logger.debug(
+                "Downloading %d bytes (total: %d bytes)", chunk_size, offset
+            )
+
+            if eraser:
+                eraser.erase_before(chunk_address + chunk_size)
+            writer.write(chunk_address, data[offset : offset + chunk_size])
+            if checkpointer:
+                checkpointer.written(offset + chunk_size)
+
+        offset += chunk_size
+        advance(chunk_size)
+
+
+def _range_unchanged(
+    dev: usb.core.Device,
+    interface: int,
+    data: image.Buffer,
+    start_address: int,
+    begin: int,
+    end: int,
+    xfer_size: int,
+) -> bool:
+    """Check if device memory already holds a range of data by reading it back.
+    Reading stops at the first block which differs.
+
+    Args:
+        dev: USB device in DFU mode.
+        interface: USB device interface.
+        data: Binary data to download.
+        start_address: Start address of data in device memory.
+        begin: Offset in data of first byte to compare.
+        end: Offset in data after the last byte to compare.
+        xfer_size: Transfer size to use when uploading.
+
+    Returns:
+        True if device memory matches the data.
+    """
+    blocks = dfuse.read_memory(
+        dev, interface, start_address + begin, end - begin, xfer_size
+    )
+    try:
+        return first_difference(blocks, data, begin, end) is None
+    finally:
+        blocks.close()
+
+
+def write_delta(
+    dev: usb.core.Device,
+    interface: int,
+    pages: List[plan.Page],
+    data: image.Buffer,
+    start_address: int,
+    writer: DfuSeWriter,
+    sparse: bool,
+    report: plan.SkipReport,
+    advance: Callable[[int], None],
+) -> None:
+    """Erase and write only the pages of a DfuSe device which differ from the
+    data. Pages are compared by reading them back until reading turns out to be
+    slower than erasing and writing, after which every page is rewritten.
+
+    Args:
+        dev: USB device in DFU mode.
+        interface: USB device interface.
+        pages: Device pages which cover the data.
+        data: Binary data to download.
+        start_address: Start address of data in device memory.
+        writer: Writer for the DfuSe device.
+        sparse: Skip pages and chunks which only contain the erased value.
+        report: Updated with the number of bytes, chunks and pages skipped.
+        advance: Called with the number of bytes handled.
+    """
+    compare = True
+    read_time, read_bytes = 0.0, 0
+    write_time, write_bytes = 0.0, 0
+    for page in pages:
+        begin = max(page.addr, start_address) - start_address
+        end = min(page.end, start_address + len(data)) - start_address
+
+        unchanged = sparse and plan.is_erased(data, begin, end)
+        if not unchanged and compare:
+            read_start = time.perf_counter()
+            try:
+                unchanged = _range_unchanged(
+                    dev,
+                    interface,
+                    data,
+                    start_address,
+                    begin,
+                    end,
+                    writer.xfer_size,
+                )
+            except (RuntimeError, usb.core.USBError) as err:
+                logger.warning("Readback failed, disabling delta: %s", err)
+                dfu.clear_status(dev, interface)
+                compare = False
+            writer.reset()
+            read_time += time.perf_counter() - read_start
+            read_bytes += end - begin
+
+        if unchanged:
+            logger.debug("Skipping unchanged page 0x%X", page.addr)
+            report.pages_skipped += 1
+            report.bytes_skipped += end - begin
+            report.chunks_skipped += math.ceil((end - begin) / writer.xfer_size)
+            advance(end - begin)
+            continue
+
+        write_start = time.perf_counter()
+        logger.info(
+            "Erasing page 0x%X of size %d in segment %d",
+            page.addr,
+            page.size,
+            page.segment_num,
+        )
+        dfuse.page_erase(dev, interface, page.addr)
+        writer.reset()
+        write_range(
+            writer,
+            data,
+            start_address,
+            begin,
+            end,
+            [(page.addr, page.end)],
+            sparse,
+            report,
+            advance,
+        )
+        write_time += time.perf_counter() - write_start
+        write_bytes += end - begin
+
+        # Compare time per byte without dividing by zero
+        if compare and read_time * write_bytes > write_time * read_bytes:
+            logger.info("Readback is slower than writing, disabling delta")
+            compare = False
+
+
+def erase_and_write(
+    writer: DfuSeWriter,
+    layout: List[descriptor.DfuSeMemoryLayout],
+    segments: List[image.Segment],
+    options: DownloadOptions,
+    report: plan.SkipReport,
+    display: progress.ProgressSink,
+    checkpointer: Optional[checkpoint.Checkpointer] = None,
+) -> Tuple[float, float]:
+    """Erase the pages of a DfuSe device which hold the data and write it.
+
+    Args:
+        writer: Writer for the DfuSe device.
+        layout: Device memory layout.
+        segments: Data to download, sorted by address. Each segment is written
+            from its own address.
+        options: Sparse download, mass erase and erase schedule options.
+        report: Updated with the work skipped by a sparse download.
+        display: Progress display.
+        checkpointer: Records progress and skips work already done, if
+            provided. Only supported for a single segment.
+
+    Returns:
+        Time spent erasing and time spent writing, in seconds.
+    """
+    interleaved = options.erase_schedule == ERASE_INTERLEAVED
+    erase_plan = plan.plan_erase_segments(
+        layout, segments, options.sparse, options.mass_erase_threshold
+    )
+    report.pages_skipped += erase_plan.pages_skipped
+    eraser = DfuSeEraser(
+        writer.dev, writer.interface, erase_plan, writer, checkpointer
+    )
+    if not interleaved:
+        eraser.erase_all()
+
+    start = time.monotonic()
+    with display.task(sum(len(s.data) for s in segments)) as advance:
+        for segment in segments:
+            write_range(
+                writer,
+                segment.data,
+                segment.address,
+                0,
+                len(segment.data),
+                erase_plan.blank_ranges,
+                options.sparse,
+                report,
+                advance,
+                checkpointer,
+                eraser if interleaved else None,
+            )
+    write_time = time.monotonic() - start
+
+    if interleaved:
+        write_time -= eraser.duration
+        # Never leave a planned page unerased, though every page should have
+        # been erased before its first chunk
+        eraser.erase_all()
+
+    logger.info(
+        "Erase took %.2f s and write took %.2f s", eraser.duration, write_time
+    )
+    return eraser.duration, write_time
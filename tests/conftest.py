@@ -1,6 +1,8 @@
 # Copyright 2022 Block, Inc.
 """Common unit test fixtures."""
 
+import struct
+import zlib
 from typing import Generator
 from unittest import mock
 
@@ -19,3 +21,44 @@ def mock_usb_get_string() -> Generator[mock.Mock, None, None]:
     """Mock usb.util.get_string."""
     with mock.patch("usb.util.get_string") as mock_obj:
         yield mock_obj
+
+
+def _with_suffix(payload: bytes) -> bytes:
+    """Append a DFU suffix for any device to a payload."""
+    data = payload + struct.pack(
+        "<HHHH3sB", 0xFFFF, 0xFFFF, 0xFFFF, 0x011A, b"UFD", 16
+    )
+    return data + struct.pack("<I", zlib.crc32(data) ^ 0xFFFFFFFF)
+
+
+@pytest.fixture()
+def dfuse_file() -> bytes:
+    """DfuSe file with two elements for alternate setting 0 and one for 1."""
+    targets = {
+        0: [(0x08000000, b"\x11" * 1024), (0x08008000, b"\x22" * 512)],
+        1: [(0x1FFF7800, b"\x33" * 16)],
+    }
+    images = b""
+    for alt, elements in targets.items():
+        body = b"".join(
+            struct.pack("<II", address, len(data)) + data
+            for address, data in elements
+        )
+        images += (
+            struct.pack(
+                "<6sBI255sII",
+                b"Target",
+                alt,
+                1,
+                f"Target {alt}".encode(),
+                len(body),
+                len(elements),
+            )
+            + body
+        )
+
+    prefix_len = struct.calcsize("<5sBIB")
+    prefix = struct.pack(
+        "<5sBIB", b"DfuSe", 1, prefix_len + len(images), len(targets)
+    )
+    return _with_suffix(prefix + images)
@@ -0,0 +1,136 @@
+# Copyright 2022 Block, Inc.
+"""Test the asyncio API."""
+
+import asyncio
+import threading
+import time
+from typing import Any, Generator, List
+from unittest import mock
+
+import pytest
+
+from pyfu_usb import (
+    VERIFY_COMPARE,
+    DownloadCancelled,
+    DownloadOptions,
+    DownloadResult,
+    aio,
+)
+from pyfu_usb.dfu import _DFU_STATE_DFU_IDLE
+from pyfu_usb.progress import ProgressUpdate
+from pyfu_usb.simulator import SimulatedDevice, Timing
+
+_DATA = bytes(range(256)) * 80
+_ADDRESS = 0x08000000
+
+
+@pytest.fixture()
+def mock_get_dfu_device() -> Generator[mock.Mock, None, None]:
+    """Mock pyfu_usb._get_dfu_device, also to find the worker's device"""
+    with mock.patch("pyfu_usb._get_dfu_device") as mock_obj, mock.patch(
+        "pyfu_usb.aio._get_dfu_device", mock_obj
+    ):
+        yield mock_obj
+
+
+def test_download(mock_get_dfu_device: mock.Mock) -> None:
+    """Test progress is iterated over and the result awaited."""
+    mock_get_dfu_device.return_value = SimulatedDevice()
+
+    async def run() -> List[ProgressUpdate]:
+        job = aio.download(
+            _DATA,
+            address=_ADDRESS,
+            options=DownloadOptions(verify=VERIFY_COMPARE),
+        )
+        updates = [update async for update in job]
+        result = await job
+        assert isinstance(result, DownloadResult)
+        assert result.error is None
+        assert job.done()
+        return updates
+
+    updates = asyncio.run(run())
+    finished = [update.description for update in updates if update.finished]
+    assert finished == ["Downloading firmware", "Verifying"]
+
+
+def test_cancel(mock_get_dfu_device: mock.Mock) -> None:
+    """Test cancelling aborts the DFU transaction and releases the device."""
+    device = SimulatedDevice(timing=Timing(transfer_ms=2))
+    mock_get_dfu_device.return_value = device
+
+    async def run() -> None:
+        job = aio.download(_DATA, address=_ADDRESS, min_interval_s=0)
+        async for update in job:
+            if update.completed:
+                job.cancel()
+        with pytest.raises(DownloadCancelled):
+            await job
+        assert job.cancelled
+
+    asyncio.run(run())
+    assert device.counts["abort"] == 1
+    assert device.state == _DFU_STATE_DFU_IDLE
+    assert not device.claimed
+    assert device.firmware_length < len(_DATA)
+
+
+def test_cancel_task(mock_get_dfu_device: mock.Mock) -> None:
+    """Test cancelling a task awaiting a download cancels the download once
+    the device is released.
+    """
+    device = SimulatedDevice(timing=Timing(transfer_ms=2))
+    mock_get_dfu_device.return_value = device
+
+    async def run() -> None:
+        job = aio.download(_DATA, address=_ADDRESS)
+        task = asyncio.ensure_future(job)
+        await job.__anext__()
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert job.done()
+        assert not device.claimed
+
+    asyncio.run(run())
+
+
+def test_workers_by_device(mock_get_dfu_device: mock.Mock) -> None:
+    """Test downloads to one device selected in different ways run one after
+    another, and workers stop once idle.
+    """
+    mock_get_dfu_device.return_value = SimulatedDevice()
+    lock = threading.Lock()
+    running: List[int] = []
+
+    def download(*args: Any, **kwargs: Any) -> DownloadResult:
+        assert kwargs["port_path"] == "1-1"
+        assert lock.acquire(blocking=False)
+        running.append(1)
+        time.sleep(0.02)
+        lock.release()
+        return DownloadResult()
+
+    async def run() -> None:
+        jobs = [
+            aio.download(_DATA, vid=0x0483, pid=0xDF11),
+            aio.download(_DATA, serial="ABC123"),
+            aio.download(_DATA, port_path="1-1"),
+        ]
+        await asyncio.gather(*jobs)
+        assert aio._workers == {}
+
+    with mock.patch("pyfu_usb.aio._download", side_effect=download):
+        asyncio.run(run())
+    assert len(running) == 3
+
+
+def test_list_devices() -> None:
+    """Test devices are found without blocking the event loop."""
+    device = SimulatedDevice()
+    with mock.patch(
+        "pyfu_usb.aio._get_dfu_devices", return_value=[device]
+    ) as mock_get_dfu_devices:
+        assert asyncio.run(aio.list_devices(serial="ABC")) == [device]
+    assert mock_get_dfu_devices.call_args.kwargs["runtime"] is None
@@ -0,0 +1,36 @@
+# Copyright 2022 Block, Inc.
+"""Test download benchmarks."""
+
+import dataclasses
+
+from benchmarks import download
+
+
+def test_make_cases() -> None:
+    """Test cases with too many blocks are left out."""
+    cases = download.make_cases(
+        [4096, 1 << 20], [64, 4096], protocols=["dfuse"], max_blocks=1024
+    )
+    assert [case.name for case in cases] == [
+        "dfuse-4096-64-dense",
+        "dfuse-4096-64-sparse",
+        "dfuse-4096-4096-dense",
+        "dfuse-4096-4096-sparse",
+        "dfuse-1048576-4096-dense",
+        "dfuse-1048576-4096-sparse",
+    ]
+    assert download.parse_size("16M") == 1 << 24
+
+
+def test_run_case() -> None:
+    """Test a sparse DfuSe download skips erased blocks."""
+    dense = download.run_case(download.Case("dfuse", 64 * 1024, 1024, False))
+    sparse = download.run_case(download.Case("dfuse", 64 * 1024, 1024, True))
+    assert dense.transfers_per_kib > sparse.transfers_per_kib
+    assert dense.getstatus_polls > sparse.getstatus_polls
+    assert dense.peak_alloc_bytes is not None
+
+    baseline = {"results": [dataclasses.asdict(dense)]}
+    assert not download.compare([dense], baseline, 0.1)
+    dense.transfers += 1
+    assert download.compare([dense], baseline, 0.1)
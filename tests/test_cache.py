@@ -0,0 +1,184 @@
+# Copyright 2022 Block, Inc.
+"""Test descriptor cache."""
+
+import concurrent.futures
+from pathlib import Path
+from typing import Generator
+from unittest import mock
+
+import pytest
+
+from pyfu_usb.cache import DescriptorCache, DeviceKey
+from pyfu_usb.descriptor import DfuDescriptor, DfuSeMemoryLayout
+
+_LAYOUT = [
+    DfuSeMemoryLayout(
+        addr=0x08000000,
+        last_addr=0x0800FFFF,
+        size=0x10000,
+        num_pages=4,
+        page_size=0x4000,
+    )
+]
+
+
+def _make_device(serial: str, bcd_device: int = 0x0200) -> mock.Mock:
+    """Fake USB device."""
+    dev = mock.Mock()
+    dev.idVendor = 0x0483
+    dev.idProduct = 0xDF11
+    dev.bcdDevice = bcd_device
+    dev.serial_number = serial
+    return dev
+
+
+@pytest.fixture()
+def mock_get_dfu_desc() -> Generator[mock.Mock, None, None]:
+    """Mock pyfu_usb.descriptor.get_dfu_descriptor."""
+    with mock.patch("pyfu_usb.descriptor.get_dfu_descriptor") as mock_obj:
+        mock_obj.return_value = DfuDescriptor(
+            bmAttributes=0x0B,
+            wDetachTimeOut=0xFF,
+            wTransferSize=2048,
+            bcdDFUVersion=0x011A,
+        )
+        yield mock_obj
+
+
+@pytest.fixture()
+def mock_get_layout() -> Generator[mock.Mock, None, None]:
+    """Mock pyfu_usb.descriptor.get_memory_layout."""
+    with mock.patch("pyfu_usb.descriptor.get_memory_layout") as mock_obj:
+        mock_obj.return_value = _LAYOUT
+        yield mock_obj
+
+
+def test_device_key() -> None:
+    """Test device identity includes release number and serial number."""
+    key = DeviceKey.from_device(_make_device("ABC123"))
+    assert str(key) == "0483:df11:0200:ABC123"
+    assert key != DeviceKey.from_device(_make_device("ABC123", 0x0201))
+
+
+def test_cache_hits(
+    mock_get_dfu_desc: mock.Mock, mock_get_layout: mock.Mock
+) -> None:
+    """Test descriptors are read from the device once."""
+    descriptor_cache = DescriptorCache()
+    dev = _make_device("ABC123")
+
+    for _ in range(3):
+        desc = descriptor_cache.get_dfu_descriptor(dev)
+        assert desc is not None
+        assert desc.wTransferSize == 2048
+        assert descriptor_cache.get_memory_layout(dev, 0) == _LAYOUT
+    assert 0 in descriptor_cache.layouts(dev, 0)
+    assert 1 not in descriptor_cache.layouts(dev, 0)
+    assert list(descriptor_cache.layouts(dev, 0)) == [0]
+
+    mock_get_dfu_desc.assert_called_once_with(dev)
+    mock_get_layout.assert_called_once_with(dev, 0, alternate_index=0)
+    assert (descriptor_cache.hits, descriptor_cache.misses) == (4, 2)
+
+    descriptor_cache.get_memory_layout(_make_device("OTHER"), 0)
+    assert mock_get_layout.call_count == 2
+
+
+def test_cache_counts_concurrent_lookups(
+    mock_get_dfu_desc: mock.Mock, mock_get_layout: mock.Mock
+) -> None:
+    """Test every lookup from several threads is counted."""
+    descriptor_cache = DescriptorCache()
+    dev = _make_device("ABC123")
+
+    def lookup(_: int) -> None:
+        descriptor_cache.get_dfu_descriptor(dev)
+        descriptor_cache.get_memory_layout(dev, 0)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as pool:
+        list(pool.map(lookup, range(400)))
+    assert descriptor_cache.hits + descriptor_cache.misses == 800
+
+
+def test_cache_empty_layout_not_stored(mock_get_layout: mock.Mock) -> None:
+    """Test a layout which could not be read is read again next time."""
+    mock_get_layout.return_value = []
+    descriptor_cache = DescriptorCache()
+    dev = _make_device("ABC123")
+    assert descriptor_cache.get_memory_layout(dev, 0) == []
+    assert descriptor_cache.get_memory_layout(dev, 0) == []
+    assert mock_get_layout.call_count == 2
+
+
+def test_cache_persistence(
+    tmp_path: Path, mock_get_dfu_desc: mock.Mock, mock_get_layout: mock.Mock
+) -> None:
+    """Test a cache file is used by later caches."""
+    path = str(tmp_path / "cache" / "descriptors.json")
+    dev = _make_device("ABC123")
+    DescriptorCache(path).get_dfu_descriptor(dev)
+    DescriptorCache(path).get_memory_layout(dev, 0, 1)
+
+    descriptor_cache = DescriptorCache(path)
+    assert descriptor_cache.get_dfu_descriptor(dev) is not None
+    assert descriptor_cache.get_memory_layout(dev, 0, 1) == _LAYOUT
+    assert (descriptor_cache.hits, descriptor_cache.misses) == (2, 0)
+    mock_get_dfu_desc.assert_called_once()
+    mock_get_layout.assert_called_once()
+
+
+def test_cache_invalidate_and_prune(
+    tmp_path: Path, mock_get_dfu_desc: mock.Mock
+) -> None:
+    """Test entries of unplugged devices are removed."""
+    path = str(tmp_path / "descriptors.json")
+    first = _make_device("AAA")
+    second = _make_device("BBB")
+    descriptor_cache = DescriptorCache(path)
+    descriptor_cache.get_dfu_descriptor(first)
+    descriptor_cache.get_dfu_descriptor(second)
+
+    descriptor_cache.prune([second])
+    descriptor_cache.get_dfu_descriptor(first)
+    assert mock_get_dfu_desc.call_count == 3
+
+    DescriptorCache(path).invalidate(second)
+    descriptor_cache = DescriptorCache(path)
+    descriptor_cache.get_dfu_descriptor(first)
+    descriptor_cache.get_dfu_descriptor(second)
+    assert descriptor_cache.hits == 1
+
+
+def test_cache_delete_layout(
+    tmp_path: Path, mock_get_layout: mock.Mock
+) -> None:
+    """Test deleting a layout removes only that alternate setting."""
+    path = str(tmp_path / "descriptors.json")
+    dev = _make_device("ABC123")
+    layouts = DescriptorCache(path).layouts(dev, 0)
+    layouts[1] = _LAYOUT
+    layouts[2] = _LAYOUT
+
+    del layouts[1]
+    with pytest.raises(KeyError):
+        del layouts[1]
+    assert list(DescriptorCache(path).layouts(dev, 0)) == [2]
+
+    layouts.clear()
+    assert len(DescriptorCache(path).layouts(dev, 0)) == 0
+    mock_get_layout.assert_not_called()
+
+
+def test_cache_invalid_file(
+    tmp_path: Path, mock_get_dfu_desc: mock.Mock
+) -> None:
+    """Test an invalid cache file is ignored and replaced."""
+    path = tmp_path / "descriptors.json"
+    path.write_text("{not json")
+    descriptor_cache = DescriptorCache(str(path))
+    descriptor_cache.get_dfu_descriptor(_make_device("ABC123"))
+    assert descriptor_cache.misses == 1
+    assert "ABC123" in path.read_text()
+
+    path.write_text("[]")
+    assert DescriptorCache(str(path)).get_dfu_descriptor(_make_device("ABC123"))
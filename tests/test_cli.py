@@ -2,12 +2,17 @@
 """Test command-line interface."""
 
 import argparse
+import json
+from pathlib import Path
 from typing import Generator
 from unittest import mock
 
 import pytest
 
-from pyfu_usb.__main__ import cli, create_parser
+from pyfu_usb import GROUP_HUB, DeviceResult, DownloadOptions, DownloadResult
+from pyfu_usb.__main__ import cli, create_parser, main
+from pyfu_usb.plan import ErasePlan
+from pyfu_usb.progress import NullProgress
 
 
 @pytest.fixture()
@@ -23,6 +28,13 @@ def mock_list_devices() -> Generator[mock.Mock, None, None]:
         yield mock_obj
 
 
+@pytest.fixture()
+def mock_download_all() -> Generator[mock.Mock, None, None]:
+    """Mock pyfu_usb.__main__.download_all"""
+    with mock.patch("pyfu_usb.__main__.download_all") as mock_obj:
+        yield mock_obj
+
+
 @pytest.fixture()
 def mock_download() -> Generator[mock.Mock, None, None]:
     """Mock pyfu_usb.__main__.download"""
@@ -48,7 +60,135 @@ def test_device_opt(
     """Test device option works."""
     args = parser.parse_args(["--device", "bbbb:bbbb", "--list"])
     assert cli(args) == 0
-    mock_list_devices.assert_called_with(vid=0xBBBB, pid=0xBBBB)
+    mock_list_devices.assert_called_with(
+        vid=0xBBBB,
+        pid=0xBBBB,
+        serial=None,
+        bus=None,
+        port_path=None,
+        descriptor_cache=None,
+    )
+
+
+def test_select_opts(
+    parser: argparse.ArgumentParser, mock_download: mock.Mock
+) -> None:
+    """Test serial number, bus and path options are passed to download."""
+    args = parser.parse_args(
+        ["-D", "some_file.bin", "-S", "ABC123", "--bus", "3", "-p", "3-1.4"]
+    )
+    assert cli(args) == 0
+    assert mock_download.call_args.kwargs["serial"] == "ABC123"
+    assert mock_download.call_args.kwargs["bus"] == 3
+    assert mock_download.call_args.kwargs["port_path"] == "3-1.4"
+
+
+def test_all_with_serial_opt(
+    parser: argparse.ArgumentParser, mock_download_all: mock.Mock
+) -> None:
+    """Test --all rejects options which select a single device."""
+    args = parser.parse_args(["-D", "some_file.bin", "--all", "-S", "ABC123"])
+    assert cli(args) == 1
+    mock_download_all.assert_not_called()
+
+    args = parser.parse_args(["-D", "some_file.bin", "--all", "--trace", "t"])
+    assert cli(args) == 1
+    mock_download_all.assert_not_called()
+
+
+def test_wait_opt(
+    parser: argparse.ArgumentParser, mock_list_devices: mock.Mock
+) -> None:
+    """Test wait option waits for a device before listing."""
+    args = parser.parse_args(["--list", "--wait", "2.5", "-S", "ABC123"])
+    with mock.patch("pyfu_usb.__main__._wait_for_dfu_devices") as mock_wait:
+        assert cli(args) == 0
+        mock_wait.side_effect = RuntimeError()
+        assert cli(args) == 1
+    assert mock_wait.call_args.kwargs["timeout"] == 2.5
+    assert mock_wait.call_args.kwargs["serial"] == "ABC123"
+    assert mock_wait.call_args.kwargs["runtime"] is False
+    mock_list_devices.assert_called_once()
+
+    args = parser.parse_args(["--wait", "2.5", "--detach", "-p", "1-2"])
+    with mock.patch(
+        "pyfu_usb.__main__._wait_for_dfu_devices"
+    ) as mock_wait, mock.patch("pyfu_usb.__main__.detach_device"):
+        assert cli(args) == 0
+    assert mock_wait.call_args.kwargs["runtime"] is None
+
+
+def test_detach_opt(parser: argparse.ArgumentParser) -> None:
+    """Test detach option without a file only switches to DFU mode."""
+    args = parser.parse_args(["--detach", "-p", "1-2"])
+    with mock.patch("pyfu_usb.__main__.detach_device") as mock_detach:
+        mock_detach.return_value.idVendor = 0xBBBB
+        mock_detach.return_value.idProduct = 0xDF11
+        assert cli(args) == 0
+        mock_detach.side_effect = RuntimeError()
+        assert cli(args) == 1
+    assert mock_detach.call_args.kwargs["port_path"] == "1-2"
+
+
+def test_dry_run_opt(parser: argparse.ArgumentParser) -> None:
+    """Test dry run logs the erase plan instead of downloading."""
+    args = parser.parse_args(
+        ["-D", "some_file.bin", "-a", "8000000", "--dry-run", "--mass-erase"]
+    )
+    with mock.patch("pyfu_usb.__main__.get_erase_plan") as mock_plan:
+        mock_plan.return_value = ErasePlan(pages=[], erase_pages=[])
+        assert cli(args) == 0
+    assert mock_plan.call_args.args == ("some_file.bin", 0x8000000)
+    assert mock_plan.call_args.kwargs["mass_erase_threshold"] == 0.9
+
+    args = parser.parse_args(["-D", "some_file.bin", "--dry-run"])
+    assert cli(args) == 1
+
+
+def test_cache_opt(
+    parser: argparse.ArgumentParser,
+    mock_list_devices: mock.Mock,
+    tmp_path: Path,
+) -> None:
+    """Test cache option opens the cache file."""
+    path = str(tmp_path / "cache.json")
+    args = parser.parse_args(["--list", "--cache", path])
+    assert cli(args) == 0
+    descriptor_cache = mock_list_devices.call_args.kwargs["descriptor_cache"]
+    assert descriptor_cache.path == path
+
+
+@pytest.mark.parametrize("metrics_format", ["json", "prometheus"])
+def test_metrics_opt(
+    parser: argparse.ArgumentParser,
+    mock_download: mock.Mock,
+    tmp_path: Path,
+    metrics_format: str,
+) -> None:
+    """Test metrics option writes the metrics of the download."""
+    path = tmp_path / "metrics"
+    args = parser.parse_args(
+        [
+            "-D",
+            "some_file.bin",
+            "-S",
+            "ABC123",
+            "--metrics",
+            str(path),
+            "--metrics-format",
+            metrics_format,
+        ]
+    )
+    assert cli(args) == 0
+    metrics_hook = mock_download.call_args.kwargs["metrics_hook"]
+    metrics_hook(DownloadResult(bytes_sent=1024, duration=0.5))
+
+    if metrics_format == "json":
+        assert json.loads(path.read_text())["throughput"] == 2048
+    else:
+        assert 'pyfu_usb_download_bytes_sent{serial="ABC123"} 1024' in (
+            path.read_text()
+        )
 
 
 def test_bad_device_arg(parser: argparse.ArgumentParser) -> None:
@@ -57,6 +197,25 @@ def test_bad_device_arg(parser: argparse.ArgumentParser) -> None:
     assert cli(args) == 1
 
 
+def test_bad_path_arg(
+    parser: argparse.ArgumentParser, capsys: pytest.CaptureFixture[str]
+) -> None:
+    """Test a malformed path option fails when parsed."""
+    with pytest.raises(SystemExit):
+        parser.parse_args(["-D", "some_file.bin", "-p", "3:1.4"])
+    assert "Invalid port path '3:1.4'" in capsys.readouterr().err
+
+
+def test_bad_mass_erase_arg(
+    parser: argparse.ArgumentParser, capsys: pytest.CaptureFixture[str]
+) -> None:
+    """Test a mass erase threshold outside (0, 1] fails when parsed."""
+    for value in ("0", "1.5", "most"):
+        with pytest.raises(SystemExit):
+            parser.parse_args(["-D", "some_file.bin", "--mass-erase", value])
+    assert "Mass erase threshold must be in (0, 1]" in capsys.readouterr().err
+
+
 def test_download_opt(
     parser: argparse.ArgumentParser, mock_download: mock.Mock
 ) -> None:
@@ -71,9 +230,27 @@ def test_download_opt(
         vid=None,
         pid=None,
         address=int(address, 16),
+        options=DownloadOptions(),
+        serial=None,
+        bus=None,
+        port_path=None,
+        detach=False,
+        descriptor_cache=None,
+        trace_path=None,
+        metrics_hook=None,
+        display=None,
     )
 
 
+def test_no_progress_opt(
+    parser: argparse.ArgumentParser, mock_download: mock.Mock
+) -> None:
+    """Test no progress option downloads without progress bars."""
+    args = parser.parse_args(["--download", "some_file.bin", "--no-progress"])
+    assert cli(args) == 0
+    assert isinstance(mock_download.call_args.kwargs["display"], NullProgress)
+
+
 def test_bad_download_opt(
     parser: argparse.ArgumentParser, mock_download: mock.Mock
 ) -> None:
@@ -81,3 +258,62 @@ def test_bad_download_opt(
     args = parser.parse_args(["--download", "some_file.bin"])
     mock_download.side_effect = ValueError()
     assert cli(args) == 1
+
+
+def test_verify_opt(
+    parser: argparse.ArgumentParser, mock_download: mock.Mock
+) -> None:
+    """Test verify option defaults to comparing every byte."""
+    args = parser.parse_args(["--download", "some_file.bin", "--verify"])
+    assert cli(args) == 0
+    assert mock_download.call_args.kwargs["options"].verify == "compare"
+
+    args = parser.parse_args(
+        ["--download", "some_file.bin", "--verify", "hash"]
+    )
+    assert cli(args) == 0
+    assert mock_download.call_args.kwargs["options"].verify == "hash"
+
+
+def test_download_all_opt(
+    parser: argparse.ArgumentParser, mock_download_all: mock.Mock
+) -> None:
+    """Test downloading to all devices fails if any device fails."""
+    args = parser.parse_args(
+        ["--download", "some_file.bin", "--all", "--max-per-hub", "2"]
+    )
+    mock_download_all.return_value = [
+        DeviceResult(1, 2, "1-1", None, 1.0),
+        DeviceResult(1, 3, "1-2", None, 1.0),
+    ]
+    assert cli(args) == 0
+    assert mock_download_all.call_args.kwargs["max_per_group"] == 2
+    assert mock_download_all.call_args.kwargs["group"] == GROUP_HUB
+
+    mock_download_all.return_value.append(
+        DeviceResult(1, 4, "1-3", RuntimeError(), 1.0)
+    )
+    assert cli(args) == 1
+
+
+def test_serve_cmd() -> None:
+    """Test the serve command starts the service."""
+    argv = [
+        "pyfu-usb",
+        "serve",
+        "--port",
+        "0",
+        "--max-per-bus",
+        "2",
+        "--image-root",
+        "images",
+    ]
+    with mock.patch("sys.argv", argv), mock.patch(
+        "pyfu_usb.serve.serve"
+    ) as mock_serve, pytest.raises(SystemExit) as exit_info:
+        main()
+    assert exit_info.value.code == 0
+    assert mock_serve.call_args.kwargs["port"] == 0
+    assert mock_serve.call_args.kwargs["max_per_bus"] == 2
+    assert mock_serve.call_args.kwargs["socket_path"] is None
+    assert mock_serve.call_args.kwargs["image_root"] == "images"
@@ -0,0 +1,151 @@
+# Copyright 2022 Block, Inc.
+"""Test switching devices from runtime mode to DFU mode."""
+
+from typing import Generator
+from unittest import mock
+
+import pytest
+import usb
+
+from pyfu_usb import detach_device, download
+from pyfu_usb.descriptor import (
+    DFU_ATTR_WILL_DETACH,
+    DfuDescriptor,
+    get_runtime_interface,
+)
+
+
+@pytest.fixture()
+def mock_get_dfu_devices() -> Generator[mock.Mock, None, None]:
+    """Mock pyfu_usb._get_dfu_devices."""
+    with mock.patch("pyfu_usb._get_dfu_devices") as mock_obj:
+        yield mock_obj
+
+
+@pytest.fixture()
+def mock_wait_for_device() -> Generator[mock.Mock, None, None]:
+    """Mock pyfu_usb.wait_for_device."""
+    with mock.patch("pyfu_usb.wait_for_device") as mock_obj:
+        yield mock_obj
+
+
+@pytest.fixture()
+def mock_dfu() -> Generator[mock.Mock, None, None]:
+    """Mock pyfu_usb.dfu."""
+    with mock.patch("pyfu_usb.dfu") as mock_obj:
+        yield mock_obj
+
+
+@pytest.fixture()
+def mock_get_dfu_desc() -> Generator[mock.Mock, None, None]:
+    """Mock pyfu_usb.descriptor.get_dfu_descriptor."""
+    with mock.patch("pyfu_usb.descriptor.get_dfu_descriptor") as mock_obj:
+        yield mock_obj
+
+
+def _make_runtime_device() -> mock.MagicMock:
+    """Fake USB device with a runtime mode DFU interface."""
+    intf = mock.Mock(
+        bInterfaceClass=0xFE,
+        bInterfaceSubClass=1,
+        bInterfaceProtocol=1,
+        bInterfaceNumber=3,
+    )
+    dev = mock.MagicMock()
+    dev.__iter__.return_value = [[intf]]
+    dev.bus = 1
+    dev.address = 7
+    dev.port_numbers = (2, 4)
+    return dev
+
+
+def test_get_runtime_interface() -> None:
+    """Test the runtime mode DFU interface is found."""
+    dev = _make_runtime_device()
+    assert get_runtime_interface(dev) == 3
+
+    dev.__iter__.return_value[0][0].bInterfaceProtocol = 2
+    assert get_runtime_interface(dev) is None
+
+
+@pytest.mark.parametrize("will_detach", [False, True])
+def test_detach_device(
+    mock_get_dfu_devices: mock.Mock,
+    mock_wait_for_device: mock.Mock,
+    mock_dfu: mock.Mock,
+    mock_get_dfu_desc: mock.Mock,
+    will_detach: bool,
+) -> None:
+    """Test DETACH is sent with wDetachTimeOut, followed by a reset if the
+    device does not detach by itself, and the device is found again at the
+    same location.
+    """
+    dev = _make_runtime_device()
+    mock_get_dfu_devices.return_value = [dev]
+    mock_get_dfu_desc.return_value = DfuDescriptor(
+        bmAttributes=DFU_ATTR_WILL_DETACH if will_detach else 0,
+        wDetachTimeOut=500,
+        wTransferSize=1024,
+        bcdDFUVersion=0x110,
+    )
+
+    assert detach_device(pid=0x1234) is mock_wait_for_device.return_value
+    assert mock_get_dfu_devices.call_args.kwargs["runtime"] is True
+    mock_dfu.detach.assert_called_once_with(dev, 3, 500)
+    assert dev.reset.called != will_detach
+    assert mock_wait_for_device.call_args.kwargs["port_path"] == "1-2.4"
+    assert mock_wait_for_device.call_args.kwargs["timeout"] == 10.5
+
+
+def test_detach_device_disconnects(
+    mock_get_dfu_devices: mock.Mock,
+    mock_wait_for_device: mock.Mock,
+    mock_dfu: mock.Mock,
+    mock_get_dfu_desc: mock.Mock,
+) -> None:
+    """Test a device which detaches by itself may fail the DETACH request."""
+    mock_get_dfu_devices.return_value = [_make_runtime_device()]
+    mock_get_dfu_desc.return_value = DfuDescriptor(
+        bmAttributes=DFU_ATTR_WILL_DETACH,
+        wDetachTimeOut=0,
+        wTransferSize=1024,
+        bcdDFUVersion=0x110,
+    )
+    mock_dfu.detach.side_effect = usb.core.USBError("No such device")
+    detach_device()
+    mock_wait_for_device.assert_called_once()
+
+    mock_get_dfu_desc.return_value.bmAttributes = 0
+    with pytest.raises(usb.core.USBError):
+        detach_device()
+
+
+def test_detach_device_already_dfu(
+    mock_get_dfu_devices: mock.Mock,
+    mock_dfu: mock.Mock,
+) -> None:
+    """Test a device already in DFU mode is returned without detaching."""
+    dev = mock.Mock()
+    mock_get_dfu_devices.side_effect = [[], [dev]]
+    assert detach_device() is dev
+    assert mock_get_dfu_devices.call_args.kwargs == {
+        "vid": None,
+        "pid": None,
+        "serial": None,
+        "bus": None,
+        "port_path": None,
+        "runtime": False,
+    }
+    mock_dfu.detach.assert_not_called()
+
+
+def test_download_detach() -> None:
+    """Test download switches the device to DFU mode in the same call."""
+    dev = mock.Mock()
+    with mock.patch("pyfu_usb.detach_device") as mock_detach, mock.patch(
+        "pyfu_usb._download_to_device"
+    ) as mock_download:
+        mock_detach.return_value = dev
+        download(b"\x00", vid=0x1234, detach=True)
+    mock_detach.assert_called_once()
+    assert mock_download.call_args.args[0].wrapped is dev
@@ -0,0 +1,171 @@
+# Copyright 2022 Block, Inc.
+"""Test DFU protocol implementation."""
+
+from typing import Generator, List
+from unittest import mock
+
+import pytest
+
+from pyfu_usb.dfu import (
+    _DFU_STATE_DFU_DOWNLOAD_BUSY,
+    _DFU_STATE_DFU_DOWNLOAD_IDLE,
+    _DFU_STATE_DFU_DOWNLOAD_SYNC,
+    _DFU_STATE_DFU_ERROR,
+    _DFU_STATE_DFU_IDLE,
+    _DFU_STATE_DFU_MANIFEST,
+    _DFU_STATE_DFU_MANIFEST_WAIT_RESET,
+    detach,
+    download,
+    get_status,
+    read_firmware,
+    recover,
+    upload,
+    wait_for_idle,
+)
+
+
+def _status(state: int, poll_timeout_ms: int = 0, status: int = 0) -> List[int]:
+    """Build a raw GETSTATUS response."""
+    return [
+        status,
+        poll_timeout_ms & 0xFF,
+        (poll_timeout_ms >> 8) & 0xFF,
+        (poll_timeout_ms >> 16) & 0xFF,
+        state,
+        0,
+    ]
+
+
+@pytest.fixture()
+def mock_sleep() -> Generator[mock.Mock, None, None]:
+    """Mock time.sleep."""
+    with mock.patch("time.sleep") as mock_obj:
+        yield mock_obj
+
+
+def test_get_status(mock_usb_device: mock.Mock) -> None:
+    """Test all fields of the GETSTATUS response are parsed."""
+    mock_usb_device.ctrl_transfer.return_value = [0x0E, 0x34, 0x12, 0x01, 4, 7]
+    status = get_status(mock_usb_device, 0)
+    assert status.bStatus == 0x0E
+    assert status.bwPollTimeout == 0x011234
+    assert status.bState == _DFU_STATE_DFU_DOWNLOAD_BUSY
+    assert status.iString == 7
+
+
+def test_wait_for_idle_honors_poll_timeout(
+    mock_usb_device: mock.Mock, mock_sleep: mock.Mock
+) -> None:
+    """Test the device requested poll timeout is slept between polls."""
+    mock_usb_device.ctrl_transfer.side_effect = [
+        _status(_DFU_STATE_DFU_DOWNLOAD_SYNC, 25),
+        _status(_DFU_STATE_DFU_DOWNLOAD_BUSY, 100),
+        _status(_DFU_STATE_DFU_DOWNLOAD_IDLE),
+    ]
+    assert wait_for_idle(mock_usb_device, 0) == 3
+    assert mock_sleep.call_args_list == [mock.call(0.025), mock.call(0.1)]
+
+
+def test_wait_for_idle_manifest(
+    mock_usb_device: mock.Mock, mock_sleep: mock.Mock
+) -> None:
+    """Test waiting stops once the device waits for a reset to manifest."""
+    mock_usb_device.ctrl_transfer.side_effect = [
+        _status(_DFU_STATE_DFU_MANIFEST, 10),
+        _status(_DFU_STATE_DFU_MANIFEST_WAIT_RESET),
+    ]
+    assert wait_for_idle(mock_usb_device, 0) == 2
+    mock_sleep.assert_called_once_with(0.01)
+
+
+def test_wait_for_idle_error(
+    mock_usb_device: mock.Mock, mock_sleep: mock.Mock
+) -> None:
+    """Test an error state raises an exception."""
+    mock_usb_device.ctrl_transfer.return_value = _status(
+        _DFU_STATE_DFU_ERROR, _DFU_STATE_DFU_IDLE, status=0x0A
+    )
+    with pytest.raises(RuntimeError):
+        wait_for_idle(mock_usb_device, 0)
+
+
+def test_wait_for_idle_deadline(
+    mock_usb_device: mock.Mock, mock_sleep: mock.Mock
+) -> None:
+    """Test waiting gives up once the deadline would be exceeded."""
+    mock_usb_device.ctrl_transfer.return_value = _status(
+        _DFU_STATE_DFU_DOWNLOAD_BUSY, 1000
+    )
+    with pytest.raises(RuntimeError):
+        wait_for_idle(mock_usb_device, 0, deadline_ms=500)
+    mock_sleep.assert_not_called()
+
+
+def test_download_returns_polls(
+    mock_usb_device: mock.Mock, mock_sleep: mock.Mock
+) -> None:
+    """Test download reports the number of GETSTATUS polls."""
+    mock_usb_device.ctrl_transfer.side_effect = [
+        None,
+        _status(_DFU_STATE_DFU_DOWNLOAD_BUSY, 5),
+        _status(_DFU_STATE_DFU_DOWNLOAD_IDLE),
+    ]
+    assert download(mock_usb_device, 0, 0, b"\x00") == 2
+
+
+def test_upload(mock_usb_device: mock.Mock) -> None:
+    """Test upload returns the data read from the device."""
+    mock_usb_device.ctrl_transfer.return_value = [1, 2, 3]
+    assert upload(mock_usb_device, 0, 2, 3) == b"\x01\x02\x03"
+    assert mock_usb_device.ctrl_transfer.call_args.kwargs["wValue"] == 2
+
+
+def test_read_firmware(mock_usb_device: mock.Mock) -> None:
+    """Test firmware is read until the device sends a short block."""
+    mock_usb_device.ctrl_transfer.side_effect = [
+        4 * [0xAA],
+        2 * [0xBB],
+        None,
+    ]
+    blocks = list(read_firmware(mock_usb_device, 0, 100, 4))
+    assert blocks == [4 * b"\xaa", 2 * b"\xbb"]
+
+
+def test_detach(mock_usb_device: mock.Mock) -> None:
+    """Test DETACH sends the detach timeout to the runtime interface."""
+    detach(mock_usb_device, 3, 1000)
+    kwargs = mock_usb_device.ctrl_transfer.call_args.kwargs
+    assert kwargs["bRequest"] == 0
+    assert kwargs["wValue"] == 1000
+    assert kwargs["wIndex"] == 3
+
+
+@pytest.mark.parametrize(
+    ("state", "request_code"),
+    [(_DFU_STATE_DFU_ERROR, 4), (_DFU_STATE_DFU_DOWNLOAD_IDLE, 6)],
+)
+def test_recover(
+    mock_usb_device: mock.Mock,
+    mock_sleep: mock.Mock,
+    state: int,
+    request_code: int,
+) -> None:
+    """Test errors are cleared and transfers are aborted once not busy."""
+    mock_usb_device.ctrl_transfer.side_effect = [
+        _status(_DFU_STATE_DFU_DOWNLOAD_BUSY, 5),
+        _status(state),
+        None,
+    ]
+    assert recover(mock_usb_device, 0) == state
+    mock_sleep.assert_called_once_with(0.005)
+    assert (
+        mock_usb_device.ctrl_transfer.call_args.kwargs["bRequest"]
+        == request_code
+    )
+
+
+def test_recover_idle(mock_usb_device: mock.Mock) -> None:
+    """Test nothing is sent to a device which is already idle."""
+    mock_usb_device.ctrl_transfer.return_value = _status(_DFU_STATE_DFU_IDLE)
+    assert recover(mock_usb_device, 0) == _DFU_STATE_DFU_IDLE
+    assert mock_usb_device.ctrl_transfer.call_count == 1
@@ -0,0 +1,52 @@
+# Copyright 2022 Block, Inc.
+"""Test DFU file parsing."""
+
+import pytest
+
+from pyfu_usb import dfufile
+
+
+def test_parse_dfuse_file(dfuse_file: bytes) -> None:
+    """Test a DfuSe file is split into targets and elements."""
+    dfu_file = dfufile.parse(dfuse_file)
+    assert dfu_file is not None
+    assert dfu_file.suffix.idVendor == dfufile.SUFFIX_ANY
+    assert len(dfu_file.payload) == len(dfuse_file) - 16
+
+    assert [t.alternate_setting for t in dfu_file.targets] == [0, 1]
+    assert dfu_file.targets[0].name == "Target 0"
+    elements = dfu_file.targets[0].elements
+    assert [e.address for e in elements] == [0x08000000, 0x08008000]
+    assert bytes(elements[1].data) == b"\x22" * 512
+    assert bytes(dfu_file.targets[1].elements[0].data) == b"\x33" * 16
+
+
+def test_parse_no_suffix() -> None:
+    """Test a raw binary has no DFU suffix."""
+    assert dfufile.parse(b"\xbb" * 1024) is None
+    assert dfufile.parse(b"UFD") is None
+
+
+def test_parse_bad_crc(dfuse_file: bytes) -> None:
+    """Test a corrupted file is rejected."""
+    corrupted = bytearray(dfuse_file)
+    corrupted[300] ^= 0xFF
+    with pytest.raises(ValueError, match="CRC32"):
+        dfufile.parse(corrupted)
+
+
+def test_parse_dfuse_truncated(dfuse_file: bytes) -> None:
+    """Test a container with an inconsistent size is rejected."""
+    with pytest.raises(ValueError):
+        dfufile.parse_dfuse(dfuse_file[:-100])
+
+
+def test_matches_device() -> None:
+    """Test the VID and PID in the suffix are compared with wildcards."""
+    suffix = dfufile.DfuSuffix(
+        bcdDevice=0, idProduct=0xDF11, idVendor=0x0483, bcdDFU=0x011A, dwCRC=0
+    )
+    assert dfufile.matches_device(suffix, 0x0483, 0xDF11)
+    assert not dfufile.matches_device(suffix, 0x0483, 0x1234)
+    suffix.idProduct = dfufile.SUFFIX_ANY
+    assert dfufile.matches_device(suffix, 0x0483, 0x1234)
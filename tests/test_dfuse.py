@@ -0,0 +1,68 @@
+# Copyright 2022 Block, Inc.
+"""Test DfuSe protocol implementation."""
+
+from typing import Generator
+from unittest import mock
+
+import pytest
+
+from pyfu_usb.dfuse import DFUSE_FIRST_BLOCK_NUM, mass_erase, read_memory
+
+
+@pytest.fixture()
+def mock_dfu_cmds() -> Generator[mock.Mock, None, None]:
+    """Mock DFU commands used by pyfu_usb.dfuse."""
+    with mock.patch.multiple(
+        "pyfu_usb.dfuse",
+        abort=mock.DEFAULT,
+        download=mock.DEFAULT,
+        upload=mock.DEFAULT,
+    ) as mocks:
+        mocks["upload"].side_effect = (
+            lambda dev, intf, block, size: bytes([block]) * size
+        )
+        yield mock.Mock(**mocks)
+
+
+def test_read_memory(
+    mock_usb_device: mock.Mock, mock_dfu_cmds: mock.Mock
+) -> None:
+    """Test memory is read in transfer size blocks after one address."""
+    blocks = list(read_memory(mock_usb_device, 0, 0x8000000, 2500, 1024))
+    assert [len(block) for block in blocks] == [1024, 1024, 452]
+    assert [block[0] for block in blocks] == [
+        DFUSE_FIRST_BLOCK_NUM,
+        DFUSE_FIRST_BLOCK_NUM + 1,
+        DFUSE_FIRST_BLOCK_NUM + 2,
+    ]
+    assert mock_dfu_cmds.download.call_count == 1
+
+    # Abort before and after setting the address and when done
+    assert mock_dfu_cmds.abort.call_count == 3
+
+
+def test_read_memory_closed_early(
+    mock_usb_device: mock.Mock, mock_dfu_cmds: mock.Mock
+) -> None:
+    """Test the device is returned to idle if reading stops early."""
+    blocks = read_memory(mock_usb_device, 0, 0x8000000, 4096, 1024)
+    next(blocks)
+    blocks.close()
+    assert mock_dfu_cmds.upload.call_count == 1
+    assert mock_dfu_cmds.abort.call_count == 3
+
+
+def test_read_memory_short_upload(
+    mock_usb_device: mock.Mock, mock_dfu_cmds: mock.Mock
+) -> None:
+    """Test an exception is raised if the device returns too little data."""
+    mock_dfu_cmds.upload.side_effect = None
+    mock_dfu_cmds.upload.return_value = b"\x00"
+    with pytest.raises(RuntimeError):
+        list(read_memory(mock_usb_device, 0, 0x8000000, 1024, 1024))
+
+
+def test_mass_erase(mock_dfu_cmds: mock.Mock) -> None:
+    """Test mass erase sends the erase command without an address."""
+    mass_erase(mock.Mock(), 0)
+    assert mock_dfu_cmds.download.call_args.args[2:] == (0, b"\x41")
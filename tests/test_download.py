@@ -1,17 +1,42 @@
 # Copyright 2022 Block, Inc.
 """Test download."""
 
+import contextlib
+import json
 import math
 import pathlib
-from typing import Generator
+import threading
+import time
+from typing import Dict, Generator, Optional, Tuple
 from unittest import mock
 
 import pytest
-
-from pyfu_usb import download
-from pyfu_usb.descriptor import DfuDescriptor
+import usb
+
+from pyfu_usb import (
+    ERASE_INTERLEAVED,
+    GROUP_BUS,
+    GROUP_HUB,
+    VERIFY_COMPARE,
+    VERIFY_HASH,
+    DownloadOptions,
+    DownloadResult,
+    download,
+    download_all,
+)
+from pyfu_usb.descriptor import (
+    DFU_ATTR_CAN_DOWNLOAD,
+    DFU_ATTR_CAN_UPLOAD,
+    DfuDescriptor,
+)
 from pyfu_usb.dfu import _DFU_STATE_DFU_IDLE
-from pyfu_usb.dfuse import DFUSE_VERSION_NUMBER
+from pyfu_usb.dfuse import (
+    DFUSE_FIRST_BLOCK_NUM,
+    DFUSE_LAST_BLOCK_NUM,
+    DFUSE_VERSION_NUMBER,
+)
+from pyfu_usb.downloader import dfuse_download, dfuse_download_from_idle
+from pyfu_usb.image import Segment
 
 
 @pytest.fixture()
@@ -59,8 +84,16 @@ def mock_usb_dispose() -> Generator[mock.Mock, None, None]:
 
 @pytest.fixture()
 def mock_dfu() -> Generator[mock.Mock, None, None]:
-    """Mock pyfu_usb.dfu."""
-    with mock.patch("pyfu_usb.dfu") as mock_obj:
+    """Mock pyfu_usb.dfu in every module which uses it."""
+    mock_obj = mock.MagicMock()
+    with contextlib.ExitStack() as stack:
+        for module in (
+            "pyfu_usb",
+            "pyfu_usb.downloader",
+            "pyfu_usb.writer",
+            "pyfu_usb.verify",
+        ):
+            stack.enter_context(mock.patch(f"{module}.dfu", mock_obj))
         yield mock_obj
 
 
@@ -205,3 +238,706 @@ def test_download_dfu_call_count(
     exp_xfers = math.ceil(binary_file_size / dfu_desc.wTransferSize) + 1
 
     assert mock_dfu.download.call_count == exp_xfers
+
+
+@pytest.fixture()
+def mock_dfuse() -> Generator[mock.Mock, None, None]:
+    """Mock pyfu_usb.dfuse in every module which uses it."""
+    mock_obj = mock.MagicMock()
+    with contextlib.ExitStack() as stack:
+        for module in (
+            "pyfu_usb.downloader",
+            "pyfu_usb.writer",
+            "pyfu_usb.eraser",
+            "pyfu_usb.verify",
+        ):
+            stack.enter_context(mock.patch(f"{module}.dfuse", mock_obj))
+        mock_obj.DFUSE_VERSION_NUMBER = DFUSE_VERSION_NUMBER
+        mock_obj.DFUSE_FIRST_BLOCK_NUM = DFUSE_FIRST_BLOCK_NUM
+        mock_obj.DFUSE_LAST_BLOCK_NUM = DFUSE_LAST_BLOCK_NUM
+        yield mock_obj
+
+
+@pytest.mark.parametrize("per_chunk_address", [False, True])
+def test_download_dfuse_call_count(
+    binary_file_size: int,
+    binary_file: str,
+    mock_get_dfu_devices: mock.Mock,
+    mock_usb_device: mock.Mock,
+    mock_get_dfu_desc: mock.Mock,
+    mock_usb_get_string: mock.Mock,
+    mock_dfu: mock.Mock,
+    mock_dfuse: mock.Mock,
+    per_chunk_address: bool,
+) -> None:
+    """Test that DfuSe download only sets the address when required."""
+    mock_get_dfu_devices.return_value = [mock_usb_device]
+    mock_usb_get_string.return_value = "/0x08000000/04*016Kg,01*064Kg,07*128Kg"
+
+    dfu_desc = DfuDescriptor(
+        bmAttributes=0x00,
+        wDetachTimeOut=0x100,
+        wTransferSize=1024,
+        bcdDFUVersion=DFUSE_VERSION_NUMBER,
+    )
+    mock_get_dfu_desc.return_value = dfu_desc
+    mock_dfu.download.return_value = 1
+    mock_dfuse.set_address.return_value = 1
+
+    download(
+        binary_file,
+        address=0x8000000,
+        options=DownloadOptions(per_chunk_address=per_chunk_address),
+    )
+
+    num_chunks = math.ceil(binary_file_size / dfu_desc.wTransferSize)
+    block_nums = [c.args[2] for c in mock_dfu.download.call_args_list]
+    if per_chunk_address:
+        # One per chunk plus the final jump address
+        assert mock_dfuse.set_address.call_count == num_chunks + 1
+        assert block_nums[:-1] == num_chunks * [DFUSE_FIRST_BLOCK_NUM]
+    else:
+        # One for the contiguous region plus the final jump address
+        assert mock_dfuse.set_address.call_count == 2
+        assert block_nums[:-1] == list(
+            range(DFUSE_FIRST_BLOCK_NUM, DFUSE_FIRST_BLOCK_NUM + num_chunks)
+        )
+
+    # Ends with empty download
+    assert block_nums[-1] == 0
+
+
+def test_dfuse_download_sparse(
+    mock_usb_device: mock.Mock,
+    mock_usb_get_string: mock.Mock,
+    mock_dfu: mock.Mock,
+    mock_dfuse: mock.Mock,
+) -> None:
+    """Test sparse DfuSe download skips erased-value pages and chunks."""
+    mock_usb_get_string.return_value = "/0x08000000/04*016Kg,01*064Kg,07*128Kg"
+    page_size = 1 << 14
+    data = (
+        page_size * b"\xbb"
+        + 2 * page_size * b"\xff"
+        + (page_size - 1024) * b"\xbb"
+        + 1024 * b"\xff"
+    )
+
+    report = dfuse_download(
+        mock_usb_device,
+        0,
+        data,
+        1024,
+        0x8000000,
+        options=DownloadOptions(sparse=True),
+    )
+
+    # Only the first and last pages of the image contain data
+    assert mock_dfuse.page_erase.call_args_list == [
+        mock.call(mock_usb_device, 0, 0x8000000),
+        mock.call(mock_usb_device, 0, 0x800C000),
+    ]
+    assert report.pages_skipped == 2
+    assert report.chunks_skipped == 33
+    assert report.bytes_skipped == 33 * 1024
+
+    # Chunks skipped in the middle of the image require a new address
+    assert mock_dfuse.set_address.call_args_list == [
+        mock.call(mock_usb_device, 0, 0x8000000),
+        mock.call(mock_usb_device, 0, 0x800C000),
+        mock.call(mock_usb_device, 0, 0x8000000),
+    ]
+
+
+def test_dfuse_download_delta(
+    mock_usb_device: mock.Mock,
+    mock_usb_get_string: mock.Mock,
+    mock_dfu: mock.Mock,
+    mock_dfuse: mock.Mock,
+) -> None:
+    """Test delta DfuSe download only rewrites pages which changed."""
+    mock_usb_get_string.return_value = "/0x08000000/04*016Kg,01*064Kg,07*128Kg"
+    page_size = 1 << 14
+    data = 2 * page_size * b"\xbb"
+    memory = bytearray(data)
+    memory[page_size + 100] = 0x00
+
+    def read_memory(
+        dev: mock.Mock, intf: int, address: int, length: int, xfer_size: int
+    ) -> Generator[bytes, None, None]:
+        offset = address - 0x8000000
+        for block in range(offset, offset + length, xfer_size):
+            yield bytes(memory[block : block + xfer_size])
+
+    mock_dfuse.read_memory.side_effect = read_memory
+
+    report = dfuse_download(
+        mock_usb_device,
+        0,
+        data,
+        1024,
+        0x8000000,
+        options=DownloadOptions(delta=True),
+    )
+
+    mock_dfuse.page_erase.assert_called_once_with(
+        mock_usb_device, 0, 0x8000000 + page_size
+    )
+    assert report.pages_skipped == 1
+    assert report.bytes_skipped == page_size
+
+    # Data blocks plus the final empty download
+    assert mock_dfu.download.call_count == page_size // 1024 + 1
+
+
+def test_dfuse_download_mass_erase(
+    mock_usb_device: mock.Mock,
+    mock_usb_get_string: mock.Mock,
+    mock_dfu: mock.Mock,
+    mock_dfuse: mock.Mock,
+) -> None:
+    """Test one mass erase replaces page erases for a large image."""
+    mock_usb_get_string.return_value = "/0x08000000/04*016Kg"
+    data = 3 * (1 << 14) * b"\xbb"
+
+    dfuse_download(mock_usb_device, 0, data, 1024, 0x8000000)
+    assert mock_dfuse.page_erase.call_count == 3
+    mock_dfuse.mass_erase.assert_not_called()
+
+    mock_dfuse.reset_mock()
+    dfuse_download(
+        mock_usb_device,
+        0,
+        data,
+        1024,
+        0x8000000,
+        options=DownloadOptions(mass_erase_threshold=0.75),
+    )
+    mock_dfuse.page_erase.assert_not_called()
+    mock_dfuse.mass_erase.assert_called_once_with(mock_usb_device, 0)
+
+
+def test_dfuse_download_interleaved_erase(
+    mock_usb_device: mock.Mock,
+    mock_usb_get_string: mock.Mock,
+    mock_dfu: mock.Mock,
+    mock_dfuse: mock.Mock,
+) -> None:
+    """Test each page is erased just before its first chunk is written."""
+    mock_usb_get_string.return_value = "/0x08000000/04*016Kg"
+    page_size = 1 << 14
+    data = (page_size + 2048) * b"\xbb"
+    mock_dfu.download.return_value = 0
+    mock_dfuse.page_erase.return_value = 0
+    mock_dfuse.set_address.return_value = 0
+
+    result = DownloadResult()
+    dfuse_download(
+        mock_usb_device,
+        0,
+        data,
+        1024,
+        0x8000000,
+        options=DownloadOptions(erase_schedule=ERASE_INTERLEAVED),
+        result=result,
+    )
+
+    calls = [
+        (name, args[2])
+        for name, args, _ in mock_dfuse.mock_calls
+        if name in ("page_erase", "set_address")
+    ]
+    # Erasing moves the address pointer, so the address is set again
+    assert calls == [
+        ("page_erase", 0x8000000),
+        ("set_address", 0x8000000),
+        ("page_erase", 0x8000000 + page_size),
+        ("set_address", 0x8000000 + page_size),
+        ("set_address", 0x8000000),
+    ]
+    assert result.phases.erase >= 0
+    assert result.phases.write >= 0
+
+
+def test_dfuse_download_block_retry(
+    mock_usb_device: mock.Mock,
+    mock_usb_get_string: mock.Mock,
+    mock_dfu: mock.Mock,
+    mock_dfuse: mock.Mock,
+) -> None:
+    """Test a failed block is retried on its own after recovering."""
+    mock_usb_get_string.return_value = "/0x08000000/04*016Kg,01*064Kg,07*128Kg"
+    mock_dfu.download.side_effect = [
+        1,
+        1,
+        usb.core.USBError("Pipe error"),
+        1,
+        1,
+        1,
+    ]
+
+    with mock.patch("time.sleep") as mock_sleep:
+        dfuse_download(mock_usb_device, 0, 4 * 1024 * b"\xbb", 1024, 0x8000000)
+
+    mock_sleep.assert_called_once()
+    mock_dfu.recover.assert_called_once_with(mock_usb_device, 0)
+    mock_dfuse.page_erase.assert_called_once()
+
+    # Only the failed block needs a new address, and later blocks follow on
+    assert mock_dfuse.set_address.call_args_list == [
+        mock.call(mock_usb_device, 0, 0x8000000),
+        mock.call(mock_usb_device, 0, 0x8000800),
+        mock.call(mock_usb_device, 0, 0x8000000),
+    ]
+    block_nums = [c.args[2] for c in mock_dfu.download.call_args_list]
+    assert block_nums == [2, 3, 4, 2, 3, 0]
+
+
+def test_dfuse_download_no_restart(
+    mock_usb_device: mock.Mock,
+    mock_usb_get_string: mock.Mock,
+    mock_dfu: mock.Mock,
+    mock_dfuse: mock.Mock,
+) -> None:
+    """Test leftover status is cleared first, and a block which keeps failing
+    fails the download instead of erasing and writing again.
+    """
+    mock_usb_get_string.return_value = "/0x08000000/04*016Kg,01*064Kg,07*128Kg"
+    mock_dfu.download.side_effect = usb.core.USBError("Pipe error")
+
+    with mock.patch("time.sleep"), pytest.raises(usb.core.USBError):
+        dfuse_download_from_idle(
+            mock_usb_device, 0, 4 * 1024 * b"\xbb", 1024, 0x8000000
+        )
+
+    assert mock_dfu.mock_calls[0] == mock.call.recover(mock_usb_device, 0)
+    mock_dfuse.page_erase.assert_called_once()
+
+
+def test_dfuse_download_resume(
+    tmp_path: pathlib.Path,
+    mock_usb_device: mock.Mock,
+    mock_usb_get_string: mock.Mock,
+    mock_dfu: mock.Mock,
+    mock_dfuse: mock.Mock,
+) -> None:
+    """Test an interrupted download resumes from the last confirmed block
+    without erasing again.
+    """
+    mock_usb_get_string.return_value = "/0x08000000/04*016Kg,01*064Kg,07*128Kg"
+    mock_usb_device.serial_number = "ABC123"
+    checkpoint_path = str(tmp_path / "download.checkpoint")
+    data = (2 * (1 << 14) - 1024) * b"\xbb"
+
+    # Interrupted after 3 blocks
+    mock_dfu.download.side_effect = 3 * [1] + 4 * [usb.core.USBError("")]
+    with mock.patch("time.sleep"), pytest.raises(usb.core.USBError):
+        dfuse_download(
+            mock_usb_device,
+            0,
+            data,
+            1024,
+            0x8000000,
+            options=DownloadOptions(checkpoint_path=checkpoint_path),
+        )
+    assert mock_dfuse.page_erase.call_count == 2
+    assert pathlib.Path(checkpoint_path).exists()
+
+    mock_dfu.reset_mock()
+    mock_dfuse.reset_mock()
+    mock_dfu.download.side_effect = None
+    dfuse_download(
+        mock_usb_device,
+        0,
+        data,
+        1024,
+        0x8000000,
+        options=DownloadOptions(checkpoint_path=checkpoint_path),
+    )
+    mock_dfuse.page_erase.assert_not_called()
+    assert mock_dfuse.set_address.call_args_list[0] == mock.call(
+        mock_usb_device, 0, 0x8000000 + 3 * 1024
+    )
+    # Remaining data blocks plus the final empty download
+    assert mock_dfu.download.call_count == len(data) // 1024 - 3 + 1
+    assert not pathlib.Path(checkpoint_path).exists()
+
+
+def test_dfuse_download_checkpoint_mismatch(
+    tmp_path: pathlib.Path,
+    mock_usb_device: mock.Mock,
+    mock_usb_get_string: mock.Mock,
+    mock_dfu: mock.Mock,
+    mock_dfuse: mock.Mock,
+) -> None:
+    """Test a checkpoint for a different image is ignored."""
+    mock_usb_get_string.return_value = "/0x08000000/04*016Kg,01*064Kg,07*128Kg"
+    mock_usb_device.serial_number = "ABC123"
+    checkpoint_path = tmp_path / "download.checkpoint"
+    checkpoint_path.write_text(
+        json.dumps(
+            {
+                "device": "ABC123",
+                "image_sha256": "0" * 64,
+                "address": 0x8000000,
+                "xfer_size": 1024,
+                "sparse": False,
+                "erased_end": 0x8008000,
+                "written_end": 0x8000,
+            }
+        )
+    )
+
+    dfuse_download(
+        mock_usb_device,
+        0,
+        ((1 << 14) - 1024) * b"\xbb",
+        1024,
+        0x8000000,
+        options=DownloadOptions(checkpoint_path=str(checkpoint_path)),
+    )
+    mock_dfuse.page_erase.assert_called_once()
+    assert mock_dfu.download.call_count == (1 << 14) // 1024
+
+
+def test_download_dfuse_file(
+    dfuse_file: bytes,
+    mock_get_dfu_devices: mock.Mock,
+    mock_usb_device: mock.Mock,
+    mock_get_dfu_desc: mock.Mock,
+    mock_usb_get_string: mock.Mock,
+    mock_dfu: mock.Mock,
+    mock_dfuse: mock.Mock,
+) -> None:
+    """Test each element of a DfuSe file is written to its alternate
+    setting in one session, without an address.
+    """
+    mock_get_dfu_devices.return_value = [mock_usb_device]
+    mock_usb_device.idVendor = 0x0483
+    mock_usb_device.idProduct = 0xDF11
+    mock_get_dfu_desc.return_value = DfuDescriptor(
+        bmAttributes=0x00,
+        wDetachTimeOut=0x100,
+        wTransferSize=1024,
+        bcdDFUVersion=DFUSE_VERSION_NUMBER,
+    )
+    # Layout of alternate setting 0 for both of its elements, then 1
+    flash = "/0x08000000/04*016Kg,01*064Kg"
+    mock_usb_get_string.side_effect = [flash, flash, "/0x1FFF7800/01*016 g"]
+
+    download(dfuse_file)
+
+    mock_usb_device.set_interface_altsetting.assert_has_calls(
+        [mock.call(0, 0), mock.call(0, 1)]
+    )
+    assert mock_usb_device.set_interface_altsetting.call_count == 2
+    erased = [c.args[2] for c in mock_dfuse.page_erase.call_args_list]
+    assert erased == [0x08000000, 0x08008000, 0x1FFF7800]
+
+    written = b"".join(
+        bytes(c.args[3])
+        for c in mock_dfu.download.call_args_list
+        if c.args[3] is not None
+    )
+    assert written == b"\x11" * 1024 + b"\x22" * 512 + b"\x33" * 16
+
+    # Leaves DFU mode once, jumping to the first element
+    assert mock_dfuse.set_address.call_args_list[-1].args[2] == 0x08000000
+    assert mock_dfu.download.call_args_list[-1].args[3] is None
+    mock_dfu.release_interface.assert_called_once()
+
+
+def test_download_dfuse_file_dfu_device(
+    dfuse_file: bytes,
+    mock_get_dfu_devices: mock.Mock,
+    mock_usb_device: mock.Mock,
+    mock_get_dfu_desc: mock.Mock,
+    mock_dfu: mock.Mock,
+) -> None:
+    """Test a DfuSe file is rejected by a plain DFU device."""
+    mock_get_dfu_devices.return_value = [mock_usb_device]
+    mock_usb_device.idVendor = 0x0483
+    mock_usb_device.idProduct = 0xDF11
+    mock_get_dfu_desc.return_value = DfuDescriptor(
+        bmAttributes=0x00,
+        wDetachTimeOut=0x100,
+        wTransferSize=1024,
+        bcdDFUVersion=0x0110,
+    )
+
+    with pytest.raises(ValueError, match="DfuSe device"):
+        download(dfuse_file)
+    mock_dfu.download.assert_not_called()
+
+
+def test_dfuse_download_segments(
+    mock_usb_device: mock.Mock,
+    mock_usb_get_string: mock.Mock,
+    mock_dfu: mock.Mock,
+    mock_dfuse: mock.Mock,
+) -> None:
+    """Test each segment is written from its own address, the gap between
+    them is not written, and a page shared by segments is erased once.
+    """
+    mock_usb_get_string.return_value = "/0x08000000/04*016Kg"
+    mock_dfu.download.return_value = 0
+    mock_dfuse.page_erase.return_value = 0
+    mock_dfuse.set_address.return_value = 0
+    segments = [
+        Segment(0x08000000, 2048 * b"\x11"),
+        Segment(0x08003000, 1024 * b"\x22"),
+        Segment(0x08008000, 16 * b"\x33"),
+    ]
+
+    dfuse_download(mock_usb_device, 0, segments, 1024, 0x08000000)
+
+    erased = [c.args[2] for c in mock_dfuse.page_erase.call_args_list]
+    assert erased == [0x08000000, 0x08008000]
+    addresses = [c.args[2] for c in mock_dfuse.set_address.call_args_list]
+    assert addresses == [0x08000000, 0x08003000, 0x08008000, 0x08000000]
+    chunks = [c.args[3] for c in mock_dfu.download.call_args_list]
+    assert sum(len(c) for c in chunks[:-1]) == 2048 + 1024 + 16
+    assert chunks[-1] is None
+
+    with pytest.raises(ValueError):
+        dfuse_download(mock_usb_device, 0, [], 1024, 0x08000000)
+
+
+def test_download_hex_file(
+    tmp_path: pathlib.Path,
+    mock_get_dfu_devices: mock.Mock,
+    mock_usb_device: mock.Mock,
+    mock_get_dfu_desc: mock.Mock,
+    mock_usb_get_string: mock.Mock,
+    mock_dfu: mock.Mock,
+    mock_dfuse: mock.Mock,
+) -> None:
+    """Test an Intel HEX file is downloaded without an address, jumping to
+    its first segment.
+    """
+    mock_get_dfu_devices.return_value = [mock_usb_device]
+    mock_get_dfu_desc.return_value = DfuDescriptor(
+        bmAttributes=0x00,
+        wDetachTimeOut=0x100,
+        wTransferSize=1024,
+        bcdDFUVersion=DFUSE_VERSION_NUMBER,
+    )
+    mock_usb_get_string.return_value = "/0x08000000/04*016Kg"
+    hex_file = tmp_path / "test.hex"
+    hex_file.write_text(":020000040800F2\n:0400100001020304E2\n:00000001FF\n")
+
+    download(str(hex_file))
+
+    mock_dfuse.page_erase.assert_called_once()
+    assert mock_dfuse.set_address.call_args_list[0].args[2] == 0x08000010
+    assert mock_dfuse.set_address.call_args_list[-1].args[2] == 0x08000010
+    assert (
+        bytes(mock_dfu.download.call_args_list[0].args[3])
+        == b"\x01\x02\x03\x04"
+    )
+
+
+@pytest.mark.parametrize("verify", [VERIFY_COMPARE, VERIFY_HASH])
+def test_dfuse_download_verify(
+    mock_usb_device: mock.Mock,
+    mock_usb_get_string: mock.Mock,
+    mock_dfu: mock.Mock,
+    mock_dfuse: mock.Mock,
+    verify: str,
+) -> None:
+    """Test DfuSe download is verified by reading back device memory."""
+    mock_usb_get_string.return_value = "/0x08000000/04*016Kg,01*064Kg,07*128Kg"
+    data = bytes(range(256)) * 16
+    memory = bytearray(data)
+
+    def read_memory(
+        dev: mock.Mock, intf: int, address: int, length: int, xfer_size: int
+    ) -> Generator[bytes, None, None]:
+        offset = address - 0x8000000
+        for block in range(offset, offset + length, xfer_size):
+            yield bytes(memory[block : block + xfer_size])
+
+    mock_dfuse.read_memory.side_effect = read_memory
+
+    dfuse_download(
+        mock_usb_device,
+        0,
+        data,
+        1024,
+        0x8000000,
+        options=DownloadOptions(verify=verify),
+    )
+
+    memory[3000] ^= 0xFF
+    if verify == VERIFY_COMPARE:
+        match = "0x8000BB8"
+    else:
+        match = "SHA-256"
+    with pytest.raises(RuntimeError, match=match):
+        dfuse_download(
+            mock_usb_device,
+            0,
+            data,
+            1024,
+            0x8000000,
+            options=DownloadOptions(verify=verify),
+        )
+
+
+def test_download_dfu_verify_unsupported(
+    binary_file: str,
+    mock_get_dfu_devices: mock.Mock,
+    mock_usb_device: mock.Mock,
+    mock_get_dfu_desc: mock.Mock,
+    mock_dfu: mock.Mock,
+) -> None:
+    """Test verifying a DFU device which cannot upload after manifesting."""
+    mock_get_dfu_devices.return_value = [mock_usb_device]
+    mock_get_dfu_desc.return_value = DfuDescriptor(
+        bmAttributes=DFU_ATTR_CAN_DOWNLOAD | DFU_ATTR_CAN_UPLOAD,
+        wDetachTimeOut=0x100,
+        wTransferSize=1024,
+        bcdDFUVersion=0x00,
+    )
+    with pytest.raises(ValueError):
+        download(binary_file, options=DownloadOptions(verify=VERIFY_COMPARE))
+    mock_dfu.download.assert_not_called()
+
+
+@pytest.mark.parametrize(
+    ("verify", "erase_schedule"),
+    [("crc", ERASE_INTERLEAVED), (None, "later")],
+)
+def test_download_bad_options(
+    verify: Optional[str], erase_schedule: str
+) -> None:
+    """Test unknown verification modes and erase schedules are rejected
+    when the options are created, before any device is touched.
+    """
+    with pytest.raises(ValueError, match="Unknown"):
+        DownloadOptions(verify=verify, erase_schedule=erase_schedule)
+
+
+def test_download_dfu_buffer(
+    mock_get_dfu_devices: mock.Mock,
+    mock_usb_device: mock.Mock,
+    mock_get_dfu_desc: mock.Mock,
+    mock_dfu: mock.Mock,
+) -> None:
+    """Test downloading an in-memory buffer to a DFU device."""
+    mock_get_dfu_devices.return_value = [mock_usb_device]
+    mock_get_dfu_desc.return_value = DfuDescriptor(
+        bmAttributes=0x00,
+        wDetachTimeOut=0x100,
+        wTransferSize=1024,
+        bcdDFUVersion=0x00,
+    )
+
+    data = bytes(range(256)) * 10
+    download(data)
+
+    chunks = [c.args[3] for c in mock_dfu.download.call_args_list]
+    assert b"".join(chunks[:-1]) == data
+    assert chunks[-1] is None
+
+
+def _make_device(bus: int, ports: Tuple[int, ...]) -> mock.Mock:
+    """Fake USB device at a location on the bus."""
+    dev = mock.Mock()
+    dev.bus = bus
+    dev.address = len(ports)
+    dev.port_numbers = ports
+    return dev
+
+
+@pytest.mark.parametrize(
+    ("group", "max_concurrent"), [(GROUP_BUS, 1), (GROUP_HUB, 2)]
+)
+def test_download_all(
+    mock_get_dfu_devices: mock.Mock,
+    mock_get_dfu_desc: mock.Mock,
+    mock_dfu: mock.Mock,
+    group: str,
+    max_concurrent: int,
+) -> None:
+    """Test downloading to several devices respects the group limit."""
+    devices = [
+        _make_device(1, (1, 1)),
+        _make_device(1, (1, 2)),
+        _make_device(1, (2, 1)),
+        _make_device(1, (2, 2)),
+    ]
+    mock_get_dfu_devices.return_value = devices
+    mock_get_dfu_desc.return_value = DfuDescriptor(
+        bmAttributes=0x00,
+        wDetachTimeOut=0x100,
+        wTransferSize=1024,
+        bcdDFUVersion=0x00,
+    )
+
+    lock = threading.Lock()
+    active: Dict[int, int] = {}
+    peak = [0]
+
+    def fake_download(
+        dev: mock.Mock, intf: int, transaction: int, data: Optional[bytes]
+    ) -> int:
+        with lock:
+            active[id(dev)] = 1
+            peak[0] = max(peak[0], len(active))
+        time.sleep(0.001)
+        with lock:
+            active.pop(id(dev))
+        return 1
+
+    mock_dfu.download.side_effect = fake_download
+
+    results = download_all(
+        bytes(4096), max_per_group=1, group=group, max_workers=4
+    )
+
+    assert [result.port_path for result in results] == [
+        "1-1.1",
+        "1-1.2",
+        "1-2.1",
+        "1-2.2",
+    ]
+    assert all(result.success for result in results)
+    assert peak[0] <= max_concurrent
+    assert mock_dfu.claim_interface.call_count == len(devices)
+    assert mock_dfu.release_interface.call_count == len(devices)
+
+
+def test_download_all_reports_errors(
+    mock_get_dfu_devices: mock.Mock,
+    mock_get_dfu_desc: mock.Mock,
+    mock_dfu: mock.Mock,
+) -> None:
+    """Test a failing device does not stop downloads to the others."""
+    good, bad = _make_device(1, (1,)), _make_device(2, (1,))
+    mock_get_dfu_devices.return_value = [good, bad]
+    mock_get_dfu_desc.side_effect = lambda dev: (
+        None
+        if dev is bad
+        else DfuDescriptor(
+            bmAttributes=0x00,
+            wDetachTimeOut=0x100,
+            wTransferSize=1024,
+            bcdDFUVersion=0x00,
+        )
+    )
+
+    results = download_all(bytes(4096))
+
+    assert results[0].success
+    assert isinstance(results[1].error, ValueError)
+    mock_dfu.release_interface.assert_any_call(bad)
+
+
+def test_download_all_checkpoint_error(mock_get_dfu_devices: mock.Mock) -> None:
+    """Test downloading to several devices rejects a shared checkpoint."""
+    with pytest.raises(ValueError, match="Checkpoints"):
+        download_all(
+            bytes(4096), options=DownloadOptions(checkpoint_path="checkpoint")
+        )
+    mock_get_dfu_devices.assert_not_called()
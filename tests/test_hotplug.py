@@ -0,0 +1,134 @@
+# Copyright 2022 Block, Inc.
+"""Test waiting for DFU devices to appear."""
+
+import ctypes
+from typing import Any, Generator
+from unittest import mock
+
+import pytest
+
+from pyfu_usb import wait_for_device
+from pyfu_usb.hotplug import HotplugMonitor, open_monitor
+
+
+@pytest.fixture()
+def mock_get_dfu_devices() -> Generator[mock.Mock, None, None]:
+    """Mock pyfu_usb._get_dfu_devices."""
+    with mock.patch("pyfu_usb._get_dfu_devices") as mock_obj:
+        yield mock_obj
+
+
+@pytest.fixture()
+def mock_open_monitor() -> Generator[mock.Mock, None, None]:
+    """Mock pyfu_usb.hotplug.open_monitor."""
+    with mock.patch("pyfu_usb.hotplug.open_monitor") as mock_obj:
+        yield mock_obj
+
+
+@pytest.fixture()
+def mock_sleep() -> Generator[mock.Mock, None, None]:
+    """Mock time.sleep."""
+    with mock.patch("time.sleep") as mock_obj:
+        yield mock_obj
+
+
+def test_monitor_arrival() -> None:
+    """Test an arrival reported while handling events ends the wait."""
+    lib = mock.Mock()
+    callbacks = []
+
+    def register(*args: Any) -> int:
+        callbacks.append(args[6])
+        ctypes.cast(args[8], ctypes.POINTER(ctypes.c_int)).contents.value = 7
+        return 0
+
+    def handle_events(*args: Any) -> int:
+        callbacks[0](None, None, 1, None)
+        return 0
+
+    lib.libusb_hotplug_register_callback.side_effect = register
+    lib.libusb_handle_events_timeout_completed.side_effect = handle_events
+
+    with HotplugMonitor(lib, "ctx", vid=0xBBBB) as monitor:
+        assert lib.libusb_hotplug_register_callback.call_args.args[3] == 0xBBBB
+        assert lib.libusb_hotplug_register_callback.call_args.args[4] == -1
+        assert monitor.wait(1.0)
+    lib.libusb_hotplug_deregister_callback.assert_called_once()
+
+
+def test_monitor_error() -> None:
+    """Test a failure to register the callback raises an exception."""
+    lib = mock.Mock()
+    lib.libusb_hotplug_register_callback.return_value = -12
+    with pytest.raises(RuntimeError):
+        HotplugMonitor(lib, "ctx")
+
+
+def test_open_monitor_unsupported() -> None:
+    """Test no monitor is returned when libusb lacks hotplug support."""
+    with mock.patch("usb.backend.libusb1.get_backend") as mock_backend:
+        mock_backend.return_value = None
+        assert open_monitor() is None
+
+        mock_backend.return_value = mock.Mock()
+        mock_backend.return_value.lib.libusb_has_capability.return_value = 0
+        assert open_monitor() is None
+
+
+def test_wait_for_device_poll(
+    mock_get_dfu_devices: mock.Mock,
+    mock_open_monitor: mock.Mock,
+    mock_sleep: mock.Mock,
+) -> None:
+    """Test devices are scanned with a backoff without hotplug support."""
+    device = mock.Mock()
+    mock_open_monitor.return_value = None
+    mock_get_dfu_devices.side_effect = [[], [], [], [device]]
+
+    assert wait_for_device(vid=0xBBBB, serial="ABC123") is device
+    assert [call.args[0] for call in mock_sleep.call_args_list] == [
+        0.01,
+        0.02,
+        0.04,
+    ]
+    assert mock_get_dfu_devices.call_args.kwargs["serial"] == "ABC123"
+
+
+def test_wait_for_device_hotplug(
+    mock_get_dfu_devices: mock.Mock,
+    mock_open_monitor: mock.Mock,
+    mock_sleep: mock.Mock,
+) -> None:
+    """Test devices are scanned after hotplug arrivals."""
+    device = mock.Mock()
+    monitor = mock_open_monitor.return_value
+    mock_get_dfu_devices.side_effect = [[], [device]]
+
+    assert wait_for_device(pid=0xBBBB) is device
+    mock_open_monitor.assert_called_once_with(vid=None, pid=0xBBBB)
+    monitor.wait.assert_called_once()
+    monitor.close.assert_called_once()
+    mock_sleep.assert_not_called()
+
+
+def test_wait_for_device_timeout(
+    mock_get_dfu_devices: mock.Mock,
+    mock_open_monitor: mock.Mock,
+    mock_sleep: mock.Mock,
+) -> None:
+    """Test waiting gives up after the timeout."""
+    mock_open_monitor.return_value = None
+    mock_get_dfu_devices.return_value = []
+    with pytest.raises(RuntimeError):
+        wait_for_device(timeout=0)
+
+
+def test_wait_for_device_too_many(
+    mock_get_dfu_devices: mock.Mock,
+    mock_open_monitor: mock.Mock,
+) -> None:
+    """Test more than one matching device raises an exception."""
+    mock_open_monitor.return_value = None
+    mock_get_dfu_devices.return_value = [mock.Mock(), mock.Mock()]
+    with pytest.raises(RuntimeError):
+        wait_for_device()
@@ -0,0 +1,87 @@
+# Copyright 2022 Block, Inc.
+"""Test firmware image sources."""
+
+import io
+import os
+import pathlib
+
+import pytest
+
+from pyfu_usb.image import ChunkSource
+
+
+@pytest.fixture()
+def image_data() -> bytes:
+    """Fake firmware image."""
+    return bytes(range(256)) * 10
+
+
+def test_file_is_memory_mapped(
+    image_data: bytes, tmp_path: pathlib.Path
+) -> None:
+    """Test files are read as slices of a memory map."""
+    bin_file = tmp_path / "test.bin"
+    bin_file.write_bytes(image_data)
+
+    with ChunkSource(str(bin_file)) as source:
+        assert source.length == len(image_data)
+        chunks = list(source.chunks(1024))
+        assert all(isinstance(chunk, memoryview) for chunk in chunks)
+        assert b"".join(chunks) == image_data
+        del chunks
+
+
+def test_empty_file(tmp_path: pathlib.Path) -> None:
+    """Test empty files can be opened."""
+    bin_file = tmp_path / "empty.bin"
+    bin_file.write_bytes(b"")
+    with ChunkSource(bin_file) as source:
+        assert source.length == 0
+        assert list(source.chunks(1024)) == []
+
+
+def test_buffer(image_data: bytes) -> None:
+    """Test in-memory buffers are sliced without copying."""
+    buffer = bytearray(image_data)
+    with ChunkSource(buffer) as source:
+        chunk = next(source.chunks(100))
+        buffer[0] = 0xAA
+        assert chunk[0] == 0xAA
+
+
+def test_bytes_io(image_data: bytes) -> None:
+    """Test BytesIO is read from its current position."""
+    fin = io.BytesIO(image_data)
+    fin.seek(10)
+    with ChunkSource(fin) as source:
+        assert source.length == len(image_data) - 10
+        assert source.buffer.tobytes() == image_data[10:]
+
+
+def test_pipe_is_streamed(image_data: bytes) -> None:
+    """Test pipes are streamed in fixed size chunks."""
+    read_fd, write_fd = os.pipe()
+    with os.fdopen(write_fd, "wb") as fout:
+        fout.write(image_data)
+
+    with os.fdopen(read_fd, "rb") as fin, ChunkSource(fin) as source:
+        assert source.length is None
+        chunks = list(source.chunks(1000))
+        assert [len(chunk) for chunk in chunks] == [1000, 1000, 560]
+        assert b"".join(chunks) == image_data
+
+
+def test_iterator(image_data: bytes) -> None:
+    """Test iterators of bytes are re-chunked and can be buffered."""
+    pieces = [image_data[i : i + 7] for i in range(0, len(image_data), 7)]
+
+    with ChunkSource(iter(pieces)) as source:
+        assert [len(chunk) for chunk in source.chunks(1024)] == [
+            1024,
+            1024,
+            512,
+        ]
+
+    with ChunkSource(iter(pieces)) as source:
+        assert source.buffer.tobytes() == image_data
+        assert source.length == len(image_data)
@@ -0,0 +1,34 @@
+# Copyright 2022 Block, Inc.
+"""Test the CLI imports heavy modules only when they are used."""
+
+import json
+import subprocess
+import sys
+
+# Modules which are only imported when used, not to start the CLI
+_LAZY_MODULES = (
+    "importlib.metadata",
+    "pyfu_usb.cache",
+    "pyfu_usb.hotplug",
+    "pyfu_usb.loaders",
+    "pyfu_usb.metrics",
+    "pyfu_usb.trace",
+    "rich",
+)
+
+
+def test_lazy_imports() -> None:
+    """Test heavy modules are not imported to start the CLI."""
+    code = (
+        "import json, sys, pyfu_usb.__main__;"
+        "print(json.dumps(sorted(sys.modules)))"
+    )
+    proc = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, check=True
+    )
+    modules = json.loads(proc.stdout)
+    assert [
+        module
+        for module in modules
+        if module.split(".")[0] == "rich" or module in _LAZY_MODULES
+    ] == []
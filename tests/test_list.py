@@ -1,9 +1,12 @@
 # Copyright 2022 Block, Inc.
 """Test list."""
 
+from typing import Tuple
 from unittest import mock
 
-from pyfu_usb import list_devices
+import pytest
+
+from pyfu_usb import _get_dfu_devices, list_devices
 
 
 def test_list_devices(
@@ -18,6 +21,60 @@ def test_list_devices(
         mock_usb_find.return_value = [mock_usb_device]
         mock_usb_device.bus = 1
         mock_usb_device.address = 2
+        mock_usb_device.port_numbers = (1,)
         mock_usb_device.idVendor = 0xBBBB
         mock_usb_device.idProduct = 0xBBBB
         list_devices()
+
+
+def _make_device(port_numbers: Tuple[int, ...], serial: str) -> mock.Mock:
+    """Fake USB device with a DFU interface."""
+    intf = mock.Mock(bInterfaceClass=0xFE, bInterfaceSubClass=1)
+    dev = mock.MagicMock()
+    dev.__iter__.return_value = [[intf]]
+    dev.bus = 1
+    dev.address = 5
+    dev.port_numbers = port_numbers
+    dev.serial_number = serial
+    return dev
+
+
+def test_get_dfu_devices_filters() -> None:
+    """Test cheap filters are passed to pyusb and the rest are matched."""
+    first = _make_device((1, 2), "AAA")
+    second = _make_device((1, 3), "BBB")
+
+    with mock.patch("usb.core.find", spec=True) as mock_usb_find:
+        mock_usb_find.side_effect = lambda custom_match, **kwargs: [
+            dev for dev in (first, second) if custom_match(dev)
+        ]
+        assert _get_dfu_devices(vid=0xBBBB, port_path="1-1.3") == [second]
+        assert mock_usb_find.call_args.kwargs["idVendor"] == 0xBBBB
+        assert mock_usb_find.call_args.kwargs["bus"] == 1
+        assert "idProduct" not in mock_usb_find.call_args.kwargs
+
+        assert _get_dfu_devices(serial="AAA") == [first]
+        assert _get_dfu_devices(serial="CCC") == []
+
+
+def test_get_dfu_devices_port_path_error() -> None:
+    """Test malformed port paths are rejected before searching."""
+    with mock.patch("usb.core.find", spec=True) as mock_usb_find:
+        for port_path in ("1", "1-", "x-1", "1-2..3", "1-2.3 "):
+            with pytest.raises(ValueError, match="Invalid port path"):
+                _get_dfu_devices(port_path=port_path)
+        mock_usb_find.assert_not_called()
+
+
+def test_get_dfu_devices_serial_error() -> None:
+    """Test devices whose serial number cannot be read do not match."""
+    dev = _make_device((1,), "AAA")
+    type(dev).serial_number = mock.PropertyMock(
+        side_effect=ValueError("no langid")
+    )
+
+    with mock.patch("usb.core.find", spec=True) as mock_usb_find:
+        mock_usb_find.side_effect = lambda custom_match, **kwargs: [
+            dev for dev in [dev] if custom_match(dev)
+        ]
+        assert _get_dfu_devices(serial="AAA") == []
@@ -0,0 +1,167 @@
+# Copyright 2022 Block, Inc.
+"""Test loading images with addresses."""
+
+import struct
+from typing import List, Tuple
+
+import pytest
+
+from pyfu_usb import loaders
+
+
+def _ihex_record(record_type: int, address: int, data: bytes) -> str:
+    """Format an Intel HEX record."""
+    record = bytes([len(data), address >> 8, address & 0xFF, record_type])
+    record += data
+    return ":" + (record + bytes([-sum(record) & 0xFF])).hex().upper()
+
+
+def _srec_record(record_type: int, address: int, data: bytes) -> str:
+    """Format an S-record with a 32-bit address."""
+    record = bytes([len(data) + 5]) + address.to_bytes(4, "big") + data
+    return f"S{record_type}" + (record + bytes([~sum(record) & 0xFF])).hex()
+
+
+def _elf32(segments: List[Tuple[int, int, bytes]]) -> bytes:
+    """Build a little endian 32-bit ELF file with program headers only.
+
+    Args:
+        segments: Type, physical address and data of each program header.
+    """
+    phoff = 0x34
+    data_offset = phoff + 32 * len(segments)
+    header = b"\x7fELF" + bytes([1, 1, 1]) + bytes(9)
+    # e_type, e_machine, e_version, e_entry, e_phoff, e_shoff, e_flags,
+    # e_ehsize, e_phentsize, e_phnum, e_shentsize, e_shnum, e_shstrndx
+    header += struct.pack(
+        "<HHIIIIIHHHHHH",
+        2,
+        40,
+        1,
+        0,
+        phoff,
+        0,
+        0,
+        0x34,
+        32,
+        len(segments),
+        0,
+        0,
+        0,
+    )
+    program_headers = b""
+    contents = b""
+    for p_type, paddr, data in segments:
+        program_headers += struct.pack(
+            "<IIIIIIII",
+            p_type,
+            data_offset + len(contents),
+            paddr + 0x10000000,
+            paddr,
+            len(data),
+            len(data) + 0x100,
+            0,
+            4,
+        )
+        contents += data
+    return header + program_headers + contents
+
+
+def test_load_ihex() -> None:
+    """Test contiguous records are merged into one segment per gap."""
+    lines = [_ihex_record(0x04, 0, b"\x08\x00")]
+    lines += [
+        _ihex_record(0x00, offset, bytes([offset >> 4]) * 16)
+        for offset in range(0, 0x100, 0x10)
+    ]
+    lines += [
+        _ihex_record(0x04, 0, b"\x08\x01"),
+        _ihex_record(0x00, 0x0000, b"\xaa" * 4),
+        _ihex_record(0x05, 0, b"\x08\x00\x01\x01"),
+        _ihex_record(0x01, 0, b""),
+    ]
+
+    segments = loaders.load_ihex("\r\n".join(lines).encode())
+    assert [(s.address, len(s.data)) for s in segments] == [
+        (0x08000000, 0x100),
+        (0x08010000, 4),
+    ]
+    assert bytes(segments[0].data[0x20:0x22]) == b"\x02\x02"
+
+
+def test_load_ihex_out_of_order() -> None:
+    """Test records out of address order are sorted and merged."""
+    lines = [
+        _ihex_record(0x00, 0x10, b"\x02" * 16),
+        _ihex_record(0x00, 0x00, b"\x01" * 16),
+    ]
+    segments = loaders.load_ihex("\n".join(lines).encode())
+    assert len(segments) == 1
+    assert segments[0].data == b"\x01" * 16 + b"\x02" * 16
+
+    lines.append(_ihex_record(0x00, 0x08, b"\x03"))
+    with pytest.raises(ValueError, match="overlaps"):
+        loaders.load_ihex("\n".join(lines).encode())
+
+
+def test_load_ihex_bad_checksum() -> None:
+    """Test corrupted records are rejected."""
+    line = _ihex_record(0x00, 0, b"\x01\x02")
+    corrupted = line[:-2] + ("00" if line[-2:] != "00" else "01")
+    with pytest.raises(ValueError, match="checksum"):
+        loaders.load_ihex(corrupted.encode())
+    with pytest.raises(ValueError, match="start code"):
+        loaders.load_ihex(b"garbage")
+
+
+def test_load_srec() -> None:
+    """Test S3 data records are merged and other records are ignored."""
+    lines = [
+        "S00F000068656C6C6F202020202000003C",
+        _srec_record(3, 0x08000000, b"\x11" * 16),
+        _srec_record(3, 0x08000010, b"\x22" * 16),
+        _srec_record(3, 0x08000100, b"\x33" * 8),
+        _srec_record(7, 0x08000000, b""),
+    ]
+    segments = loaders.load_srec("\n".join(lines).encode())
+    assert [(s.address, len(s.data)) for s in segments] == [
+        (0x08000000, 32),
+        (0x08000100, 8),
+    ]
+
+    with pytest.raises(ValueError, match="checksum"):
+        loaders.load_srec(lines[1][:-2].encode() + b"00")
+
+
+def test_load_elf() -> None:
+    """Test loadable segments are placed at their physical address."""
+    data = _elf32(
+        [
+            (1, 0x08000000, b"\x11" * 64),
+            (1, 0x20000000, b""),
+            (4, 0x0, b"\x00" * 8),
+            (1, 0x08000040, b"\x22" * 16),
+        ]
+    )
+    segments = loaders.load_elf(data)
+    assert [(s.address, bytes(s.data)) for s in segments] == [
+        (0x08000000, b"\x11" * 64),
+        (0x08000040, b"\x22" * 16),
+    ]
+
+    with pytest.raises(ValueError):
+        loaders.load_elf(data[:0x40])
+
+
+def test_load_by_name() -> None:
+    """Test the format is chosen by extension, or by ELF contents."""
+    hex_data = _ihex_record(0x00, 0, b"\x01").encode()
+    segments = loaders.load(hex_data, "firmware.HEX")
+    assert segments is not None
+    assert segments[0].data == b"\x01"
+    assert loaders.load(hex_data, "firmware.bin") is None
+
+    elf_data = _elf32([(1, 0x08000000, b"\x11" * 4)])
+    segments = loaders.load(elf_data, "<buffer>")
+    assert segments is not None
+    assert segments[0].address == 0x08000000
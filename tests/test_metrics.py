@@ -0,0 +1,97 @@
+# Copyright 2022 Block, Inc.
+"""Test metrics returned from downloads."""
+
+from typing import Generator
+from unittest import mock
+
+import pytest
+
+from pyfu_usb import VERIFY_COMPARE, DownloadOptions, DownloadResult, download
+from pyfu_usb.metrics import LATENCY_BUCKETS_S, LatencyHistogram
+from pyfu_usb.simulator import OP_WRITE, Fault, SimulatedDevice
+
+_DATA = bytes(range(256)) * 80
+
+
+@pytest.fixture()
+def mock_get_dfu_device() -> Generator[mock.Mock, None, None]:
+    """Mock pyfu_usb._get_dfu_device"""
+    with mock.patch("pyfu_usb._get_dfu_device") as mock_obj:
+        yield mock_obj
+
+
+def test_download_result(mock_get_dfu_device: mock.Mock) -> None:
+    """Test download returns the metrics of every phase and request."""
+    device = SimulatedDevice()
+    mock_get_dfu_device.return_value = device
+    hook = mock.Mock()
+
+    result = download(
+        _DATA,
+        address=0x08000000,
+        options=DownloadOptions(verify=VERIFY_COMPARE),
+        metrics_hook=hook,
+    )
+
+    hook.assert_called_once_with(result)
+    assert result.error is None
+    assert result.transfers == device.counts["transfer"]
+    assert result.polls == result.latency["GETSTATUS"].count
+    assert result.bytes_sent >= len(_DATA)
+    # Leaving DFU mode ends with an empty download
+    assert result.latency["DNLOAD"].count == len(_DATA) // 2048 + 1
+    assert result.phases.manifest > 0
+    assert result.latency["ERASE"].count == 2
+    assert result.retries == 0
+    assert result.phases.write > 0
+    assert result.phases.verify > 0
+    assert result.duration >= sum(vars(result.phases).values())
+    assert result.throughput > 0
+
+
+def test_download_retries(mock_get_dfu_device: mock.Mock) -> None:
+    """Test blocks sent again after a stall are counted."""
+    mock_get_dfu_device.return_value = SimulatedDevice(
+        faults=[Fault(OP_WRITE, after=2)]
+    )
+    result = download(_DATA, address=0x08000000)
+    assert result.retries == 1
+    assert result.latency["DNLOAD"].errors == 1
+
+
+def test_download_failure(mock_get_dfu_device: mock.Mock) -> None:
+    """Test the metrics hook is called when a download fails."""
+    mock_get_dfu_device.return_value = SimulatedDevice()
+    hook = mock.Mock()
+    with pytest.raises(ValueError):
+        download(_DATA, metrics_hook=hook)
+
+    result = hook.call_args.args[0]
+    assert isinstance(result.error, ValueError)
+    assert result.phases.claim > 0
+    assert "pyfu_usb_download_success 0" in result.to_prometheus()
+
+
+def test_histogram_export() -> None:
+    """Test latency histograms are exported with cumulative buckets."""
+    histogram = LatencyHistogram()
+    for latency_s in (0.00005, 0.003, 0.003, 10.0):
+        histogram.observe(latency_s)
+    assert histogram.buckets[0] == 1
+    assert histogram.buckets[-1] == 1
+    assert histogram.max_s == 10.0
+
+    result = DownloadResult(latency={"GETSTATUS": histogram})
+    text = result.to_prometheus({"board": 'A"1'})
+    assert (
+        'pyfu_usb_request_duration_seconds_bucket{board="A\\"1",'
+        'request="GETSTATUS",le="0.005"} 3'
+    ) in text
+    assert (
+        'pyfu_usb_request_duration_seconds_count{board="A\\"1",'
+        'request="GETSTATUS"} 4'
+    ) in text
+
+    obj = result.to_json()
+    assert obj["latency_buckets"] == list(LATENCY_BUCKETS_S)
+    assert obj["latency"]["GETSTATUS"]["count"] == 4
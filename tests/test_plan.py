@@ -0,0 +1,182 @@
+# Copyright 2022 Block, Inc.
+"""Test planning of DfuSe erase and write operations."""
+
+from typing import List
+
+import pytest
+
+from pyfu_usb import DownloadOptions
+from pyfu_usb.descriptor import DfuSeMemoryLayout
+from pyfu_usb.image import Segment
+from pyfu_usb.plan import (
+    get_data_ranges,
+    get_pages,
+    is_erased,
+    merge_ranges,
+    plan_erase,
+    plan_erase_segments,
+    ranges_contain,
+)
+
+
+def test_is_erased() -> None:
+    """Test erased value detection within a range of data."""
+    data = b"\xff\xff\x00\xff"
+    assert is_erased(data, 0, 2)
+    assert not is_erased(data, 1, 3)
+    assert is_erased(data, 3, 4)
+    assert is_erased(data, 2, 2)
+
+
+def test_merge_ranges() -> None:
+    """Test overlapping and adjacent ranges are merged."""
+    assert merge_ranges([(20, 30), (0, 10), (10, 15), (14, 18)]) == [
+        (0, 18),
+        (20, 30),
+    ]
+    assert merge_ranges([]) == []
+
+
+def test_ranges_contain() -> None:
+    """Test checking if a range is inside a list of ranges."""
+    ranges = [(0, 18), (20, 30)]
+    assert ranges_contain(ranges, 0, 18)
+    assert ranges_contain(ranges, 20, 25)
+    assert not ranges_contain(ranges, 15, 22)
+    assert not ranges_contain(ranges, 30, 31)
+    assert not ranges_contain([], 0, 1)
+
+
+def test_get_pages() -> None:
+    """Test pages intersecting an address range are found across segments."""
+    layout = [
+        DfuSeMemoryLayout(
+            addr=0x1000,
+            last_addr=0x1FFF,
+            size=0x1000,
+            num_pages=4,
+            page_size=0x400,
+        ),
+        DfuSeMemoryLayout(
+            addr=0x2000,
+            last_addr=0x3FFF,
+            size=0x2000,
+            num_pages=1,
+            page_size=0x2000,
+        ),
+    ]
+    pages = get_pages(layout, 0x1500, 0x2001)
+    assert [(page.addr, page.end, page.segment_num) for page in pages] == [
+        (0x1400, 0x1800, 0),
+        (0x1800, 0x1C00, 0),
+        (0x1C00, 0x2000, 0),
+        (0x2000, 0x4000, 1),
+    ]
+    assert get_pages(layout, 0x4000, 0x5000) == []
+    assert len(get_pages(layout, 0x1000, 0x1400)) == 1
+
+
+def test_get_data_ranges() -> None:
+    """Test chunks of erased values are left out when requested."""
+    data = 4 * b"\x00" + 4 * b"\xff" + 2 * b"\x00"
+    assert get_data_ranges(data, 4, skip_erased=False) == [(0, 10)]
+    assert get_data_ranges(data, 4, skip_erased=True) == [(0, 4), (8, 10)]
+    assert get_data_ranges(b"", 4, skip_erased=False) == []
+
+
+def _layout() -> List[DfuSeMemoryLayout]:
+    """Memory layout with four 1 KiB pages and one 8 KiB page."""
+    return [
+        DfuSeMemoryLayout(
+            addr=0x1000,
+            last_addr=0x1FFF,
+            size=0x1000,
+            num_pages=4,
+            page_size=0x400,
+        ),
+        DfuSeMemoryLayout(
+            addr=0x2000,
+            last_addr=0x3FFF,
+            size=0x2000,
+            num_pages=1,
+            page_size=0x2000,
+        ),
+    ]
+
+
+def test_plan_erase_exact_pages() -> None:
+    """Test the page containing an unaligned start is erased, and the page
+    after the end of the image is not.
+    """
+    erase_plan = plan_erase(_layout(), 0x400 * b"\x00", 0x1200)
+    assert [page.addr for page in erase_plan.erase_pages] == [0x1000, 0x1400]
+    assert erase_plan.erase_ranges == [(0x1000, 0x1800)]
+    assert erase_plan.num_operations == 2
+
+    erase_plan = plan_erase(_layout(), 0x800 * b"\x00", 0x1000)
+    assert [page.addr for page in erase_plan.erase_pages] == [0x1000, 0x1400]
+
+
+def test_plan_erase_sparse() -> None:
+    """Test pages which only hold the erased value are skipped."""
+    data = 0x400 * b"\x00" + 0x400 * b"\xff" + 0x400 * b"\x00"
+    erase_plan = plan_erase(_layout(), data, 0x1000, sparse=True)
+    assert erase_plan.erase_ranges == [(0x1000, 0x1400), (0x1800, 0x1C00)]
+    assert erase_plan.pages_skipped == 1
+    assert erase_plan.blank_ranges == [(0x1000, 0x1C00)]
+
+
+def test_plan_erase_mass_erase() -> None:
+    """Test mass erase is used when the image covers most of the memory."""
+    data = 0x1000 * b"\x00"
+    assert not plan_erase(_layout(), data, 0x1000).mass_erase
+    assert not plan_erase(
+        _layout(), data, 0x1000, mass_erase_threshold=0.9
+    ).mass_erase
+
+    erase_plan = plan_erase(_layout(), data, 0x1000, mass_erase_threshold=0.3)
+    assert erase_plan.mass_erase
+    assert erase_plan.num_operations == 1
+    assert erase_plan.pages_skipped == 0
+
+
+def test_plan_erase_mass_erase_no_pages() -> None:
+    """Test mass erase needs a page to erase and a threshold in (0, 1]."""
+    erased = 0x400 * b"\xff"
+    erase_plan = plan_erase(
+        _layout(), erased, 0x1000, sparse=True, mass_erase_threshold=0.01
+    )
+    assert not erase_plan.mass_erase
+    assert erase_plan.num_operations == 0
+
+    for threshold in (0.0, -1.0, 1.5):
+        with pytest.raises(ValueError, match="Mass erase threshold"):
+            plan_erase(
+                _layout(), erased, 0x1000, mass_erase_threshold=threshold
+            )
+    with pytest.raises(ValueError, match="Mass erase threshold"):
+        DownloadOptions(mass_erase_threshold=0.0)
+
+
+def test_plan_erase_segments() -> None:
+    """Test only the pages touched by segments are erased, and a page shared
+    by two segments is erased once.
+    """
+    segments = [
+        Segment(0x1000, 0x100 * b"\x00"),
+        Segment(0x1300, 0x200 * b"\x00"),
+        Segment(0x1C00, 0x10 * b"\x00"),
+    ]
+    erase_plan = plan_erase_segments(_layout(), segments)
+    assert [page.addr for page in erase_plan.erase_pages] == [
+        0x1000,
+        0x1400,
+        0x1C00,
+    ]
+    assert erase_plan.erase_ranges == [(0x1000, 0x1800), (0x1C00, 0x2000)]
+
+    # A page is only skipped if every segment in it is blank
+    segments[1] = Segment(0x1300, 0x200 * b"\xff")
+    erase_plan = plan_erase_segments(_layout(), segments, sparse=True)
+    assert [page.addr for page in erase_plan.erase_pages] == [0x1000, 0x1C00]
+    assert erase_plan.pages_skipped == 1
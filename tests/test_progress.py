@@ -0,0 +1,74 @@
+# Copyright 2022 Block, Inc.
+"""Test progress displays."""
+
+from typing import List
+from unittest import mock
+
+import pytest
+
+from pyfu_usb import VERIFY_COMPARE, DfuSession, DownloadOptions
+from pyfu_usb.progress import (
+    CallbackProgress,
+    LabelledProgress,
+    NullProgress,
+    ProgressUpdate,
+    RichProgress,
+)
+from pyfu_usb.simulator import SimulatedDevice
+
+_DATA = bytes(range(256)) * 80
+
+
+def test_callback_throttled() -> None:
+    """Test callbacks are only made at the start and end of a fast task."""
+    updates: List[ProgressUpdate] = []
+    sink = CallbackProgress(updates.append, min_interval_s=60)
+    with sink.task(1000, "Writing") as advance:
+        for _ in range(100):
+            advance(10)
+
+    assert [update.completed for update in updates] == [0, 1000]
+    assert updates[-1].finished
+    assert updates[-1].description == "Writing"
+
+
+def test_callback_min_bytes() -> None:
+    """Test callbacks are made every time enough bytes were handled."""
+    updates: List[ProgressUpdate] = []
+    sink = CallbackProgress(updates.append, min_interval_s=60, min_bytes=250)
+    with LabelledProgress(sink, "[1-1]").task(None) as advance:
+        for _ in range(100):
+            advance(10)
+
+    assert [update.completed for update in updates] == [0, 250, 500, 750, 1000]
+    assert not updates[-1].finished
+    assert updates[0].description == "[1-1] Downloading firmware"
+
+
+def test_rich_throttled() -> None:
+    """Test the rich progress bar is updated less often than every block."""
+    bar = mock.Mock()
+    with RichProgress(bar, min_interval_s=60).task(1000) as advance:
+        for _ in range(100):
+            advance(10)
+
+    bar.update.assert_called_once_with(bar.add_task.return_value, advance=1000)
+
+
+def test_session_progress(capsys: pytest.CaptureFixture[str]) -> None:
+    """Test a session reports the progress of every task to its display."""
+    updates: List[ProgressUpdate] = []
+    device = SimulatedDevice()
+    with DfuSession(device, display=CallbackProgress(updates.append)) as s:
+        s.download(
+            _DATA,
+            address=0x08000000,
+            options=DownloadOptions(verify=VERIFY_COMPARE),
+        )
+
+    finished = [update.description for update in updates if update.finished]
+    assert finished == ["Downloading firmware", "Verifying"]
+
+    with DfuSession(SimulatedDevice(), display=NullProgress()) as session:
+        session.download(_DATA, address=0x08000000)
+    assert capsys.readouterr().out == ""
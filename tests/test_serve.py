@@ -0,0 +1,279 @@
+# Copyright 2022 Block, Inc.
+"""Test the service which flashes jobs sent over a local socket."""
+
+import asyncio
+import base64
+import json
+import threading
+from pathlib import Path
+from typing import Any, Dict, Generator, List, Optional
+from unittest import mock
+
+import pytest
+
+from pyfu_usb.serve import (
+    STATUS_CANCELLED,
+    STATUS_DONE,
+    STATUS_FAILED,
+    STATUS_PROGRESS,
+    STATUS_QUEUED,
+    STATUS_RUNNING,
+    DeviceScheduler,
+    ImageCache,
+    Server,
+)
+from pyfu_usb.simulator import SimulatedDevice, Timing
+
+_DATA = bytes(range(256)) * 80
+
+# Intel HEX image of 16 bytes at 0x08000000
+_HEX = (
+    ":020000040800F2\n"
+    ":10000000000102030405060708090A0B0C0D0E0F78\n"
+    ":00000001FF\n"
+)
+
+
+@pytest.fixture()
+def device() -> Generator[SimulatedDevice, None, None]:
+    """Simulated device which the service finds."""
+    device = SimulatedDevice(serial_number="ABC123")
+    with mock.patch(
+        "pyfu_usb.serve._get_dfu_devices", return_value=[device]
+    ), mock.patch("pyfu_usb._get_dfu_device", return_value=device):
+        yield device
+
+
+class _Client:
+    """Client of a server under test."""
+
+    def __init__(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        self.reader = reader
+        self.writer = writer
+
+    async def send(self, request: Dict[str, Any]) -> None:
+        self.writer.write(json.dumps(request).encode() + b"\n")
+        await self.writer.drain()
+
+    async def receive(self) -> Dict[str, Any]:
+        return json.loads(await self.reader.readline())
+
+    async def job(self) -> List[Dict[str, Any]]:
+        """Receive the messages of a job until it ends."""
+        messages = [await self.receive()]
+        while messages[-1].get("status") in (
+            STATUS_QUEUED,
+            STATUS_RUNNING,
+            STATUS_PROGRESS,
+        ):
+            messages.append(await self.receive())
+        return messages
+
+
+def _run(server_test: Any, image_root: Optional[Path] = None) -> None:
+    """Run a test against a server listening on a free port."""
+
+    async def run() -> None:
+        server = Server(
+            image_root=None if image_root is None else str(image_root)
+        )
+        listener = await server.start(port=0)
+        port = listener.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        try:
+            await server_test(server, _Client(reader, writer))
+        finally:
+            writer.close()
+            listener.close()
+            await listener.wait_closed()
+
+    asyncio.run(run())
+
+
+def test_flash(device: SimulatedDevice, tmp_path: Path) -> None:
+    """Test job status is streamed, and images are parsed once."""
+    path = tmp_path / "app.hex"
+    path.write_text(_HEX)
+    request = {
+        "op": "flash",
+        "image": "app.hex",
+        "device": {"serial": "ABC123"},
+        "options": {"verify": "hash"},
+    }
+
+    async def server_test(server: Server, client: _Client) -> None:
+        await client.send(request)
+        messages = await client.job()
+        assert messages[0] == {"job": 1, "status": STATUS_QUEUED}
+        assert messages[1]["status"] == STATUS_RUNNING
+        assert messages[1]["device"] == "1-1"
+        assert not messages[1]["cached"]
+        digest = messages[1]["image"]
+        assert any(m["status"] == STATUS_PROGRESS for m in messages)
+        assert messages[-1]["status"] == STATUS_DONE
+        assert messages[-1]["result"]["error"] is None
+
+        device.reset()
+        await client.send(request)
+        messages = await client.job()
+        assert messages[1]["cached"]
+        assert messages[1]["image"] == digest
+        assert messages[-1]["status"] == STATUS_DONE
+        assert server.image_cache.hits == 1
+        assert not server.scheduler.busy
+
+    _run(server_test, tmp_path)
+    assert device.read_memory(0x08000000, 16) == bytes(range(16))
+
+
+def test_cancel() -> None:
+    """Test a running job with an uploaded image is cancelled and its device
+    released.
+    """
+    device = SimulatedDevice(timing=Timing(transfer_ms=2))
+
+    async def server_test(server: Server, client: _Client) -> None:
+        await client.send(
+            {
+                "op": "flash",
+                "image": "app.bin",
+                "data": base64.b64encode(_DATA).decode(),
+                "options": {"address": "0x08000000"},
+            }
+        )
+        assert (await client.receive())["status"] == STATUS_QUEUED
+        assert (await client.receive())["status"] == STATUS_RUNNING
+        await client.send({"op": "cancel", "job": 1})
+        messages = await client.job()
+        assert messages[-1] == {"job": 1, "status": STATUS_CANCELLED}
+        assert not server.scheduler.busy
+
+    with mock.patch(
+        "pyfu_usb.serve._get_dfu_devices", return_value=[device]
+    ), mock.patch("pyfu_usb._get_dfu_device", return_value=device):
+        _run(server_test)
+    assert not device.claimed
+
+
+def test_errors(device: SimulatedDevice, tmp_path: Path) -> None:
+    """Test invalid requests and failed jobs are reported."""
+
+    async def server_test(server: Server, client: _Client) -> None:
+        await client.send(
+            {"op": "flash", "image": "a.bin", "options": {"x": 1}}
+        )
+        assert (
+            "Unknown flash job options: x" in (await client.receive())["error"]
+        )
+        await client.send({"op": "reboot"})
+        assert "Unknown op" in (await client.receive())["error"]
+        await client.send({"op": "cancel", "job": 7})
+        assert "No such job" in (await client.receive())["error"]
+
+        await client.send(
+            {
+                "op": "flash",
+                "image": "a.bin",
+                "options": {"checkpoint_path": "/etc/passwd"},
+            }
+        )
+        assert (
+            "Unknown flash job options: checkpoint_path"
+            in (await client.receive())["error"]
+        )
+        for name in ("../a.bin", str(tmp_path.parent / "a.bin")):
+            await client.send({"op": "flash", "image": name})
+            assert "outside the image root" in (await client.receive())["error"]
+        await client.send({"op": "flash", "image": "a.bin", "data": "!"})
+        assert "error" in await client.receive()
+
+        await client.send({"op": "flash", "image": "no.bin"})
+        messages = await client.job()
+        assert messages[-1]["status"] == STATUS_FAILED
+        assert "FileNotFoundError" in messages[-1]["error"]
+
+        await client.send({"op": "list"})
+        devices = (await client.receive())["devices"]
+        assert [(d["serial"], d["busy"]) for d in devices] == [
+            ("ABC123", False)
+        ]
+
+    _run(server_test, tmp_path)
+
+
+def test_image_root_required(device: SimulatedDevice) -> None:
+    """Test images cannot be named by path without an image root."""
+
+    async def server_test(server: Server, client: _Client) -> None:
+        await client.send({"op": "flash", "image": "app.bin"})
+        assert "must upload" in (await client.receive())["error"]
+
+    _run(server_test)
+
+
+def test_scheduler_bus_limit() -> None:
+    """Test jobs wait for their bus to be below the limit."""
+    devices = [SimulatedDevice(), SimulatedDevice()]
+    devices[1].port_numbers = (2,)
+
+    async def run() -> None:
+        scheduler = DeviceScheduler(max_per_bus=1)
+        first = await scheduler.acquire({})
+        second = asyncio.ensure_future(scheduler.acquire({}))
+        await asyncio.sleep(0.01)
+        assert not second.done()
+
+        await scheduler.release(first)
+        assert await second is devices[0]
+
+    with mock.patch("pyfu_usb.serve._get_dfu_devices", return_value=devices):
+        asyncio.run(run())
+
+
+def test_scheduler_scan_unlocked() -> None:
+    """Test a job can end while another job scans for devices."""
+    devices = [SimulatedDevice()]
+    scanning, resume = threading.Event(), threading.Event()
+    scans = 0
+
+    def scan() -> List[SimulatedDevice]:
+        nonlocal scans
+        scans += 1
+        if scans == 2:
+            scanning.set()
+            resume.wait(5)
+        return devices
+
+    async def run() -> None:
+        loop = asyncio.get_running_loop()
+        scheduler = DeviceScheduler()
+        first = await scheduler.acquire({})
+        second = asyncio.ensure_future(scheduler.acquire({}))
+        await loop.run_in_executor(None, scanning.wait, 5)
+
+        await asyncio.wait_for(scheduler.release(first), 1)
+        resume.set()
+        assert await second is devices[0]
+
+    with mock.patch("pyfu_usb.serve._get_dfu_devices", side_effect=scan):
+        asyncio.run(run())
+
+
+def test_image_cache_eviction(tmp_path: Path) -> None:
+    """Test the least recently used images are evicted."""
+    cache = ImageCache(max_bytes=2 * (len(_DATA) + 1))
+    paths = []
+    for index in range(3):
+        path = tmp_path / f"{index}.bin"
+        path.write_bytes(_DATA + bytes([index]))
+        paths.append(str(path))
+
+    for path in paths[:2]:
+        cache.load(path)
+    assert cache.load(paths[0])[2]
+    cache.load(paths[2])
+    assert len(cache) == 2
+    assert cache.load(paths[0])[2]
+    assert not cache.load(paths[1])[2]
@@ -0,0 +1,165 @@
+# Copyright 2022 Block, Inc.
+"""Test DFU sessions which keep the interface claimed."""
+
+import contextlib
+from typing import Generator
+from unittest import mock
+
+import pytest
+
+from pyfu_usb import VERIFY_COMPARE, DfuSession, DownloadResult
+from pyfu_usb.cache import DescriptorCache
+from pyfu_usb.descriptor import (
+    DFU_ATTR_CAN_DOWNLOAD,
+    DFU_ATTR_CAN_UPLOAD,
+    DfuDescriptor,
+)
+from pyfu_usb.dfuse import (
+    DFUSE_FIRST_BLOCK_NUM,
+    DFUSE_LAST_BLOCK_NUM,
+    DFUSE_VERSION_NUMBER,
+)
+from pyfu_usb.image import Segment
+
+
+@pytest.fixture()
+def mock_get_dfu_desc() -> Generator[mock.Mock, None, None]:
+    """Mock pyfu_usb.descriptor.get_dfu_descriptor."""
+    with mock.patch("pyfu_usb.descriptor.get_dfu_descriptor") as mock_obj:
+        mock_obj.return_value = DfuDescriptor(
+            bmAttributes=DFU_ATTR_CAN_DOWNLOAD | DFU_ATTR_CAN_UPLOAD,
+            wDetachTimeOut=0x100,
+            wTransferSize=1024,
+            bcdDFUVersion=DFUSE_VERSION_NUMBER,
+        )
+        yield mock_obj
+
+
+@pytest.fixture()
+def mock_dfu() -> Generator[mock.Mock, None, None]:
+    """Mock pyfu_usb.dfu in every module which uses it."""
+    mock_obj = mock.MagicMock()
+    with contextlib.ExitStack() as stack:
+        for module in (
+            "pyfu_usb",
+            "pyfu_usb.downloader",
+            "pyfu_usb.writer",
+            "pyfu_usb.verify",
+            "pyfu_usb.session",
+        ):
+            stack.enter_context(mock.patch(f"{module}.dfu", mock_obj))
+        mock_obj.download.return_value = 0
+        yield mock_obj
+
+
+@pytest.fixture()
+def mock_dfuse() -> Generator[mock.Mock, None, None]:
+    """Mock pyfu_usb.dfuse in every module which uses it."""
+    mock_obj = mock.MagicMock()
+    with contextlib.ExitStack() as stack:
+        for module in (
+            "pyfu_usb.downloader",
+            "pyfu_usb.writer",
+            "pyfu_usb.eraser",
+            "pyfu_usb.verify",
+            "pyfu_usb.session",
+        ):
+            stack.enter_context(mock.patch(f"{module}.dfuse", mock_obj))
+        mock_obj.DFUSE_VERSION_NUMBER = DFUSE_VERSION_NUMBER
+        mock_obj.DFUSE_FIRST_BLOCK_NUM = DFUSE_FIRST_BLOCK_NUM
+        mock_obj.DFUSE_LAST_BLOCK_NUM = DFUSE_LAST_BLOCK_NUM
+        mock_obj.page_erase.return_value = 0
+        mock_obj.set_address.return_value = 0
+        yield mock_obj
+
+
+def test_session_reuses_claim_and_descriptors(
+    mock_usb_device: mock.Mock,
+    mock_usb_get_string: mock.Mock,
+    mock_get_dfu_desc: mock.Mock,
+    mock_dfu: mock.Mock,
+    mock_dfuse: mock.Mock,
+) -> None:
+    """Test several downloads claim the interface and read the descriptor and
+    memory layout once, and only leave DFU mode when asked to.
+    """
+    mock_usb_get_string.return_value = "/0x08000000/04*016Kg"
+
+    with DfuSession(mock_usb_device) as session:
+        result = session.download(2048 * b"\xaa", address=0x08000000)
+        assert isinstance(result, DownloadResult)
+        assert result.retries == 0
+        assert result.duration >= result.phases.write > 0
+        session.download(1024 * b"\xbb", address=0x08004000)
+        session.download_segments([Segment(0x08008000, 16 * b"\xcc")])
+        assert session.erase(0x08000000, 0x4001) == 2
+        mock_dfu.download.assert_called()
+        assert all(c.args[3] is not None for c in mock_dfu.download.mock_calls)
+        session.leave(0x08000000)
+
+    mock_dfu.claim_interface.assert_called_once_with(mock_usb_device, 0)
+    mock_dfu.release_interface.assert_called_once_with(mock_usb_device)
+    mock_get_dfu_desc.assert_called_once()
+    mock_usb_get_string.assert_called_once()
+    assert mock_dfu.download.call_args_list[-1].args[3] is None
+    assert mock_dfuse.set_address.call_args_list[-1].args[2] == 0x08000000
+
+
+def test_session_upload_and_verify(
+    mock_usb_device: mock.Mock,
+    mock_get_dfu_desc: mock.Mock,
+    mock_dfu: mock.Mock,
+    mock_dfuse: mock.Mock,
+) -> None:
+    """Test memory is read back and compared within the session."""
+    data = bytes(range(256)) * 8
+
+    def read_memory(
+        dev: object, interface: int, address: int, length: int, xfer_size: int
+    ) -> Generator[bytes, None, None]:
+        offset = address - 0x08000000
+        yield data[offset : offset + length]
+
+    mock_dfuse.read_memory.side_effect = read_memory
+
+    with DfuSession(mock_usb_device) as session:
+        assert session.upload(16, address=0x08000000) == data[:16]
+        session.verify(data, address=0x08000000, mode=VERIFY_COMPARE)
+        with pytest.raises(RuntimeError):
+            session.verify(b"\x01" + data[1:], address=0x08000000)
+        with pytest.raises(ValueError):
+            session.upload(16)
+
+
+def test_session_not_open(mock_usb_device: mock.Mock) -> None:
+    """Test operations fail before the session is opened."""
+    session = DfuSession(mock_usb_device)
+    with pytest.raises(RuntimeError):
+        session.download(b"\x00", address=0x08000000)
+
+
+def test_sessions_share_descriptor_cache(
+    mock_usb_device: mock.Mock,
+    mock_usb_get_string: mock.Mock,
+    mock_get_dfu_desc: mock.Mock,
+    mock_dfu: mock.Mock,
+    mock_dfuse: mock.Mock,
+) -> None:
+    """Test later sessions with the same device read descriptors from the
+    cache.
+    """
+    mock_usb_get_string.return_value = "/0x08000000/04*016Kg"
+    mock_usb_device.idVendor = 0x0483
+    mock_usb_device.idProduct = 0xDF11
+    mock_usb_device.bcdDevice = 0x0200
+    descriptor_cache = DescriptorCache()
+
+    for _ in range(2):
+        with DfuSession(
+            mock_usb_device, descriptor_cache=descriptor_cache
+        ) as session:
+            session.download(1024 * b"\xaa", address=0x08000000)
+
+    mock_get_dfu_desc.assert_called_once()
+    mock_usb_get_string.assert_called_once()
+    assert descriptor_cache.hits == 2
@@ -0,0 +1,151 @@
+# Copyright 2022 Block, Inc.
+"""Test downloads to the simulated DFU device."""
+
+import pytest
+
+from pyfu_usb import (
+    VERIFY_COMPARE,
+    DfuSession,
+    DownloadOptions,
+    _download_to_device,
+    dfu,
+)
+from pyfu_usb import dfuse as dfuse_requests
+from pyfu_usb.descriptor import (
+    DFU_ATTR_CAN_DOWNLOAD,
+    DFU_ATTR_CAN_UPLOAD,
+    DFU_ATTR_MANIFESTATION_TOLERANT,
+    get_dfu_descriptor,
+    get_memory_layout,
+)
+from pyfu_usb.image import ChunkSource, LoadedImage, Segment
+from pyfu_usb.simulator import (
+    FAULT_CORRUPT,
+    FAULT_ERROR,
+    OP_ERASE,
+    OP_WRITE,
+    STATUS_ERR_ERASE,
+    Fault,
+    SimulatedDevice,
+    Timing,
+)
+
+_DATA = bytes(range(256)) * 80
+
+
+def test_descriptors() -> None:
+    """Test the DFU descriptor and memory layouts are read like from USB."""
+    device = SimulatedDevice(
+        layouts=(
+            "@Internal Flash  /0x08000000/04*016Kg,01*064Kg,07*128Kg",
+            "@Option Bytes  /0x1FFFC000/01*016 e",
+        )
+    )
+    desc = get_dfu_descriptor(device)
+    assert desc is not None
+    assert (desc.wTransferSize, desc.bcdDFUVersion) == (2048, 0x011A)
+    assert len(get_memory_layout(device, 0)) == 3
+    assert get_memory_layout(device, 0, alternate_index=1)[0].addr == (
+        0x1FFFC000
+    )
+
+
+def test_dfuse_download() -> None:
+    """Test an image is written and verified before leaving DFU mode."""
+    device = SimulatedDevice()
+    with DfuSession(device) as session:
+        session.download(
+            _DATA,
+            address=0x08004000,
+            options=DownloadOptions(verify=VERIFY_COMPARE),
+        )
+        session.leave(0x08004000)
+
+    assert device.read_memory(0x08004000, len(_DATA)) == _DATA
+    assert device.read_memory(0x08000000, 16) == b"\xff" * 16
+    assert device.counts[OP_ERASE] == 2
+    assert not device.attached
+    assert not device.claimed
+
+
+def test_write_without_erase() -> None:
+    """Test writing flash which is not erased can only clear bits."""
+    device = SimulatedDevice()
+    dfuse_requests.set_address(device, 0, 0x08000000)
+    dfu.download(device, 0, 2, b"\x0f\xf0")
+    dfu.download(device, 0, 2, b"\xff\x00")
+    assert device.read_memory(0x08000000, 2) == b"\x0f\x00"
+
+
+def test_poll_timeout() -> None:
+    """Test the host waits for the bwPollTimeout the device reports."""
+    device = SimulatedDevice(timing=Timing(program_ms_per_kb=5.0))
+    dfuse_requests.set_address(device, 0, 0x08000000)
+    assert dfu.download(device, 0, 2, b"\x00" * 2048) == 2
+
+    device.timing.poll_timeout_ms = 1
+    assert dfu.download(device, 0, 3, b"\x00" * 2048) > 2
+
+
+def test_stall_is_retried() -> None:
+    """Test a stalled block is cleared and written again."""
+    device = SimulatedDevice(faults=[Fault(OP_WRITE, after=2)])
+    with DfuSession(device) as session:
+        session.download(_DATA, address=0x08000000)
+
+    assert device.read_memory(0x08000000, len(_DATA)) == _DATA
+    assert device.counts["stall"] == 1
+
+
+def test_faults() -> None:
+    """Test failed erases and corrupted writes are reported."""
+    device = SimulatedDevice(
+        faults=[Fault(OP_ERASE, kind=FAULT_ERROR, status=STATUS_ERR_ERASE)]
+    )
+    with DfuSession(device) as session, pytest.raises(RuntimeError):
+        session.download(_DATA, address=0x08000000)
+
+    device = SimulatedDevice(faults=[Fault(OP_WRITE, kind=FAULT_CORRUPT)])
+    with DfuSession(device) as session, pytest.raises(RuntimeError):
+        session.download(
+            _DATA,
+            address=0x08000000,
+            options=DownloadOptions(verify=VERIFY_COMPARE),
+        )
+
+
+@pytest.mark.parametrize("delta", [False, True])
+def test_dfuse_download_jump_address(delta: bool) -> None:
+    """Test segments are written at their own address when jumping elsewhere."""
+    device = SimulatedDevice()
+    loaded = LoadedImage("image.hex", _DATA, [Segment(0x08000000, _DATA)])
+    _download_to_device(
+        device,
+        0,
+        ChunkSource(loaded),
+        0x08000200,
+        options=DownloadOptions(delta=delta),
+    )
+
+    assert device.read_memory(0x08000000, len(_DATA)) == _DATA
+
+
+@pytest.mark.parametrize("tolerant", [True, False])
+def test_dfu_download(tolerant: bool) -> None:
+    """Test a plain DFU device is downloaded to and manifests."""
+    attributes = DFU_ATTR_CAN_DOWNLOAD | DFU_ATTR_CAN_UPLOAD
+    if tolerant:
+        attributes |= DFU_ATTR_MANIFESTATION_TOLERANT
+    device = SimulatedDevice(
+        layouts=(), transfer_size=1024, attributes=attributes
+    )
+    _download_to_device(
+        device,
+        0,
+        ChunkSource(_DATA),
+        None,
+        options=DownloadOptions(verify=VERIFY_COMPARE if tolerant else None),
+    )
+
+    assert device.read_memory(0, len(_DATA)) == _DATA
+    assert dfu.get_status(device, 0).bState == (0x02 if tolerant else 0x08)
@@ -0,0 +1,109 @@
+# Copyright 2022 Block, Inc.
+"""Test recording and replaying USB control transfers."""
+
+from pathlib import Path
+
+import pytest
+import usb
+
+from pyfu_usb import DfuSession, dfu
+from pyfu_usb.simulator import OP_WRITE, Fault, SimulatedDevice
+from pyfu_usb.trace import (
+    ReplayDevice,
+    TraceRecorder,
+    read_trace,
+    request_name,
+    summarize,
+)
+
+_DATA = bytes(range(256)) * 80
+_ADDRESS = 0x08004000
+
+
+def _record(path: Path, device: SimulatedDevice, data: bytes) -> None:
+    """Record a DfuSe download to a simulated device."""
+    with TraceRecorder(device, str(path)) as traced, DfuSession(
+        traced
+    ) as session:
+        session.download(data, address=_ADDRESS)
+
+
+def test_record_and_replay(tmp_path: Path) -> None:
+    """Test a replayed download sends the recorded transfers."""
+    path = tmp_path / "download.trace"
+    _record(path, SimulatedDevice(serial_number="ABC123"), _DATA)
+
+    header, records = read_trace(str(path))
+    assert header["serial"] == "ABC123"
+    # Leftover status is cleared before the memory layout is read
+    assert [record.name for record in records[:2]] == [
+        "GETSTATUS",
+        "GET_DESCRIPTOR",
+    ]
+    assert {"SET_ADDRESS", "ERASE", "DNLOAD", "GETSTATUS"} <= {
+        record.name for record in records
+    }
+    assert all(record.duration_ns >= 0 for record in records)
+
+    device = ReplayDevice(str(path))
+    assert device.serial_number == "ABC123"
+    with DfuSession(device) as session:
+        session.download(_DATA, address=_ADDRESS)
+    assert device.finished
+
+
+def test_replay_diverges(tmp_path: Path) -> None:
+    """Test a replay stops when different data is downloaded."""
+    path = tmp_path / "download.trace"
+    _record(path, SimulatedDevice(), _DATA)
+
+    device = ReplayDevice(str(path))
+    with DfuSession(device) as session, pytest.raises(RuntimeError):
+        session.download(_DATA[::-1], address=_ADDRESS)
+
+
+def test_replay_errors(tmp_path: Path) -> None:
+    """Test recorded errors are raised again, so they are handled the same
+    way when replayed.
+    """
+    path = tmp_path / "download.trace"
+    _record(path, SimulatedDevice(faults=[Fault(OP_WRITE, after=2)]), _DATA)
+
+    _, records = read_trace(str(path))
+    stalls = [record for record in records if record.error is not None]
+    assert [(record.name, record.errno) for record in stalls] == [
+        ("DNLOAD", 32)
+    ]
+
+    device = ReplayDevice(str(path))
+    with DfuSession(device) as session:
+        session.download(_DATA, address=_ADDRESS)
+    assert device.finished
+
+    device = ReplayDevice(str(path))
+    device.position = device.records.index(stalls[0])
+    with pytest.raises(usb.core.USBError, match="Pipe error"):
+        dfu.download(device, 0, stalls[0].wValue, _DATA[2048:4096])
+
+
+def test_summarize(tmp_path: Path) -> None:
+    """Test latency is profiled by request."""
+    path = tmp_path / "download.trace"
+    _record(path, SimulatedDevice(), _DATA)
+
+    _, records = read_trace(str(path))
+    stats = summarize(records)
+    assert stats["DNLOAD"].count == len(_DATA) // 2048
+    assert stats["ERASE"].count == 2
+    assert 0 <= stats["GETSTATUS"].min_s <= stats["GETSTATUS"].mean_s
+    assert stats["GETSTATUS"].mean_s <= stats["GETSTATUS"].max_s
+
+
+def test_request_name() -> None:
+    """Test DFU requests and DfuSe commands are named."""
+    assert request_name(0xA1, 3, 0) == "GETSTATUS"
+    assert request_name(0x21, 1, 2, b"\x41\x00\x40\x00\x08") == "DNLOAD"
+    assert request_name(0x21, 1, 0, b"\x41\x00\x40\x00\x08") == "ERASE"
+    assert request_name(0x21, 1, 0, b"\x41") == "MASS_ERASE"
+    assert request_name(0x21, 1, 0, b"\x21\x00\x40\x00\x08") == "SET_ADDRESS"
+    assert request_name(0x40, 9, 0) == "0x40/0x09"